@@ -9,6 +9,11 @@ For any hope of decent results, the checkpoints should be from the same or child
 EMA (exponential moving average) of the model weights or performing SWA (stochastic
 weight averaging), but post-training.
 
+Checkpoints are memory-mapped (safetensors, or torch zip serialization) and averaged tensor by tensor on
+a pool of threads. With --safetensors the averaged tensors are written to the output as they complete and only
+the float64 accumulators of the tensors in flight are held in memory, independent of the model size (a torch
+output holds the averaged float32 state dict until it is saved).
+
 Hacked together by / Copyright 2020 Ross Wightman (https://github.com/rwightman)
 """
 import torch
@@ -16,13 +21,13 @@ import argparse
 import os
 import glob
 import hashlib
+import json
+import struct
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from timm.models import load_state_dict
-from timm.models._helpers import _torch_load
-try:
-    import safetensors.torch
-    _has_safetensors = True
-except ImportError:
-    _has_safetensors = False
+from timm.models._helpers import _torch_load, _SAFETENSORS_DTYPES
 
 DEFAULT_OUTPUT = "./averaged.pth"
 DEFAULT_SAFE_OUTPUT = "./averaged.safetensors"
@@ -41,14 +46,22 @@ parser.add_argument('--no-sort', dest='no_sort', action='store_true',
 parser.add_argument('-n', type=int, default=10, metavar='N',
                     help='Number of checkpoints to average')
 parser.add_argument('--safetensors', action='store_true',
-                    help='Save weights using safetensors instead of the default torch way (pickle).')
+                    help='Save weights using safetensors instead of the default torch way (pickle), '
+                         'written incrementally w/ bounded memory.')
+parser.add_argument('--weights', default='', type=str, metavar='W1,W2,...',
+                    help='Comma separated weight per selected checkpoint (in selection order), default: uniform')
+parser.add_argument('--ema-decay', type=float, default=None, metavar='DECAY',
+                    help='Weight checkpoints by DECAY ** age, age in epochs (or selection order) from the newest')
+parser.add_argument('-j', '--workers', type=int, default=4, metavar='N',
+                    help='Number of tensors averaged in parallel (default: 4)')
 
 
-def checkpoint_metric(checkpoint_path):
-    if not checkpoint_path or not os.path.isfile(checkpoint_path):
-        return {}
+def checkpoint_info(checkpoint_path):
+    """ (metric, epoch) of a training checkpoint, memory-mapped so the tensor data is not read. """
+    if not checkpoint_path or not os.path.isfile(checkpoint_path) or checkpoint_path.endswith('.safetensors'):
+        return None, None
     print("=> Extracting metric from checkpoint '{}'".format(checkpoint_path))
-    checkpoint = _torch_load(checkpoint_path, map_location='cpu', weights_only=True)
+    checkpoint = _torch_load(checkpoint_path, map_location='cpu', weights_only=True, mmap=True)
     metric = None
     if 'metric' in checkpoint:
         metric = checkpoint['metric']
@@ -56,7 +69,74 @@ def checkpoint_metric(checkpoint_path):
         metrics = checkpoint['metrics']
         print(metrics)
         metric = metrics[checkpoint['metric_name']]
-    return metric
+    return metric, checkpoint.get('epoch', None)
+
+
+def checkpoint_metric(checkpoint_path):
+    return checkpoint_info(checkpoint_path)[0]
+
+
+def checkpoint_weights(checkpoints, weights='', ema_decay=None):
+    """ Averaging weight per checkpoint, uniform by default. """
+    if weights:
+        assert ema_decay is None, 'Only one of --weights and --ema-decay can be set.'
+        weights = [float(w) for w in weights.split(',')]
+        assert len(weights) == len(checkpoints), \
+            f'{len(weights)} weights given for {len(checkpoints)} selected checkpoints.'
+        return weights
+    if ema_decay is not None:
+        epochs = [checkpoint_info(c)[1] for c in checkpoints]
+        if any(e is None for e in epochs):
+            epochs = list(range(len(checkpoints)))  # selection order, the last one is the newest
+        return [ema_decay ** (max(epochs) - e) for e in epochs]
+    return [1.] * len(checkpoints)
+
+
+class SafetensorsWriter:
+    """ Write a safetensors file incrementally, tensors can be written in any order (and from any thread)
+    once the header (names, shapes, dtypes) is known.
+    """
+
+    def __init__(self, path, specs, metadata=None):
+        assert sys.byteorder == 'little', 'safetensors are little-endian'
+        dtype_names = {v: k for k, v in _SAFETENSORS_DTYPES.items()}
+        header = {}
+        offset = 0
+        for name, (shape, dtype) in specs.items():
+            nbytes = torch.Size(shape).numel() * torch.empty((), dtype=dtype).element_size()
+            header[name] = dict(dtype=dtype_names[dtype], shape=list(shape), data_offsets=[offset, offset + nbytes])
+            offset += nbytes
+        header['__metadata__'] = metadata or {'format': 'pt'}
+        header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+        header_bytes += b' ' * (-len(header_bytes) % 8)
+        self._data_start = 8 + len(header_bytes)
+        self._offsets = {k: v['data_offsets'][0] for k, v in header.items() if k != '__metadata__'}
+        self._lock = threading.Lock()
+        self._f = open(path, 'wb')
+        self._f.write(struct.pack('<Q', len(header_bytes)))
+        self._f.write(header_bytes)
+        self._f.truncate(self._data_start + offset)
+
+    def write(self, name, tensor):
+        data = tensor.contiguous().reshape(-1).view(torch.uint8).numpy()
+        with self._lock:
+            self._f.seek(self._data_start + self._offsets[name])
+            self._f.write(data)
+
+    def close(self):
+        self._f.close()
+
+
+def average_tensor(tensors, weights, dtype=torch.float32):
+    """ Weighted average of tensors in float64, clamped to the range of and cast to dtype. """
+    acc = torch.zeros(tensors[0].shape, dtype=torch.float64)
+    for t, w in zip(tensors, weights):
+        assert t.shape == acc.shape, f'Shape mismatch, {t.shape} != {acc.shape}.'
+        acc.add_(t.to(dtype=torch.float64), alpha=w)
+    acc.div_(sum(weights))
+    # float32 overflow seems unlikely based on weights seen to date, but who knows
+    info = torch.finfo(dtype)
+    return acc.clamp_(info.min, info.max).to(dtype=dtype)
 
 
 def main():
@@ -113,39 +193,72 @@ def main():
         print('Error: No checkpoints found to average.')
         exit(1)
 
-    avg_state_dict = {}
-    avg_counts = {}
-    for c in avg_checkpoints:
-        new_state_dict = load_state_dict(c, args.use_ema)
-        if not new_state_dict:
+    weights = checkpoint_weights(avg_checkpoints, args.weights, args.ema_decay)
+    if args.weights or args.ema_decay is not None:
+        print("Weights: " + ', '.join(f'{w:.4g}' for w in weights))
+
+    # memory-mapped, tensor data is only read when a tensor is averaged
+    state_dicts = []
+    for c, w in zip(avg_checkpoints, weights):
+        try:
+            state_dicts.append((load_state_dict(c, args.use_ema, mmap=True), w))
+        except FileNotFoundError:
             print(f"Error: Checkpoint ({c}) doesn't exist")
-            continue
-        for k, v in new_state_dict.items():
-            if k not in avg_state_dict:
-                avg_state_dict[k] = v.clone().to(dtype=torch.float64)
-                avg_counts[k] = 1
-            else:
-                avg_state_dict[k] += v.to(dtype=torch.float64)
-                avg_counts[k] += 1
-
-    for k, v in avg_state_dict.items():
-        v.div_(avg_counts[k])
+    if not state_dicts:
+        print('Error: No checkpoints found to average.')
+        exit(1)
 
-    # float32 overflow seems unlikely based on weights seen to date, but who knows
-    float32_info = torch.finfo(torch.float32)
+    specs = {}
+    for state_dict, _ in state_dicts:
+        for k, v in state_dict.items():
+            specs.setdefault(k, (v.shape, torch.float32))
+
+    # written to a temporary file, only moved to the output path once complete
+    tmp_output = output + '.tmp'
+    writer = None
     final_state_dict = {}
-    for k, v in avg_state_dict.items():
-        v = v.clamp(float32_info.min, float32_info.max)
-        final_state_dict[k] = v.to(dtype=torch.float32)
 
-    if args.safetensors:
-        assert _has_safetensors, "`pip install safetensors` to use .safetensors"
-        safetensors.torch.save_file(final_state_dict, output)
-    else:
-        torch.save(final_state_dict, output)
+    def _average(k):
+        present = [(sd[k], w) for sd, w in state_dicts if k in sd]
+        v = average_tensor([t for t, _ in present], [w for _, w in present])
+        if writer is not None:
+            writer.write(k, v)
+        else:
+            final_state_dict[k] = v
+
+    # bounded number of tensors in flight, each holds a float64 accumulator until written
+    in_flight = threading.BoundedSemaphore(2 * args.workers)
+
+    def _submit(executor, k):
+        in_flight.acquire()
+        future = executor.submit(_average, k)
+        future.add_done_callback(lambda _: in_flight.release())
+        return future
+
+    success = False
+    try:
+        if args.safetensors:
+            writer = SafetensorsWriter(tmp_output, specs)
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            futures = [_submit(executor, k) for k in specs]
+            for f in futures:
+                f.result()
+        if writer is None:
+            torch.save(final_state_dict, tmp_output)
+        success = True
+    finally:
+        if writer is not None:
+            writer.close()
+        if success:
+            os.replace(tmp_output, output)
+        elif os.path.exists(tmp_output):
+            os.remove(tmp_output)
 
+    sha256 = hashlib.sha256()
     with open(output, 'rb') as f:
-        sha_hash = hashlib.sha256(f.read()).hexdigest()
+        for chunk in iter(lambda: f.read(2**20), b''):
+            sha256.update(chunk)
+    sha_hash = sha256.hexdigest()
     print(f"=> Saved state_dict to '{output}, SHA256: {sha_hash}'")
 
 
@@ -9,6 +9,10 @@ import argparse
 import csv
 import json
 import logging
+import itertools
+import os
+import tempfile
+import threading
 import time
 from collections import OrderedDict
 from contextlib import suppress
@@ -18,12 +22,13 @@ import torch
 import torch.nn as nn
 import torch.nn.parallel
 
-from timm.data import resolve_data_config
+from timm.data import create_dataset, create_loader, resolve_data_config
 from timm.layers import set_fast_norm
 from timm.models import create_model, is_model, list_models
 from timm.optim import create_optimizer_v2
 from timm.utils import setup_default_logging, set_jit_fuser, decay_batch_step, check_batch_size_retry, ParseKwargs,\
-    reparameterize_model
+    reparameterize_model, compile_regions, profile_model, estimate_batch_size, batch_size_arg
+from timm.utils.onnx import create_onnx_runtime_model
 
 try:
     from deepspeed.profiling.flops_profiler import get_model_profile
@@ -58,7 +63,8 @@ parser = argparse.ArgumentParser(description='PyTorch Benchmark')
 parser.add_argument('--model-list', metavar='NAME', default='',
                     help='txt file based list of model names to benchmark')
 parser.add_argument('--bench', default='both', type=str,
-                    help="Benchmark mode. One of 'inference', 'train', 'both'. Defaults to 'both'")
+                    help="Benchmark mode. One of 'inference', 'train', 'both', 'profile', 'latency', "
+                         "'e2e', 'e2e_infer', 'e2e_train'. Defaults to 'both'")
 parser.add_argument('--detail', action='store_true', default=False,
                     help='Provide train fwd/bwd/opt breakdown detail if True. Defaults to False')
 parser.add_argument('--no-retry', action='store_true', default=False,
@@ -73,12 +79,47 @@ parser.add_argument('--num-bench-iter', default=40, type=int,
                     help='Number of benchmark iterations (default: 40)')
 parser.add_argument('--device', default='cuda', type=str,
                     help="device to run benchmark on")
+parser.add_argument('--profile-granularity', default='block', type=str,
+                    help="Row granularity of the native profiler (--bench profile). One of 'stage', 'block', 'top', "
+                         "or an int module depth (default: block).")
+parser.add_argument('--profile-no-backward', action='store_true', default=False,
+                    help='Native profiler runs forward only (in eval mode).')
+parser.add_argument('--profile-dir', default='', type=str, metavar='PATH',
+                    help='Write per-module native profiles (csv, json) and chrome traces to this dir.')
+parser.add_argument('--latency-batch-sizes', default=None, type=int, nargs='+', metavar='N',
+                    help='Batch sizes swept in --bench latency (default: --batch-size).')
+parser.add_argument('--latency-threads', default=None, type=int, nargs='+', metavar='N',
+                    help='torch intra-op thread counts swept in --bench latency (default: torch default).')
+parser.add_argument('--latency-streams', default=(1,), type=int, nargs='+', metavar='N',
+                    help='Numbers of concurrent request streams (threads) swept in --bench latency (default: 1).')
+parser.add_argument('--latency-pin-cores', action='store_true', default=False,
+                    help='Pin each request stream to a disjoint set of cores in --bench latency (Linux only).')
+parser.add_argument('--interop-threads', default=None, type=int, metavar='N',
+                    help='torch inter-op thread count, set once at startup (default: torch default).')
+
+# end-to-end (data pipeline + model) benchmark args
+parser.add_argument('--data-dir', metavar='DIR', default='',
+                    help='Dataset root dir for --bench e2e, synthetic JPEGs are generated if empty.')
+parser.add_argument('--dataset', metavar='NAME', default='',
+                    help='dataset type + name ("<type>/<name>") (default: ImageFolder or ImageTar if empty)')
+parser.add_argument('--split', metavar='NAME', default='validation',
+                    help='dataset split (default: validation)')
+parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
+                    help='number of data loading workers (default: 4)')
+parser.add_argument('--pin-mem', action='store_true', default=False,
+                    help='Pin CPU memory in DataLoader for more efficient (sometimes) transfer to GPU.')
+parser.add_argument('--synthetic-samples', default=512, type=int, metavar='N',
+                    help='Number of synthetic JPEGs generated for --bench e2e w/o --data-dir (default: 512)')
+parser.add_argument('--synthetic-image-size', default=(375, 500), type=int, nargs=2, metavar=('H', 'W'),
+                    help='Size of the synthetic JPEGs (default: 375 500)')
 
 # common inference / train args
 parser.add_argument('--model', '-m', metavar='NAME', default='resnet50',
                     help='model architecture (default: resnet50)')
-parser.add_argument('-b', '--batch-size', default=256, type=int,
-                    metavar='N', help='mini-batch size (default: 256)')
+parser.add_argument('-b', '--batch-size', default=256, type=batch_size_arg,
+                    metavar='N', help="mini-batch size, 'auto' to estimate from memory use (default: 256)")
+parser.add_argument('--memory-budget', default=None, type=float, metavar='GB',
+                    help='Memory budget for --batch-size auto (default: memory available on device)')
 parser.add_argument('--img-size', default=None, type=int,
                     metavar='N', help='Input image dimension, uses model default if empty')
 parser.add_argument('--input-size', default=None, nargs=3, type=int, metavar='N',
@@ -108,6 +149,22 @@ parser.add_argument('--reparam', default=False, action='store_true',
 parser.add_argument('--model-kwargs', nargs='*', default={}, action=ParseKwargs)
 parser.add_argument('--torchcompile-mode', type=str, default=None,
                     help="torch.compile mode (default: None).")
+parser.add_argument('--torchcompile-regions', default=False, action='store_true',
+                    help="With --torchcompile, compile the repeated blocks (one graph per distinct block) "
+                         "instead of the whole model.")
+
+parser.add_argument('--backend', default='torch', type=str, choices=('torch', 'onnxruntime'),
+                    help='Execution backend (default: torch). onnxruntime runs on CPU.')
+parser.add_argument('--onnx-file', default='', type=str, metavar='PATH',
+                    help='ONNX graph for --backend onnxruntime, exported from the model if empty or missing.')
+parser.add_argument('--ort-intra-threads', default=0, type=int, metavar='N',
+                    help='onnxruntime intra-op threads (default: 0, onnxruntime default)')
+parser.add_argument('--ort-inter-threads', default=0, type=int, metavar='N',
+                    help='onnxruntime inter-op threads (default: 0, onnxruntime default)')
+parser.add_argument('--ort-opt-level', default='all', type=str, choices=('disable', 'basic', 'extended', 'all'),
+                    help='onnxruntime graph optimization level (default: all)')
+parser.add_argument('--ort-quantize', default=False, action='store_true',
+                    help='Apply onnxruntime dynamic int8 quantization.')
 
 # codegen (model compilation) options
 scripting_group = parser.add_mutually_exclusive_group()
@@ -205,6 +262,8 @@ def profile_fvcore(model, input_size=(3, 224, 224), batch_size=1, detailed=False
 
 
 class BenchmarkRunner:
+    is_training = False
+
     def __init__(
             self,
             model_name,
@@ -213,6 +272,7 @@ class BenchmarkRunner:
             torchscript=False,
             torchcompile=None,
             torchcompile_mode=None,
+            torchcompile_regions=False,
             aot_autograd=False,
             reparam=False,
             precision='float32',
@@ -220,6 +280,13 @@ class BenchmarkRunner:
             num_warm_iter=10,
             num_bench_iter=50,
             use_train_size=False,
+            backend='torch',
+            onnx_file='',
+            ort_intra_threads=0,
+            ort_inter_threads=0,
+            ort_opt_level='all',
+            ort_quantize=False,
+            memory_budget=None,
             **kwargs
     ):
         self.model_name = model_name
@@ -240,6 +307,7 @@ class BenchmarkRunner:
             in_chans=3,
             global_pool=kwargs.pop('gp', 'fast'),
             scriptable=torchscript,
+            exportable=backend == 'onnxruntime',
             drop_rate=kwargs.pop('drop', 0.),
             drop_path_rate=kwargs.pop('drop_path', None),
             drop_block_rate=kwargs.pop('drop_block', None),
@@ -256,18 +324,52 @@ class BenchmarkRunner:
         self.param_count = count_params(self.model)
         _logger.info('Model %s created, param count: %d' % (model_name, self.param_count))
 
-        data_config = resolve_data_config(kwargs, model=self.model, use_test_size=not use_train_size)
-        self.input_size = data_config['input_size']
+        self.data_config = resolve_data_config(kwargs, model=self.model, use_test_size=not use_train_size)
+        self.input_size = self.data_config['input_size']
         self.batch_size = kwargs.pop('batch_size', 256)
+        if self.batch_size == 'auto':
+            # estimate on the eager model, before compilation / export
+            reserved_bytes = 0
+            if self.is_training:
+                if kwargs.get('grad_checkpointing', False):
+                    self.model.set_grad_checkpointing()
+                # optimizer state, up to 2x params for adam-like optimizers
+                reserved_bytes = 2 * sum(p.numel() * p.element_size() for p in self.model.parameters())
+            self.batch_size = estimate_batch_size(
+                self.model,
+                self.input_size,
+                dtype=self.data_dtype,
+                training=self.is_training,
+                amp_autocast=self.amp_autocast,
+                channels_last=self.channels_last,
+                memory_budget=memory_budget * 2**30 if memory_budget else None,
+                reserved_bytes=reserved_bytes,
+            )
 
+        self.backend = backend
         self.compiled = False
-        if torchscript:
+        if backend == 'onnxruntime':
+            assert self.device == 'cpu' and self.amp_dtype is None and self.model_dtype == torch.float32, \
+                'The onnxruntime backend runs in float32 on CPU.'
+            self.model = create_onnx_runtime_model(
+                self.model,
+                onnx_file=onnx_file,
+                input_size=self.input_size,
+                quantize=ort_quantize,
+                intra_op_threads=ort_intra_threads,
+                inter_op_threads=ort_inter_threads,
+                opt_level=ort_opt_level,
+            )
+        elif torchscript:
             self.model = torch.jit.script(self.model)
             self.compiled = True
         elif torchcompile:
             assert has_compile, 'A version of torch w/ torch.compile() is required, possibly a nightly.'
             torch._dynamo.reset()
-            self.model = torch.compile(self.model, backend=torchcompile, mode=torchcompile_mode)
+            if torchcompile_regions:
+                compile_regions(self.model, backend=torchcompile, mode=torchcompile_mode)
+            else:
+                self.model = torch.compile(self.model, backend=torchcompile, mode=torchcompile_mode)
             self.compiled = True
         elif aot_autograd:
             assert has_functorch, "functorch is needed for --aot-autograd"
@@ -275,6 +377,7 @@ class BenchmarkRunner:
             self.compiled = True
 
         self.example_inputs = None
+        self.first_step_time = None
         self.num_warm_iter = num_warm_iter
         self.num_bench_iter = num_bench_iter
         self.log_freq = num_bench_iter // 5
@@ -317,8 +420,10 @@ class InferenceBenchmarkRunner(BenchmarkRunner):
         with torch.inference_mode():
             self._init_input()
 
-            for _ in range(self.num_warm_iter):
-                _step()
+            for i in range(self.num_warm_iter):
+                delta_step = _step()
+                if i == 0:
+                    self.first_step_time = delta_step
 
             total_step = 0.
             num_samples = 0
@@ -343,8 +448,11 @@ class InferenceBenchmarkRunner(BenchmarkRunner):
             img_size=self.input_size[-1],
             param_count=round(self.param_count / 1e6, 2),
         )
+        if self.compiled and self.first_step_time is not None:
+            # first warmup step includes compilation (or scripting optimization passes)
+            results['compile_time'] = round(1000 * self.first_step_time, 3)
 
-        retries = 0 if self.compiled else 2  # skip profiling if model is scripted
+        retries = 0 if self.compiled or self.backend != 'torch' else 2  # skip profiling if model is scripted
         while retries:
             retries -= 1
             try:
@@ -365,7 +473,138 @@ class InferenceBenchmarkRunner(BenchmarkRunner):
         return results
 
 
+class LatencyBenchmarkRunner(BenchmarkRunner):
+    """ Serving latency benchmark.
+
+    Sweeps batch size, intra-op thread count and the number of concurrent request streams, each stream is a
+    thread issuing requests back to back against the shared model. Every sweep point reports the request latency
+    distribution (p50 / p90 / p99) and the aggregate throughput, together they form a latency vs throughput curve.
+    """
+
+    def __init__(
+            self,
+            model_name,
+            device='cuda',
+            torchscript=False,
+            latency_batch_sizes=None,
+            latency_threads=None,
+            latency_streams=(1,),
+            latency_pin_cores=False,
+            **kwargs
+    ):
+        super().__init__(model_name=model_name, device=device, torchscript=torchscript, **kwargs)
+        self.model.eval()
+        self.batch_sizes = latency_batch_sizes or [self.batch_size]
+        self.num_threads = latency_threads or [torch.get_num_threads()]
+        self.num_streams = latency_streams or [1]
+        self.pin_cores = latency_pin_cores and hasattr(os, 'sched_setaffinity')
+        if latency_pin_cores and not self.pin_cores:
+            _logger.warning('Core pinning is not supported on this platform, ignoring --latency-pin-cores.')
+
+    def _stream_cores(self, num_streams):
+        if not self.pin_cores:
+            return [None] * num_streams
+        cores = sorted(os.sched_getaffinity(0))
+        per_stream = max(1, len(cores) // num_streams)
+        return [cores[i * per_stream % len(cores):][:per_stream] for i in range(num_streams)]
+
+    def _measure(self, batch_size, num_threads, num_streams):
+        torch.set_num_threads(num_threads)
+        stream_cores = self._stream_cores(num_streams)
+        latencies = [[] for _ in range(num_streams)]
+        errors = []
+        start_barrier = threading.Barrier(num_streams + 1)
+        end_barrier = threading.Barrier(num_streams + 1)
+
+        def _stream(idx):
+            try:
+                if stream_cores[idx] is not None:
+                    os.sched_setaffinity(0, stream_cores[idx])  # pid 0 is the calling thread on Linux
+                # thread counts, inference mode and autocast are thread local
+                torch.set_num_threads(num_threads)
+                inputs = torch.randn((batch_size,) + self.input_size, device=self.device, dtype=self.data_dtype)
+                if self.channels_last:
+                    inputs = inputs.contiguous(memory_format=torch.channels_last)
+                with torch.inference_mode(), self.amp_autocast():
+                    for _ in range(self.num_warm_iter):
+                        self.model(inputs)
+                    self.time_fn(True)
+                    start_barrier.wait()
+                    for _ in range(self.num_bench_iter):
+                        t_start = self.time_fn()
+                        self.model(inputs)
+                        latencies[idx].append(self.time_fn(True) - t_start)
+            except Exception as e:
+                errors.append(e)
+                start_barrier.abort()
+            finally:
+                try:
+                    end_barrier.wait()
+                except threading.BrokenBarrierError:
+                    pass
+
+        threads = [threading.Thread(target=_stream, args=(i,), daemon=True) for i in range(num_streams)]
+        for t in threads:
+            t.start()
+        try:
+            start_barrier.wait()
+            t_run_start = self.time_fn()
+            end_barrier.wait()
+            t_run_elapsed = self.time_fn() - t_run_start
+        except threading.BrokenBarrierError:
+            end_barrier.abort()
+            t_run_elapsed = None
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+
+        latencies = torch.tensor(list(itertools.chain(*latencies)), dtype=torch.float64) * 1000
+        p50, p90, p99 = latencies.quantile(torch.tensor([0.5, 0.9, 0.99], dtype=torch.float64)).tolist()
+        num_requests = latencies.numel()
+        return dict(
+            batch_size=batch_size,
+            num_threads=num_threads,
+            num_streams=num_streams,
+            samples_per_sec=round(num_requests * batch_size / t_run_elapsed, 2),
+            requests_per_sec=round(num_requests / t_run_elapsed, 2),
+            latency_mean=round(latencies.mean().item(), 3),
+            latency_p50=round(p50, 3),
+            latency_p90=round(p90, 3),
+            latency_p99=round(p99, 3),
+            latency_max=round(latencies.max().item(), 3),
+            img_size=self.input_size[-1],
+            param_count=round(self.param_count / 1e6, 2),
+        )
+
+    def run(self):
+        _logger.info(
+            f'Running latency benchmark on {self.model_name} for {self.num_bench_iter} requests per stream w/ '
+            f'input size {self.input_size}, batch sizes {self.batch_sizes}, threads {self.num_threads} '
+            f'and streams {self.num_streams}.')
+
+        prev_threads = torch.get_num_threads()
+        results = []
+        try:
+            for num_threads, batch_size, num_streams in itertools.product(
+                    self.num_threads, self.batch_sizes, self.num_streams):
+                r = self._measure(batch_size, num_threads, num_streams)
+                _logger.info(
+                    f"Latency bs={batch_size} threads={num_threads} streams={num_streams}."
+                    f" {r['samples_per_sec']:0.2f} samples/sec."
+                    f" p50 {r['latency_p50']:0.3f} ms, p90 {r['latency_p90']:0.3f} ms,"
+                    f" p99 {r['latency_p99']:0.3f} ms.")
+                results.append(r)
+        finally:
+            torch.set_num_threads(prev_threads)
+
+        _logger.info(f"Latency benchmark of {self.model_name} done. {len(results)} sweep points.")
+
+        return results
+
+
 class TrainBenchmarkRunner(BenchmarkRunner):
+    is_training = True
 
     def __init__(
             self,
@@ -425,8 +664,10 @@ class TrainBenchmarkRunner(BenchmarkRunner):
 
         self._init_input()
 
-        for _ in range(self.num_warm_iter):
-            _step()
+        for i in range(self.num_warm_iter):
+            delta_step = _step()
+            if i == 0:
+                self.first_step_time = delta_step
 
         t_run_start = self.time_fn()
         if self.detail:
@@ -483,6 +724,8 @@ class TrainBenchmarkRunner(BenchmarkRunner):
                 img_size=self.input_size[-1],
                 param_count=round(self.param_count / 1e6, 2),
             )
+        if self.compiled and self.first_step_time is not None:
+            results['compile_time'] = round(1000 * self.first_step_time, 3)
 
         _logger.info(
             f"Train benchmark of {self.model_name} done. "
@@ -491,34 +734,251 @@ class TrainBenchmarkRunner(BenchmarkRunner):
         return results
 
 
+def create_synthetic_jpegs(root, num_samples=512, image_size=(375, 500), num_classes=8, seed=42):
+    """ Write random JPEGs into an image folder layout (one sub folder per class) under root.
+
+    Existing images are reused, so the same root can be shared across runs.
+    """
+    from PIL import Image
+    generator = torch.Generator().manual_seed(seed)
+    for i in range(num_samples):
+        class_dir = os.path.join(root, f'class_{i % num_classes:03d}')
+        filename = os.path.join(class_dir, f'{i:06d}.jpg')
+        if os.path.exists(filename):
+            continue
+        os.makedirs(class_dir, exist_ok=True)
+        # smooth noise compresses (and decodes) closer to natural images than per pixel noise
+        low_res = torch.randint(0, 256, (image_size[0] // 16 + 1, image_size[1] // 16 + 1, 3), generator=generator)
+        img = Image.fromarray(low_res.to(torch.uint8).numpy()).resize(image_size[::-1], Image.BILINEAR)
+        img.save(filename, quality=90)
+    return root
+
+
+class E2EBenchmarkRunner(BenchmarkRunner):
+    """ End-to-end benchmark of the data pipeline and the model.
+
+    Batches come from `create_loader` over a real dataset (or locally generated synthetic JPEGs) w/ the model's
+    data config, the time of each step is split into loader wait, host to device copy and model compute.
+    """
+
+    def __init__(
+            self,
+            model_name,
+            device='cuda',
+            is_training=False,
+            data_dir='',
+            dataset='',
+            split='validation',
+            workers=4,
+            pin_mem=False,
+            synthetic_samples=512,
+            synthetic_image_size=(375, 500),
+            **kwargs
+    ):
+        self.is_training = is_training
+        super().__init__(model_name=model_name, device=device, **kwargs)
+        if is_training:
+            self.model.train()
+        else:
+            self.model.eval()
+
+        if not data_dir and not dataset:
+            data_dir = os.path.join(tempfile.gettempdir(), 'timm_e2e_synthetic_{}x{}'.format(*synthetic_image_size))
+            _logger.info(f'Generating {synthetic_samples} synthetic JPEGs in {data_dir}.')
+            create_synthetic_jpegs(data_dir, num_samples=synthetic_samples, image_size=synthetic_image_size)
+        self.dataset = create_dataset(
+            root=data_dir,
+            name=dataset,
+            split=split,
+            is_training=is_training,
+            batch_size=self.batch_size,
+        )
+        self.workers = workers
+        self.loader = create_loader(
+            self.dataset,
+            input_size=self.data_config['input_size'],
+            batch_size=self.batch_size,
+            is_training=is_training,
+            use_prefetcher=False,  # explicit device copy below so it can be timed separately
+            interpolation=self.data_config['interpolation'],
+            mean=self.data_config['mean'],
+            std=self.data_config['std'],
+            num_workers=workers,
+            crop_pct=self.data_config['crop_pct'],
+            crop_mode=self.data_config['crop_mode'],
+            pin_memory=pin_mem,
+            persistent_workers=workers > 0,
+        )
+
+        if is_training:
+            self.loss = nn.CrossEntropyLoss().to(self.device)
+            self.optimizer = create_optimizer_v2(
+                self.model,
+                opt=kwargs.pop('opt', 'sgd'),
+                lr=kwargs.pop('lr', 1e-4))
+
+    def _batches(self):
+        # restart the loader when exhausted so short datasets can cover all warmup + bench steps
+        while True:
+            yielded = False
+            for batch in self.loader:
+                yielded = True
+                yield batch
+            assert yielded, 'Dataset is empty or smaller than a batch.'
+
+    def run(self):
+        def _compute(inputs, target):
+            with self.amp_autocast():
+                output = self.model(inputs)
+                if self.is_training:
+                    if isinstance(output, tuple):
+                        output = output[0]
+                    self.loss(output, target).backward()
+            if self.is_training:
+                self.optimizer.step()
+                self.optimizer.zero_grad()
+
+        def _step(batch_iter):
+            t_start = self.time_fn()
+            inputs, target = next(batch_iter)
+            t_load_end = self.time_fn()
+            inputs = inputs.to(
+                device=self.device,
+                dtype=self.data_dtype,
+                non_blocking=True,
+                memory_format=torch.channels_last if self.channels_last else torch.contiguous_format,
+            )
+            target = target.to(device=self.device, non_blocking=True)
+            t_copy_end = self.time_fn(True)
+            _compute(inputs, target)
+            t_end = self.time_fn(True)
+            return inputs.shape[0], t_load_end - t_start, t_copy_end - t_load_end, t_end - t_copy_end
+
+        mode = 'train' if self.is_training else 'inference'
+        _logger.info(
+            f'Running end-to-end {mode} benchmark on {self.model_name} for {self.num_bench_iter} steps w/ '
+            f'input size {self.input_size}, batch size {self.batch_size} and {self.workers} loader workers.')
+
+        batch_iter = self._batches()
+        with torch.inference_mode(not self.is_training):
+            for i in range(self.num_warm_iter):
+                _, _, _, delta_compute = _step(batch_iter)
+                if i == 0:
+                    self.first_step_time = delta_compute
+
+            total_load = 0.
+            total_copy = 0.
+            total_compute = 0.
+            num_samples = 0
+            t_run_start = self.time_fn()
+            for i in range(self.num_bench_iter):
+                batch_size, delta_load, delta_copy, delta_compute = _step(batch_iter)
+                num_samples += batch_size
+                total_load += delta_load
+                total_copy += delta_copy
+                total_compute += delta_compute
+                num_steps = i + 1
+                if num_steps % self.log_freq == 0:
+                    _logger.info(
+                        f"E2E [{num_steps}/{self.num_bench_iter}]."
+                        f" {num_samples / (self.time_fn() - t_run_start):0.2f} samples/sec."
+                        f" {1000 * total_load / num_steps:0.3f} ms/step load,"
+                        f" {1000 * total_copy / num_steps:0.3f} ms/step copy,"
+                        f" {1000 * total_compute / num_steps:0.3f} ms/step compute.")
+            t_run_elapsed = self.time_fn(True) - t_run_start
+
+        total_step = total_load + total_copy + total_compute
+        results = dict(
+            samples_per_sec=round(num_samples / t_run_elapsed, 2),
+            step_time=round(1000 * total_step / self.num_bench_iter, 3),
+            load_time=round(1000 * total_load / self.num_bench_iter, 3),
+            copy_time=round(1000 * total_copy / self.num_bench_iter, 3),
+            compute_time=round(1000 * total_compute / self.num_bench_iter, 3),
+            # fraction of the step spent waiting on the loader, near 1.0 means the data pipeline is the ceiling
+            load_frac=round(total_load / total_step, 3),
+            batch_size=self.batch_size,
+            img_size=self.input_size[-1],
+            param_count=round(self.param_count / 1e6, 2),
+        )
+        if self.compiled and self.first_step_time is not None:
+            results['compile_time'] = round(1000 * self.first_step_time, 3)
+
+        _logger.info(
+            f"End-to-end {mode} benchmark of {self.model_name} done. "
+            f"{results['samples_per_sec']:.2f} samples/sec, {results['load_frac']:.1%} of step time in loader wait.")
+
+        return results
+
+
 class ProfileRunner(BenchmarkRunner):
 
-    def __init__(self, model_name, device='cuda', profiler='', **kwargs):
+    def __init__(
+            self,
+            model_name,
+            device='cuda',
+            profiler='timm',
+            profile_granularity='block',
+            profile_no_backward=False,
+            profile_dir='',
+            **kwargs
+    ):
         super().__init__(model_name=model_name, device=device, **kwargs)
-        if not profiler:
-            if has_deepspeed_profiling:
-                profiler = 'deepspeed'
-            elif has_fvcore_profiling:
-                profiler = 'fvcore'
-        assert profiler, "One of deepspeed or fvcore needs to be installed for profiling to work."
         self.profiler = profiler
-        self.model.eval()
+        self.granularity = int(profile_granularity) if profile_granularity.isdigit() else profile_granularity
+        self.backward = not profile_no_backward and self.profiler == 'timm'
+        self.profile_dir = profile_dir
+        self.model.train(self.backward)
+
+    def _profile_timm(self):
+        self._init_input()
+        profile = profile_model(
+            self.model,
+            granularity=self.granularity,
+            backward=self.backward,
+            num_iter=self.num_bench_iter,
+            num_warmup=self.num_warm_iter,
+            amp_autocast=self.amp_autocast,
+            example_input=self.example_inputs,
+        )
+        _logger.info(f'Per-module profile of {self.model_name}:\n{profile.table()}')
+        if self.profile_dir:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            base = os.path.join(self.profile_dir, self.model_name.replace('/', '_'))
+            profile.to_csv(f'{base}-profile.csv')
+            profile.to_json(f'{base}-profile.json')
+            profile.to_chrome_trace(f'{base}-trace.json')
+        total = profile.total
+        results = dict(
+            gmacs=round(total.fwd_flops / 2e9 / self.batch_size, 2),
+            fwd_time=round(total.fwd_ms, 3),
+            bwd_time=round(total.bwd_ms, 3),
+            act_mb=round(total.act_bytes / 2**20, 2),
+        )
+        if profile.peak_mem_bytes is not None:
+            results['peak_mem_mb'] = round(profile.peak_mem_bytes / 2**20, 2)
+        return results
 
     def run(self):
         _logger.info(
-            f'Running profiler on {self.model_name} w/ '
+            f'Running {self.profiler} profiler on {self.model_name} w/ '
             f'input size {self.input_size} and batch size {self.batch_size}.')
 
-        macs = 0
-        activations = 0
-        if self.profiler == 'deepspeed':
-            macs, _ = profile_deepspeed(self.model, self.input_size, batch_size=self.batch_size, detailed=True)
-        elif self.profiler == 'fvcore':
-            macs, activations = profile_fvcore(self.model, self.input_size, batch_size=self.batch_size, detailed=True)
+        if self.profiler == 'timm':
+            results = self._profile_timm()
+        else:
+            macs = 0
+            activations = 0
+            if self.profiler == 'deepspeed':
+                macs, _ = profile_deepspeed(self.model, self.input_size, batch_size=self.batch_size, detailed=True)
+            elif self.profiler == 'fvcore':
+                macs, activations = profile_fvcore(
+                    self.model, self.input_size, batch_size=self.batch_size, detailed=True)
+            results = dict(
+                gmacs=round(macs / 1e9, 2),
+                macts=round(activations / 1e6, 2),
+            )
 
-        results = dict(
-            gmacs=round(macs / 1e9, 2),
-            macts=round(activations / 1e6, 2),
+        results.update(
             batch_size=self.batch_size,
             img_size=self.input_size[-1],
             param_count=round(self.param_count / 1e6, 2),
@@ -545,6 +1005,7 @@ def _try_run(
         try:
             torch.cuda.empty_cache()
             bench = bench_fn(model_name=model_name, batch_size=batch_size, **bench_kwargs)
+            batch_size = bench.batch_size  # resolved if 'auto'
             results = bench.run()
             return results
         except RuntimeError as e:
@@ -553,7 +1014,7 @@ def _try_run(
             if not check_batch_size_retry(error_str):
                 _logger.error(f'Unrecoverable error encountered while benchmarking {model_name}, skipping.')
                 break
-            if no_batch_size_retry:
+            if no_batch_size_retry or batch_size == 'auto':
                 break
         batch_size = decay_batch_step(batch_size)
         _logger.warning(f'Reducing batch size to {batch_size} for retry.')
@@ -574,9 +1035,30 @@ def benchmark(args):
     model = bench_kwargs.pop('model')
     batch_size = bench_kwargs.pop('batch_size')
 
+    if args.bench == 'latency':
+        # one result row per sweep point, a latency vs throughput curve for the model
+        run_results = _try_run(
+            model,
+            LatencyBenchmarkRunner,
+            bench_kwargs=bench_kwargs,
+            initial_batch_size=batch_size,
+            no_batch_size_retry=args.no_retry or bool(args.latency_batch_sizes),
+        )
+        if 'error' in run_results:
+            return OrderedDict(model=model, **run_results)
+        model_results = []
+        for r in run_results:
+            row = OrderedDict(model=model)
+            row.update({'_'.join(['infer', k]): v for k, v in r.items() if k != 'param_count'})
+            row['param_count'] = r['param_count']
+            model_results.append(row)
+        return model_results
+
     bench_fns = (InferenceBenchmarkRunner,)
     prefixes = ('infer',)
-    if args.bench == 'both':
+    if args.backend != 'torch' and args.bench in ('both', 'train'):
+        _logger.warning(f'Only inference can be benchmarked with the {args.backend} backend.')
+    elif args.bench == 'both':
         bench_fns = (
             InferenceBenchmarkRunner,
             TrainBenchmarkRunner
@@ -586,15 +1068,29 @@ def benchmark(args):
         bench_fns = TrainBenchmarkRunner,
         prefixes = 'train',
     elif args.bench.startswith('profile'):
-        # specific profiler used if included in bench mode string, otherwise default to deepspeed, fallback to fvcore
+        # specific profiler used if included in bench mode string, otherwise default to native timm profiler
         if 'deepspeed' in args.bench:
             assert has_deepspeed_profiling, "deepspeed must be installed to use deepspeed flop counter"
             bench_kwargs['profiler'] = 'deepspeed'
+            batch_size = 1
         elif 'fvcore' in args.bench:
             assert has_fvcore_profiling, "fvcore must be installed to use fvcore flop counter"
             bench_kwargs['profiler'] = 'fvcore'
+            batch_size = 1
         bench_fns = ProfileRunner,
-        batch_size = 1
+    elif args.bench.startswith('e2e'):
+        bench_fns = (E2EBenchmarkRunner,)
+        prefixes = ('e2e_infer',)
+        if args.bench in ('e2e', 'e2e_train'):
+            train_fn = partial(E2EBenchmarkRunner, is_training=True)
+            if args.backend != 'torch':
+                _logger.warning(f'Only inference can be benchmarked with the {args.backend} backend.')
+            elif args.bench == 'e2e':
+                bench_fns = (E2EBenchmarkRunner, train_fn)
+                prefixes = ('e2e_infer', 'e2e_train')
+            else:
+                bench_fns = (train_fn,)
+                prefixes = ('e2e_train',)
 
     model_results = OrderedDict(model=model)
     for prefix, bench_fn in zip(prefixes, bench_fns):
@@ -611,9 +1107,10 @@ def benchmark(args):
         if 'error' in run_results:
             break
     if 'error' not in model_results:
-        param_count = model_results.pop('infer_param_count', model_results.pop('train_param_count', 0))
+        param_count = 0
+        for prefix in prefixes:
+            param_count = model_results.pop(f'{prefix}_param_count', param_count)
         model_results.setdefault('param_count', param_count)
-        model_results.pop('train_param_count', 0)
     return model_results
 
 
@@ -626,6 +1123,10 @@ def main():
     if args.fast_norm:
         set_fast_norm()
 
+    if args.interop_threads:
+        # can only be set once, before any inter-op parallel work is started
+        torch.set_num_interop_threads(args.interop_threads)
+
     if args.model_list:
         args.model = ''
         with open(args.model_list) as f:
@@ -650,18 +1151,26 @@ def main():
                     continue
                 args.model = m
                 r = benchmark(args)
-                if r:
+                if isinstance(r, list):
+                    results.extend(r)
+                elif r:
                     results.append(r)
                 time.sleep(10)
         except KeyboardInterrupt as e:
             pass
         sort_key = 'infer_samples_per_sec'
-        if 'train' in args.bench:
+        if args.bench.startswith('e2e'):
+            sort_key = 'e2e_train_samples_per_sec' if args.bench == 'e2e_train' else 'e2e_infer_samples_per_sec'
+        elif 'train' in args.bench:
             sort_key = 'train_samples_per_sec'
         elif 'profile' in args.bench:
             sort_key = 'infer_gmacs'
         results = filter(lambda x: sort_key in x, results)
-        results = sorted(results, key=lambda x: x[sort_key], reverse=True)
+        if args.bench != 'latency':
+            # keep latency curves in sweep order
+            results = sorted(results, key=lambda x: x[sort_key], reverse=True)
+        else:
+            results = list(results)
     else:
         results = benchmark(args)
 
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+""" Benchmark Regression Suite
+
+Runs a set of models through the `benchmark.py` inference / train runners (on CPU by default), repeating
+each measurement to get a distribution, appends the run to a JSON history and compares it against a
+baseline run from the history. Models with a statistically significant throughput drop (step time
+increase) beyond a threshold are flagged as regressions.
+
+Record a baseline, then compare a change against it:
+    python benchmark_suite.py --label main --history-file suite.json
+    python benchmark_suite.py --label my-change --history-file suite.json --baseline main --fail-on-regression
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import subprocess
+import time
+from collections import OrderedDict
+
+import torch
+
+from benchmark import InferenceBenchmarkRunner, TrainBenchmarkRunner, write_results
+from timm.utils import setup_default_logging
+from timm.version import __version__
+
+_logger = logging.getLogger('benchmark_suite')
+
+# small / medium models covering the common block types (conv, depthwise, attention, hybrid)
+DEFAULT_MODELS = (
+    'resnet18',
+    'resnet50',
+    'mobilenetv3_large_100',
+    'efficientnet_b0',
+    'convnext_tiny',
+    'regnety_016',
+    'vit_small_patch16_224',
+    'deit_tiny_patch16_224',
+    'swin_tiny_patch4_window7_224',
+    'levit_128',
+)
+
+parser = argparse.ArgumentParser(description='PyTorch Benchmark Regression Suite')
+parser.add_argument('--models', nargs='+', default=None, type=str,
+                    help='Models to benchmark (default: built in CPU suite).')
+parser.add_argument('--model-list', default='', type=str,
+                    help='txt file based list of model names to benchmark')
+parser.add_argument('--bench', default='inference', type=str,
+                    help="Benchmark mode. One of 'inference', 'train', 'both'. Defaults to 'inference'")
+parser.add_argument('--device', default='cpu', type=str,
+                    help='device to run benchmark on (default: cpu)')
+parser.add_argument('-b', '--batch-size', default=8, type=int, metavar='N',
+                    help='mini-batch size (default: 8)')
+parser.add_argument('--img-size', default=None, type=int, metavar='N',
+                    help='Input image dimension, uses model default if empty')
+parser.add_argument('--precision', default='float32', type=str,
+                    help='Numeric precision. One of (amp, float32, float16, bfloat16)')
+parser.add_argument('--channels-last', action='store_true', default=False,
+                    help='Use channels_last memory layout')
+parser.add_argument('--threads', default=None, type=int, metavar='N',
+                    help='torch intra-op threads (default: torch default)')
+parser.add_argument('--repeats', default=5, type=int, metavar='N',
+                    help='Number of repeated measurements per model (default: 5)')
+parser.add_argument('--num-warm-iter', default=5, type=int,
+                    help='Number of warmup iterations per measurement (default: 5)')
+parser.add_argument('--num-bench-iter', default=20, type=int,
+                    help='Number of benchmark iterations per measurement (default: 20)')
+
+# history / comparison
+parser.add_argument('--history-file', default='benchmark_suite_history.json', type=str,
+                    help='JSON file runs are appended to and baselines are read from.')
+parser.add_argument('--label', default='', type=str,
+                    help='Label of this run (ie branch name) to reference it as a baseline.')
+parser.add_argument('--baseline', default='latest', type=str,
+                    help="Baseline run to compare against, a run label or id, 'latest' for the most recent run "
+                         "in the history or '' for no comparison (default: latest).")
+parser.add_argument('--threshold', default=5., type=float, metavar='PCT',
+                    help='Relative throughput drop (percent) flagged as a regression (default: 5).')
+parser.add_argument('--confidence', default=0.95, type=float, choices=(0.9, 0.95, 0.99),
+                    help='Confidence level of the change intervals (default: 0.95).')
+parser.add_argument('--no-save', action='store_true', default=False,
+                    help='Do not append this run to the history.')
+parser.add_argument('--fail-on-regression', action='store_true', default=False,
+                    help='Exit with a non-zero status if any regressions are found.')
+parser.add_argument('--results-file', default='', type=str,
+                    help='Output csv file for the comparison results')
+parser.add_argument('--results-format', default='csv', type=str,
+                    help='Format for results file one of (csv, json) (default: csv).')
+
+# two-sided t distribution critical values by degrees of freedom, larger df use the normal approximation
+_T_TABLE = {
+    0.9: (6.314, 2.920, 2.353, 2.132, 2.015, 1.943, 1.895, 1.860, 1.833, 1.812, 1.796, 1.782, 1.771, 1.761, 1.753),
+    0.95: (12.71, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228, 2.201, 2.179, 2.160, 2.145, 2.131),
+    0.99: (63.66, 9.925, 5.841, 4.604, 4.032, 3.707, 3.499, 3.355, 3.250, 3.169, 3.106, 3.055, 3.012, 2.977, 2.947),
+}
+_Z = {0.9: 1.645, 0.95: 1.960, 0.99: 2.576}
+
+
+def t_critical(df, confidence=0.95):
+    if df < 1:
+        return math.inf
+    table = _T_TABLE[confidence]
+    if df <= len(table):
+        return table[max(0, int(math.floor(df)) - 1)]
+    # interpolate between the last table entry and the normal approximation
+    return _Z[confidence] + (table[-1] - _Z[confidence]) * len(table) / df
+
+
+def mean_std(values):
+    n = len(values)
+    mean = sum(values) / n
+    var = sum((v - mean) ** 2 for v in values) / (n - 1) if n > 1 else 0.
+    return mean, math.sqrt(var)
+
+
+def compare_samples(baseline, current, confidence=0.95):
+    """ Relative change of the mean (current vs baseline) w/ a Welch t-test confidence interval, in percent. """
+    m0, s0 = mean_std(baseline)
+    m1, s1 = mean_std(current)
+    n0, n1 = len(baseline), len(current)
+    se = math.sqrt(s0 ** 2 / n0 + s1 ** 2 / n1)
+    if se > 0:
+        df = se ** 4 / ((s0 ** 2 / n0) ** 2 / max(n0 - 1, 1) + (s1 ** 2 / n1) ** 2 / max(n1 - 1, 1))
+        half_width = t_critical(df, confidence) * se
+    else:
+        half_width = 0.
+    diff = m1 - m0
+    return dict(
+        change=100 * diff / m0,
+        change_low=100 * (diff - half_width) / m0,
+        change_high=100 * (diff + half_width) / m0,
+    )
+
+
+def _git_revision():
+    try:
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        rev = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=cwd, stderr=subprocess.DEVNULL)
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=cwd, stderr=subprocess.DEVNULL)
+        return rev.decode().strip() + ('-dirty' if dirty else '')
+    except Exception:
+        return ''
+
+
+def load_history(history_file):
+    if not os.path.exists(history_file):
+        return []
+    with open(history_file) as f:
+        return json.load(f)
+
+
+def save_history(history_file, history):
+    tmp_file = f'{history_file}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(history, f, indent=2)
+    os.replace(tmp_file, history_file)
+
+
+def find_baseline(history, baseline):
+    if not baseline or not history:
+        return None
+    if baseline == 'latest':
+        return history[-1]
+    for run in reversed(history):
+        if baseline in (run['id'], run.get('label', '')):
+            return run
+    return None
+
+
+def run_model(model_name, args):
+    bench_kwargs = dict(
+        device=args.device,
+        batch_size=args.batch_size,
+        img_size=args.img_size,
+        gp=None,
+        precision=args.precision,
+        channels_last=args.channels_last,
+        num_warm_iter=args.num_warm_iter,
+        num_bench_iter=args.num_bench_iter,
+    )
+    modes = dict(inference=InferenceBenchmarkRunner, train=TrainBenchmarkRunner)
+    if args.bench != 'both':
+        modes = {args.bench: modes[args.bench]}
+
+    results = OrderedDict()
+    for mode, bench_fn in modes.items():
+        # one runner (model) per mode, repeated (warmup + timed) measurements
+        bench = bench_fn(model_name=model_name, **bench_kwargs)
+        samples_per_sec = []
+        step_time = []
+        for _ in range(args.repeats):
+            r = bench.run()
+            samples_per_sec.append(r['samples_per_sec'])
+            step_time.append(r['step_time'])
+        results[mode] = dict(
+            samples_per_sec=samples_per_sec,
+            step_time=step_time,
+            batch_size=bench.batch_size,
+            img_size=bench.input_size[-1],
+        )
+        del bench
+    return results
+
+
+def compare_runs(baseline, current, threshold=5., confidence=0.95):
+    rows = []
+    for model_name, modes in current['results'].items():
+        for mode, r in modes.items():
+            b = baseline['results'].get(model_name, {}).get(mode, None)
+            if b is None:
+                continue
+            if (b['batch_size'], b['img_size']) != (r['batch_size'], r['img_size']):
+                _logger.warning(f'Skipping {model_name} {mode}, batch or image size differs from the baseline.')
+                continue
+            throughput = compare_samples(b['samples_per_sec'], r['samples_per_sec'], confidence)
+            latency = compare_samples(b['step_time'], r['step_time'], confidence)
+            # regression: throughput dropped (latency increased) more than threshold, and the change is significant
+            regressed = (
+                (throughput['change'] < -threshold and throughput['change_high'] < 0)
+                or (latency['change'] > threshold and latency['change_low'] > 0)
+            )
+            rows.append(OrderedDict(
+                model=model_name,
+                mode=mode,
+                samples_per_sec=round(mean_std(r['samples_per_sec'])[0], 2),
+                baseline_samples_per_sec=round(mean_std(b['samples_per_sec'])[0], 2),
+                throughput_change=round(throughput['change'], 2),
+                throughput_change_low=round(throughput['change_low'], 2),
+                throughput_change_high=round(throughput['change_high'], 2),
+                step_time=round(mean_std(r['step_time'])[0], 3),
+                baseline_step_time=round(mean_std(b['step_time'])[0], 3),
+                step_time_change=round(latency['change'], 2),
+                step_time_change_low=round(latency['change_low'], 2),
+                step_time_change_high=round(latency['change_high'], 2),
+                regressed=regressed,
+            ))
+    return rows
+
+
+def main():
+    setup_default_logging()
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    if args.model_list:
+        with open(args.model_list) as f:
+            model_names = [line.rstrip() for line in f if line.strip()]
+    else:
+        model_names = args.models or list(DEFAULT_MODELS)
+
+    history = load_history(args.history_file)
+    baseline = find_baseline(history, args.baseline)
+    if args.baseline and baseline is None:
+        _logger.warning(f'Baseline {args.baseline} not found in {args.history_file}, no comparison will be made.')
+
+    run_id = time.strftime('%Y%m%d-%H%M%S')
+    current = OrderedDict(
+        id=run_id,
+        label=args.label,
+        git=_git_revision(),
+        torch=torch.__version__,
+        timm=__version__,
+        platform=platform.platform(),
+        processor=platform.processor() or platform.machine(),
+        threads=torch.get_num_threads(),
+        config=dict(
+            bench=args.bench,
+            device=args.device,
+            precision=args.precision,
+            channels_last=args.channels_last,
+            repeats=args.repeats,
+            num_warm_iter=args.num_warm_iter,
+            num_bench_iter=args.num_bench_iter,
+        ),
+        results=OrderedDict(),
+    )
+    for model_name in model_names:
+        try:
+            current['results'][model_name] = run_model(model_name, args)
+        except RuntimeError as e:
+            _logger.error(f'"{e}" while benchmarking {model_name}, skipping.')
+
+    if not args.no_save:
+        save_history(args.history_file, history + [current])
+        _logger.info(f'Run {run_id} saved to {args.history_file}.')
+
+    if baseline is None:
+        return
+
+    for key in ('threads', 'torch', 'processor'):
+        if baseline.get(key) != current[key]:
+            _logger.warning(f'Baseline {key} ({baseline.get(key)}) differs from this run ({current[key]}).')
+    if baseline.get('config') != current['config']:
+        _logger.warning(f'Baseline config {baseline.get("config")} differs from this run {current["config"]}.')
+
+    rows = compare_runs(baseline, current, threshold=args.threshold, confidence=args.confidence)
+    _logger.info(
+        f'Comparison vs baseline {baseline["id"]} {baseline.get("label", "")} ({baseline.get("git", "")}), '
+        f'throughput change % w/ {int(100 * args.confidence)}% confidence interval:')
+    for r in rows:
+        _logger.info(
+            f'{"REGRESSED " if r["regressed"] else "          "}{r["model"]:<32} {r["mode"]:<9} '
+            f'{r["samples_per_sec"]:>10.2f} samples/sec {r["throughput_change"]:>+7.2f}% '
+            f'[{r["throughput_change_low"]:+.2f}, {r["throughput_change_high"]:+.2f}]')
+    regressions = [r for r in rows if r['regressed']]
+    _logger.info(f'{len(regressions)} of {len(rows)} benchmarks regressed by more than {args.threshold}%.')
+
+    if args.results_file:
+        write_results(args.results_file, rows, format=args.results_format)
+
+    if regressions and args.fail_on_regression:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,22 +6,37 @@ Run validation or benchmark script in separate process for each model
 Benchmark all 'vit*' models:
 python bulk_runner.py  --model-list 'vit*' --results-file vit_bench.csv benchmark.py --amp -b 512
 
+Benchmark the same models w/ the onnxruntime (CPU) backend, results use the same columns:
+python bulk_runner.py  --model-list 'vit*' --results-file vit_bench_ort.csv benchmark.py --device cpu --backend onnxruntime
+
 Validate all models:
 python bulk_runner.py  --model-list all --results-file val.csv --pretrained validate.py --data-dir /imagenet/validation/ --amp -b 512 --retry
 
+Benchmark all models on CPU w/ 8 concurrent workers (one per 16 cores), resumable if interrupted:
+python bulk_runner.py  --model-list all --results-file cpu_bench.csv --num-workers 8 --timeout 1800 benchmark.py --device cpu -b 64
+
 Hacked together by Ross Wightman (https://github.com/rwightman)
 """
 import argparse
+import glob
 import os
+import queue
+import shutil
+import signal
 import sys
 import csv
 import json
 import subprocess
+import threading
 import time
-from typing import Callable, List, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple, Union
 
+import torch
 
 from timm.models import is_model, list_models, get_pretrained_cfg, get_arch_pretrained_cfgs
+from timm.utils import decay_batch_step
+from timm.utils.decay_batch import available_memory
 
 
 parser = argparse.ArgumentParser(description='Per-model process launcher')
@@ -62,6 +77,39 @@ parser.add_argument(
          "with the same behavior as 'python -m'.",
 )
 
+# scheduling args
+parser.add_argument(
+    '--num-workers', type=int, default=1, metavar='N',
+    help='Number of models run concurrently (default: 1)')
+parser.add_argument(
+    '--cores-per-worker', type=int, default=None, metavar='N',
+    help='Cores each worker is pinned to (default: available cores / num workers)')
+parser.add_argument(
+    '--numa', action='store_true', default=False,
+    help='Pin each worker to a NUMA node instead of a core range, workers sharing a node split its cores '
+         '(Linux only).')
+parser.add_argument(
+    '--no-pin', action='store_true', default=False,
+    help='Do not pin workers to cores or limit their thread counts.')
+parser.add_argument(
+    '--timeout', type=float, default=None, metavar='SEC',
+    help='Per model timeout in seconds, timed out (or killed) runs are retried at a smaller batch size.')
+parser.add_argument(
+    '--default-batch-size', type=int, default=256, metavar='N',
+    help='Batch size of the script when -b is not in its args, the starting point of retries (default: 256)')
+parser.add_argument(
+    '--journal', default='', type=str, metavar='FILENAME',
+    help='Results journal used to resume interrupted runs (default: <results-file>.journal.jsonl)')
+parser.add_argument(
+    '--no-resume', action='store_true', default=False,
+    help='Ignore (and overwrite) an existing journal instead of skipping the models already run.')
+parser.add_argument(
+    '--retry-errors', action='store_true', default=False,
+    help='Re-run the models w/ an error result in the journal when resuming.')
+parser.add_argument(
+    '--log-dir', default='', type=str, metavar='DIR',
+    help='Write the stderr of each model run to a log file in this dir instead of the console.')
+
 # positional
 parser.add_argument(
     "script", type=str,
@@ -138,9 +186,179 @@ def _get_model_cfgs(
         return [(n, {'img-size': r}) for n, r in sorted(model_cfgs)]
 
 
+def _parse_cpulist(cpulist: str) -> List[int]:
+    cores = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cores.extend(range(int(start), int(end) + 1))
+        else:
+            cores.append(int(part))
+    return cores
+
+
+def _worker_core_sets(
+        num_workers: int,
+        cores_per_worker: Optional[int] = None,
+        numa: bool = False,
+) -> List[Optional[List[int]]]:
+    """ Split the available cores (or NUMA nodes) into disjoint per worker core sets. """
+    if not hasattr(os, 'sched_getaffinity'):
+        return [None] * num_workers
+    available = sorted(os.sched_getaffinity(0))
+    if numa:
+        nodes = []
+        for node_dir in sorted(glob.glob('/sys/devices/system/node/node[0-9]*')):
+            with open(os.path.join(node_dir, 'cpulist')) as f:
+                node_cores = [c for c in _parse_cpulist(f.read()) if c in available]
+            if node_cores:
+                nodes.append(node_cores)
+        if nodes:
+            # workers are assigned to nodes round robin, a node's cores are split between the workers sharing it
+            core_sets = []
+            for i in range(num_workers):
+                node_cores = nodes[i % len(nodes)]
+                node_workers = len(range(i % len(nodes), num_workers, len(nodes)))
+                if node_workers > len(node_cores):
+                    parser.error(
+                        f'--num-workers {num_workers} exceeds the cores available on NUMA node {i % len(nodes)} '
+                        f'({len(node_cores)} cores for {node_workers} workers).')
+                per_worker = len(node_cores) // node_workers
+                start = (i // len(nodes)) * per_worker
+                core_sets.append(node_cores[start:start + per_worker])
+            return core_sets
+        print('No NUMA nodes found, splitting cores evenly.')
+    if num_workers > len(available):
+        parser.error(f'--num-workers {num_workers} exceeds the {len(available)} available cores, use --no-pin.')
+    cores_per_worker = cores_per_worker or len(available) // num_workers
+    if cores_per_worker * num_workers > len(available):
+        parser.error(
+            f'--cores-per-worker {cores_per_worker} x --num-workers {num_workers} exceeds the {len(available)} '
+            f'available cores, use at most {len(available) // num_workers} cores per worker.')
+    return [available[i * cores_per_worker:(i + 1) * cores_per_worker] for i in range(num_workers)]
+
+
+def _script_arg(script_args: List[str], names: Tuple[str, ...]) -> Optional[str]:
+    value = None
+    for i, a in enumerate(script_args):
+        if a in names and i + 1 < len(script_args):
+            value = script_args[i + 1]
+        elif '=' in a and a.split('=', 1)[0] in names:
+            value = a.split('=', 1)[1]
+    return value
+
+
+def _script_batch_size(script_args: List[str]) -> Optional[int]:
+    batch_size = _script_arg(script_args, ('-b', '--batch-size'))
+    # None if not set or not a number (ie 'auto')
+    return int(batch_size) if batch_size is not None and batch_size.isdigit() else None
+
+
+def _worker_memory_budget(script_args: List[str], num_workers: int) -> List[str]:
+    """ Split the memory budget of `--batch-size auto` between concurrent workers.
+
+    The scripts default to all of the memory available on the device, which every concurrent worker would claim.
+    """
+    if num_workers <= 1 or _script_arg(script_args, ('-b', '--batch-size')) != 'auto':
+        return []
+    if _script_arg(script_args, ('--memory-budget',)) is not None:
+        return []
+    if _script_arg(script_args, ('--device',)) != 'cpu':
+        parser.error('--memory-budget is required for --batch-size auto w/ multiple workers sharing a device.')
+    budget = available_memory(torch.device('cpu')) / num_workers
+    return ['--memory-budget', f'{budget / 2**30:.3f}']
+
+
+def _cfg_key(model_name, extra_args):
+    return json.dumps([model_name, extra_args], sort_keys=True)
+
+
+def _load_journal(journal_file):
+    completed = {}
+    if os.path.exists(journal_file):
+        with open(journal_file) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # partially written line from an interrupted run
+                completed[entry['key']] = entry['result']
+    return completed
+
+
+def _run_model(
+        cmd,
+        cmd_args,
+        model_name,
+        extra_args,
+        cores: Optional[List[int]] = None,
+        timeout: Optional[float] = None,
+        log_file: str = '',
+        default_batch_size: int = 256,
+):
+    """ Run the script for one model, retrying at decayed batch sizes on timeout or if the process is killed.
+
+    Returns the parsed script result (or an error dict), None if the run was interrupted.
+    """
+    args_str = (cmd, *[str(e) for e in cmd_args], '--model', model_name)
+    if extra_args is not None:
+        extra_args = [(f'--{k}', str(v)) for k, v in extra_args.items()]
+        args_str += tuple([i for t in extra_args for i in t])
+
+    env = os.environ.copy()
+    set_affinity = False
+    if cores is not None:
+        num_threads = str(len(cores))
+        env.update(OMP_NUM_THREADS=num_threads, MKL_NUM_THREADS=num_threads)
+        # no preexec_fn, it isn't safe to use from threads (the child may deadlock before exec)
+        if shutil.which('taskset'):
+            args_str = ('taskset', '-c', ','.join(str(c) for c in cores)) + args_str
+        else:
+            set_affinity = True
+
+    batch_size = _script_batch_size(cmd_args)
+    error_str = 'Unknown'
+    while True:
+        run_args = args_str if batch_size is None else args_str + ('--batch-size', str(batch_size))
+        stderr = open(log_file, 'a') if log_file else None
+        try:
+            proc = subprocess.Popen(args=run_args, stdout=subprocess.PIPE, stderr=stderr, env=env)
+            if set_affinity:
+                os.sched_setaffinity(proc.pid, cores)  # before the interpreter starts any threads
+            try:
+                stdout, _ = proc.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.communicate()
+                raise
+            if proc.returncode == -signal.SIGINT:
+                return None  # interrupted, not a result
+            if proc.returncode >= 0:
+                if proc.returncode:
+                    raise subprocess.CalledProcessError(proc.returncode, run_args)
+                return json.loads(stdout.decode('utf-8').split('--result')[-1])
+            # killed by a signal, most likely the OOM killer
+            error_str = f'Killed by signal {-proc.returncode}'
+        except subprocess.TimeoutExpired:
+            error_str = f'Timed out after {timeout} sec'
+        except Exception as e:
+            return dict(model=model_name, error=str(e))
+        finally:
+            if stderr is not None:
+                stderr.close()
+        # w/o -b in the script args the retries start from the script's default batch size
+        batch_size = decay_batch_step(batch_size or default_batch_size)
+        if not batch_size:
+            return dict(model=model_name, error=error_str)
+        print(f'{model_name}: {error_str}, retrying w/ batch size {batch_size}.')
+
+
 def main():
     args = parser.parse_args()
     cmd, cmd_args = cmd_from_args(args)
+    cmd_args += _worker_memory_budget(args.script_args, args.num_workers)
 
     model_cfgs = []
     if args.model_list == 'all':
@@ -187,27 +405,69 @@ def main():
             sort_key = args.sort_key
         print(f'Script: {args.script}, Args: {args.script_args}, Sort key: {sort_key}')
 
+        journal_file = args.journal or f'{results_file}.journal.jsonl'
+        completed = {} if args.no_resume else _load_journal(journal_file)
+        if args.retry_errors:
+            completed = {k: r for k, r in completed.items() if 'error' not in r}
+        pending = [(m, ax) for m, ax in model_cfgs if m and _cfg_key(m, ax) not in completed]
+        if len(pending) < len(model_cfgs):
+            print(f'Resuming from {journal_file}, {len(model_cfgs) - len(pending)} models already run.')
+        if args.log_dir:
+            os.makedirs(args.log_dir, exist_ok=True)
+
+        core_sets = [None] * args.num_workers
+        if not args.no_pin and (args.num_workers > 1 or args.cores_per_worker or args.numa):
+            core_sets = _worker_core_sets(args.num_workers, args.cores_per_worker, numa=args.numa)
+        free_core_sets = queue.Queue()
+        for c in core_sets:
+            free_core_sets.put(c)
+        journal_lock = threading.Lock()
+        stop = threading.Event()
+
+        def _task(m, ax):
+            if stop.is_set():
+                return
+            cores = free_core_sets.get()
+            try:
+                log_file = ''
+                if args.log_dir:
+                    log_name = '-'.join([m] + [f'{k}{v}' for k, v in (ax or {}).items()]).replace('/', '_')
+                    log_file = os.path.join(args.log_dir, f'{log_name}.log')
+                r = _run_model(
+                    cmd, cmd_args, m, ax, cores=cores, timeout=args.timeout, log_file=log_file,
+                    default_batch_size=args.default_batch_size,
+                )
+            finally:
+                free_core_sets.put(cores)
+            if r is None or stop.is_set():
+                return  # interrupted, don't record a partial result
+            with journal_lock:
+                completed[_cfg_key(m, ax)] = r
+                with open(journal_file, 'a') as jf:
+                    jf.write(json.dumps(dict(key=_cfg_key(m, ax), result=r)) + '\n')
+            print(f"{m}: {'error' if 'error' in r else 'done'} [{len(completed)}/{len(model_cfgs)}]")
+            if args.delay:
+                time.sleep(args.delay)
+
+        if args.no_resume and os.path.exists(journal_file):
+            os.remove(journal_file)
+        executor = ThreadPoolExecutor(max_workers=args.num_workers)
         try:
-            for m, ax in model_cfgs:
-                if not m:
-                    continue
-                args_str = (cmd, *[str(e) for e in cmd_args], '--model', m)
-                if ax is not None:
-                    extra_args = [(f'--{k}', str(v)) for k, v in ax.items()]
-                    extra_args = [i for t in extra_args for i in t]
-                    args_str += tuple(extra_args)
-                try:
-                    o = subprocess.check_output(args=args_str).decode('utf-8').split('--result')[-1]
-                    r = json.loads(o)
-                    results.append(r)
-                except Exception as e:
-                    # FIXME batch_size retry loop is currently done in either validation.py or benchmark.py
-                    # for further robustness (but more overhead), we may want to manage that by looping here...
-                    errors.append(dict(model=m, error=str(e)))
-                if args.delay:
-                    time.sleep(args.delay)
+            futures = [executor.submit(_task, m, ax) for m, ax in pending]
+            for f in futures:
+                f.result()
         except KeyboardInterrupt as e:
-            pass
+            stop.set()
+            print('Interrupted, waiting for running models to exit. Re-run to resume.')
+        finally:
+            # queued tasks return immediately once stop is set
+            executor.shutdown(wait=True)
+
+        # merge results of this and any previous (resumed) runs in model list order
+        for m, ax in model_cfgs:
+            r = completed.get(_cfg_key(m, ax), None)
+            if r is not None:
+                results.append(r)
 
         errors.extend(list(filter(lambda x: 'error' in x, results)))
         if errors:
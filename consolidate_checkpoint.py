@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+""" Sharded Checkpoint Consolidation Script
+
+Assembles a sharded (per-rank, `train.py --checkpoint-sharded`) checkpoint directory into the standard single
+file training checkpoint, as loaded by `validate.py --checkpoint` / `train.py --resume` or cleaned further with
+`clean_checkpoint.py`.
+"""
+import argparse
+import os
+
+from timm.utils import consolidate_sharded_checkpoint, is_sharded_checkpoint
+
+parser = argparse.ArgumentParser(description='PyTorch Sharded Checkpoint Consolidation')
+parser.add_argument('--checkpoint', default='', type=str, metavar='PATH',
+                    help='path to sharded checkpoint directory')
+parser.add_argument('--output', default='', type=str, metavar='PATH',
+                    help='output filename (default: <checkpoint>.pth.tar)')
+parser.add_argument('--no-optimizer', dest='no_optimizer', action='store_true',
+                    help='drop the optimizer state')
+parser.add_argument('--no-ema', dest='no_ema', action='store_true',
+                    help='drop the EMA weights')
+
+
+def main():
+    args = parser.parse_args()
+
+    if not is_sharded_checkpoint(args.checkpoint):
+        print("Error: Sharded checkpoint ({}) doesn't exist".format(args.checkpoint))
+        exit(1)
+
+    output = args.output or args.checkpoint.rstrip('/\\') + '.pth.tar'
+    if os.path.exists(output):
+        print("Error: Output filename ({}) already exists.".format(output))
+        exit(1)
+
+    exclude = []
+    if args.no_optimizer:
+        exclude.append('optimizer')
+    if args.no_ema:
+        exclude += ['state_dict_ema', 'task_state_ema']
+
+    print("=> Loading sharded checkpoint '{}'".format(args.checkpoint))
+    state = consolidate_sharded_checkpoint(args.checkpoint, output, exclude=exclude)
+    print("=> Saved checkpoint (epoch {}) to '{}'".format(state.get('epoch', None), output))
+
+
+if __name__ == '__main__':
+    main()
@@ -22,7 +22,9 @@ from timm.data import create_dataset, create_loader, resolve_data_config, ImageN
     CustomDatasetInfo, DatasetInfoLabelMapper
 from timm.layers import apply_test_time_pool
 from timm.models import create_model
-from timm.utils import AverageMeter, setup_default_logging, set_jit_fuser, ParseKwargs
+from timm.utils import AverageMeter, setup_default_logging, set_jit_fuser, ParseKwargs, compile_regions, \
+    ShapeBucketModel, create_exported_model, reparameterize_model
+from timm.utils.onnx import create_onnx_runtime_model
 
 try:
     from functorch.compile import memory_efficient_fusion
@@ -107,6 +109,31 @@ parser.add_argument('--fuser', default='', type=str,
 parser.add_argument('--model-kwargs', nargs='*', default={}, action=ParseKwargs)
 parser.add_argument('--torchcompile-mode', type=str, default=None,
                     help="torch.compile mode (default: None).")
+parser.add_argument('--torchcompile-regions', default=False, action='store_true',
+                    help="With --torchcompile, compile the repeated blocks (one graph per distinct block) "
+                         "instead of the whole model.")
+parser.add_argument('--bucket-batch-sizes', type=int, nargs='+', default=None, metavar='N',
+                    help='Run the model on static batch size buckets, inputs are padded to the nearest bucket. '
+                         'Combined with --torchscript / --torchcompile, one trace / graph is built per bucket '
+                         'ahead of time.')
+parser.add_argument('--bucket-img-sizes', type=int, nargs='+', default=None, metavar='N',
+                    help='Static image size buckets for --bucket-batch-sizes, inputs are zero padded to the '
+                         'nearest bucket (default: none, input size is not bucketed)')
+parser.add_argument('--reparam', default=False, action='store_true',
+                    help='Reparameterize model')
+
+parser.add_argument('--backend', default='torch', type=str, choices=('torch', 'onnxruntime'),
+                    help='Execution backend (default: torch). onnxruntime runs on CPU.')
+parser.add_argument('--onnx-file', default='', type=str, metavar='PATH',
+                    help='ONNX graph for --backend onnxruntime, exported from the model if empty or missing.')
+parser.add_argument('--ort-intra-threads', default=0, type=int, metavar='N',
+                    help='onnxruntime intra-op threads (default: 0, onnxruntime default)')
+parser.add_argument('--ort-inter-threads', default=0, type=int, metavar='N',
+                    help='onnxruntime inter-op threads (default: 0, onnxruntime default)')
+parser.add_argument('--ort-opt-level', default='all', type=str, choices=('disable', 'basic', 'extended', 'all'),
+                    help='onnxruntime graph optimization level (default: all)')
+parser.add_argument('--ort-quantize', default=False, action='store_true',
+                    help='Apply onnxruntime dynamic int8 quantization.')
 
 scripting_group = parser.add_mutually_exclusive_group()
 scripting_group.add_argument('--torchscript', default=False, action='store_true',
@@ -115,6 +142,15 @@ scripting_group.add_argument('--torchcompile', nargs='?', type=str, default=None
                              help="Enable compilation w/ specified backend (default: inductor).")
 scripting_group.add_argument('--aot-autograd', default=False, action='store_true',
                              help="Enable AOT Autograd support.")
+scripting_group.add_argument('--aot-export', nargs='?', type=str, default=None, const='aoti',
+                             choices=('aoti', 'export'),
+                             help="Run an ahead-of-time exported artifact (default: aoti), loaded from the export "
+                                  "cache or created and cached on first use.")
+parser.add_argument('--export-cache-dir', type=str, default=None,
+                    help='Exported artifact cache dir '
+                         '(default: env TIMM_EXPORT_CACHE or <torch hub>/checkpoints/exported)')
+parser.add_argument('--export-rebuild', default=False, action='store_true',
+                    help='Re-export the model even if a cached artifact exists.')
 
 parser.add_argument('--results-dir', type=str, default=None,
                     help='folder for output results')
@@ -186,46 +222,135 @@ def main():
     elif args.input_size is not None:
         in_chans = args.input_size[0]
 
-    model = create_model(
-        args.model,
-        num_classes=args.num_classes,
-        in_chans=in_chans,
-        pretrained=args.pretrained,
-        checkpoint_path=args.checkpoint,
-        **args.model_kwargs,
-    )
-    if args.num_classes is None:
-        assert hasattr(model, 'num_classes'), 'Model must have `num_classes` attr if not set on cmd line/config.'
-        args.num_classes = model.num_classes
-    # Preserve metadata before TorchScript/compile/DataParallel wrappers, which do
-    # not consistently forward custom model attributes such as pretrained_cfg.
-    pretrained_cfg = dict(getattr(model, 'pretrained_cfg', {}) or {})
-
-    _logger.info(
-        f'Model {args.model} created, param count: {sum([m.numel() for m in model.parameters()])}')
-
-    data_config = resolve_data_config(vars(args), model=model)
-    test_time_pool = False
-    if args.test_pool:
-        model, test_time_pool = apply_test_time_pool(model, data_config)
-
-    model = model.to(device=device, dtype=model_dtype)
-    model.eval()
-    if args.channels_last:
-        model = model.to(memory_format=torch.channels_last)
-
-    if args.torchscript:
-        model = torch.jit.script(model)
-    elif args.torchcompile:
-        assert has_compile, 'A version of torch w/ torch.compile() is required for --compile, possibly a nightly.'
-        torch._dynamo.reset()
-        model = torch.compile(model, backend=args.torchcompile, mode=args.torchcompile_mode)
-    elif args.aot_autograd:
-        assert has_functorch, "functorch is needed for --aot-autograd"
-        model = memory_efficient_fusion(model)
-
-    if args.num_gpu > 1:
-        model = torch.nn.DataParallel(model, device_ids=list(range(args.num_gpu)))
+    bucketed_model = None
+    if args.aot_export:
+        # load (or create on first use) an AOT exported artifact, skips model creation and weight loading
+        # NOTE --torchscript / --torchcompile / --aot-autograd are already exclusive via the argparse group
+        unsupported = [
+            name for name, enabled in (
+                ('--backend onnxruntime', args.backend == 'onnxruntime'),
+                ('--bucket-batch-sizes', bool(args.bucket_batch_sizes)),
+                ('--bucket-img-sizes', bool(args.bucket_img_sizes)),
+                ('--test-pool', args.test_pool),
+            ) if enabled
+        ]
+        if unsupported:
+            parser.error(f'--aot-export cannot be combined with {", ".join(unsupported)}.')
+        if args.amp:
+            _logger.warning('AMP is not applied to exported models, use --model-dtype for lower precision.')
+        input_size = args.input_size
+        if input_size is None and args.img_size is not None:
+            input_size = (in_chans, args.img_size, args.img_size)
+        model = create_exported_model(
+            args.model,
+            pretrained=args.pretrained,
+            checkpoint_path=args.checkpoint,
+            input_size=input_size,
+            batch_size=args.batch_size,
+            dtype=model_dtype,
+            device=device,
+            reparam=args.reparam,
+            channels_last=args.channels_last,
+            export_format=args.aot_export,
+            cache_dir=args.export_cache_dir,
+            rebuild=args.export_rebuild,
+            num_classes=args.num_classes,
+            in_chans=in_chans,
+            **args.model_kwargs,
+        )
+        if args.num_classes is None:
+            args.num_classes = model.num_classes
+        pretrained_cfg = dict(model.pretrained_cfg)
+        data_config = resolve_data_config(vars(args), model=model)
+        test_time_pool = False
+    else:
+        model = create_model(
+            args.model,
+            num_classes=args.num_classes,
+            in_chans=in_chans,
+            pretrained=args.pretrained,
+            checkpoint_path=args.checkpoint,
+            exportable=args.backend == 'onnxruntime',
+            **args.model_kwargs,
+        )
+        if args.num_classes is None:
+            assert hasattr(model, 'num_classes'), 'Model must have `num_classes` attr if not set on cmd line/config.'
+            args.num_classes = model.num_classes
+        # Preserve metadata before TorchScript/compile/DataParallel wrappers, which do
+        # not consistently forward custom model attributes such as pretrained_cfg.
+        pretrained_cfg = dict(getattr(model, 'pretrained_cfg', {}) or {})
+
+        _logger.info(
+            f'Model {args.model} created, param count: {sum([m.numel() for m in model.parameters()])}')
+
+        data_config = resolve_data_config(vars(args), model=model)
+        test_time_pool = False
+        if args.test_pool:
+            model, test_time_pool = apply_test_time_pool(model, data_config)
+        if args.reparam:
+            model = reparameterize_model(model)
+
+        model = model.to(device=device, dtype=model_dtype)
+        model.eval()
+        if args.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+
+        if args.backend == 'onnxruntime':
+            assert device.type == 'cpu' and model_dtype in (None, torch.float32) and not args.amp, \
+                'The onnxruntime backend runs in float32 on CPU.'
+            model = create_onnx_runtime_model(
+                model,
+                onnx_file=args.onnx_file,
+                input_size=data_config['input_size'],
+                quantize=args.ort_quantize,
+                intra_op_threads=args.ort_intra_threads,
+                inter_op_threads=args.ort_inter_threads,
+                opt_level=args.ort_opt_level,
+                reuse_outputs=False,  # outputs are kept across batches
+            )
+        elif args.bucket_batch_sizes:
+            bucket_mode = 'eager'
+            if args.torchscript:
+                bucket_mode = 'torchscript'
+            elif args.torchcompile and not args.torchcompile_regions:
+                assert has_compile, 'A version of torch w/ torch.compile() is required for --compile.'
+                torch._dynamo.reset()
+                bucket_mode = 'compile'
+            elif args.torchcompile:
+                torch._dynamo.reset()
+                compile_regions(model, backend=args.torchcompile, mode=args.torchcompile_mode)
+            compile_kwargs = None
+            if args.torchcompile:
+                compile_kwargs = dict(backend=args.torchcompile, mode=args.torchcompile_mode)
+            model = bucketed_model = ShapeBucketModel(
+                model,
+                batch_sizes=args.bucket_batch_sizes,
+                img_sizes=args.bucket_img_sizes,
+                mode=bucket_mode,
+                compile_kwargs=compile_kwargs,
+            )
+            bucketed_model.warmup(
+                in_chans=in_chans,
+                img_size=data_config['input_size'][-2:],
+                device=device,
+                dtype=model_dtype or torch.float32,
+                memory_format=torch.channels_last if args.channels_last else None,
+            )
+        elif args.torchscript:
+            model = torch.jit.script(model)
+        elif args.torchcompile:
+            assert has_compile, 'A version of torch w/ torch.compile() is required for --compile, possibly a nightly.'
+            torch._dynamo.reset()
+            if args.torchcompile_regions:
+                compile_regions(model, backend=args.torchcompile, mode=args.torchcompile_mode)
+            else:
+                model = torch.compile(model, backend=args.torchcompile, mode=args.torchcompile_mode)
+        elif args.aot_autograd:
+            assert has_functorch, "functorch is needed for --aot-autograd"
+            model = memory_efficient_fusion(model)
+
+        if args.num_gpu > 1:
+            model = torch.nn.DataParallel(model, device_ids=list(range(args.num_gpu)))
 
     root_dir = args.data or args.data_dir
     dataset = create_dataset(
@@ -315,6 +440,12 @@ def main():
                 _logger.info('Predict: [{0}/{1}] Time {batch_time.val:.3f} ({batch_time.avg:.3f})'.format(
                     batch_idx, len(loader), batch_time=batch_time))
 
+    if bucketed_model is not None:
+        for s in bucketed_model.stats():
+            _logger.info(
+                f"Bucket {s['bucket']}: {s['calls']} calls, {s['samples']} samples, pad ratio {s['pad_ratio']:.3f}, "
+                f"warmup {s['warmup_time']:.3f}s, avg {1000 * s['avg_time']:.3f}ms")
+
     all_indices = np.concatenate(all_indices, axis=0) if all_indices else None
     all_labels = np.concatenate(all_labels, axis=0) if all_labels else None
     all_outputs = np.concatenate(all_outputs, axis=0).astype(np.float32)
@@ -21,6 +21,8 @@ Copyright 2020 Ross Wightman
 import argparse
 
 import timm
+from timm.data import resolve_data_config
+from timm.layers import attach_preprocess, create_preprocess
 from timm.utils.model import reparameterize_model
 from timm.utils.onnx import onnx_export
 
@@ -61,6 +63,14 @@ parser.add_argument('--verbose', default=False, action='store_true',
                     help='Extra stdout output')
 parser.add_argument('--dynamo', default=False, action='store_true',
                     help='Use torch dynamo export.')
+parser.add_argument('--preprocess', default=False, action='store_true',
+                    help='Include resize / crop and normalization in the graph, the input is a uint8 NHWC image batch.')
+parser.add_argument('--preprocess-resize', default=None, type=str, choices=('center', 'squash', 'border', 'none'),
+                    help='In-graph resize mode (default: model crop_mode). With "center" or "border", the exported '
+                         'graph is specific to the aspect ratio of --preprocess-img-size, "squash" / "none" work '
+                         'for any size.')
+parser.add_argument('--preprocess-img-size', default=None, type=int, nargs=2, metavar='N',
+                    help='Example uint8 image height and width for --preprocess (default: model resize size).')
 
 def main():
     args = parser.parse_args()
@@ -92,6 +102,15 @@ def main():
     else:
         input_size = None
 
+    if args.preprocess:
+        data_config = resolve_data_config(vars(args), model=model)
+        preprocess_kwargs = dict(antialias=False)  # antialiased resize is not supported by the ONNX exporter
+        if args.preprocess_resize is not None:
+            preprocess_kwargs['resize_mode'] = None if args.preprocess_resize == 'none' else args.preprocess_resize
+        attach_preprocess(model, create_preprocess(data_config, **preprocess_kwargs))
+        # input_size is now that of the uint8 example image
+        input_size = (3,) + tuple(args.preprocess_img_size) if args.preprocess_img_size else None
+
     onnx_export(
         model,
         args.output,
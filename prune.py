@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+""" Model Pruning Script
+
+Structured channel pruning of a model to a FLOPs or latency budget. Outputs a pruned structure spec
+(`<output>.txt`) that can be used with `adapt_model_from_file` or `create_model(..., pruned=<spec path>)`
+and the sliced weights (`<output>.safetensors` or `<output>.pth`).
+
+Example:
+    python prune.py --model resnet50 --pretrained --target 0.5 --importance taylor \
+        --data-dir /imagenet --split validation --output ./resnet50_pruned
+"""
+import argparse
+import logging
+import os
+
+import torch
+
+from timm.data import create_dataset, create_loader, resolve_data_config
+from timm.models import create_model, load_checkpoint, prune_model
+from timm.utils import setup_default_logging
+
+try:
+    import safetensors.torch
+    _has_safetensors = True
+except ImportError:
+    _has_safetensors = False
+
+_logger = logging.getLogger('prune')
+
+parser = argparse.ArgumentParser(description='PyTorch Model Channel Pruning')
+parser.add_argument('--model', '-m', metavar='NAME', default='resnet50',
+                    help='model architecture (default: resnet50)')
+parser.add_argument('--pretrained', action='store_true',
+                    help='use pre-trained model')
+parser.add_argument('--checkpoint', default='', type=str, metavar='PATH',
+                    help='path to checkpoint to prune (default: none)')
+parser.add_argument('--num-classes', type=int, default=None,
+                    help='Number classes in dataset')
+parser.add_argument('--output', default='', type=str, metavar='PATH',
+                    help='output path prefix for spec and weights (default: ./<model>_pruned)')
+parser.add_argument('--target', default=0.5, type=float,
+                    help='fraction of FLOPs or latency to keep (default: 0.5)')
+parser.add_argument('--budget', default='flops', type=str, choices=('flops', 'latency'),
+                    help='budget type (default: flops)')
+parser.add_argument('--importance', default='bn', type=str, choices=('bn', 'l1', 'taylor'),
+                    help='channel importance criterion (default: bn)')
+parser.add_argument('--min-keep-ratio', default=0.1, type=float,
+                    help='minimum fraction of channels kept per channel group (default: 0.1)')
+parser.add_argument('--channel-divisor', default=1, type=int,
+                    help='keep channel counts a multiple of this (default: 1)')
+parser.add_argument('--data-dir', metavar='DIR', default=None,
+                    help='path to calibration dataset (root dir), required for taylor importance')
+parser.add_argument('--dataset', metavar='NAME', default='',
+                    help='dataset type + name ("<type>/<name>") (default: ImageFolder or ImageTar if empty)')
+parser.add_argument('--split', metavar='NAME', default='validation',
+                    help='dataset split (default: validation)')
+parser.add_argument('-b', '--batch-size', default=32, type=int,
+                    metavar='N', help='calibration batch size (default: 32)')
+parser.add_argument('--num-batches', default=8, type=int,
+                    help='number of calibration batches (default: 8)')
+parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
+                    help='number of data loading workers (default: 4)')
+parser.add_argument('--device', default='cpu', type=str,
+                    help="Device (accelerator) to use.")
+parser.add_argument('--safetensors', action='store_true',
+                    help='Save weights using safetensors instead of the default torch way (pickle).')
+
+
+def main():
+    setup_default_logging()
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    model = create_model(args.model, pretrained=args.pretrained, num_classes=args.num_classes)
+    if args.checkpoint:
+        load_checkpoint(model, args.checkpoint)
+    model = model.to(device)
+    data_config = resolve_data_config(vars(args), model=model)
+
+    loader = None
+    if args.data_dir:
+        dataset = create_dataset(root=args.data_dir, name=args.dataset, split=args.split)
+        loader = create_loader(
+            dataset,
+            input_size=data_config['input_size'],
+            batch_size=args.batch_size,
+            use_prefetcher=False,
+            interpolation=data_config['interpolation'],
+            mean=data_config['mean'],
+            std=data_config['std'],
+            num_workers=args.workers,
+            crop_pct=data_config['crop_pct'],
+        )
+
+    pruned, model_string = prune_model(
+        model,
+        target=args.target,
+        budget=args.budget,
+        importance=args.importance,
+        loader=loader,
+        num_batches=args.num_batches,
+        example_input=torch.randn((1,) + tuple(data_config['input_size'])),
+        min_keep_ratio=args.min_keep_ratio,
+        channel_divisor=args.channel_divisor,
+        device=device,
+    )
+    param_count = sum(p.numel() for p in model.parameters())
+    pruned_param_count = sum(p.numel() for p in pruned.parameters())
+    _logger.info(f'Pruned params {param_count / 1e6:.3f}M -> {pruned_param_count / 1e6:.3f}M')
+
+    output = args.output or f'./{args.model}_pruned'
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output + '.txt', 'w') as f:
+        f.write(model_string)
+    state_dict = {k: v.cpu().contiguous() for k, v in pruned.state_dict().items()}
+    if args.safetensors:
+        assert _has_safetensors, "`pip install safetensors` to use .safetensors"
+        safetensors.torch.save_file(state_dict, output + '.safetensors')
+        weights_file = output + '.safetensors'
+    else:
+        torch.save(state_dict, output + '.pth')
+        weights_file = output + '.pth'
+    _logger.info(f'Pruned spec saved to {output}.txt, weights to {weights_file}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+""" Add analytic model stats (params, GMACs, activations) to the model metadata csv.
+
+Stats are estimated on the meta device (no weights allocated) with `timm.utils.estimate_model_stats`, at the
+input size of each model's default pretrained config. Existing (hand curated) columns are kept.
+
+    python results/generate_model_metadata.py --metadata-file results/model_metadata-in1k.csv
+"""
+import argparse
+import csv
+import logging
+import warnings
+
+from timm.utils import estimate_model_stats, setup_default_logging
+
+_logger = logging.getLogger('generate_model_metadata')
+
+STAT_COLUMNS = ('img_size', 'param_count', 'gmacs', 'macts')
+
+parser = argparse.ArgumentParser(description='Generate model metadata stats')
+parser.add_argument('--metadata-file', default='results/model_metadata-in1k.csv', type=str,
+                    help='Metadata csv with a model column, updated in place unless --output-file is set.')
+parser.add_argument('--output-file', default='', type=str,
+                    help='Output csv file (default: update --metadata-file).')
+parser.add_argument('--img-size', default=None, type=int,
+                    help='Input image size for all models (default: pretrained cfg input size).')
+
+
+def model_stats(model_name, img_size=None):
+    input_size = (3, img_size, img_size) if img_size else None
+    stats = estimate_model_stats(model_name, input_size=input_size)
+    return dict(
+        img_size=stats.input_size[-1],
+        param_count=round(stats.params / 1e6, 2),
+        gmacs=round(stats.macs / 1e9, 2),
+        macts=round(stats.acts / 1e6, 2),
+    )
+
+
+def main():
+    setup_default_logging()
+    args = parser.parse_args()
+
+    with open(args.metadata_file) as f:
+        rows = list(csv.DictReader(f))
+    fieldnames = list(rows[0].keys())
+    fieldnames += [c for c in STAT_COLUMNS if c not in fieldnames]
+
+    for row in rows:
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')  # deprecated name mappings, etc
+                row.update(model_stats(row['model'], img_size=args.img_size))
+        except Exception as e:
+            _logger.warning(f'Unable to estimate stats for {row["model"]}: {e}')
+            row.update({c: row.get(c, '') for c in STAT_COLUMNS})
+
+    with open(args.output_file or args.metadata_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,14 @@ import inspect
 import pytest
 import torch
 
-from timm.models._helpers import load_state_dict, resume_checkpoint
+import timm
+from timm.models._helpers import load_safetensors, load_state_dict, resume_checkpoint
+
+try:
+    import safetensors.torch
+    _HAS_SAFETENSORS = True
+except ImportError:
+    _HAS_SAFETENSORS = False
 
 
 _HAS_WEIGHTS_ONLY = 'weights_only' in inspect.signature(torch.load).parameters
@@ -109,3 +116,198 @@ def test_resume_checkpoint_weights_only_false_allows_custom_globals(tmp_path):
     assert resume_epoch == 4
     assert torch.equal(dst_model.weight, src_model.weight)
     assert torch.equal(dst_model.bias, src_model.bias)
+
+
+@pytest.mark.skipif(not _HAS_SAFETENSORS, reason='requires safetensors')
+def test_load_safetensors_mmap(tmp_path):
+    checkpoint_path = tmp_path / 'mmap_ckpt.safetensors'
+    tensors = {
+        'a': torch.randn(3, 5),
+        'b': torch.randn(7).to(torch.bfloat16),
+        'c': torch.arange(6, dtype=torch.int64).reshape(2, 3),
+        'd': torch.tensor([True, False, True]),
+        'e': torch.randn(1).half(),
+        'f': torch.randn(256, 128),
+    }
+    safetensors.torch.save_file(tensors, checkpoint_path)
+
+    loaded = load_safetensors(checkpoint_path, mmap=True)
+    assert loaded.keys() == tensors.keys()
+    for k, v in tensors.items():
+        assert loaded[k].dtype == v.dtype
+        assert torch.equal(loaded[k], v)
+
+    # each tensor has its own storage, a retained tensor doesn't pin (or save) the whole file
+    assert all(t.untyped_storage().nbytes() == t.numel() * t.element_size() for t in loaded.values())
+
+    # mapping is copy-on-write, the file is not modified
+    loaded['a'].zero_()
+    loaded['f'].zero_()
+    reloaded = load_safetensors(checkpoint_path, mmap=True)
+    assert torch.equal(reloaded['a'], tensors['a']) and torch.equal(reloaded['f'], tensors['f'])
+
+
+@pytest.mark.skipif(not _HAS_SAFETENSORS, reason='requires safetensors')
+@pytest.mark.parametrize('model_name', ['vit_tiny_patch16_224', 'levit_128s'])
+@pytest.mark.parametrize('ext', ['.safetensors', '.pth'])
+def test_pretrained_meta_init(tmp_path, model_name, ext):
+    torch.manual_seed(0)
+    model = timm.create_model(model_name).eval()
+    checkpoint_path = str(tmp_path / f'weights{ext}')
+    state_dict = {k: v.contiguous() for k, v in model.state_dict().items()}
+    if ext == '.safetensors':
+        safetensors.torch.save_file(state_dict, checkpoint_path)
+    else:
+        torch.save(state_dict, checkpoint_path)
+    overlay = dict(file=checkpoint_path, custom_load=False)
+
+    meta_model = timm.create_model(model_name, pretrained=True, meta_init=True, pretrained_cfg_overlay=overlay)
+    meta_model.eval()
+    for t in list(meta_model.parameters()) + list(meta_model.buffers()):
+        assert not t.is_meta
+    x = torch.randn(2, *model.pretrained_cfg['input_size'])
+    with torch.no_grad():
+        assert torch.equal(meta_model(x), model(x))
+
+    # classifier not in checkpoint for different num_classes, initialized on materialization
+    meta_model = timm.create_model(
+        model_name, pretrained=True, meta_init=True, num_classes=10, pretrained_cfg_overlay=overlay)
+    for t in list(meta_model.parameters()) + list(meta_model.buffers()):
+        assert not t.is_meta
+    assert meta_model(x).shape == (2, 10)
+
+
+@pytest.mark.skipif(not _HAS_SAFETENSORS, reason='requires safetensors')
+def test_pretrained_cache_converted(tmp_path, monkeypatch):
+    monkeypatch.setattr(timm.models._builder, '_CACHE_CONVERTED', True)
+    torch.manual_seed(0)
+    model = timm.create_model('deit_tiny_patch16_224')
+    checkpoint_path = tmp_path / 'weights.pth'
+    torch.save({'model': model.state_dict()}, checkpoint_path)  # unwrapped + pos embed resampled by filter fn
+    overlay = dict(file=str(checkpoint_path))
+    cache_dir = tmp_path / 'cache'
+    converted_dir = cache_dir / 'converted'
+    x = torch.randn(1, 3, 160, 160)
+
+    def _create(**kwargs):
+        m = timm.create_model(
+            'deit_tiny_patch16_224', pretrained=True, img_size=160, pretrained_cfg_overlay=overlay,
+            cache_dir=cache_dir, **kwargs)
+        with torch.no_grad():
+            return m.eval()(x)
+
+    out = _create()
+    converted = list(converted_dir.iterdir())
+    assert len(converted) == 1
+    mtime = converted[0].stat().st_mtime_ns
+
+    # later loads use the converted weights
+    assert torch.equal(_create(), out)
+    assert torch.equal(_create(meta_init=True), out)
+    assert list(converted_dir.iterdir()) == converted
+    assert converted[0].stat().st_mtime_ns == mtime
+
+    # different model config is a new entry
+    _create(num_classes=10)
+    assert len(list(converted_dir.iterdir())) == 2
+
+    # local dir source is keyed on the weight file inside it, updated weights are a new entry
+    weights_dir = tmp_path / 'local'
+    weights_dir.mkdir()
+    torch.save({'model': model.state_dict()}, weights_dir / 'pytorch_model.bin')
+    overlay = dict(source='local-dir', file=str(weights_dir))
+    torch.testing.assert_close(_create(), out)
+    assert len(list(converted_dir.iterdir())) == 3
+    with torch.no_grad():
+        model.head.bias.add_(1.)
+    torch.save({'model': model.state_dict()}, weights_dir / 'pytorch_model.bin')
+    assert not torch.allclose(_create(), out)
+    assert len(list(converted_dir.iterdir())) == 4
+
+
+@pytest.mark.skipif(not _HAS_SAFETENSORS, reason='requires safetensors')
+@pytest.mark.parametrize('model_name', ['vit_tiny_patch16_224', 'eva02_tiny_patch14_224', 'convnext_atto'])
+def test_stream_blocks(tmp_path, model_name):
+    torch.manual_seed(0)
+    model = timm.create_model(model_name).eval()
+    checkpoint_path = str(tmp_path / 'weights.safetensors')
+    safetensors.torch.save_file({k: v.contiguous() for k, v in model.state_dict().items()}, checkpoint_path)
+    overlay = dict(file=checkpoint_path, custom_load=False)
+    x = torch.randn(2, *model.pretrained_cfg['input_size'])
+
+    streamed = timm.create_model(model_name, pretrained=True, stream_blocks=True, pretrained_cfg_overlay=overlay)
+    streamed.eval()
+    blocks = streamed.blocks if hasattr(streamed, 'blocks') else streamed.stages
+    assert isinstance(blocks, timm.models.StreamingSequential)
+    assert all(p.is_meta for n, p in streamed.named_parameters() if n.startswith(('blocks.', 'stages.')))
+    assert streamed.state_dict().keys() == model.state_dict().keys()
+    # block attributes are reachable through the streamed block callables
+    if hasattr(model, 'blocks'):
+        assert all(blk.attn is blk.module.attn for blk in blocks)
+    with torch.no_grad():
+        expected = model(x)
+        assert torch.equal(streamed(x), expected)
+        assert torch.equal(streamed(x), expected)
+        for a, b in zip(
+                model.forward_intermediates(x, indices=2, intermediates_only=True),
+                streamed.forward_intermediates(x, indices=2, intermediates_only=True),
+        ):
+            assert torch.equal(a, b)
+
+    # streaming an existing meta model from a checkpoint
+    meta_model = timm.models.stream_blocks(timm.create_model(model_name, device='meta'), checkpoint_path)
+    with torch.no_grad():
+        assert torch.equal(meta_model.eval()(x), expected)
+
+
+@pytest.mark.skipif(not _HAS_SAFETENSORS, reason='requires safetensors')
+def test_avg_checkpoints_safetensors_writer(tmp_path):
+    import avg_checkpoints
+    torch.manual_seed(0)
+    tensors = {
+        'a.weight': torch.randn(3, 5),
+        'b.half': torch.randn(7).half(),
+        'c.bf16': torch.randn(2, 2, 3).bfloat16(),
+        'd.index': torch.arange(9).reshape(3, 3),
+        'e.scalar': torch.tensor(1.5),
+    }
+    output = str(tmp_path / 'written.safetensors')
+    writer = avg_checkpoints.SafetensorsWriter(output, {k: (v.shape, v.dtype) for k, v in tensors.items()})
+    for k in reversed(list(tensors)):
+        writer.write(k, tensors[k])
+    writer.close()
+    for loaded in (safetensors.torch.load_file(output), load_state_dict(output)):
+        assert loaded.keys() == tensors.keys()
+        for k, v in tensors.items():
+            assert loaded[k].dtype == v.dtype and torch.equal(loaded[k], v)
+
+
+@pytest.mark.skipif(not _HAS_SAFETENSORS, reason='requires safetensors')
+@pytest.mark.parametrize('avg_args,weights', [
+    ([], [1., 1., 1.]),
+    (['--weights', '1,2,5'], [1., 2., 5.]),
+    (['--ema-decay', '0.5'], [0.25, 0.5, 1.]),
+])
+def test_avg_checkpoints(tmp_path, monkeypatch, avg_args, weights):
+    import sys
+    import avg_checkpoints
+    torch.manual_seed(0)
+    state_dicts = []
+    for epoch in range(3):
+        state_dict = {'w': torch.randn(4, 6), 'b': torch.randn(6).half()}
+        # metric increases w/ epoch, so the metric sorted selection is in epoch order
+        torch.save({'state_dict': state_dict, 'epoch': epoch, 'metric': float(epoch)}, tmp_path / f'ckpt-{epoch}.pth')
+        state_dicts.append(state_dict)
+    output = str(tmp_path / 'averaged.safetensors')
+    monkeypatch.setattr(sys, 'argv', [
+        'avg_checkpoints.py', '--input', str(tmp_path), '--filter', '*.pth', '--output', output,
+        '--safetensors', '-j', '2'] + avg_args)
+    avg_checkpoints.main()
+    assert not (tmp_path / 'averaged.safetensors.tmp').exists()
+
+    for loaded in (safetensors.torch.load_file(output), load_state_dict(output)):
+        assert loaded.keys() == {'w', 'b'}
+        for k in ('w', 'b'):
+            expected = sum(sd[k].double() * w for sd, w in zip(state_dicts, weights)) / sum(weights)
+            assert loaded[k].dtype == torch.float32
+            torch.testing.assert_close(loaded[k], expected.float())
@@ -3,6 +3,9 @@ import torch
 import torch.nn as nn
 
 from timm.layers import create_act_layer, set_layer_config, get_act_layer, get_act_fn, Attention2d, MultiQueryAttentionV2
+from timm.layers import RelPosBias, RelPosMlp, PosEmbedCache, RotaryEmbeddingCat, shifted_window_mask
+from timm.layers import Attention, local_attention, local_attn_mask
+from timm.layers import Preprocess
 
 import importlib
 import os
@@ -158,3 +161,249 @@ def test_attn2d(bias, expand_first, head_first, attn_mask):
     o2 = attn(x, mask)
     
     assert torch.allclose(o1, o2, atol=1e-5), f"{torch.abs(o1 - o2).max()}"
+
+
+@pytest.mark.parametrize("rel_pos_cls", [RelPosBias, RelPosMlp])
+def test_rel_pos_bias_cache(rel_pos_cls):
+    rel_pos = rel_pos_cls(window_size=(7, 7), num_heads=4)
+    rel_pos.eval()
+    with torch.no_grad():
+        b1 = rel_pos.get_bias()
+        b2 = rel_pos.get_bias()
+    assert b1 is b2  # cached in eval
+
+    # param update must invalidate the cached bias
+    with torch.no_grad():
+        for p in rel_pos.parameters():
+            p.add_(1.0)
+        b3 = rel_pos.get_bias()
+    assert b3 is not b1
+    assert not torch.equal(b1, b3)
+
+    # no caching when grads are needed or in train mode
+    assert rel_pos.get_bias().requires_grad
+    rel_pos.train()
+    assert rel_pos.get_bias() is not rel_pos.get_bias()
+    assert not rel_pos.bias_cache._entries
+
+
+def test_pos_embed_cache_lru():
+    cache = PosEmbedCache(max_size=2)
+    src = nn.Parameter(torch.ones(4))
+    calls = []
+
+    def _fn(k):
+        calls.append(k)
+        return src * k
+
+    with torch.no_grad():
+        for k in (1, 2, 1, 3, 1):
+            cache(lambda: _fn(k), (src,), key=(k,))
+        assert calls == [1, 2, 3]  # 2 evicted as least recently used
+        assert len(cache) == 2
+
+        # in-place weight update invalidates
+        src.mul_(2.)
+        assert torch.equal(cache(lambda: _fn(1), (src,), key=(1,)), src)
+        assert calls == [1, 2, 3, 1]
+
+    # bypassed when grads are needed
+    assert cache(lambda: _fn(1), (src,), key=(1,)).requires_grad
+    assert calls == [1, 2, 3, 1, 1]
+
+    # bounded by bytes, the most recent entry is always kept
+    cache = PosEmbedCache(max_size=None, max_bytes=64)
+    with torch.no_grad():
+        for n in (8, 8, 32):
+            cache(lambda: torch.zeros(n), (src,), key=(n, len(cache)))
+    assert len(cache) == 1
+
+
+def test_rope_embed_cache():
+    rope = RotaryEmbeddingCat(dim=32, in_pixels=False)
+    e1 = rope.get_embed((7, 9))
+    assert e1 is rope.get_embed((7, 9))
+    assert e1 is not rope.get_embed((9, 7))
+    batch = rope.get_batch_embeds([(7, 9), (5, 3)])
+    torch.testing.assert_close(batch[1], rope.get_embed((5, 3)))
+
+
+@pytest.mark.parametrize("feat_size,window_size,shift_size", [
+    ((14, 14), (7, 7), (3, 3)),
+    ((16, 12), (8, 6), (4, 3)),
+    ((14, 7), (7, 7), (3, 0)),
+])
+def test_shifted_window_mask(feat_size, window_size, shift_size):
+    # reference, region fill as in original Swin impl
+    H, W = feat_size
+    img_mask = torch.zeros((H, W))
+    cnt = 0
+    for h in ((0, -window_size[0]), (-window_size[0], -shift_size[0]), (-shift_size[0], None)):
+        for w in ((0, -window_size[1]), (-window_size[1], -shift_size[1]), (-shift_size[1], None)):
+            img_mask[h[0]:h[1], w[0]:w[1]] = cnt
+            cnt += 1
+    img_mask = img_mask.reshape(H // window_size[0], window_size[0], W // window_size[1], window_size[1])
+    mask_windows = img_mask.permute(0, 2, 1, 3).reshape(-1, window_size[0] * window_size[1])
+    expected = (mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)) == 0
+
+    mask = shifted_window_mask(feat_size, window_size, shift_size)
+    assert mask.dtype == torch.bool
+    assert torch.equal(mask, expected)
+
+
+def _small_swin(model_name, **kwargs):
+    from timm.models import SwinTransformer, SwinTransformerV2, SwinTransformerV2Cr
+    model_cls = dict(swin=SwinTransformer, swinv2=SwinTransformerV2, swinv2_cr=SwinTransformerV2Cr)[model_name]
+    img_size = (64, 64) if model_name == 'swinv2_cr' else 64
+    return model_cls(
+        img_size=img_size, embed_dim=16, depths=(2, 2), num_heads=(2, 2), window_size=4, num_classes=4, **kwargs)
+
+
+@pytest.mark.parametrize('model_name', ['swin', 'swinv2', 'swinv2_cr'])
+def test_swin_bool_attn_mask(model_name):
+    torch.manual_seed(0)
+    model = _small_swin(model_name).eval()
+    bool_model = _small_swin(model_name, bool_attn_mask=True).eval()
+    bool_model.load_state_dict(model.state_dict())
+    shifted = [m for m in bool_model.modules() if getattr(m, 'attn_mask', None) is not None]
+    assert shifted and all(m.attn_mask.dtype == torch.bool for m in shifted)
+
+    x = torch.randn(2, 3, 64, 64)
+    with torch.no_grad():
+        # -inf vs -100 masking, exp(-100) is negligible next to the unmasked logits
+        torch.testing.assert_close(bool_model(x), model(x), rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('model_name', ['swin', 'swinv2', 'swinv2_cr'])
+@pytest.mark.parametrize('bool_attn_mask', [False, True])
+def test_swin_dynamic_mask_cache(model_name, bool_attn_mask):
+    torch.manual_seed(0)
+    model = _small_swin(model_name, strict_img_size=False, bool_attn_mask=bool_attn_mask).eval()
+    blocks = [m for m in model.modules() if hasattr(m, 'mask_cache') and any(m.shift_size)]
+    assert blocks
+    num_built = []
+    for blk in blocks:
+        blk.get_attn_mask = lambda *args, _fn=blk.get_attn_mask, **kwargs: num_built.append(1) or _fn(*args, **kwargs)
+
+    inputs = [torch.randn(1, 3, 64, 64), torch.randn(1, 3, 32, 96)]
+    with torch.no_grad():
+        outputs = [model(x) for x in inputs + inputs]  # alternating sizes
+        assert len(num_built) == 2 * len(blocks)  # one mask per block per size, then cache hits
+        assert all(len(blk.mask_cache) == 2 for blk in blocks)
+
+        # reference w/ freshly built masks (and combined bias + mask)
+        for m in model.modules():
+            for cache in ('mask_cache', 'mask_bias_cache'):
+                if hasattr(m, cache):
+                    getattr(m, cache).clear()
+        for x, out, cached_out in zip(inputs, outputs[:2], outputs[2:]):
+            expected = model(x)
+            torch.testing.assert_close(out, expected)
+            torch.testing.assert_close(cached_out, expected)
+
+
+@pytest.mark.parametrize("mode", ['window', 'neighborhood'])
+@pytest.mark.parametrize("feat_size,window_size", [((8, 8), (4, 4)), ((7, 10), (3, 5)), ((5, 3), (7, 7))])
+@pytest.mark.parametrize("num_prefix_tokens,global_prefix", [(0, True), (1, True), (3, False)])
+@pytest.mark.parametrize("fused", [True, False])
+def test_local_attention(mode, feat_size, window_size, num_prefix_tokens, global_prefix, fused):
+    torch.manual_seed(0)
+    N = num_prefix_tokens + feat_size[0] * feat_size[1]
+    q, k, v = [torch.randn(2, 3, N, 8) for _ in range(3)]
+    out = local_attention(
+        q, k, v, feat_size, window_size,
+        mode=mode,
+        num_prefix_tokens=num_prefix_tokens,
+        global_prefix=global_prefix,
+        fused=fused,
+    )
+    mask = local_attn_mask(feat_size, window_size, mode, num_prefix_tokens, global_prefix)
+    expected = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+    torch.testing.assert_close(out, expected, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("mode", ['window', 'neighborhood'])
+def test_attention_set_local_attn(mode):
+    attn = Attention(32, num_heads=4).eval()
+    x = torch.randn(2, 1 + 6 * 9, 32)
+    mask = local_attn_mask((6, 9), (3, 3), mode, num_prefix_tokens=1)
+    with torch.no_grad():
+        expected = attn(x, attn_mask=mask)
+        attn.set_local_attn(3, mode=mode, feat_size=(6, 9), num_prefix_tokens=1)
+        out = attn(x)
+        torch.testing.assert_close(out, expected, rtol=1e-5, atol=1e-5)
+        attn.set_local_attn(None)
+        assert not torch.allclose(attn(x), out)
+
+
+def test_attention_local_attn_feat_size_kwarg():
+    attn = Attention(32, num_heads=4).eval()
+    attn.set_local_attn(3, feat_size=(6, 9), num_prefix_tokens=1)
+    x = torch.randn(2, 1 + 9 * 6, 32)
+    mask = local_attn_mask((9, 6), (3, 3), 'window', num_prefix_tokens=1)
+    with torch.no_grad():
+        out = attn(x, feat_size=(9, 6))
+        attn.set_local_attn(None)
+        expected = attn(x, attn_mask=mask)
+    torch.testing.assert_close(out, expected, rtol=1e-5, atol=1e-5)
+
+
+def test_vit_dynamic_local_attn_no_module_state():
+    from timm.models import VisionTransformer
+    model = VisionTransformer(
+        img_size=64, patch_size=16, embed_dim=32, depth=2, num_heads=2,
+        dynamic_img_size=True, local_attn_window=2).eval()
+    attn = model.blocks[0].attn
+    with torch.no_grad():
+        out = model.forward_features(torch.randn(1, 3, 64, 96))
+    assert out.shape[1] == 4 * 6 + 1
+    assert attn.local_feat_size == (4, 4)
+
+
+@pytest.mark.parametrize('resize_mode', ['center', 'squash', 'border', None])
+def test_preprocess(resize_mode):
+    mean, std = (0.5, 0.4, 0.3), (0.2, 0.25, 0.3)
+    pp = Preprocess(img_size=32, mean=mean, std=std, crop_pct=0.8, resize_mode=resize_mode)
+    in_size = (32, 32) if resize_mode is None else (40, 60)
+    x = torch.randint(0, 256, (2,) + in_size + (3,), dtype=torch.uint8)
+    out = pp(x)
+    assert out.shape == (2, 3, 32, 32) and out.dtype == torch.float32
+
+    expected = x.permute(0, 3, 1, 2).float()
+    if resize_mode == 'center':
+        # shortest edge to 32 / 0.8 = 40, center crop 32 of (40, 60)
+        expected = expected[..., 4:36, 14:46]
+    elif resize_mode == 'squash':
+        expected = torch.nn.functional.interpolate(expected, size=(40, 40), mode='bilinear', antialias=True)
+        expected = expected[..., 4:36, 4:36]
+    elif resize_mode == 'border':
+        # longest edge to 40 -> (27, 40), pad height to 32 w/ the uint8 mean color, center crop width 32
+        resized = torch.nn.functional.interpolate(expected, size=(27, 40), mode='bilinear', antialias=True)
+        expected = torch.tensor([round(255 * m) for m in mean]).float().view(1, 3, 1, 1).repeat(2, 1, 32, 40)
+        expected[..., 2:29, :] = resized
+        expected = expected[..., 4:36]
+    expected = (expected / 255. - torch.tensor(mean).view(1, 3, 1, 1)) / torch.tensor(std).view(1, 3, 1, 1)
+    torch.testing.assert_close(out, expected, rtol=1e-4, atol=1e-4)
+
+
+def test_create_model_preprocess():
+    import timm
+    from timm.data import resolve_data_config, create_transform
+    model = timm.create_model('resnet18', num_classes=4).eval()
+    pp_model = timm.create_model('resnet18', num_classes=4, preprocess=True).eval()
+    pp_model.load_state_dict(model.state_dict())  # state_dict keys unchanged
+
+    data_config = resolve_data_config(model=model)
+    h, w = 240, 320
+    yy, xx = torch.meshgrid(torch.arange(h), torch.arange(w), indexing='ij')
+    img = torch.stack([xx * 255 // w, yy * 255 // h, (xx + yy) * 255 // (h + w)], -1).to(torch.uint8)
+    from PIL import Image
+    ref_input = create_transform(**data_config)(Image.fromarray(img.numpy())).unsqueeze(0)
+    pp_input = pp_model.input_preprocess(img.unsqueeze(0))
+    # PIL resizes w/ its own bicubic kernel and rounds to uint8, allow 3 uint8 levels (in normalized units)
+    atol = 3. / (255. * min(data_config['std']))
+    torch.testing.assert_close(pp_input, ref_input, rtol=0, atol=atol)
+    with torch.no_grad():
+        torch.testing.assert_close(pp_model(img.unsqueeze(0)), model(pp_input))
+        traced = torch.jit.trace(pp_model, img.unsqueeze(0))
+        torch.testing.assert_close(traced(img.unsqueeze(0)), pp_model(img.unsqueeze(0)))
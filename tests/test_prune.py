@@ -0,0 +1,46 @@
+import pytest
+import torch
+
+import timm
+from timm.models import prune_model, model_to_string, adapt_model_from_string
+
+
+def test_prune_model_dead_channels():
+    # channels with zero BN gamma/beta carry no signal, pruning them must not change the output
+    torch.manual_seed(0)
+    model = timm.create_model('resnet18').eval()
+    for name, m in model.named_modules():
+        if isinstance(m, torch.nn.BatchNorm2d):
+            torch.nn.init.ones_(m.weight)
+            if name.startswith('layer') and name.endswith('bn1'):
+                m.weight.data[::2] = 0
+                m.bias.data[::2] = 0
+    x = torch.randn(2, 3, 64, 64)
+    pruned, model_string = prune_model(model, target=0.8, importance='bn', example_input=x)
+    assert 32 <= pruned.layer1[0].conv1.out_channels < 64
+    assert pruned.layer1[0].conv2.in_channels == pruned.layer1[0].conv1.out_channels
+    assert torch.allclose(pruned(x), model(x), atol=1e-5)
+    assert model_string == model_to_string(pruned)
+
+
+def test_prune_model_residual_and_groups():
+    model = timm.create_model('resnext26ts').eval()
+    x = torch.randn(1, 3, 64, 64)
+    pruned, model_string = prune_model(model, target=0.6, importance='l1', example_input=x)
+    conv2 = pruned.stages[0][0].conv2_kxk.conv
+    assert conv2.groups == model.stages[0][0].conv2_kxk.conv.groups
+    assert conv2.out_channels % conv2.groups == 0
+    assert pruned(x).shape == model(x).shape
+
+    rebuilt = adapt_model_from_string(model, model_string)
+    rebuilt.load_state_dict(pruned.state_dict())
+    assert torch.allclose(rebuilt(x), pruned(x))
+
+
+def test_prune_model_restores_model_on_error():
+    model = timm.create_model('resnet18').train()
+    x = torch.randn(1, 3, 64, 64)
+    with pytest.raises(AssertionError):
+        prune_model(model, importance='taylor', example_input=x)  # taylor importance needs a loader
+    assert model.training
+    assert all(m.training for m in model.modules())
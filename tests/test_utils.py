@@ -1,3 +1,5 @@
+import os
+
 from torch.nn.modules.batchnorm import BatchNorm2d
 from torchvision.ops.misc import FrozenBatchNorm2d
 
@@ -198,3 +200,347 @@ def test_freeze_unfreeze_string_input():
     _freeze_unfreeze(model, 'layer1', mode='unfreeze')
     assert model.layer1[0].conv1.weight.requires_grad == True
 
+
+def test_compile_regions():
+    import torch
+    from timm.utils import compile_regions
+    model = timm.create_model('vit_tiny_patch16_224', img_size=32, patch_size=8, depth=3).eval()
+    x = torch.randn(2, 3, 32, 32)
+    with torch.no_grad():
+        expected = model(x)
+    compiled = compile_regions(model, backend='eager')
+    assert compiled == ['blocks.0', 'blocks.1', 'blocks.2']
+    assert list(model.state_dict().keys())[0] == 'cls_token'
+    with torch.no_grad():
+        torch.testing.assert_close(model(x), expected)
+
+    model = timm.create_model('resnet18')
+    compiled = compile_regions(model, backend='eager')
+    assert compiled == [f'layer{i}.{j}' for i in range(1, 5) for j in range(2)]
+
+
+@pytest.mark.parametrize('mode', ['eager', 'torchscript'])
+def test_shape_bucket_model(mode):
+    import torch
+    from timm.utils import ShapeBucketModel
+    model = timm.create_model('resnet18', num_classes=10).eval()
+    x = torch.randn(5, 3, 32, 32)
+    with torch.no_grad():
+        expected = model(x)
+    bucketed = ShapeBucketModel(model, batch_sizes=(2, 4), mode=mode)
+    bucketed.warmup(img_size=32)
+    with torch.inference_mode():
+        # 5 -> split into 4 + 1 (padded to 2)
+        torch.testing.assert_close(bucketed(x), expected, rtol=1e-4, atol=1e-4)
+    stats = {s['bucket']: s for s in bucketed.stats()}
+    assert stats['4']['calls'] == 1 and stats['2']['calls'] == 1
+    assert stats['2']['pad_samples'] == 1
+
+    # w/o spatial buckets, another input size isn't run on a graph traced at the warmup size
+    x = torch.randn(4, 3, 48, 40)
+    with torch.no_grad():
+        torch.testing.assert_close(bucketed(x), model(x), rtol=1e-4, atol=1e-4)
+    if mode == 'torchscript':
+        assert (4, 3, 48, 40) in bucketed._runners
+
+    # spatial buckets, feature maps cropped back
+    model = timm.create_model('resnet18', features_only=True, out_indices=(3,)).eval()
+    bucketed = ShapeBucketModel(model, batch_sizes=(4,), img_sizes=(64, 96), mode=mode)
+    with torch.no_grad():
+        assert bucketed(torch.randn(3, 3, 50, 70))[0].shape == (3, 256, 4, 5)
+
+
+def test_create_exported_model(tmp_path):
+    import os
+    import torch
+    from timm.utils import create_exported_model
+    kwargs = dict(input_size=(3, 32, 32), export_format='export', cache_dir=str(tmp_path), num_classes=10)
+    exported = create_exported_model('resnet18', **kwargs)
+    assert exported.num_classes == 10
+    assert tuple(exported.pretrained_cfg['input_size']) == (3, 32, 32)
+    mtime = os.stat(exported.path).st_mtime_ns
+    x = torch.randn(3, 3, 32, 32)
+    with torch.no_grad():
+        out = exported(x)
+    assert out.shape == (3, 10)
+
+    # cache hit, same artifact and outputs
+    cached = create_exported_model('resnet18', **kwargs)
+    assert cached.path == exported.path and os.stat(cached.path).st_mtime_ns == mtime
+    with torch.no_grad():
+        torch.testing.assert_close(cached(x), out)
+
+    # example batch size is not part of a dynamic batch spec
+    assert create_exported_model('resnet18', batch_size=4, **kwargs).path == exported.path
+
+    # different spec, different artifact
+    assert create_exported_model('resnet18', reparam=True, **kwargs).path != exported.path
+
+
+def test_onnx_runtime_model():
+    pytest.importorskip('onnxruntime')
+    pytest.importorskip('onnx')
+    import torch
+    from timm.utils.onnx import create_onnx_runtime_model
+    model = timm.create_model('resnet18', num_classes=10, exportable=True).eval()
+    x = torch.randn(3, 3, 32, 32)
+    with torch.no_grad():
+        expected = model(x)
+    for io_binding in (True, False):
+        ort_model = create_onnx_runtime_model(model, input_size=(3, 32, 32), io_binding=io_binding)
+        for _ in range(2):  # 2nd call uses the preallocated outputs
+            torch.testing.assert_close(ort_model(x), expected, rtol=1e-4, atol=1e-4)
+        # dynamic batch
+        torch.testing.assert_close(ort_model(x[:1]), expected[:1], rtol=1e-4, atol=1e-4)
+
+
+def test_profile_model(tmp_path):
+    import csv
+    import json
+    import torch
+    from torch.utils.flop_counter import FlopCounterMode
+    from timm.utils import profile_model
+    model = timm.create_model('resnet18', num_classes=10)
+    profile = profile_model(model, input_size=(3, 32, 32), batch_size=2, num_iter=1, num_warmup=0)
+    assert [r.name for r in profile.rows][:4] == ['conv1', 'bn1', 'act1', 'maxpool']
+    assert 'layer1.0' in [r.name for r in profile.rows]
+    assert all(r.fwd_ms > 0 and r.calls == 1 for r in profile.rows)
+    assert profile.total.bwd_ms > 0 and profile.total.act_bytes > 0
+    assert profile.total.params == sum(p.numel() for p in model.parameters())
+
+    # per-row flops add up to the total, which matches the torch flop counter
+    with FlopCounterMode(display=False) as counter:
+        model(torch.randn(2, 3, 32, 32)).sum().backward()
+    total = profile.total
+    assert total.fwd_flops + total.bwd_flops == counter.get_total_flops()
+    assert sum(r.fwd_flops for r in profile.rows) == total.fwd_flops
+    assert sum(r.bwd_flops for r in profile.rows) == total.bwd_flops
+
+    stage_rows = [r.name for r in profile_model(model, input_size=(3, 32, 32), batch_size=2, granularity='stage').rows]
+    assert stage_rows[4:8] == ['layer1', 'layer2', 'layer3', 'layer4']
+
+    profile.to_csv(str(tmp_path / 'profile.csv'))
+    profile.to_json(str(tmp_path / 'profile.json'))
+    profile.to_chrome_trace(str(tmp_path / 'trace.json'))
+    with open(tmp_path / 'profile.csv') as f:
+        assert len(list(csv.DictReader(f))) == len(profile.rows) + 1
+    with open(tmp_path / 'profile.json') as f:
+        assert json.load(f)['total']['fwd_flops'] == total.fwd_flops
+    with open(tmp_path / 'trace.json') as f:
+        events = [e for e in json.load(f)['traceEvents'] if e['ph'] == 'X']
+    assert {e['tid'] for e in events} == {0, 1}
+
+
+def test_estimate_model_stats():
+    import torch
+    from torch.utils.flop_counter import FlopCounterMode
+    from timm.utils import estimate_model_stats
+    stats = estimate_model_stats('resnet18', input_size=(3, 64, 64), batch_size=2, per_layer=True, num_classes=10)
+    model = timm.create_model('resnet18', num_classes=10).eval()
+    with torch.no_grad(), FlopCounterMode(display=False) as counter:
+        model(torch.randn(2, 3, 64, 64))
+    assert stats.flops == counter.get_total_flops()
+    assert stats.macs == stats.flops // 2
+    assert stats.params == sum(p.numel() for p in model.parameters())
+    assert stats.acts > 0 and stats.act_bytes > 0
+    layers = {l.name: l for l in stats.layers}
+    assert layers['conv1'].output_shape == (2, 64, 32, 32)
+    assert layers['conv1'].act_bytes == 2 * 64 * 32 * 32 * 4
+    assert sum(l.macs for l in stats.layers) == stats.macs
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/clear_refs'), reason='host peak memory is measured via procfs')
+def test_estimate_batch_size():
+    from timm.utils import estimate_batch_size
+    model = timm.create_model('resnet18', num_classes=10)
+    kwargs = dict(input_size=(3, 64, 64), memory_budget=256 * 2**20, trial_batch_sizes=(2, 8))
+    batch_size = estimate_batch_size(model, **kwargs)
+    assert 1 <= batch_size <= 4096
+    assert batch_size < 8 or batch_size % 8 == 0
+    assert model.training  # mode restored
+    assert estimate_batch_size(model, max_batch_size=4, **kwargs) <= 4
+    assert estimate_batch_size(model, training=True, **kwargs) >= 1
+    assert all(p.grad is None for p in model.parameters())
+
+
+def test_step_telemetry(tmp_path):
+    import json
+    import time
+    import torch
+    from timm.utils import StepTelemetry
+    trace_file = str(tmp_path / 'trace.jsonl')
+    telemetry = StepTelemetry(torch.device('cpu'), trace_file=trace_file)
+    for step in range(3):
+        telemetry.start()
+        telemetry.mark('data', host=True)
+        telemetry.mark('forward')
+        telemetry.mark('forward')  # repeated phases accumulate
+        telemetry.end(step=step)
+    phase_ms = telemetry.flush()
+    assert list(phase_ms.keys()) == ['data', 'forward', 'total']
+    assert telemetry.flush() == {}
+    with open(trace_file) as f:
+        lines = [json.loads(l) for l in f]
+    assert [l['step'] for l in lines] == [0, 1, 2]
+    assert all(l['total_ms'] >= l['forward_ms'] >= 0 for l in lines)
+
+    # total is the wall time of the step, incl. time after the last marked phase
+    telemetry.start()
+    telemetry.mark('data', host=True)
+    time.sleep(0.05)
+    telemetry.end(step=3)
+    phase_ms = telemetry.flush()
+    assert phase_ms['total'] >= 50 > phase_ms['data']
+
+    disabled = StepTelemetry(torch.device('cpu'), enabled=False)
+    disabled.start()
+    disabled.mark('data')
+    disabled.end(step=0)
+    assert disabled.flush() == {}
+
+
+def test_profiler_capture(tmp_path):
+    import json
+    import torch
+    from timm.utils import ProfilerCapture
+    model = timm.create_model('resnet18', num_classes=10).eval()
+    capture = ProfilerCapture(
+        str(tmp_path), prefix='eval', wait=1, warmup=1, active=2, repeat=1, profile_memory=True, model=model)
+    with capture, torch.no_grad():
+        for _ in range(5):
+            model(torch.randn(2, 3, 32, 32))
+            capture.step()
+    assert capture.done
+    assert not model._forward_hooks and not model.layer1[0]._forward_pre_hooks
+    files = os.listdir(tmp_path)
+    assert any(f.startswith('eval-trace-') for f in files)
+    assert any(f.startswith('eval-ops-') for f in files)
+    module_memory = [f for f in files if f.startswith('eval-module-memory-')]
+    if module_memory:
+        with open(tmp_path / module_memory[0]) as f:
+            assert 'layer1.0' in json.load(f)
+
+    # repeat=0 captures until stopped, a restart continues the step count
+    capture = ProfilerCapture(str(tmp_path / 'repeat'), prefix='train', wait=0, warmup=1, active=1, repeat=0)
+    with torch.no_grad():
+        for _ in range(2):
+            capture.start()
+            for _ in range(4):
+                model(torch.randn(2, 3, 32, 32))
+                capture.step()
+            capture.stop()
+    assert not capture.done and capture.num_captured == 4
+    assert len([f for f in os.listdir(tmp_path / 'repeat') if f.startswith('train-trace-')]) == 4
+
+
+def test_checkpoint_saver_async(tmp_path):
+    import torch
+    from timm.utils import CheckpointSaver
+    model = torch.nn.Linear(4, 2)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
+    saver = CheckpointSaver(model, optimizer, checkpoint_dir=str(tmp_path), recovery_dir=str(tmp_path),
+                            max_history=2, async_save=True)
+    expected = model.weight.detach().clone()
+    saver.save_checkpoint(0, metric=1.)
+    with torch.no_grad():
+        model.weight.add_(1.)  # modified while the save may still be in flight
+    assert saver.save_checkpoint(1, metric=3.) == (3., 1)
+    assert saver.save_checkpoint(2, metric=2.) == (3., 1)
+    saver.save_recovery(2, batch_idx=5)
+    saver.close()
+
+    files = sorted(os.listdir(tmp_path))
+    assert files == [
+        'checkpoint-1.pth.tar', 'checkpoint-2.pth.tar', 'last.pth.tar', 'model_best.pth.tar',
+        'recovery-2-5.pth.tar']
+    checkpoint = torch.load(tmp_path / 'checkpoint-1.pth.tar', weights_only=False)
+    torch.testing.assert_close(checkpoint['state_dict']['weight'], expected + 1.)
+    assert checkpoint['metric'] == 3.
+    assert torch.load(tmp_path / 'model_best.pth.tar', weights_only=False)['epoch'] == 1
+    assert saver.find_recovery().endswith('recovery-2-5.pth.tar')
+    assert not saver._buffers
+
+    # tied weights keep sharing a storage in the snapshot
+    tied = torch.nn.Sequential(torch.nn.Embedding(8, 4), torch.nn.Linear(4, 8, bias=False))
+    tied[1].weight = tied[0].weight
+    saver = CheckpointSaver(tied, torch.optim.SGD(tied.parameters(), lr=0.1), checkpoint_dir=str(tmp_path / 'tied'),
+                            recovery_dir=str(tmp_path / 'tied'), async_save=True)
+    snapshot = saver._snapshot(saver._get_state(0))['state_dict']
+    assert snapshot['0.weight'].untyped_storage().data_ptr() == snapshot['1.weight'].untyped_storage().data_ptr()
+    torch.testing.assert_close(snapshot['1.weight'], tied[1].weight.detach())
+
+    # a failed write doesn't update the top-n list / best metric
+    def _fail(*args):
+        raise OSError('disk full')
+    saver._write = _fail
+    saver.save_checkpoint(0, metric=1.)
+    with pytest.raises(OSError):
+        saver.wait()
+    assert saver.checkpoint_files == [] and saver.best_metric is None
+    saver.close()
+
+
+def _sharded_checkpoint_worker(rank, world_size, root):
+    import torch
+    import torch.distributed as dist
+    from timm.utils import CheckpointSaver, load_sharded_checkpoint
+    dist.init_process_group('gloo', init_method=f'file://{root}/init', rank=rank, world_size=world_size)
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.Linear(16, 4))
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
+    model(torch.randn(2, 8)).sum().backward()
+    optimizer.step()
+    saver = CheckpointSaver(
+        model, optimizer, checkpoint_dir=root, recovery_dir=root,
+        sharded=True, rank=rank, world_size=world_size, rank_state_fn=lambda: {'rank': rank}, run_id='run')
+    saver.save_checkpoint(0, metric=1.)
+    saver.close()
+    dist.barrier()
+
+    checkpoint, rank_state = load_sharded_checkpoint(os.path.join(root, 'last'))
+    assert rank_state == {'rank': rank}
+    assert checkpoint['epoch'] == 0 and checkpoint['metric'] == 1.
+    for k, v in model.state_dict().items():
+        torch.testing.assert_close(checkpoint['state_dict'][k], v)
+    restored = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
+    restored.load_state_dict(checkpoint['optimizer'])
+    for k, v in optimizer.state_dict()['state'].items():
+        torch.testing.assert_close(restored.state_dict()['state'][k]['momentum_buffer'], v['momentum_buffer'])
+    dist.destroy_process_group()
+
+
+def test_sharded_checkpoint(tmp_path):
+    import torch
+    import torch.multiprocessing as mp
+    from timm.utils import consolidate_sharded_checkpoint
+    if not torch.distributed.is_available():
+        pytest.skip('torch.distributed not available')
+    mp.spawn(_sharded_checkpoint_worker, args=(2, str(tmp_path)), nprocs=2)
+
+    assert sorted(os.listdir(tmp_path / 'last')) == [
+        'common.pth', 'manifest.json', 'shard-00000-of-00002.done', 'shard-00000-of-00002.pth',
+        'shard-00001-of-00002.done', 'shard-00001-of-00002.pth']
+    assert os.path.isdir(tmp_path / 'checkpoint-0') and os.path.isdir(tmp_path / 'model_best')
+    state = consolidate_sharded_checkpoint(str(tmp_path / 'last'), str(tmp_path / 'last.pth.tar'))
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.Linear(16, 4))
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
+    model(torch.randn(2, 8)).sum().backward()
+    optimizer.step()
+    checkpoint = torch.load(tmp_path / 'last.pth.tar', weights_only=False)
+    for k, v in model.state_dict().items():
+        torch.testing.assert_close(checkpoint['state_dict'][k], v)
+    assert state['optimizer']['param_groups'] == optimizer.state_dict()['param_groups']
+
+
+def test_sharded_checkpoint_stale_shards(tmp_path):
+    import torch
+    from timm.utils.sharded_checkpoint import save_sharded_checkpoint, wait_for_shards
+    state = {'state_dict': {'w': torch.ones(4)}, 'epoch': 0}
+    # shards of an earlier (interrupted) run left in the dir
+    for rank in range(2):
+        save_sharded_checkpoint(state, str(tmp_path), rank=rank, world_size=2, save_id='old-1')
+    save_sharded_checkpoint(state, str(tmp_path), rank=0, world_size=2, save_id='new-1')
+    assert not wait_for_shards(str(tmp_path), 2, save_id='new-1', timeout=0.2)
+    save_sharded_checkpoint(state, str(tmp_path), rank=1, world_size=2, save_id='new-1')
+    assert wait_for_shards(str(tmp_path), 2, save_id='new-1', timeout=0.2)
@@ -15,7 +15,16 @@ from .adaptive_avgmax_pool import (
     AdaptiveAvgMaxPool2d,
     SelectAdaptivePool2d,
 )
-from .attention import Attention, AttentionRope, maybe_add_mask, resolve_self_attn_mask
+from .attention import (
+    Attention,
+    AttentionRope,
+    LocalAttnMixin,
+    local_attention,
+    local_attn_mask,
+    maybe_add_mask,
+    resolve_self_attn_mask,
+    shifted_window_mask,
+)
 from .attention2d import MultiQueryAttention2d, Attention2d, MultiQueryAttentionV2
 from .attention_pool import AttentionPoolLatent, AttentionPoolPrr
 from .attention_pool2d import AttentionPool2d, RotAttentionPool2d
@@ -110,11 +119,12 @@ from .patch_embed import PatchEmbed, PatchEmbedWithSize, PatchEmbedInterpolator,
 from .pool1d import global_pool_nlc
 from .other_pool import LsePlus2d, LsePlus1d, SimPool2d, SimPool1d
 from .pool2d_same import AvgPool2dSame, create_pool2d
-from .pos_embed import resample_abs_pos_embed, resample_abs_pos_embed_nhwc
+from .pos_embed import PosEmbedCache, resample_abs_pos_embed, resample_abs_pos_embed_nhwc
 from .pos_embed_rel import (
     RelPosMlp,
     RelPosBias,
     RelPosBiasTf,
+    RelPosBiasCache,
     gen_relative_position_index,
     gen_relative_log_coords,
     resize_rel_pos_bias_table,
@@ -140,6 +150,7 @@ from .pos_embed_sincos import (
     get_mixed_freqs,
     create_rope_embed,
 )
+from .preprocess import Preprocess, create_preprocess, attach_preprocess
 from .squeeze_excite import SEModule, SqueezeExcite, EffectiveSEModule, EffectiveSqueezeExcite
 from .selective_kernel import SelectiveKernel
 from .separable_conv import SeparableConv2d, SeparableConvNormAct
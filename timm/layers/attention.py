@@ -1,4 +1,5 @@
-from typing import Final, Optional, Type
+import math
+from typing import Final, Optional, Tuple, Type, Union
 
 import torch
 from torch import nn as nn
@@ -6,10 +7,14 @@ from torch.nn import functional as F
 
 from ._fx import register_notrace_function
 from .config import use_fused_attn
+from .helpers import to_2tuple
 from .pos_embed_sincos import apply_rot_embed_cat
 
 
-__all__ = ['Attention', 'AttentionRope', 'maybe_add_mask', 'resolve_self_attn_mask']
+__all__ = [
+    'Attention', 'AttentionRope', 'LocalAttnMixin', 'maybe_add_mask', 'resolve_self_attn_mask',
+    'shifted_window_mask', 'local_attention', 'local_attn_mask',
+]
 
 
 @torch.fx.wrap
@@ -40,7 +45,327 @@ def resolve_self_attn_mask(
     return attn_bias
 
 
-class Attention(nn.Module):
+def _window_region_ids(size: int, window: int, shift: int, device: Optional[torch.device] = None) -> torch.Tensor:
+    # region index along one axis of a cyclically shifted feature map, equivalent to filling the
+    # slices (0, -window), (-window, -shift), (-shift, None) with 0, 1, 2
+    idx = torch.arange(size, device=device)
+    if shift == 0:
+        return torch.zeros_like(idx)
+    return (idx >= size - window).long() + (idx >= size - shift).long()
+
+
+def shifted_window_mask(
+        feat_size: Tuple[int, int],
+        window_size: Tuple[int, int],
+        shift_size: Tuple[int, int],
+        device: Optional[torch.device] = None,
+) -> torch.Tensor:
+    """Boolean attention mask for shifted window (Swin style) attention.
+
+    Tokens may attend to each other only if they came from the same region of the un-shifted
+    feature map. Built with vectorized comparisons instead of a per-region fill loop.
+
+    Args:
+        feat_size: Feature map (H, W), padded up to a multiple of window_size if needed.
+        window_size: Window (h, w).
+        shift_size: Cyclic shift (h, w).
+        device: Output device.
+
+    Returns:
+        Mask of shape (num_windows, window_area, window_area), True where attention is allowed.
+    """
+    win_h, win_w = window_size
+    H = math.ceil(feat_size[0] / win_h) * win_h
+    W = math.ceil(feat_size[1] / win_w) * win_w
+    ids_h = _window_region_ids(H, win_h, shift_size[0], device=device)
+    ids_w = _window_region_ids(W, win_w, shift_size[1], device=device)
+    region = ids_h[:, None] * 3 + ids_w[None, :]  # H, W
+    region = region.reshape(H // win_h, win_h, W // win_w, win_w).permute(0, 2, 1, 3).reshape(-1, win_h * win_w)
+    return region.unsqueeze(1) == region.unsqueeze(2)
+
+
+def local_attn_mask(
+        feat_size: Tuple[int, int],
+        window_size: Tuple[int, int],
+        mode: str = 'window',
+        num_prefix_tokens: int = 0,
+        global_prefix: bool = True,
+        device: Optional[torch.device] = None,
+) -> torch.Tensor:
+    """Dense boolean mask (True = attend) equivalent to `local_attention`.
+
+    Args:
+        feat_size: Patch grid (H, W).
+        window_size: Local window (h, w).
+        mode: 'window' for non-overlapping windows, 'neighborhood' for a sliding window centered on each query.
+        num_prefix_tokens: Number of cls / reg tokens preceding the patch tokens.
+        global_prefix: Prefix tokens attend to, and are attended by, all tokens.
+        device: Output device.
+
+    Returns:
+        Mask of shape (N, N) where N = num_prefix_tokens + H * W.
+    """
+    H, W = feat_size
+    win_h, win_w = window_size
+    ys = torch.arange(H, device=device).repeat_interleave(W)
+    xs = torch.arange(W, device=device).repeat(H)
+    if mode == 'window':
+        patch_mask = ((ys[:, None] // win_h) == (ys[None, :] // win_h)) & ((xs[:, None] // win_w) == (xs[None, :] // win_w))
+    else:
+        assert mode == 'neighborhood', f'Unknown local attention mode {mode}'
+        dy = ys[None, :] - ys[:, None]
+        dx = xs[None, :] - xs[:, None]
+        rh, rw = win_h // 2, win_w // 2
+        patch_mask = (dy >= -rh) & (dy < win_h - rh) & (dx >= -rw) & (dx < win_w - rw)
+    P = num_prefix_tokens
+    N = P + H * W
+    mask = torch.zeros((N, N), dtype=torch.bool, device=device)
+    mask[P:, P:] = patch_mask
+    if global_prefix:
+        mask[:P, :] = True
+        mask[:, :P] = True
+    else:
+        mask[:P, :P] = True
+    return mask
+
+
+def _masked_attn(
+        q: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        attn_mask: Optional[torch.Tensor] = None,
+        dropout_p: float = 0.,
+        fused: bool = True,
+) -> torch.Tensor:
+    if fused:
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+    attn = (q * q.shape[-1] ** -0.5) @ k.transpose(-2, -1)
+    if attn_mask is not None:
+        attn = attn.masked_fill(~attn_mask, float('-inf'))
+    attn = attn.softmax(dim=-1)
+    if dropout_p > 0.:
+        attn = F.dropout(attn, p=dropout_p)
+    return attn @ v
+
+
+def _grid_tiles(
+        x: torch.Tensor,
+        tile_size: Tuple[int, int],
+        kernel_size: Tuple[int, int],
+        pad: Tuple[int, int, int, int],
+) -> torch.Tensor:
+    # (..., H, W, D) grid -> (..., nTh, nTw, kh * kw, D) tiles of kernel_size taken with stride tile_size
+    x = F.pad(x, (0, 0) + pad)
+    x = x.unfold(-3, kernel_size[0], tile_size[0]).unfold(-3, kernel_size[1], tile_size[1])
+    x = x.flatten(-2).transpose(-2, -1)  # ..., nTh, nTw, kh * kw, D
+    return x
+
+
+def _seq_to_tiles(
+        x: torch.Tensor,
+        num_prefix_tokens: int,
+        feat_size: Tuple[int, int],
+        tile_size: Tuple[int, int],
+        kernel_size: Tuple[int, int],
+        pad: Tuple[int, int, int, int],
+) -> torch.Tensor:
+    # (B, num_heads, P + H * W, D) -> (B * num_tiles, num_heads, kh * kw, D)
+    B, num_heads, _, D = x.shape
+    x = x[:, :, num_prefix_tokens:].reshape(B, num_heads, feat_size[0], feat_size[1], D)
+    x = _grid_tiles(x, tile_size, kernel_size, pad)  # B, num_heads, nTh, nTw, kh * kw, D
+    return x.permute(0, 2, 3, 1, 4, 5).reshape(-1, num_heads, kernel_size[0] * kernel_size[1], D)
+
+
+def _resolve_local_feat_size(
+        seq_len: int,
+        num_prefix_tokens: int,
+        feat_size: Optional[Tuple[int, int]] = None,
+) -> Tuple[int, int]:
+    num_patches = seq_len - num_prefix_tokens
+    if feat_size is not None and feat_size[0] * feat_size[1] == num_patches:
+        return feat_size
+    # fallback for changed input size, assume square grid
+    side = int(math.sqrt(num_patches))
+    assert side * side == num_patches, \
+        f'Cannot infer local attention grid for {num_patches} tokens, set feat_size via set_local_attn()'
+    return side, side
+
+
+def local_attention(
+        q: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        feat_size: Tuple[int, int],
+        window_size: Tuple[int, int],
+        mode: str = 'window',
+        num_prefix_tokens: int = 0,
+        global_prefix: bool = True,
+        dropout_p: float = 0.,
+        fused: bool = True,
+) -> torch.Tensor:
+    """Local 2D self-attention over a patch grid w/ optional global prefix tokens.
+
+    The grid is split into tiles of window_size. In 'window' mode each tile attends within itself
+    (block-sparse, non-overlapping windows). In 'neighborhood' mode the keys for a tile are taken from a
+    halo around it and masked so each query attends to the window_size neighborhood centered on it
+    (clipped at the borders). Each tile is one batch entry of a single SDPA call, so cost scales
+    with N * window area instead of N^2. Result matches dense attention w/ `local_attn_mask`.
+
+    Args:
+        q: Query (B, num_heads, N, head_dim), N = num_prefix_tokens + H * W.
+        k: Key (B, num_heads, N, head_dim).
+        v: Value (B, num_heads, N, head_dim).
+        feat_size: Patch grid (H, W).
+        window_size: Local window (h, w).
+        mode: One of 'window', 'neighborhood'.
+        num_prefix_tokens: Number of cls / reg tokens preceding the patch tokens.
+        global_prefix: Prefix tokens attend to, and are attended by, all tokens. Otherwise prefix tokens
+            only attend to each other.
+        dropout_p: Attention dropout.
+        fused: Use F.scaled_dot_product_attention.
+
+    Returns:
+        Attention output (B, num_heads, N, head_dim).
+    """
+    B, num_heads, N, D = q.shape
+    P = num_prefix_tokens
+    H, W = feat_size
+    win_h, win_w = window_size
+    assert N == P + H * W, f'Sequence length {N} does not match grid {feat_size} + {P} prefix tokens'
+
+    nTh = (H + win_h - 1) // win_h
+    nTw = (W + win_w - 1) // win_w
+    pad_h, pad_w = nTh * win_h - H, nTw * win_w - W
+    if mode == 'window':
+        kernel = (win_h, win_w)
+        k_pad = (0, pad_w, 0, pad_h)
+    else:
+        assert mode == 'neighborhood', f'Unknown local attention mode {mode}'
+        rh, rw = win_h // 2, win_w // 2
+        kernel = (2 * win_h - 1, 2 * win_w - 1)
+        k_pad = (rw, pad_w + win_w - 1 - rw, rh, pad_h + win_h - 1 - rh)
+    num_tiles = nTh * nTw
+    q_area = win_h * win_w
+    k_area = kernel[0] * kernel[1]
+
+    # tile queries, keys, values -> (B * num_tiles, num_heads, area, D)
+    q_tiles = _seq_to_tiles(q, P, feat_size, window_size, window_size, (0, pad_w, 0, pad_h))
+    k_tiles = _seq_to_tiles(k, P, feat_size, window_size, kernel, k_pad)
+    v_tiles = _seq_to_tiles(v, P, feat_size, window_size, kernel, k_pad)
+
+    # masking for padding and (neighborhood) relative offsets, shared across batch & heads
+    tile_mask: Optional[torch.Tensor] = None
+    if mode != 'window' or pad_h or pad_w:
+        valid = torch.ones((H, W, 1), dtype=q.dtype, device=q.device)
+        q_valid = _grid_tiles(valid, window_size, window_size, (0, pad_w, 0, pad_h)).reshape(num_tiles, q_area) > 0
+        k_valid = _grid_tiles(valid, window_size, kernel, k_pad).reshape(num_tiles, k_area) > 0
+        tile_mask = k_valid.unsqueeze(1).expand(-1, q_area, -1)
+        if mode != 'window':
+            qy = torch.arange(win_h, device=q.device).repeat_interleave(win_w)
+            qx = torch.arange(win_w, device=q.device).repeat(win_h)
+            ky = torch.arange(kernel[0], device=q.device).repeat_interleave(kernel[1])
+            kx = torch.arange(kernel[1], device=q.device).repeat(kernel[0])
+            dy = ky[None, :] - qy[:, None]
+            dx = kx[None, :] - qx[:, None]
+            rel_mask = (dy >= 0) & (dy < win_h) & (dx >= 0) & (dx < win_w)  # q_area, k_area
+            tile_mask = tile_mask & rel_mask.unsqueeze(0)
+        # queries in padding are discarded, let them attend to anything to avoid fully masked rows
+        tile_mask = tile_mask | ~q_valid.unsqueeze(-1)
+
+    if P and global_prefix:
+        k_prefix = k[:, :, :P].unsqueeze(1).expand(-1, num_tiles, -1, -1, -1).reshape(B * num_tiles, num_heads, P, D)
+        v_prefix = v[:, :, :P].unsqueeze(1).expand(-1, num_tiles, -1, -1, -1).reshape(B * num_tiles, num_heads, P, D)
+        k_tiles = torch.cat([k_prefix, k_tiles], dim=2)
+        v_tiles = torch.cat([v_prefix, v_tiles], dim=2)
+        if tile_mask is not None:
+            tile_mask = F.pad(tile_mask, (P, 0), value=True)
+
+    if tile_mask is not None:
+        tile_mask = tile_mask.unsqueeze(1).unsqueeze(0).expand(B, -1, -1, -1, -1)
+        tile_mask = tile_mask.reshape(B * num_tiles, 1, q_area, -1)
+
+    x = _masked_attn(q_tiles, k_tiles, v_tiles, tile_mask, dropout_p=dropout_p, fused=fused)
+
+    # merge tiles -> B, num_heads, H * W, D
+    x = x.reshape(B, nTh, nTw, num_heads, win_h, win_w, D).permute(0, 3, 1, 4, 2, 5, 6)
+    x = x.reshape(B, num_heads, nTh * win_h, nTw * win_w, D)[:, :, :H, :W].reshape(B, num_heads, H * W, D)
+
+    if P:
+        if global_prefix:
+            x_prefix = _masked_attn(q[:, :, :P], k, v, dropout_p=dropout_p, fused=fused)
+        else:
+            x_prefix = _masked_attn(q[:, :, :P], k[:, :, :P], v[:, :, :P], dropout_p=dropout_p, fused=fused)
+        x = torch.cat([x_prefix, x], dim=2)
+    return x
+
+
+class LocalAttnMixin:
+    """ Local (windowed / neighborhood) attention config for attention modules w/ (B, heads, N, D) q / k / v.
+
+    The module calls `_init_local_attn()` in `__init__` and `_local_attn()` in `forward` when
+    `local_window_size` is set. No parameters are added, weights trained w/ global attention are used as is.
+    """
+
+    def _init_local_attn(self) -> None:
+        # disabled by default, see set_local_attn()
+        self.local_window_size: Optional[Tuple[int, int]] = None
+        self.local_mode = 'window'
+        self.local_feat_size: Optional[Tuple[int, int]] = None
+        self.local_num_prefix_tokens = 0
+        self.local_global_prefix = True
+
+    def set_local_attn(
+            self,
+            window_size: Optional[Union[int, Tuple[int, int]]],
+            mode: str = 'window',
+            feat_size: Optional[Tuple[int, int]] = None,
+            num_prefix_tokens: Optional[int] = None,
+            global_prefix: bool = True,
+    ) -> None:
+        """Enable (or disable w/ window_size=None) local attention over the patch grid.
+
+        Args:
+            window_size: Local window size, None for global attention.
+            mode: 'window' (non-overlapping windows) or 'neighborhood' (sliding window centered on each query).
+            feat_size: Patch grid size, a square grid is assumed if not set or not matching the sequence length.
+            num_prefix_tokens: Number of cls / reg tokens preceding the patch tokens, for modules that don't
+                define `num_prefix_tokens` themselves.
+            global_prefix: Prefix tokens attend globally and are visible to all patch tokens.
+        """
+        assert mode in ('window', 'neighborhood'), f'Unknown local attention mode {mode}'
+        self.local_window_size = None if window_size is None else to_2tuple(window_size)
+        self.local_mode = mode
+        self.local_feat_size = None if feat_size is None else tuple(feat_size)
+        if num_prefix_tokens is not None:
+            self.local_num_prefix_tokens = num_prefix_tokens
+        self.local_global_prefix = global_prefix
+
+    def _local_attn(
+            self,
+            q: torch.Tensor,
+            k: torch.Tensor,
+            v: torch.Tensor,
+            num_prefix_tokens: int,
+            dropout_p: float = 0.,
+            fused: bool = True,
+            feat_size: Optional[Tuple[int, int]] = None,
+    ) -> torch.Tensor:
+        assert self.local_window_size is not None
+        if feat_size is None:
+            feat_size = self.local_feat_size
+        return local_attention(
+            q, k, v,
+            feat_size=_resolve_local_feat_size(q.shape[2], num_prefix_tokens, feat_size),
+            window_size=self.local_window_size,
+            mode=self.local_mode,
+            num_prefix_tokens=num_prefix_tokens,
+            global_prefix=self.local_global_prefix,
+            dropout_p=dropout_p,
+            fused=fused,
+        )
+
+
+class Attention(nn.Module, LocalAttnMixin):
     """Standard Multi-head Self Attention module with QKV projection.
 
     This module implements the standard multi-head attention mechanism used in transformers.
@@ -108,11 +433,14 @@ class Attention(nn.Module):
         self.proj = nn.Linear(self.attn_dim, dim_out, bias=proj_bias, **dd)
         self.proj_drop = nn.Dropout(proj_drop)
 
+        self._init_local_attn()
+
     def forward(
             self,
             x: torch.Tensor,
             attn_mask: Optional[torch.Tensor] = None,
             is_causal: bool = False,
+            feat_size: Optional[Tuple[int, int]] = None,
     ) -> torch.Tensor:
         B, N, C = x.shape
         gate = self.gate(x).sigmoid() if self.gate is not None else None
@@ -120,7 +448,16 @@ class Attention(nn.Module):
         q, k, v = qkv.unbind(0)
         q, k = self.q_norm(q), self.k_norm(k)
 
-        if self.fused_attn:
+        if self.local_window_size is not None:
+            assert attn_mask is None and not is_causal, 'attn_mask and is_causal not supported w/ local attention'
+            x = self._local_attn(
+                q, k, v,
+                num_prefix_tokens=self.local_num_prefix_tokens,
+                dropout_p=self.attn_drop.p if self.training else 0.,
+                fused=self.fused_attn,
+                feat_size=feat_size,
+            )
+        elif self.fused_attn:
             x = F.scaled_dot_product_attention(
                 q, k, v,
                 attn_mask=attn_mask,
@@ -145,7 +482,7 @@ class Attention(nn.Module):
         return x
 
 
-class AttentionRope(nn.Module):
+class AttentionRope(nn.Module, LocalAttnMixin):
     """ A Self Attention module with ROPE support.
 
     Includes options for:
@@ -229,12 +566,15 @@ class AttentionRope(nn.Module):
         self.proj = nn.Linear(self.attn_dim, dim_out, bias=proj_bias, **dd)
         self.proj_drop = nn.Dropout(proj_drop)
 
+        self._init_local_attn()
+
     def forward(
             self,
             x,
             rope: Optional[torch.Tensor] = None,
             attn_mask: Optional[torch.Tensor] = None,
             is_causal: bool = False,
+            feat_size: Optional[Tuple[int, int]] = None,
     ):
         """Forward pass for the attention module.
 
@@ -243,6 +583,7 @@ class AttentionRope(nn.Module):
             rope: Rotary position embeddings tensor for position-aware attention
             attn_mask: Optional attention mask to apply during attention computation
             is_causal: If True, use causal (autoregressive) masking
+            feat_size: Patch grid (H, W) for local attention, overrides the grid set via set_local_attn()
 
         Returns:
             Tensor of shape (batch_size, sequence_length, dim_out)
@@ -267,7 +608,16 @@ class AttentionRope(nn.Module):
             q = torch.cat([q[:, :, :npt, :], apply_rot_embed_cat(q[:, :, npt:, :], rope, half=half)], dim=2).type_as(v)
             k = torch.cat([k[:, :, :npt, :], apply_rot_embed_cat(k[:, :, npt:, :], rope, half=half)], dim=2).type_as(v)
 
-        if self.fused_attn:
+        if self.local_window_size is not None:
+            assert attn_mask is None and not is_causal, 'attn_mask and is_causal not supported w/ local attention'
+            x = self._local_attn(
+                q, k, v,
+                num_prefix_tokens=self.num_prefix_tokens,
+                dropout_p=self.attn_drop.p if self.training else 0.,
+                fused=self.fused_attn,
+                feat_size=feat_size,
+            )
+        elif self.fused_attn:
             x = F.scaled_dot_product_attention(
                 q, k, v,
                 attn_mask=attn_mask,
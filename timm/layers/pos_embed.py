@@ -4,7 +4,9 @@ Hacked together by / Copyright 2022 Ross Wightman
 """
 import logging
 import math
-from typing import List, Tuple, Optional, Union
+import os
+from collections import OrderedDict
+from typing import Callable, List, Tuple, Optional, Sequence, Union
 
 import torch
 import torch.nn.functional as F
@@ -13,6 +15,117 @@ from ._fx import register_notrace_function
 
 _logger = logging.getLogger(__name__)
 
+_USE_POS_EMBED_CACHE = int(os.environ.get('TIMM_POS_EMBED_CACHE', 1)) > 0
+
+
+def _is_tracing_or_compiling() -> bool:
+    if torch.jit.is_tracing():
+        return True
+    if hasattr(torch, 'compiler') and hasattr(torch.compiler, 'is_compiling') and torch.compiler.is_compiling():
+        return True
+    fx_trace = torch.fx._symbolic_trace
+    is_fx_tracing = getattr(fx_trace, 'is_fx_symbolic_tracing', getattr(fx_trace, 'is_fx_tracing', None))
+    return is_fx_tracing is not None and is_fx_tracing()
+
+
+def _autocast_key(device_type: str):
+    try:
+        if torch.is_autocast_enabled(device_type):
+            return torch.get_autocast_dtype(device_type)
+        return None
+    except (TypeError, AttributeError):
+        return torch.is_autocast_enabled()  # older PyTorch
+
+
+class PosEmbedCache:
+    """ Bounded LRU cache of position embeddings derived from module weights.
+
+    Used for values that are a pure function of a few source tensors and a target shape, ie absolute
+    pos embeds resampled to a dynamic grid size or rotary sin/cos tables built for a feature shape.
+    Entries are keyed by (key, device, dtype, autocast dtype) and recomputed if any source tensor is
+    modified in-place (optimizer step, load_state_dict) or replaced (.to()). The cache is bypassed while
+    tracing, scripting, compiling or when gradients are required for the sources.
+
+    Disable globally with TIMM_POS_EMBED_CACHE=0.
+    """
+
+    def __init__(
+            self,
+            max_size: Optional[int] = 8,
+            enabled: Optional[bool] = None,
+            max_bytes: Optional[int] = None,
+    ):
+        """
+        Args:
+            max_size: Max number of entries, least recently used are evicted first. Unbounded if None.
+            enabled: Enable the cache, defaults to TIMM_POS_EMBED_CACHE env setting.
+            max_bytes: Max total size of the cached tensors, least recently used are evicted first (the most
+                recent entry is always kept). Unbounded if None.
+        """
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.enabled = _USE_POS_EMBED_CACHE if enabled is None else enabled
+        self._entries: 'OrderedDict[Tuple, Tuple[Tuple, torch.Tensor]]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self) -> None:
+        self._entries = OrderedDict()
+
+    def _nbytes(self) -> int:
+        return sum(v.numel() * v.element_size() for _, v in self._entries.values() if v is not None)
+
+    def _lookup(
+            self,
+            fn: Callable[[], torch.Tensor],
+            sources: Sequence[torch.Tensor],
+            key: Tuple = (),
+    ) -> torch.Tensor:
+        if not self.enabled or _is_tracing_or_compiling():
+            return fn()
+        if torch.is_grad_enabled() and any(t.requires_grad for t in sources):
+            return fn()
+        if sources and sources[0].is_meta:
+            return fn()  # no data to cache (shape propagation, ie FLOP estimation)
+
+        if sources:
+            device = sources[0].device
+            full_key = tuple(key) + (device, sources[0].dtype, _autocast_key(device.type))
+        else:
+            full_key = tuple(key)  # values not derived from weights, key must fully describe them
+        versions = tuple((t.data_ptr(), t._version) for t in sources)
+        entry = self._entries.get(full_key, None)
+        if entry is None or entry[0] != versions:
+            with torch.no_grad():
+                entry = (versions, fn())
+            self._entries[full_key] = entry
+            self._entries.move_to_end(full_key)
+            if self.max_size is not None and len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            if self.max_bytes is not None:
+                while len(self._entries) > 1 and self._nbytes() > self.max_bytes:
+                    self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(full_key)
+        return entry[1]
+
+    def __call__(
+            self,
+            fn: Callable[[], torch.Tensor],
+            sources: Sequence[torch.Tensor],
+            key: Tuple = (),
+    ) -> torch.Tensor:
+        """Return the cached result of `fn()` or compute and cache it.
+
+        Args:
+            fn: Computes the embedding from the sources.
+            sources: Parameters and buffers the embedding is computed from, the first sets device and dtype.
+                May be empty if key fully determines the result.
+            key: Extra key items, ie target grid shape.
+        """
+        return self._lookup(fn, sources, key)
+
 
 @torch.fx.wrap
 @register_notrace_function
@@ -4,7 +4,7 @@ Hacked together by / Copyright 2022 Ross Wightman
 """
 import math
 import os
-from typing import Optional, Tuple
+from typing import Callable, Optional, Sequence, Tuple
 
 import torch
 import torch.nn as nn
@@ -13,9 +13,48 @@ import torch.nn.functional as F
 from .grid import ndgrid
 from .interpolate import RegularGridInterpolator
 from .mlp import Mlp
+from .pos_embed import PosEmbedCache
 from .weight_init import trunc_normal_
 
 _USE_SCIPY = int(os.environ.get('TIMM_USE_SCIPY_INTERP', 0)) > 0
+_USE_BIAS_CACHE = int(os.environ.get('TIMM_REL_POS_BIAS_CACHE', 1)) > 0
+
+
+class RelPosBiasCache(PosEmbedCache):
+    """ Eval mode cache of materialized relative position bias tensors.
+
+    Generalizes the LeViT attention bias cache. Gathering (or running an MLP over) a bias table is
+    done once per (window size, device, dtype) while the owning module is in eval mode. Entries are
+    dropped when the module runs in train mode and recomputed if any source tensor is modified in-place
+    (optimizer step, load_state_dict) or replaced (set_window_size, .to()). The cache is bypassed while
+    tracing, scripting, compiling or when gradients are required for the sources.
+
+    Disable globally with TIMM_REL_POS_BIAS_CACHE=0.
+    """
+
+    def __init__(self, max_size: Optional[int] = None, max_bytes: Optional[int] = None):
+        super().__init__(max_size=max_size, enabled=_USE_BIAS_CACHE, max_bytes=max_bytes)
+
+    def __call__(
+            self,
+            module: nn.Module,
+            fn: Callable[[], torch.Tensor],
+            sources: Sequence[torch.Tensor],
+            key: Tuple = (),
+    ) -> torch.Tensor:
+        """Return the cached result of `fn()` or compute and cache it.
+
+        Args:
+            module: Owning module, its training flag controls cache use.
+            fn: Computes the bias tensor from the sources.
+            sources: Parameters and buffers the bias is computed from.
+            key: Extra key items, ie window size.
+        """
+        if module.training:
+            if self._entries:
+                self.clear()
+            return fn()
+        return self._lookup(fn, sources, key)
 
 
 def gen_relative_position_index(
@@ -298,6 +337,7 @@ class RelPosBias(nn.Module):
             torch.empty(index_size, device=device, dtype=torch.long),
             persistent=False,
         )
+        self.bias_cache = RelPosBiasCache()
 
         # TODO: skip init when on meta device when safe to do so
         self.reset_parameters()
@@ -317,12 +357,26 @@ class RelPosBias(nn.Module):
             ).view(-1)
         )
 
-    def get_bias(self) -> torch.Tensor:
+    def _calc_bias(self) -> torch.Tensor:
         relative_position_bias = self.relative_position_bias_table[self.relative_position_index]
         # win_h * win_w, win_h * win_w, num_heads
         relative_position_bias = relative_position_bias.view(self.bias_shape).permute(2, 0, 1)
         return relative_position_bias.unsqueeze(0).contiguous()
 
+    @torch.jit.unused
+    def _cached_bias(self) -> torch.Tensor:
+        return self.bias_cache(
+            self,
+            self._calc_bias,
+            (self.relative_position_bias_table, self.relative_position_index),
+            key=self.window_size,
+        )
+
+    def get_bias(self) -> torch.Tensor:
+        if torch.jit.is_scripting():
+            return self._calc_bias()
+        return self._cached_bias()
+
     def forward(self, attn, shared_rel_pos: Optional[torch.Tensor] = None):
         return attn + self.get_bias()
 
@@ -419,11 +473,12 @@ class RelPosMlp(nn.Module):
             torch.empty(rel_coords_shape, **dd),
             persistent=False,
         )
+        self.bias_cache = RelPosBiasCache()
 
         # TODO: skip init when on meta device when safe to do so
         self.reset_parameters()
 
-    def get_bias(self) -> torch.Tensor:
+    def _calc_bias(self) -> torch.Tensor:
         relative_position_bias = self.mlp(self.rel_coords_log)
         if self.relative_position_index is not None:
             relative_position_bias = relative_position_bias.view(-1, self.num_heads)[self.relative_position_index]
@@ -436,6 +491,16 @@ class RelPosMlp(nn.Module):
             relative_position_bias = F.pad(relative_position_bias, [self.prefix_tokens, 0, self.prefix_tokens, 0])
         return relative_position_bias.unsqueeze(0).contiguous()
 
+    @torch.jit.unused
+    def _cached_bias(self) -> torch.Tensor:
+        sources = tuple(self.mlp.parameters()) + (self.rel_coords_log, self.relative_position_index)
+        return self.bias_cache(self, self._calc_bias, sources, key=self.window_size)
+
+    def get_bias(self) -> torch.Tensor:
+        if torch.jit.is_scripting():
+            return self._calc_bias()
+        return self._cached_bias()
+
     def forward(self, attn, shared_rel_pos: Optional[torch.Tensor] = None):
         return attn + self.get_bias()
 
@@ -553,6 +618,7 @@ class RelPosBiasTf(nn.Module):
         width_lookup_shape = (window_size[1], window_size[1], vocab_width)
         self.register_buffer('height_lookup', torch.empty(height_lookup_shape, **dd), persistent=False)
         self.register_buffer('width_lookup', torch.empty(width_lookup_shape, **dd), persistent=False)
+        self.bias_cache = RelPosBiasCache()
 
         # TODO: skip init when on meta device when safe to do so
         self.reset_parameters()
@@ -569,7 +635,7 @@ class RelPosBiasTf(nn.Module):
         self.height_lookup.copy_(generate_lookup_tensor(self.window_size[0], device=device, dtype=dtype))
         self.width_lookup.copy_(generate_lookup_tensor(self.window_size[1], device=device, dtype=dtype))
 
-    def get_bias(self) -> torch.Tensor:
+    def _calc_bias(self) -> torch.Tensor:
         # FIXME change to not use one-hot/einsum?
         return reindex_2d_einsum_lookup(
             self.relative_position_bias_table,
@@ -579,6 +645,16 @@ class RelPosBiasTf(nn.Module):
             self.width_lookup
         )
 
+    @torch.jit.unused
+    def _cached_bias(self) -> torch.Tensor:
+        sources = (self.relative_position_bias_table, self.height_lookup, self.width_lookup)
+        return self.bias_cache(self, self._calc_bias, sources, key=self.window_size)
+
+    def get_bias(self) -> torch.Tensor:
+        if torch.jit.is_scripting():
+            return self._calc_bias()
+        return self._cached_bias()
+
     def forward(self, attn, shared_rel_pos: Optional[torch.Tensor] = None):
         return attn + self.get_bias()
 
@@ -10,6 +10,7 @@ from torch import nn as nn
 
 from ._fx import register_notrace_function
 from .grid import ndgrid
+from .pos_embed import PosEmbedCache
 from .trace_utils import _assert
 
 def pixel_freq_bands(
@@ -580,6 +581,8 @@ class RotaryEmbeddingCat(nn.Module):
                 num_pos *= s
             emb_shape = (num_pos, dim * 2)  # concatenated sin & cos
             self.register_buffer('pos_embed', torch.empty(emb_shape, device=device, dtype=dtype), persistent=False)
+        # bands mode embeddings for recently used shapes
+        self.embed_cache = PosEmbedCache()
 
         # TODO: skip init when on meta device when safe to do so
         self.reset_parameters()
@@ -642,18 +645,28 @@ class RotaryEmbeddingCat(nn.Module):
             )
             self.feat_shape = feat_shape
 
+    def _calc_embed(self, shape: List[int]) -> torch.Tensor:
+        assert self.bands is not None
+        embeds = build_rotary_pos_embed(
+            shape,
+            self.bands,
+            in_pixels=self.in_pixels,
+            ref_feat_shape=self.ref_feat_shape,
+            grid_offset=self.grid_offset,
+            grid_indexing=self.grid_indexing,
+        )
+        return torch.cat(embeds, -1)
+
+    @torch.jit.unused
+    def _cached_embed(self, shape: List[int]) -> torch.Tensor:
+        return self.embed_cache(lambda: self._calc_embed(shape), (self.bands,), key=tuple(shape))
+
     def get_embed(self, shape: Optional[List[int]] = None):
         if shape is not None and self.bands is not None:
-            # rebuild embeddings from cached bands every call, use if target shape changes
-            embeds = build_rotary_pos_embed(
-                shape,
-                self.bands,
-                in_pixels=self.in_pixels,
-                ref_feat_shape=self.ref_feat_shape,
-                grid_offset=self.grid_offset,
-                grid_indexing=self.grid_indexing,
-            )
-            return torch.cat(embeds, -1)
+            # build embeddings from cached bands, use if target shape changes
+            if torch.jit.is_scripting():
+                return self._calc_embed(shape)
+            return self._cached_embed(shape)
         elif self.pos_embed is not None:
             return self.pos_embed
         else:
@@ -688,22 +701,12 @@ class RotaryEmbeddingCat(nn.Module):
         max_h = max(h for h, w in shapes)
         max_w = max(w for h, w in shapes)
 
-        # Generate embeddings for max size ONCE
-        sin_emb, cos_emb = build_rotary_pos_embed(
-            feat_shape=(max_h, max_w),
-            bands=self.bands,
-            in_pixels=self.in_pixels,
-            ref_feat_shape=self.ref_feat_shape,
-            grid_offset=self.grid_offset,
-            grid_indexing=self.grid_indexing,
-        )
-
-        # sin_emb and cos_emb are (max_h * max_w, dim//2)
-        # concat and reshape to 2D for slicing
-        rope_embed_2d = torch.cat([sin_emb, cos_emb], dim=-1).view(max_h, max_w, -1)
+        # Generate embeddings for max size ONCE, concatenated sin & cos (max_h * max_w, dim)
+        # reshape to 2D for slicing
+        rope_embed_2d = self.get_embed([max_h, max_w]).view(max_h, max_w, -1)
 
         if seq_len is not None:
-            flat_embeds = torch.zeros(len(shapes), seq_len, rope_embed_2d.shape[-1]).type_as(sin_emb)
+            flat_embeds = torch.zeros(len(shapes), seq_len, rope_embed_2d.shape[-1]).type_as(rope_embed_2d)
             for i, (h, w) in enumerate(shapes):
                 src_len = h * w
                 flat_embeds[i, :src_len] = rope_embed_2d[:h, :w].reshape(src_len, -1)
@@ -933,6 +936,8 @@ class RotaryEmbeddingMixed(nn.Module):
             self._init_buffers()
         else:
             self.t_x = self.t_y = None
+        # embeddings for recently used shapes, only used when freqs don't require grad
+        self.embed_cache = PosEmbedCache()
 
     def _init_buffers(self) -> None:
         """Compute and fill non-persistent buffer values."""
@@ -976,18 +981,25 @@ class RotaryEmbeddingMixed(nn.Module):
             Tensor of shape (depth, H*W, dim) containing concatenated sin/cos embeddings
         """
         if shape is not None:
-            t_x, t_y = get_mixed_grid(
-                shape,
-                grid_indexing=self.grid_indexing,
-                device=self.freqs.device
-            )
-        elif self.t_x is not None and self.t_y is not None:
-            t_x, t_y = self.t_x, self.t_y
-        else:
-            assert False, "get_embed() requires pre-computed t_x/t_y or valid shape"
+            if torch.jit.is_scripting():
+                return self._calc_embed(shape)
+            return self._cached_embed(shape)
+        t_x, t_y = self.t_x, self.t_y
+        assert t_x is not None and t_y is not None, "get_embed() requires pre-computed t_x/t_y or valid shape"
+        return get_mixed_freqs(self.freqs, t_x, t_y)
 
+    def _calc_embed(self, shape: List[int]) -> torch.Tensor:
+        t_x, t_y = get_mixed_grid(
+            shape,
+            grid_indexing=self.grid_indexing,
+            device=self.freqs.device
+        )
         return get_mixed_freqs(self.freqs, t_x, t_y)
 
+    @torch.jit.unused
+    def _cached_embed(self, shape: List[int]) -> torch.Tensor:
+        return self.embed_cache(lambda: self._calc_embed(shape), (self.freqs,), key=tuple(shape))
+
     def get_batch_embeds(
             self,
             shapes: List[Tuple[int, int]],
@@ -1014,12 +1026,7 @@ class RotaryEmbeddingMixed(nn.Module):
         max_w = max(w for h, w in shapes)
 
         # Generate embeddings for max size ONCE
-        t_x, t_y = get_mixed_grid(
-            [max_h, max_w],
-            grid_indexing=self.grid_indexing,
-            device=self.freqs.device
-        )
-        max_embed = get_mixed_freqs(self.freqs, t_x, t_y)  # (depth, num_heads, max_h*max_w, dim)
+        max_embed = self.get_embed([max_h, max_w])  # (depth, num_heads, max_h*max_w, dim)
 
         # Reshape to 2D grid for easy slicing
         depth, num_heads, _, dim = max_embed.shape
@@ -0,0 +1,198 @@
+""" In-graph image preprocessing
+
+Resize / center crop, dtype conversion, normalization and memory format conversion as a module, so that a
+model (and exported TorchScript / ONNX / torch.export graphs of it) can take uint8 HWC image batches, 1/4
+the size of normalized float32 NCHW input, with the preprocessing running on the model's device.
+"""
+import math
+from typing import Any, Dict, Optional, Sequence, Tuple, Union
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .format import Format, FormatT
+from .helpers import to_2tuple
+
+__all__ = ['Preprocess', 'create_preprocess', 'attach_preprocess']
+
+_INTERP_MODES = {'nearest': 'nearest', 'bilinear': 'bilinear', 'bicubic': 'bicubic'}
+
+
+class Preprocess(nn.Module):
+    """ uint8 (or float in [0, 255]) image batch -> normalized float NCHW model input.
+
+    Resize modes follow the timm eval transforms (`transforms_imagenet_eval`):
+    * 'center': resize the shortest edge to img_size / crop_pct (aspect preserved), center crop img_size
+    * 'squash': resize both edges to img_size / crop_pct (aspect not preserved), center crop img_size
+    * 'border': resize the longest edge to img_size / crop_pct (aspect preserved), pad w/ the mean color
+      to img_size, center crop img_size
+    * None: no resize / crop, input is expected at the model input size
+
+    Output sizes for 'center' and 'border' depend on the input aspect ratio, so traced / exported graphs are
+    specific to the aspect ratio of the example input. 'squash' and None work for any input size.
+    """
+
+    def __init__(
+            self,
+            img_size: Union[int, Tuple[int, int]] = 224,
+            mean: Sequence[float] = (0.485, 0.456, 0.406),
+            std: Sequence[float] = (0.229, 0.224, 0.225),
+            crop_pct: float = 1.0,
+            resize_mode: Optional[str] = 'center',
+            interpolation: str = 'bilinear',
+            antialias: bool = True,
+            input_fmt: FormatT = 'NHWC',
+            channels_last: bool = False,
+            dtype: Optional[torch.dtype] = None,
+            device: Optional[torch.device] = None,
+    ):
+        """
+        Args:
+            img_size: Output (model input) image size.
+            mean: Normalization mean (for [0, 1] scaled images, as in pretrained_cfg).
+            std: Normalization std (for [0, 1] scaled images, as in pretrained_cfg).
+            crop_pct: Center crop fraction, input is resized to img_size / crop_pct before cropping.
+            resize_mode: One of 'center', 'squash', 'border', or None.
+            interpolation: Resize interpolation, one of 'nearest', 'bilinear', 'bicubic'.
+            antialias: Antialias when downsampling (closer to PIL resize results).
+            input_fmt: Input layout, 'NHWC' or 'NCHW'.
+            channels_last: Output in channels_last memory format.
+            dtype: Output dtype (dtype of the normalization buffers, follows `.to(dtype)`), default float32.
+            device: Device of normalization buffers.
+        """
+        super().__init__()
+        assert resize_mode in (None, 'center', 'squash', 'border'), f'Unsupported resize mode {resize_mode}'
+        self.img_size = to_2tuple(img_size)
+        self.scale_size = tuple(math.floor(s / crop_pct) for s in self.img_size)
+        self.resize_mode = resize_mode
+        self.interpolation = _INTERP_MODES.get(interpolation, 'bilinear')
+        self.antialias = antialias and self.interpolation != 'nearest'
+        self.input_fmt = Format(input_fmt)
+        self.channels_last = channels_last
+        self.mean = tuple(mean)
+        self.std = tuple(std)
+        self.register_buffer('scale', torch.empty(1, len(self.std), 1, 1, dtype=dtype, device=device), persistent=False)
+        self.register_buffer('bias', torch.empty(1, len(self.mean), 1, 1, dtype=dtype, device=device), persistent=False)
+        self.init_non_persistent_buffers()
+
+    def init_non_persistent_buffers(self) -> None:
+        # (x / 255 - mean) / std folded into a single scale + bias
+        mean = torch.tensor(self.mean, dtype=torch.float32, device=self.scale.device).view(1, -1, 1, 1)
+        std = torch.tensor(self.std, dtype=torch.float32, device=self.scale.device).view(1, -1, 1, 1)
+        self.scale.copy_(1. / (255. * std))
+        self.bias.copy_(-mean / std)
+
+    def _resize(self, x: torch.Tensor) -> torch.Tensor:
+        if self.resize_mode is None:
+            return x
+        # NOTE sizes are specialized (constants) in traced / exported graphs
+        in_h, in_w = int(x.shape[-2]), int(x.shape[-1])
+        if self.resize_mode == 'squash':
+            size = tuple(self.scale_size)
+        elif self.resize_mode == 'border':
+            # same rounding as ResizeKeepRatio(longest=1.0)
+            ratio = max(in_h / self.scale_size[0], in_w / self.scale_size[1])
+            size = (round(in_h / ratio), round(in_w / ratio))
+        else:
+            scale = max(self.scale_size[0] / in_h, self.scale_size[1] / in_w)
+            size = (max(self.img_size[0], round(in_h * scale)), max(self.img_size[1], round(in_w * scale)))
+        if size != (in_h, in_w):
+            x = F.interpolate(
+                x,
+                size=size,
+                mode=self.interpolation,
+                align_corners=False if self.interpolation != 'nearest' else None,
+                antialias=self.antialias,
+            )
+        if self.resize_mode == 'border':
+            x = self._pad(x)
+            size = (int(x.shape[-2]), int(x.shape[-1]))
+        # same rounding as torchvision CenterCrop
+        top = int(round((size[0] - self.img_size[0]) / 2.))
+        left = int(round((size[1] - self.img_size[1]) / 2.))
+        return x[..., top:top + self.img_size[0], left:left + self.img_size[1]]
+
+    def _pad(self, x: torch.Tensor) -> torch.Tensor:
+        # pad to at least img_size w/ the (uint8) mean color, as CenterCropOrPad in the eval transforms
+        in_h, in_w = int(x.shape[-2]), int(x.shape[-1])
+        pad_h, pad_w = max(self.img_size[0] - in_h, 0), max(self.img_size[1] - in_w, 0)
+        if not pad_h and not pad_w:
+            return x
+        fill = torch.tensor([round(255 * m) for m in self.mean], dtype=x.dtype, device=x.device)
+        out = fill.view(1, -1, 1, 1).expand(x.shape[0], -1, in_h + pad_h, in_w + pad_w).clone()
+        out[..., pad_h // 2:pad_h // 2 + in_h, pad_w // 2:pad_w // 2 + in_w] = x
+        return out
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if x.ndim == 3:
+            x = x.unsqueeze(0)
+        if self.input_fmt == Format.NHWC:
+            x = x.permute(0, 3, 1, 2)
+        # resize + normalize in float32, output in the buffer (model) dtype
+        x = self._resize(x.float())
+        if self.interpolation == 'bicubic' and self.resize_mode is not None:
+            x = x.clamp(0, 255)  # bicubic overshoot, PIL clamps to uint8 range
+        x = x * self.scale.float() + self.bias.float()
+        x = x.to(self.scale.dtype)
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        else:
+            x = x.contiguous()
+        return x
+
+    def example_input(
+            self,
+            batch_size: int = 1,
+            img_size: Optional[Tuple[int, int]] = None,
+            in_chans: int = 3,
+            device: Optional[torch.device] = None,
+    ) -> torch.Tensor:
+        """ Random uint8 input batch, at the (pre crop) scale size if resizing and `img_size` not set. """
+        h, w = img_size or (self.scale_size if self.resize_mode is not None else self.img_size)
+        shape = (batch_size, h, w, in_chans) if self.input_fmt == Format.NHWC else (batch_size, in_chans, h, w)
+        return torch.randint(0, 256, shape, dtype=torch.uint8, device=device or self.scale.device)
+
+    def extra_repr(self) -> str:
+        return (
+            f'img_size={self.img_size}, scale_size={self.scale_size}, resize_mode={self.resize_mode}, '
+            f'interpolation={self.interpolation}, input_fmt={self.input_fmt.value}'
+        )
+
+
+def create_preprocess(data_config: Dict[str, Any], **kwargs) -> Preprocess:
+    """ Create a Preprocess module from a data config (see `timm.data.resolve_data_config`).
+
+    Args:
+        data_config: Data config w/ `input_size`, `mean`, `std`, `crop_pct`, `crop_mode`, `interpolation`.
+        **kwargs: Preprocess args overriding the config (ie `input_fmt`, `resize_mode`, `channels_last`).
+    """
+    crop_mode = data_config.get('crop_mode', None) or 'center'
+    args = dict(
+        img_size=tuple(data_config['input_size'][-2:]),
+        mean=data_config['mean'],
+        std=data_config['std'],
+        crop_pct=data_config.get('crop_pct', None) or 1.0,
+        resize_mode=crop_mode,
+        interpolation=data_config.get('interpolation', 'bilinear'),
+    )
+    args.update(kwargs)
+    return Preprocess(**args)
+
+
+def _preprocess_pre_hook(module: nn.Module, args: Tuple[Any, ...]) -> Tuple[Any, ...]:
+    return (module.input_preprocess(args[0]),) + tuple(args[1:])
+
+
+def attach_preprocess(model: nn.Module, preprocess: Preprocess) -> nn.Module:
+    """ Run `preprocess` on the input of every `model(x)` call.
+
+    The module is added as `model.input_preprocess` and applied in a forward pre-hook, so the model's
+    class, attributes and state_dict keys are unchanged (the preprocess buffers are non-persistent).
+    Hooks are captured by `torch.jit.trace`, `torch.onnx.export` and `torch.export`, but not
+    `torch.jit.script`. `forward_features` and other methods called directly don't preprocess.
+    """
+    assert not hasattr(model, 'input_preprocess'), 'Model already has an input_preprocess module.'
+    model.input_preprocess = preprocess
+    model.register_forward_pre_hook(_preprocess_pre_hook)
+    return model
@@ -96,6 +96,8 @@ from ._builder import (
     resolve_pretrained_cfg as resolve_pretrained_cfg,
     set_pretrained_download_progress as set_pretrained_download_progress,
     set_pretrained_check_hash as set_pretrained_check_hash,
+    set_pretrained_meta_init as set_pretrained_meta_init,
+    set_pretrained_cache_converted as set_pretrained_cache_converted,
 )
 from ._factory import (
     create_model as create_model,
@@ -123,6 +125,7 @@ from ._features_fx import (
 )
 from ._helpers import (
     clean_state_dict as clean_state_dict,
+    load_safetensors as load_safetensors,
     load_state_dict as load_state_dict,
     load_checkpoint as load_checkpoint,
     remap_state_dict as remap_state_dict,
@@ -145,12 +148,20 @@ from ._manipulate import (
     checkpoint as checkpoint,
     adapt_input_conv as adapt_input_conv,
 )
+from ._streaming import (
+    StreamingSequential as StreamingSequential,
+    stream_blocks as stream_blocks,
+)
 from ._pretrained import (
     PretrainedCfg as PretrainedCfg,
     DefaultCfg as DefaultCfg,
     filter_pretrained_cfg as filter_pretrained_cfg,
 )
-from ._prune import adapt_model_from_string as adapt_model_from_string
+from ._prune import (
+    adapt_model_from_string as adapt_model_from_string,
+    model_to_string as model_to_string,
+    prune_model as prune_model,
+)
 from ._registry import (
     split_model_name_tag as split_model_name_tag,
     get_arch_name as get_arch_name,
@@ -1,22 +1,36 @@
 import dataclasses
+import functools
+import hashlib
 import logging
 import os
+import sys
+import types
 from copy import deepcopy
 from pathlib import Path
 from typing import Any, Callable, Dict, List, Optional, Tuple, Type, TypeVar, Union
 
+import torch
 from torch import nn as nn
 from torch.hub import load_state_dict_from_url
 
+try:
+    import safetensors.torch
+    _has_safetensors = True
+except ImportError:
+    _has_safetensors = False
+
+from timm import __version__
 from timm.models._features import FeatureListNet, FeatureDictNet, FeatureHookNet, FeatureGetterNet
 from timm.models._features_fx import FeatureGraphNet
-from timm.models._helpers import load_state_dict
-from timm.models._hub import has_hf_hub, download_cached_file, check_cached_file, load_state_dict_from_hf, \
-    load_state_dict_from_path, load_custom_from_hf
-from timm.models._manipulate import adapt_input_conv
+from timm.models._helpers import _torch_load, load_safetensors, load_state_dict
+from timm.models._hub import has_hf_hub, download_cached_file, check_cached_file, get_cache_dir, \
+    load_state_dict_from_hf, load_state_dict_from_path, load_custom_from_hf, _find_checkpoint_file, \
+    _resolve_hf_weights_file, HF_WEIGHTS_NAME
+from timm.models._manipulate import _materialize_meta_tensors, adapt_input_conv
 from timm.models._pretrained import PretrainedCfg
 from timm.models._prune import adapt_model_from_file
 from timm.models._registry import get_pretrained_cfg
+from timm.models._streaming import stream_blocks
 
 _logger = logging.getLogger(__name__)
 
@@ -25,10 +39,18 @@ _logger = logging.getLogger(__name__)
 _DOWNLOAD_PROGRESS = False
 _CHECK_HASH = False
 _USE_OLD_CACHE = int(os.environ.get('TIMM_USE_OLD_CACHE', 0)) > 0
+# Build pretrained models on the meta device and assign memory-mapped checkpoint tensors (no random init).
+# Use set_pretrained_meta_init fn or the `meta_init` model kwarg to toggle.
+_META_INIT = int(os.environ.get('TIMM_PRETRAINED_META_INIT', 0)) > 0
+# Cache pretrained weights after checkpoint filter / custom load conversion as safetensors in the hub cache dir.
+# Use set_pretrained_cache_converted fn to toggle.
+_CACHE_CONVERTED = int(os.environ.get('TIMM_CACHE_CONVERTED', 0)) > 0
 
 __all__ = [
     'set_pretrained_download_progress',
     'set_pretrained_check_hash',
+    'set_pretrained_meta_init',
+    'set_pretrained_cache_converted',
     'load_custom_pretrained',
     'load_pretrained',
     'pretrained_cfg_for_features',
@@ -100,6 +122,166 @@ def set_pretrained_check_hash(enable: bool = True) -> None:
     _CHECK_HASH = enable
 
 
+def set_pretrained_meta_init(enable: bool = True) -> None:
+    """ Set meta device construction + memory-mapped loading of pretrained models on/off (globally). """
+    global _META_INIT
+    _META_INIT = enable
+
+
+def set_pretrained_cache_converted(enable: bool = True) -> None:
+    """ Set caching of converted (filtered / custom loaded) pretrained weights on/off (globally). """
+    global _CACHE_CONVERTED
+    _CACHE_CONVERTED = enable
+
+
+def _is_custom_load(load_from: str, pretrained_loc: Any, custom_load: Union[bool, str]) -> bool:
+    if load_from in ('file', 'url'):
+        return bool(custom_load)
+    if load_from == 'hf-hub':
+        return isinstance(pretrained_loc, (list, tuple)) and custom_load == 'hf'
+    return False
+
+
+def _code_digest(code: types.CodeType, h: Optional[Any] = None) -> Any:
+    h = h or hashlib.sha256()
+    h.update(code.co_code)
+    for c in code.co_consts:
+        # nested fns / lambdas / comprehensions, their repr contains a memory address
+        if isinstance(c, types.CodeType):
+            _code_digest(c, h)
+        else:
+            h.update(repr(c).encode())
+    return h
+
+
+def _source_digest(filter_fn: Callable) -> str:
+    # source of the filter fn's module and of the modules of the helpers it calls (remap / resample fns),
+    # the filter fn bytecode alone doesn't change when only a helper is edited
+    modules = {getattr(filter_fn, '__module__', None)}
+    fn_globals = getattr(filter_fn, '__globals__', {})
+    for n in filter_fn.__code__.co_names:
+        modules.add(getattr(fn_globals.get(n, None), '__module__', None))
+    h = hashlib.sha256()
+    for module in sorted(m for m in modules if m):
+        file = getattr(sys.modules.get(module, None), '__file__', None)
+        if not file or not os.path.isfile(file):
+            continue
+        with open(file, 'rb') as f:
+            h.update(module.encode())
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def _filter_fn_key(filter_fn: Callable) -> str:
+    # qualified name + bytecode + module source so that edits to a filter fn (or the helpers it uses)
+    # invalidate converted checkpoints
+    args = ''
+    if isinstance(filter_fn, functools.partial):
+        args = repr((filter_fn.args, sorted(filter_fn.keywords.items())))
+        filter_fn = filter_fn.func
+    name = f'{getattr(filter_fn, "__module__", "")}.{getattr(filter_fn, "__qualname__", repr(filter_fn))}'
+    code = getattr(filter_fn, '__code__', None)
+    code = f'{_code_digest(code).hexdigest()}:{_source_digest(filter_fn)}' if code is not None else ''
+    return f'{name}:{code}:{args}'
+
+
+def _resolve_source_file(
+        load_from: str,
+        pretrained_loc: Any,
+        custom_load: bool = False,
+        cache_dir: Optional[Union[str, Path]] = None,
+) -> str:
+    """ Local file the pretrained weights are loaded from, downloaded (into the usual cache) if necessary. """
+    if load_from == 'file':
+        return pretrained_loc
+    if load_from == 'local-dir':
+        return str(_find_checkpoint_file(Path(pretrained_loc)))
+    if load_from == 'url':
+        return download_cached_file(
+            pretrained_loc,
+            progress=_DOWNLOAD_PROGRESS,
+            check_hash=_CHECK_HASH,
+            cache_dir=cache_dir,
+        )
+    assert load_from == 'hf-hub'
+    if isinstance(pretrained_loc, (list, tuple)):
+        model_id, filename = pretrained_loc
+    else:
+        model_id, filename = pretrained_loc, HF_WEIGHTS_NAME
+    return _resolve_hf_weights_file(model_id, filename, cache_dir=cache_dir, safe_alternatives=not custom_load)
+
+
+def _converted_cache_file(
+        model: nn.Module,
+        pretrained_cfg: Dict[str, Any],
+        load_from: str,
+        pretrained_loc: Any,
+        filter_fn: Optional[Callable] = None,
+        cache_dir: Optional[Union[str, Path]] = None,
+        custom_load: bool = False,
+) -> Optional[str]:
+    """ Location of converted weights for this model, pretrained source, and conversion fn.
+
+    The key hashes the weight source (location, plus path, size & mtime of the resolved weight file, for hub
+    and url sources after download, so a new revision or re-upload gets a new key), the model state
+    dict signature (covers model config such as img_size, num_classes), the conversion fn (bytecode plus the
+    source of its module and of the helpers it calls), and timm version.
+    """
+    if load_from in ('', 'state_dict'):
+        return None
+    source = repr(pretrained_loc)
+    source_file = _resolve_source_file(load_from, pretrained_loc, custom_load=custom_load, cache_dir=cache_dir)
+    # the real path of a hub snapshot file is its content addressed blob (named by etag / sha256)
+    st = os.stat(source_file)
+    source += f':{os.path.realpath(source_file)}:{st.st_size}:{st.st_mtime_ns}'
+    signature = ','.join(f'{k}:{tuple(v.shape)}:{v.dtype}' for k, v in model.state_dict().items())
+    key = '|'.join([
+        load_from,
+        source,
+        signature,
+        _filter_fn_key(filter_fn) if filter_fn is not None else 'custom',
+        __version__,
+    ])
+    key = hashlib.sha256(key.encode()).hexdigest()[:16]
+    architecture = pretrained_cfg.get('architecture', None) or type(model).__name__
+    tag = pretrained_cfg.get('tag', None)
+    name = '.'.join([architecture, tag]) if tag else architecture
+    if cache_dir:
+        cache_dir = os.path.join(cache_dir, 'converted')
+        os.makedirs(cache_dir, exist_ok=True)
+    else:
+        cache_dir = get_cache_dir('converted')
+    return os.path.join(cache_dir, f'{name}-{key}.safetensors')
+
+
+def _save_converted(state_dict: Dict[str, Any], converted_file: Optional[str]) -> None:
+    if not converted_file or not _has_safetensors:
+        return
+    if not all(isinstance(v, torch.Tensor) for v in state_dict.values()):
+        return
+    tensors = {}
+    storage_ranges = {}
+    for k, v in state_dict.items():
+        v = v.detach().to('cpu').contiguous()
+        ranges = storage_ranges.setdefault(v.untyped_storage().data_ptr(), [])
+        start = v.storage_offset() * v.element_size()
+        end = start + v.numel() * v.element_size()
+        if any(start < e and s < end for s, e in ranges):
+            v = v.clone()  # safetensors doesn't allow tensors with overlapping memory
+        else:
+            ranges.append((start, end))
+        tensors[k] = v
+    tmp_file = f'{converted_file}.{os.getpid()}.tmp'
+    try:
+        safetensors.torch.save_file(tensors, tmp_file)
+        os.replace(tmp_file, converted_file)
+        _logger.info(f'Cached converted pretrained weights ({converted_file})')
+    except Exception as e:
+        _logger.warning(f'Unable to cache converted pretrained weights: {e}')
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
 def load_custom_pretrained(
         model: nn.Module,
         pretrained_cfg: Optional[Dict[str, Any]] = None,
@@ -157,6 +339,8 @@ def load_pretrained(
         filter_fn: Optional[Callable] = None,
         strict: bool = True,
         cache_dir: Optional[Union[str, Path]] = None,
+        mmap: bool = False,
+        assign: bool = False,
 ) -> None:
     """ Load pretrained checkpoint
 
@@ -168,25 +352,43 @@ def load_pretrained(
         filter_fn: state_dict filter fn for load (takes state_dict, model as args)
         strict: Strict load of checkpoint
         cache_dir: Override model checkpoint cache dir for this load
+        mmap: Memory-map the checkpoint file, tensors are only read when accessed (or used)
+        assign: Assign checkpoint tensors to the model instead of copying into existing
+            params (required for models on the meta device)
     """
     pretrained_cfg = pretrained_cfg or getattr(model, 'pretrained_cfg', None)
     if not pretrained_cfg:
         raise RuntimeError("Invalid pretrained config, cannot load weights. Use `pretrained=False` for random init.")
 
     load_from, pretrained_loc = _resolve_pretrained_source(pretrained_cfg)
-    if load_from == 'state_dict':
+    custom_load = _is_custom_load(load_from, pretrained_loc, pretrained_cfg.get('custom_load', False))
+    converted_file = None
+    if _CACHE_CONVERTED and (filter_fn is not None or custom_load):
+        converted_file = _converted_cache_file(
+            model, pretrained_cfg, load_from, pretrained_loc, filter_fn, cache_dir, custom_load=custom_load)
+
+    if converted_file and os.path.isfile(converted_file):
+        _logger.info(f'Loading converted pretrained weights from cache ({converted_file})')
+        state_dict = load_safetensors(converted_file, mmap=True)
+        if custom_load:
+            # state of the model after its custom load fn, nothing left to adapt
+            model.load_state_dict(state_dict, assign=assign)
+            return
+        filter_fn = None
+    elif load_from == 'state_dict':
         _logger.info(f'Loading pretrained weights from state dict')
         state_dict = pretrained_loc  # pretrained_loc is the actual state dict for this override
     elif load_from == 'file':
         _logger.info(f'Loading pretrained weights from file ({pretrained_loc})')
-        if pretrained_cfg.get('custom_load', False):
+        if custom_load:
             model.load_pretrained(pretrained_loc)
+            _save_converted(model.state_dict(), converted_file)
             return
         else:
-            state_dict = load_state_dict(pretrained_loc)
+            state_dict = load_state_dict(pretrained_loc, mmap=mmap)
     elif load_from == 'url':
         _logger.info(f'Loading pretrained weights from url ({pretrained_loc})')
-        if pretrained_cfg.get('custom_load', False):
+        if custom_load:
             pretrained_loc = download_cached_file(
                 pretrained_loc,
                 progress=_DOWNLOAD_PROGRESS,
@@ -194,7 +396,16 @@ def load_pretrained(
                 cache_dir=cache_dir,
             )
             model.load_pretrained(pretrained_loc)
+            _save_converted(model.state_dict(), converted_file)
             return
+        elif mmap:
+            cached_file = download_cached_file(
+                pretrained_loc,
+                progress=_DOWNLOAD_PROGRESS,
+                check_hash=_CHECK_HASH,
+                cache_dir=cache_dir,
+            )
+            state_dict = _torch_load(cached_file, map_location='cpu', weights_only=True, mmap=True)
         else:
             try:
                 state_dict = load_state_dict_from_url(
@@ -216,19 +427,19 @@ def load_pretrained(
     elif load_from == 'hf-hub':
         _logger.info(f'Loading pretrained weights from Hugging Face hub ({pretrained_loc})')
         if isinstance(pretrained_loc, (list, tuple)):
-            custom_load = pretrained_cfg.get('custom_load', False)
-            if isinstance(custom_load, str) and custom_load == 'hf':
+            if custom_load:
                 load_custom_from_hf(*pretrained_loc, model, cache_dir=cache_dir)
+                _save_converted(model.state_dict(), converted_file)
                 return
             else:
-                state_dict = load_state_dict_from_hf(*pretrained_loc, cache_dir=cache_dir)
+                state_dict = load_state_dict_from_hf(*pretrained_loc, cache_dir=cache_dir, mmap=mmap)
         else:
-            state_dict = load_state_dict_from_hf(pretrained_loc, weights_only=True, cache_dir=cache_dir)
+            state_dict = load_state_dict_from_hf(pretrained_loc, weights_only=True, cache_dir=cache_dir, mmap=mmap)
     elif load_from == 'local-dir':
         _logger.info(f'Loading pretrained weights from local directory ({pretrained_loc})')
         pretrained_path = Path(pretrained_loc)
         if pretrained_path.is_dir():
-            state_dict = load_state_dict_from_path(pretrained_path)
+            state_dict = load_state_dict_from_path(pretrained_path, mmap=mmap)
         else:
             raise RuntimeError(f"Specified path is not a directory: {pretrained_loc}")
     else:
@@ -241,6 +452,7 @@ def load_pretrained(
         except TypeError as e:
             # for backwards compat with filter fn that take one arg
             state_dict = filter_fn(state_dict)
+        _save_converted(state_dict, converted_file)
 
     input_convs = pretrained_cfg.get('first_conv', None)
     if input_convs is not None and in_chans != 3:
@@ -277,7 +489,14 @@ def load_pretrained(
                 classifier_bias = state_dict[classifier_name + '.bias']
                 state_dict[classifier_name + '.bias'] = classifier_bias[label_offset:]
 
-    load_result = model.load_state_dict(state_dict, strict=strict)
+    if assign:
+        # assigned tensors keep their checkpoint dtype, cast any that differ from the model's
+        model_dtypes = {k: v.dtype for k, v in model.state_dict().items()}
+        for k, v in state_dict.items():
+            if k in model_dtypes and v.is_floating_point() and v.dtype != model_dtypes[k]:
+                state_dict[k] = v.to(model_dtypes[k])
+
+    load_result = model.load_state_dict(state_dict, strict=strict, assign=assign)
     if load_result.missing_keys:
         _logger.info(
             f'Missing keys ({", ".join(load_result.missing_keys)}) discovered while loading pretrained weights.'
@@ -288,6 +507,53 @@ def load_pretrained(
             f' This may be expected if model is being adapted.')
 
 
+def _build_pretrained_on_meta(
+        model_cls: Callable[..., nn.Module],
+        model_cfg: Optional[Any],
+        pretrained_cfg: Dict[str, Any],
+        features: bool,
+        kwargs: Dict[str, Any],
+        **load_kwargs,
+) -> Optional[nn.Module]:
+    """ Build model on meta device and assign memory-mapped pretrained weights.
+
+    Skips the random init of all params and the in-memory copy of the checkpoint. Returns None if
+    the model can't be built or loaded this way.
+    """
+    device = kwargs.get('device', None) or 'cpu'
+    meta_kwargs = dict(kwargs, device='meta')
+    try:
+        if model_cfg is None:
+            model = model_cls(**meta_kwargs)
+        else:
+            model = model_cls(cfg=model_cfg, **meta_kwargs)
+        model.pretrained_cfg = pretrained_cfg
+        model.default_cfg = model.pretrained_cfg  # alias for backwards compat
+
+        num_classes_pretrained = 0 if features else getattr(model, 'num_classes', kwargs.get('num_classes', 1000))
+        load_pretrained(
+            model,
+            pretrained_cfg=pretrained_cfg,
+            num_classes=num_classes_pretrained,
+            in_chans=kwargs.get('in_chans', 3),
+            mmap=True,
+            assign=True,
+            **load_kwargs,
+        )
+        valid = _materialize_meta_tensors(model)
+    except Exception as e:
+        _logger.info(f'Unable to build pretrained {pretrained_cfg.get("architecture")} on meta device: {e}')
+        return None
+
+    if not valid:
+        _logger.info(
+            f'Unable to initialize all meta device tensors for pretrained {pretrained_cfg.get("architecture")}.')
+        return None
+    if torch.device(device).type != 'cpu':
+        model.to(device)
+    return model
+
+
 def pretrained_cfg_for_features(pretrained_cfg: Dict[str, Any]) -> Dict[str, Any]:
     pretrained_cfg = deepcopy(pretrained_cfg)
     # remove default pretrained cfg fields that don't have much relevance for feature backbone
@@ -415,9 +681,13 @@ def build_model_with_cfg(
         pretrained_filter_fn: Filter callable for pretrained weights
         cache_dir: Override model cache dir for Hugging Face Hub and Torch checkpoints
         kwargs_filter: Kwargs keys to filter (remove) before passing to model
-        **kwargs: Model args passed through to model __init__
+        **kwargs: Model args passed through to model __init__. `meta_init=True` builds pretrained
+            models on the meta device and assigns memory-mapped weights (see `set_pretrained_meta_init`),
+            `stream_blocks=True` enables layer-streaming inference (see `stream_blocks`)
     """
     pruned = kwargs.pop('pruned', False)
+    meta_init = kwargs.pop('meta_init', None)
+    streaming = kwargs.pop('stream_blocks', False)
     features = False
     feature_cfg = feature_cfg or {}
 
@@ -440,30 +710,52 @@ def build_model_with_cfg(
         if 'feature_cls' in kwargs:
             feature_cfg['feature_cls'] = kwargs.pop('feature_cls')
 
-    # Instantiate the model
-    if model_cfg is None:
-        model = model_cls(**kwargs)
-    else:
-        model = model_cls(cfg=model_cfg, **kwargs)
-    model.pretrained_cfg = pretrained_cfg
-    model.default_cfg = model.pretrained_cfg  # alias for backwards compat
-
-    if pruned:
-        model = adapt_model_from_file(model, variant)
-
-    # For classification models, check class attr, then kwargs, then default to 1k, otherwise 0 for feats
-    num_classes_pretrained = 0 if features else getattr(model, 'num_classes', kwargs.get('num_classes', 1000))
-    if pretrained:
-        load_pretrained(
-            model,
-            pretrained_cfg=pretrained_cfg,
-            num_classes=num_classes_pretrained,
-            in_chans=kwargs.get('in_chans', 3),
+    model = None
+    if meta_init is None:
+        # block weights stay memory-mapped until used when streaming
+        meta_init = True if streaming else _META_INIT
+    if meta_init and pretrained and not pruned and not pretrained_cfg.get('custom_load', False):
+        # fast path, no random init of params that are overwritten by the pretrained weights
+        model = _build_pretrained_on_meta(
+            model_cls,
+            model_cfg,
+            pretrained_cfg,
+            features,
+            kwargs,
             filter_fn=pretrained_filter_fn,
             strict=pretrained_strict,
             cache_dir=cache_dir,
         )
 
+    if model is None:
+        # Instantiate the model
+        if model_cfg is None:
+            model = model_cls(**kwargs)
+        else:
+            model = model_cls(cfg=model_cfg, **kwargs)
+        model.pretrained_cfg = pretrained_cfg
+        model.default_cfg = model.pretrained_cfg  # alias for backwards compat
+
+        if pruned:
+            # builtin spec for the variant, or a path to a spec file (ie output of prune_model)
+            model = adapt_model_from_file(model, pruned if isinstance(pruned, str) else variant)
+
+        # For classification models, check class attr, then kwargs, then default to 1k, otherwise 0 for feats
+        num_classes_pretrained = 0 if features else getattr(model, 'num_classes', kwargs.get('num_classes', 1000))
+        if pretrained:
+            load_pretrained(
+                model,
+                pretrained_cfg=pretrained_cfg,
+                num_classes=num_classes_pretrained,
+                in_chans=kwargs.get('in_chans', 3),
+                filter_fn=pretrained_filter_fn,
+                strict=pretrained_strict,
+                cache_dir=cache_dir,
+            )
+
+    if streaming:
+        model = stream_blocks(model)
+
     # Wrap the model in a feature extraction module if enabled
     if features:
         use_getter = False
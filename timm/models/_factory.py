@@ -5,7 +5,7 @@ from urllib.parse import urlsplit
 
 from torch import nn
 
-from timm.layers import set_layer_config
+from timm.layers import set_layer_config, attach_preprocess, create_preprocess
 from ._helpers import load_checkpoint
 from ._hub import load_model_config_from_hf, load_model_config_from_path
 from ._pretrained import PretrainedCfg
@@ -51,6 +51,7 @@ def create_model(
         scriptable: Optional[bool] = None,
         exportable: Optional[bool] = None,
         no_jit: Optional[bool] = None,
+        preprocess: Union[bool, Dict[str, Any]] = False,
         **kwargs: Any,
 ) -> nn.Module:
     """Create a model.
@@ -71,6 +72,9 @@ def create_model(
         scriptable: Set layer config so that model is jit scriptable (not working for all models yet).
         exportable: Set layer config so that model is traceable / ONNX exportable (not fully impl/obeyed yet).
         no_jit: Set layer config so that model doesn't utilize jit scripted layers (so far activations only).
+        preprocess: Attach an in-graph preprocessing module (resize / crop, normalize) built from the model's
+            data config so the model takes uint8 NHWC image batches. A dict sets `Preprocess` args
+            (ie `input_fmt`, `resize_mode`, `channels_last`).
 
     Keyword Args:
         drop_rate (float): Classifier dropout rate for training.
@@ -146,4 +150,14 @@ def create_model(
     if checkpoint_path:
         load_checkpoint(model, checkpoint_path)
 
+    if preprocess:
+        from timm.data import resolve_data_config
+        preprocess_kwargs = dict(preprocess) if isinstance(preprocess, dict) else {}
+        param = next(model.parameters(), None)
+        if param is not None:
+            preprocess_kwargs.setdefault('device', param.device)
+            preprocess_kwargs.setdefault('dtype', param.dtype)
+        data_config = resolve_data_config(model=model)
+        attach_preprocess(model, create_preprocess(data_config, **preprocess_kwargs))
+
     return model
@@ -3,9 +3,13 @@
 Hacked together by / Copyright 2020 Ross Wightman
 """
 import argparse
+import json
 import logging
+import mmap
 import os
 import pickle
+import struct
+import sys
 from typing import Any, Callable, Dict, Optional, Union
 
 import torch
@@ -22,6 +26,7 @@ _logger = logging.getLogger(__name__)
 __all__ = [
     'clean_state_dict',
     'load_checkpoint',
+    'load_safetensors',
     'load_state_dict',
     'remap_state_dict',
     'resume_checkpoint',
@@ -42,7 +47,14 @@ def _torch_load(
         checkpoint_path: str,
         map_location: Union[str, torch.device] = 'cpu',
         weights_only: bool = True,
+        mmap: bool = False,
 ):
+    if mmap:
+        try:
+            return _torch_load_mmap(checkpoint_path, map_location=map_location, weights_only=weights_only)
+        except RuntimeError as e:
+            # legacy (non-zipfile) serialization format cannot be memory-mapped
+            _logger.debug(f'Unable to memory-map checkpoint ({e}), loading into memory.')
     use_safe_globals = weights_only and hasattr(torch.serialization, 'safe_globals')
     try:
         if use_safe_globals:
@@ -69,6 +81,89 @@ def _torch_load(
         ) from e
 
 
+def _torch_load_mmap(
+        checkpoint_path: str,
+        map_location: Union[str, torch.device] = 'cpu',
+        weights_only: bool = True,
+):
+    if weights_only and hasattr(torch.serialization, 'safe_globals'):
+        with torch.serialization.safe_globals([argparse.Namespace]):
+            return torch.load(checkpoint_path, map_location=map_location, weights_only=True, mmap=True)
+    return torch.load(checkpoint_path, map_location=map_location, weights_only=weights_only, mmap=True)
+
+
+_SAFETENSORS_DTYPES = {
+    'F64': torch.float64,
+    'F32': torch.float32,
+    'F16': torch.float16,
+    'BF16': torch.bfloat16,
+    'I64': torch.int64,
+    'I32': torch.int32,
+    'I16': torch.int16,
+    'I8': torch.int8,
+    'U8': torch.uint8,
+    'BOOL': torch.bool,
+}
+if hasattr(torch, 'float8_e4m3fn'):
+    _SAFETENSORS_DTYPES.update({'F8_E4M3': torch.float8_e4m3fn, 'F8_E5M2': torch.float8_e5m2})
+
+
+def _load_safetensors_mmap(checkpoint_path: str) -> Dict[str, torch.Tensor]:
+    """ Memory-map a .safetensors file, returning tensors backed by the mapped file.
+
+    No tensor data is read until it is accessed. Each tensor gets its own mapping (and storage), so a retained
+    tensor only keeps its own bytes mapped and saving it writes only its data. Tensors smaller than the
+    mapping granularity are read into memory. The mappings are private (copy-on-write), in-place
+    modification of returned tensors does not alter the file.
+    """
+    with open(checkpoint_path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        header.pop('__metadata__', None)
+        data_start = 8 + header_size
+
+        state_dict = {}
+        for k, v in header.items():
+            dtype = _SAFETENSORS_DTYPES[v['dtype']]
+            start, end = v['data_offsets']
+            start, nbytes = data_start + start, end - start
+            itemsize = torch.empty((), dtype=dtype).element_size()
+            if nbytes < mmap.ALLOCATIONGRANULARITY:
+                f.seek(start)
+                t = torch.frombuffer(bytearray(f.read(nbytes)), dtype=torch.uint8) if nbytes else \
+                    torch.empty(0, dtype=torch.uint8)
+            else:
+                map_start = start - start % mmap.ALLOCATIONGRANULARITY
+                mapped = mmap.mmap(
+                    f.fileno(), start + nbytes - map_start, offset=map_start, access=mmap.ACCESS_COPY)
+                t = torch.frombuffer(mapped, dtype=torch.uint8, count=nbytes, offset=start - map_start)
+                if start % itemsize:
+                    t = t.clone()  # unaligned, cannot view as dtype in place
+            state_dict[k] = t.view(dtype).reshape(v['shape'])
+    return state_dict
+
+
+def load_safetensors(
+        checkpoint_path: str,
+        device: Union[str, torch.device] = 'cpu',
+        mmap: bool = False,
+) -> Dict[str, torch.Tensor]:
+    """Load tensors from a .safetensors file.
+
+    Args:
+        checkpoint_path: Path to .safetensors file.
+        device: Device to load tensors to.
+        mmap: Memory-map the file, tensor data is only read from disk (lazily) when accessed.
+
+    Returns:
+        Dictionary of tensors.
+    """
+    if mmap and sys.byteorder == 'little' and torch.device(device).type == 'cpu':
+        return _load_safetensors_mmap(checkpoint_path)
+    assert _has_safetensors, "`pip install safetensors` to use .safetensors"
+    return safetensors.torch.load_file(checkpoint_path, device=device)
+
+
 def _remove_prefix(text: str, prefix: str) -> str:
     # FIXME replace with 3.9 stdlib fn when min at 3.9
     if text.startswith(prefix):
@@ -95,6 +190,7 @@ def load_state_dict(
         use_ema: bool = True,
         device: Union[str, torch.device] = 'cpu',
         weights_only: bool = True,
+        mmap: bool = False,
 ) -> Dict[str, Any]:
     """Load state dictionary from checkpoint file.
 
@@ -103,6 +199,7 @@ def load_state_dict(
         use_ema: Whether to use EMA weights if available.
         device: Device to load checkpoint to.
         weights_only: Whether to load only weights (torch.load parameter).
+        mmap: Memory-map the checkpoint file instead of reading it into memory.
 
     Returns:
         State dictionary loaded from checkpoint.
@@ -110,10 +207,9 @@ def load_state_dict(
     if checkpoint_path and os.path.isfile(checkpoint_path):
         # Check if safetensors or not and load weights accordingly
         if str(checkpoint_path).endswith(".safetensors"):
-            assert _has_safetensors, "`pip install safetensors` to use .safetensors"
-            checkpoint = safetensors.torch.load_file(checkpoint_path, device=device)
+            checkpoint = load_safetensors(checkpoint_path, device=device, mmap=mmap)
         else:
-            checkpoint = _torch_load(checkpoint_path, map_location=device, weights_only=weights_only)
+            checkpoint = _torch_load(checkpoint_path, map_location=device, weights_only=weights_only, mmap=mmap)
 
         state_dict_key = ''
         if isinstance(checkpoint, dict):
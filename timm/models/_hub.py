@@ -27,7 +27,7 @@ except ImportError:
     from typing_extensions import Literal
 
 from timm import __version__
-from ._helpers import _torch_load, load_state_dict
+from ._helpers import _torch_load, load_safetensors, load_state_dict
 from ._pretrained import filter_pretrained_cfg
 
 try:
@@ -216,6 +216,7 @@ def load_state_dict_from_hf(
         filename: str = HF_WEIGHTS_NAME,
         weights_only: bool = True,
         cache_dir: Optional[Union[str, Path]] = None,
+        mmap: bool = False,
 ):
     assert has_hf_hub(True)
     hf_model_id, hf_revision = hf_split(model_id)
@@ -233,7 +234,7 @@ def load_state_dict_from_hf(
                 _logger.info(
                     f"[{model_id}] Safe alternative available for '{filename}' "
                     f"(as '{safe_filename}'). Loading weights using safetensors.")
-                return safetensors.torch.load_file(cached_safe_file, device="cpu")
+                return load_safetensors(cached_safe_file, device="cpu", mmap=mmap)
             except EntryNotFoundError:
                 pass
 
@@ -245,7 +246,7 @@ def load_state_dict_from_hf(
         cache_dir=cache_dir,
     )
     _logger.debug(f"[{model_id}] Safe alternative not found for '{filename}'. Loading weights using default pytorch.")
-    state_dict = _torch_load(cached_file, map_location='cpu', weights_only=weights_only)
+    state_dict = _torch_load(cached_file, map_location='cpu', weights_only=weights_only, mmap=mmap)
 
     return state_dict
 
@@ -262,10 +263,7 @@ _PREFERRED_FILES = (
 )
 _EXT_PRIORITY = ('.safetensors', '.pth', '.pth.tar', '.bin')
 
-def load_state_dict_from_path(
-        path: str,
-        weights_only: bool = True,
-):
+def _find_checkpoint_file(path: Path) -> Path:
     found_file = None
     for fname in _PREFERRED_FILES:
         p = path / fname
@@ -280,19 +278,55 @@ def load_state_dict_from_path(
         if files:
             if len(files) > 1:
                 logging.warning(
-                    f"Multiple {ext} checkpoints in {path}: {names}. "
+                    f"Multiple {ext} checkpoints in {path}: {[f.name for f in files]}. "
                     f"Using '{files[0].name}'."
                 )
             found_file = files[0]
 
     if not found_file:
         raise RuntimeError(f"No suitable checkpoints found in {path}.")
+    return found_file
 
-    state_dict = load_state_dict(found_file, weights_only=weights_only)
+
+def load_state_dict_from_path(
+        path: str,
+        weights_only: bool = True,
+        mmap: bool = False,
+):
+    found_file = _find_checkpoint_file(Path(path))
+    state_dict = load_state_dict(found_file, weights_only=weights_only, mmap=mmap)
 
     return state_dict
 
 
+def _resolve_hf_weights_file(
+        model_id: str,
+        filename: str = HF_WEIGHTS_NAME,
+        cache_dir: Optional[Union[str, Path]] = None,
+        safe_alternatives: bool = True,
+) -> str:
+    """ Download (or find in cache) the weights file `load_state_dict_from_hf` would load, return its path. """
+    assert has_hf_hub(True)
+    hf_model_id, hf_revision = hf_split(model_id)
+    if safe_alternatives and _has_safetensors:
+        for safe_filename in _get_safe_alternatives(filename):
+            try:
+                return hf_hub_download(
+                    repo_id=hf_model_id,
+                    filename=safe_filename,
+                    revision=hf_revision,
+                    cache_dir=cache_dir,
+                )
+            except EntryNotFoundError:
+                pass
+    return hf_hub_download(
+        hf_model_id,
+        filename=filename,
+        revision=hf_revision,
+        cache_dir=cache_dir,
+    )
+
+
 def load_custom_from_hf(
         model_id: str,
         filename: str,
@@ -344,3 +344,41 @@ def reinit_non_persistent_buffers(model: nn.Module) -> List[str]:
             module.init_non_persistent_buffers()
             reinitialized.append(name if name else '(root)')
     return reinitialized
+
+
+def _materialize_meta_tensors(model: nn.Module, device: Union[str, torch.device] = 'cpu') -> bool:
+    """ Materialize tensors left on the meta device after an assign load of pretrained weights.
+
+    Non-persistent buffers are filled via `init_non_persistent_buffers()`, params missing from the
+    checkpoint (ie an adapted classifier) via `reset_parameters()` for modules that are entirely missing.
+
+    Returns:
+        False if a meta tensor could not be initialized, the model should then be built normally.
+    """
+    for module in model.modules():
+        meta_params = [n for n, p in module.named_parameters(recurse=False) if p.is_meta]
+        meta_buffers = [n for n, b in module.named_buffers(recurse=False) if b.is_meta]
+        if not meta_params and not meta_buffers:
+            continue
+        non_persistent = [n for n in meta_buffers if n in module._non_persistent_buffers_set]
+        missing = meta_params + [n for n in meta_buffers if n not in module._non_persistent_buffers_set]
+        if missing:
+            persistent = dict(module.named_parameters(recurse=False))
+            persistent.update({
+                n: b for n, b in module.named_buffers(recurse=False) if n not in module._non_persistent_buffers_set})
+            if not hasattr(module, 'reset_parameters') or not all(t.is_meta for t in persistent.values()):
+                return False
+        if non_persistent and not hasattr(module, 'init_non_persistent_buffers'):
+            return False
+
+        for n in meta_params:
+            p = module._parameters[n]
+            module._parameters[n] = nn.Parameter(torch.empty_like(p, device=device), requires_grad=p.requires_grad)
+        for n in meta_buffers:
+            module._buffers[n] = torch.empty_like(module._buffers[n], device=device)
+        with torch.no_grad():
+            if missing:
+                module.reset_parameters()
+            if non_persistent:
+                module.init_non_persistent_buffers()
+    return True
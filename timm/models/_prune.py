@@ -1,12 +1,29 @@
+""" Model pruning helpers
+
+Rebuild models from pruned layer shape specs (`adapt_model_from_string`, `adapt_model_from_file`) and
+produce such specs + sliced weights for new models via structured channel pruning (`prune_model`).
+"""
+import logging
+import math
 import os
 import pkgutil
+import time
 from copy import deepcopy
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 
+import torch
+import torch.nn.functional as F
 from torch import nn as nn
+from torch.overrides import TorchFunctionMode
 
 from timm.layers import Conv2dSame, BatchNormAct2d, Linear
 
-__all__ = ['extract_layer', 'set_layer', 'adapt_model_from_string', 'adapt_model_from_file']
+__all__ = [
+    'extract_layer', 'set_layer', 'adapt_model_from_string', 'adapt_model_from_file',
+    'model_to_string', 'prune_model',
+]
+
+_logger = logging.getLogger(__name__)
 
 
 def extract_layer(model, layer):
@@ -105,8 +122,14 @@ def adapt_model_from_string(parent_module, model_string):
             out_channels = s[0]
             g = 1
             if old_module.groups > 1:
-                in_channels = out_channels
-                g = in_channels
+                if old_module.groups == old_module.in_channels:
+                    # depthwise, in and out channels follow each other
+                    in_channels = out_channels
+                    g = in_channels
+                else:
+                    # grouped, group count is fixed and channels are pruned uniformly per group
+                    g = old_module.groups
+                    in_channels = s[1] * g
             new_conv = conv(
                 in_channels=in_channels,
                 out_channels=out_channels,
@@ -167,10 +190,550 @@ def adapt_model_from_file(parent_module, model_variant):
 
     Args:
         parent_module: Original model to adapt.
-        model_variant: Name of pruned model variant file.
+        model_variant: Name of builtin pruned model variant file, or path to a spec file.
 
     Returns:
         Adapted model with pruned layer dimensions.
     """
+    if os.path.isfile(model_variant):
+        # a spec file written by prune_model / model_to_string
+        with open(model_variant, 'r') as f:
+            return adapt_model_from_string(parent_module, f.read().strip())
     adapt_data = pkgutil.get_data(__name__, os.path.join('_pruned', model_variant + '.txt'))
     return adapt_model_from_string(parent_module, adapt_data.decode('utf-8').strip())
+
+
+def model_to_string(model: nn.Module) -> str:
+    """Generate a pruned structure string specification from a model.
+
+    Inverse of `adapt_model_from_string`, the shape of every state dict entry is recorded.
+
+    Args:
+        model: Model (usually pruned) to describe.
+
+    Returns:
+        String containing layer shapes.
+    """
+    return '***'.join(f'{k}:{list(v.shape)}' for k, v in model.state_dict().items())
+
+
+# Exact types that adapt_model_from_string can rebuild, subclasses are not safe to rebuild.
+_CONV_TYPES = (nn.Conv2d, Conv2dSame)
+_NORM_TYPES = (nn.BatchNorm2d, BatchNormAct2d)
+_LINEAR_TYPES = (nn.Linear, Linear)
+
+# Functions that mix channels, any tracked channel space passed through them can't be pruned.
+_MIXING_FNS = {
+    F.linear, F.conv1d, F.conv2d, F.conv3d, F.conv_transpose1d, F.conv_transpose2d,
+    torch.matmul, torch.mm, torch.bmm, torch.addmm, torch.baddbmm, torch.einsum,
+    torch.Tensor.matmul, torch.Tensor.mm, torch.Tensor.bmm, torch.Tensor.__matmul__,
+    torch.cat, torch.concat, torch.stack,
+}
+
+
+def _lcm(a: int, b: int) -> int:
+    return a * b // math.gcd(a, b)
+
+
+class _ChannelSpace:
+    """A set of channels that must be pruned together (union-find node)."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.parent = self
+        self.fixed = False
+        self.groups = 1
+
+
+def _find(space: _ChannelSpace) -> _ChannelSpace:
+    while space.parent is not space:
+        space.parent = space.parent.parent
+        space = space.parent
+    return space
+
+
+def _union(a: _ChannelSpace, b: _ChannelSpace) -> _ChannelSpace:
+    a, b = _find(a), _find(b)
+    if a is not b:
+        b.parent = a
+        a.fixed = a.fixed or b.fixed or a.size != b.size
+        a.groups = _lcm(a.groups, b.groups)
+    return a
+
+
+def _flatten_tensors(obj) -> List[torch.Tensor]:
+    if isinstance(obj, torch.Tensor):
+        return [obj]
+    if isinstance(obj, (list, tuple)):
+        return [t for o in obj for t in _flatten_tensors(o)]
+    if isinstance(obj, dict):
+        return [t for o in obj.values() for t in _flatten_tensors(o)]
+    return []
+
+
+class _ChannelGraph(TorchFunctionMode):
+    """Trace channel dependencies of a model by running a forward pass.
+
+    Supported conv / norm / linear modules are treated as leaves via module hooks, every other torch
+    function call is observed and tensors that share a channel (dim 1) size with their inputs are
+    bound to the same channel space. Residual adds and multiplicative gates (SE) unify spaces,
+    depthwise convs pass their space through, and anything that reshapes, concatenates or mixes
+    channels in an unknown way marks the affected spaces as fixed (not prunable).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.spaces: List[_ChannelSpace] = []
+        self.convs: List[Dict[str, Any]] = []
+        self.norms: List[Tuple[str, _ChannelSpace]] = []
+        self.linears: List[Dict[str, Any]] = []
+        self._tensor_space: Dict[int, _ChannelSpace] = {}
+        self._refs: List[torch.Tensor] = []  # keep traced tensors alive so ids remain unique
+        self._depth = 0
+        self._pending: Dict[int, Any] = {}
+
+    def new_space(self, size: int, fixed: bool = False) -> _ChannelSpace:
+        space = _ChannelSpace(size)
+        space.fixed = fixed
+        self.spaces.append(space)
+        return space
+
+    def space_of(self, t) -> Optional[_ChannelSpace]:
+        if not isinstance(t, torch.Tensor):
+            return None
+        space = self._tensor_space.get(id(t), None)
+        return _find(space) if space is not None else None
+
+    def set_space(self, t: torch.Tensor, space: _ChannelSpace):
+        self._tensor_space[id(t)] = space
+        self._refs.append(t)
+
+    def fix(self, tensors: Iterable[torch.Tensor]):
+        for t in tensors:
+            space = self.space_of(t)
+            if space is not None:
+                space.fixed = True
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        out = func(*args, **kwargs)
+        if self._depth == 0:
+            self._propagate(func, _flatten_tensors(args) + _flatten_tensors(kwargs), out)
+        return out
+
+    def _propagate(self, func, inputs: List[torch.Tensor], out):
+        outputs = _flatten_tensors(out)
+        if not outputs:
+            return  # shape / size queries, etc
+        in_spaces = [(t, self.space_of(t)) for t in inputs]
+        tracked = [s for _, s in in_spaces if s is not None]
+        if not tracked:
+            return
+        if func in _MIXING_FNS:
+            for s in tracked:
+                s.fixed = True
+            return
+
+        matched = set()
+        for o in outputs:
+            if o.ndim < 2:
+                continue
+            channels = o.shape[1]
+            out_space = None
+            for t, s in in_spaces:
+                if s is None:
+                    if t.ndim >= 2 and t.shape[1] == channels > 1:
+                        # untracked tensor (param, constant) with the same channel count pins these channels
+                        pinned = self.new_space(channels, fixed=True)
+                        out_space = pinned if out_space is None else _union(out_space, pinned)
+                elif s.size == channels:
+                    out_space = s if out_space is None else _union(out_space, s)
+                    matched.add(id(s))
+            if out_space is not None:
+                self.set_space(o, _find(out_space))
+        for s in tracked:
+            if id(s) not in matched:
+                _find(s).fixed = True
+
+    def _pre_hook(self, name: str, module: nn.Module, args):
+        if self._depth > 0:
+            return
+        inputs = _flatten_tensors(args)
+        mt = type(module)
+        if mt in _CONV_TYPES or mt in _NORM_TYPES or mt in _LINEAR_TYPES:
+            self._pending[id(module)] = self.space_of(inputs[0]) if inputs else None
+            self._depth += 1
+        elif any(True for _ in module.parameters(recurse=False)):
+            # params used in an unsupported way, channels in / out of this module can't change
+            self.fix(inputs)
+
+    def _hook(self, name: str, module: nn.Module, args, output):
+        mt = type(module)
+        is_leaf = mt in _CONV_TYPES or mt in _NORM_TYPES or mt in _LINEAR_TYPES
+        if is_leaf and id(module) in self._pending:
+            self._depth -= 1
+            in_space = self._pending.pop(id(module))
+            if mt in _CONV_TYPES:
+                self._add_conv(name, module, in_space, output)
+            elif mt in _NORM_TYPES:
+                if in_space is not None:
+                    self.norms.append((name, in_space))
+                    self.set_space(output, in_space)
+            else:
+                x = _flatten_tensors(args)[0]
+                if in_space is not None and x.ndim != 2:
+                    in_space.fixed = True
+                    in_space = None
+                self.linears.append(dict(
+                    name=name,
+                    in_space=in_space,
+                    in_features=module.in_features,
+                    out_features=module.out_features,
+                    tokens=x.numel() // x.shape[0] // x.shape[-1],
+                ))
+        elif self._depth == 0 and any(True for _ in module.parameters(recurse=False)):
+            self.fix(_flatten_tensors(output))
+
+    def _add_conv(self, name: str, module: nn.Conv2d, in_space: Optional[_ChannelSpace], output: torch.Tensor):
+        groups = module.groups
+        depthwise = groups > 1 and groups == module.in_channels == module.out_channels
+        if depthwise and in_space is not None:
+            out_space = in_space
+        else:
+            out_space = self.new_space(module.out_channels)
+            if groups > 1:
+                if in_space is not None:
+                    if depthwise or module.in_channels % groups:
+                        in_space.fixed = True
+                    else:
+                        in_space.groups = _lcm(in_space.groups, groups)
+                if depthwise or groups == module.in_channels:
+                    out_space.fixed = True  # depthwise on fixed input or channel multiplier
+                else:
+                    out_space.groups = groups
+        self.convs.append(dict(
+            name=name,
+            in_space=in_space,
+            out_space=out_space,
+            depthwise=depthwise and in_space is not None,
+            groups=groups,
+            in_channels=module.in_channels,
+            out_channels=module.out_channels,
+            kernel=module.kernel_size[0] * module.kernel_size[1],
+            spatial=output.shape[-2] * output.shape[-1],
+        ))
+        self.set_space(output, out_space)
+
+    def trace(self, model: nn.Module, example_input: torch.Tensor):
+        handles = []
+        for name, m in model.named_modules():
+            mt = type(m)
+            if mt not in _CONV_TYPES + _NORM_TYPES + _LINEAR_TYPES and isinstance(m, _CONV_TYPES + _NORM_TYPES):
+                raise ValueError(
+                    f'Module {name} ({mt.__name__}) can not be rebuilt by adapt_model_from_string, '
+                    f'pruning is not supported for this model.')
+            handles.append(m.register_forward_pre_hook(lambda mod, a, n=name: self._pre_hook(n, mod, a)))
+            handles.append(m.register_forward_hook(lambda mod, a, o, n=name: self._hook(n, mod, a, o)))
+        try:
+            with torch.no_grad(), self:
+                output = model(example_input)
+        finally:
+            for h in handles:
+                h.remove()
+        # the model output (logits or features) must keep its shape
+        self.fix(_flatten_tensors(output))
+        self._tensor_space.clear()
+        self._refs.clear()
+
+    def roots(self) -> List[_ChannelSpace]:
+        roots = []
+        seen = set()
+        for s in self.spaces:
+            r = _find(s)
+            if id(r) not in seen:
+                seen.add(id(r))
+                if r.size % r.groups:
+                    r.fixed = True
+                roots.append(r)
+        return roots
+
+
+def _channel_importance(
+        model: nn.Module,
+        graph: _ChannelGraph,
+        importance: str,
+        loader: Optional[Iterable] = None,
+        num_batches: int = 8,
+        device: Optional[torch.device] = None,
+) -> Dict[int, torch.Tensor]:
+    """Per channel space importance scores, normalized to a mean of 1 within each space."""
+    params = dict(model.named_parameters())
+    if importance == 'taylor':
+        assert loader is not None, 'A loader with calibration batches is required for Taylor importance.'
+        model.zero_grad(set_to_none=True)
+        for batch_idx, batch in enumerate(loader):
+            if batch_idx >= num_batches:
+                break
+            if isinstance(batch, (list, tuple)):
+                input, target = batch[0], batch[1] if len(batch) > 1 else None
+            else:
+                input, target = batch, None
+            input = input.to(device)
+            output = model(input)
+            if target is None or target.ndim != 1:
+                target = output.detach().argmax(dim=-1)  # pseudo-labels
+            F.cross_entropy(output, target.to(device)).backward()
+
+    def _score(weight_name: str, reduce_dims) -> torch.Tensor:
+        w = params[weight_name]
+        if importance == 'taylor':
+            s = w * w.grad if w.grad is not None else torch.zeros_like(w)
+            return (s.sum(dim=reduce_dims) if reduce_dims else s).pow(2)
+        w = w.abs()
+        return w.sum(dim=reduce_dims) if reduce_dims else w
+
+    scores: Dict[int, torch.Tensor] = {}
+    with torch.no_grad():
+        if importance in ('bn', 'taylor'):
+            for name, space in graph.norms:
+                r = _find(space)
+                if name + '.weight' in params:
+                    s = _score(name + '.weight', None).float()
+                    scores[id(r)] = scores[id(r)] + s if id(r) in scores else s
+        for conv in graph.convs:
+            r = _find(conv['out_space'])
+            if conv['depthwise'] or (importance != 'l1' and id(r) in scores):
+                continue
+            s = _score(conv['name'] + '.weight', (1, 2, 3)).float()
+            if importance == 'l1' and id(r) in scores:
+                scores[id(r)] = scores[id(r)] + s
+            elif id(r) not in scores:
+                scores[id(r)] = s
+    model.zero_grad(set_to_none=True)
+
+    for k, s in scores.items():
+        s = s.cpu()
+        mean = s.mean()
+        s = s / mean if mean > 0 else torch.ones_like(s)
+        # small deterministic offset breaks ties so equal scores don't prune whole layers at once
+        scores[k] = s + 1e-4 * torch.linspace(0, 1, len(s))
+    return scores
+
+
+def _select_channels(
+        roots: List[_ChannelSpace],
+        scores: Dict[int, torch.Tensor],
+        threshold: float,
+        min_keep_ratio: float,
+        channel_divisor: int,
+) -> Dict[int, torch.Tensor]:
+    """Select the indices of the channels to keep in each prunable space for a global threshold."""
+    keep = {}
+    for r in roots:
+        if r.fixed or id(r) not in scores:
+            continue
+        s = scores[id(r)]
+        multiple = _lcm(r.groups, channel_divisor)
+        num_keep = max(int((s >= threshold).sum()), math.ceil(min_keep_ratio * r.size), 1)
+        num_keep = min(r.size, math.ceil(num_keep / multiple) * multiple)
+        if num_keep == r.size:
+            continue
+        per_group = num_keep // r.groups
+        s = s.reshape(r.groups, -1)
+        idx = s.topk(per_group, dim=1).indices.sort(dim=1).values
+        idx = idx + torch.arange(r.groups).unsqueeze(1) * s.shape[1]
+        keep[id(r)] = idx.flatten()
+    return keep
+
+
+def _count_macs(graph: _ChannelGraph, keep: Dict[int, torch.Tensor]) -> int:
+    def _size(space, default):
+        if space is None:
+            return default
+        r = _find(space)
+        return len(keep[id(r)]) if id(r) in keep else r.size
+
+    macs = 0
+    for c in graph.convs:
+        cin = _size(c['in_space'], c['in_channels'])
+        cout = _size(c['out_space'], c['out_channels'])
+        if c['depthwise']:
+            macs += c['spatial'] * c['kernel'] * cout
+        else:
+            macs += c['spatial'] * c['kernel'] * (cin // c['groups']) * cout
+    for fc in graph.linears:
+        macs += fc['tokens'] * _size(fc['in_space'], fc['in_features']) * fc['out_features']
+    return macs
+
+
+def _slice_state_dict(
+        model: nn.Module,
+        graph: _ChannelGraph,
+        keep: Dict[int, torch.Tensor],
+) -> Dict[str, torch.Tensor]:
+    """Slice model weights (and norm buffers) down to the kept channels."""
+    state_dict = {k: v.detach().clone() for k, v in model.state_dict().items()}
+
+    def _idx(space):
+        return keep.get(id(_find(space)), None) if space is not None else None
+
+    for c in graph.convs:
+        w_key, b_key = c['name'] + '.weight', c['name'] + '.bias'
+        w = state_dict[w_key]
+        out_idx = _idx(c['out_space'])
+        in_idx = None if c['depthwise'] else _idx(c['in_space'])
+        if out_idx is not None:
+            w = w[out_idx.to(w.device)]
+            if b_key in state_dict:
+                state_dict[b_key] = state_dict[b_key][out_idx.to(w.device)]
+        if in_idx is not None:
+            g = c['groups']
+            if g == 1:
+                w = w[:, in_idx.to(w.device)]
+            else:
+                # per group selection, input channel offsets are local to each group
+                in_per_group = c['in_channels'] // g
+                local = in_idx.reshape(g, -1) - torch.arange(g).unsqueeze(1) * in_per_group
+                out_group = torch.arange(w.shape[0]) // (w.shape[0] // g)
+                gather_idx = local[out_group][:, :, None, None].expand(-1, -1, *w.shape[2:])
+                w = torch.gather(w, 1, gather_idx.to(w.device))
+        state_dict[w_key] = w
+    for name, space in graph.norms:
+        idx = _idx(space)
+        if idx is None:
+            continue
+        for k in ('weight', 'bias', 'running_mean', 'running_var'):
+            key = f'{name}.{k}'
+            if key in state_dict:
+                state_dict[key] = state_dict[key][idx.to(state_dict[key].device)]
+    for fc in graph.linears:
+        idx = _idx(fc['in_space'])
+        if idx is not None:
+            key = fc['name'] + '.weight'
+            state_dict[key] = state_dict[key][:, idx.to(state_dict[key].device)]
+    return state_dict
+
+
+def _build_pruned(model: nn.Module, state_dict: Dict[str, torch.Tensor]) -> Tuple[nn.Module, str]:
+    model_string = '***'.join(f'{k}:{list(v.shape)}' for k, v in state_dict.items())
+    pruned = adapt_model_from_string(model, model_string)
+    pruned.load_state_dict(state_dict)
+    return pruned, model_string
+
+
+def _measure_latency(model: nn.Module, example_input: torch.Tensor, num_iter: int = 10) -> float:
+    with torch.no_grad():
+        for _ in range(2):
+            model(example_input)
+        start = time.perf_counter()
+        for _ in range(num_iter):
+            model(example_input)
+        return (time.perf_counter() - start) / num_iter
+
+
+def prune_model(
+        model: nn.Module,
+        target: float = 0.5,
+        budget: str = 'flops',
+        importance: str = 'bn',
+        loader: Optional[Iterable] = None,
+        num_batches: int = 8,
+        example_input: Optional[torch.Tensor] = None,
+        min_keep_ratio: float = 0.1,
+        channel_divisor: int = 1,
+        latency_batch_size: int = 1,
+        device: Optional[Union[str, torch.device]] = None,
+) -> Tuple[nn.Module, str]:
+    """Structured channel pruning of a model to a FLOPs or latency budget.
+
+    Channel dependencies are found by tracing one forward pass. Channels joined by residual adds,
+    SE gating or depthwise convs are pruned together, grouped convs are pruned uniformly per group,
+    and channels reshaped, concatenated or fed through unsupported layers are left as is. Channels are
+    ranked per layer, normalized, and a global threshold is searched to meet the budget.
+
+    Only models built from modules `adapt_model_from_string` can rebuild (Conv2d, Conv2dSame,
+    BatchNorm2d, BatchNormAct2d, Linear + parameter free layers) are supported, this covers
+    ResNet and EfficientNet families.
+
+    Args:
+        model: Model to prune, it is not modified.
+        target: Fraction of the original FLOPs (MACs) or latency to keep.
+        budget: Budget type, one of 'flops' or 'latency'.
+        importance: Channel ranking criterion, one of 'bn' (BN gamma magnitude), 'l1' (filter L1 norm)
+            or 'taylor' (first-order Taylor on BN gamma / filters, needs a loader).
+        loader: Iterable of calibration batches, (input, target) tuples or input tensors.
+        num_batches: Number of calibration batches used for Taylor importance.
+        example_input: Input used to trace the model (and measure latency), the first loader batch or
+            a random tensor of the model's pretrained_cfg input_size is used if not set.
+        min_keep_ratio: Minimum fraction of channels kept in every prunable channel group.
+        channel_divisor: Keep channel counts a multiple of this value.
+        latency_batch_size: Batch size used to measure latency.
+        device: Device to run on, defaults to device of model parameters. The model is moved to it while
+            pruning and back afterwards, the pruned model is returned on it.
+
+    Returns:
+        Pruned model (with sliced weights), pruned structure string for `adapt_model_from_string`.
+    """
+    assert budget in ('flops', 'latency'), f'Unknown pruning budget {budget}'
+    assert importance in ('bn', 'l1', 'taylor'), f'Unknown importance criterion {importance}'
+    assert 0. < target <= 1.
+    model_device = next(model.parameters()).device
+    device = torch.device(device) if device is not None else model_device
+    was_training = model.training
+    try:
+        model.to(device)
+        model.eval()
+
+        if example_input is None:
+            if loader is not None:
+                batch = next(iter(loader))
+                example_input = batch[0] if isinstance(batch, (list, tuple)) else batch
+            else:
+                input_size = getattr(model, 'pretrained_cfg', {}).get('input_size', (3, 224, 224))
+                example_input = torch.randn((1,) + tuple(input_size))
+        example_input = example_input[:1].to(device)
+
+        graph = _ChannelGraph()
+        graph.trace(model, example_input)
+        roots = graph.roots()
+        scores = _channel_importance(model, graph, importance, loader=loader, num_batches=num_batches, device=device)
+        prunable = [r for r in roots if not r.fixed and id(r) in scores]
+        _logger.info(f'Found {len(prunable)} prunable channel groups out of {len(roots)}.')
+
+        select = lambda t: _select_channels(roots, scores, t, min_keep_ratio, channel_divisor)
+        t_high = max((float(scores[id(r)].max()) for r in prunable), default=0.) + 1e-6
+
+        if budget == 'flops':
+            base = _count_macs(graph, {})
+            measure = lambda k: _count_macs(graph, k) / base
+            num_steps = 30
+        else:
+            bench_input = example_input.expand(latency_batch_size, *example_input.shape[1:])
+            base = _measure_latency(model, bench_input)
+            measure = lambda k: _measure_latency(
+                _build_pruned(model, _slice_state_dict(model, graph, k))[0], bench_input) / base
+            num_steps = 8
+
+        # bisect the global threshold, smallest threshold (least pruning) that meets the budget wins
+        keep = select(t_high)
+        ratio = measure(keep)
+        if ratio > target:
+            _logger.warning(f'Unable to meet {budget} target of {target:.3f}, best is {ratio:.3f}.')
+        else:
+            t_low = 0.
+            for _ in range(num_steps):
+                t_mid = (t_low + t_high) / 2
+                keep_mid = select(t_mid)
+                ratio_mid = measure(keep_mid)
+                if ratio_mid <= target:
+                    t_high, keep, ratio = t_mid, keep_mid, ratio_mid
+                else:
+                    t_low = t_mid
+        _logger.info(f'Pruned {len(keep)} channel groups, {budget} ratio {ratio:.3f} (target {target:.3f}).')
+
+        pruned, model_string = _build_pruned(model, _slice_state_dict(model, graph, keep))
+    finally:
+        # restore the source model, also when pruning fails
+        model.to(model_device)
+        model.train(was_training)
+    return pruned, model_string
@@ -0,0 +1,213 @@
+""" Layer-streaming inference
+
+Run models whose weights don't fit in memory by keeping the blocks of a sequential block container
+(`VisionTransformer.blocks`, `Eva.blocks`, `ConvNeXt.stages`, ...) on the meta device. Each block's weights
+are materialized from their (ideally memory-mapped) source just before the block runs and released
+afterwards, the next block's weights are paged in on a background thread while the current one computes.
+
+Memory-mapped weights used on CPU are not copied, the OS can reclaim their pages once a block is released.
+For other devices, or if the input dtype differs, each block is copied / cast on use.
+
+Use `create_model(..., pretrained=True, stream_blocks=True)`, or `stream_blocks(model)` on a model with
+weights loaded via `load_pretrained(..., mmap=True, assign=True)` / `load_checkpoint`.
+"""
+import logging
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+import torch
+from torch import nn as nn
+
+from ._helpers import load_state_dict
+from ._manipulate import _materialize_meta_tensors
+
+_logger = logging.getLogger(__name__)
+
+__all__ = ['StreamingSequential', 'stream_blocks']
+
+_PREFETCH_EXECUTOR: Optional[ThreadPoolExecutor] = None
+
+
+def _prefetch_executor() -> ThreadPoolExecutor:
+    global _PREFETCH_EXECUTOR
+    if _PREFETCH_EXECUTOR is None:
+        _PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='timm_stream')
+    return _PREFETCH_EXECUTOR
+
+
+def _page_in(weights: Dict[str, torch.Tensor]) -> None:
+    # read one element per page so that memory-mapped weights are resident before use, without a copy
+    for v in weights.values():
+        if v.numel():
+            v.reshape(-1)[::max(1, 4096 // v.element_size())].float().sum()
+
+
+class _StreamedBlock:
+    """ Callable for one block of a StreamingSequential, materializes -> runs -> releases the block. """
+
+    def __init__(self, parent: 'StreamingSequential', idx: int):
+        self.parent = parent
+        self.idx = idx
+
+    @property
+    def module(self) -> nn.Module:
+        return self.parent.get_module(self.idx)
+
+    def __call__(self, x: torch.Tensor, *args, **kwargs) -> Any:
+        return self.parent.run_block(self.idx, x, *args, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        # attributes of the (meta) block, ie `blk.attn` in loops that walk / configure the blocks
+        if name in ('parent', 'idx'):
+            raise AttributeError(name)  # not initialized yet (copy / unpickle)
+        return getattr(self.module, name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        if name in ('parent', 'idx'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.module, name, value)
+
+
+class StreamingSequential(nn.Sequential):
+    """ Sequential block container that streams block weights in on use.
+
+    Blocks are kept on the meta device (so the module tree, state_dict keys, and block attributes are
+    unchanged), their weights are kept in `block_weights` (usually memory-mapped views of a checkpoint file).
+    Iterating / indexing yields callables that materialize the block on the device and in the dtype of
+    its (first) input, run it, and release the weights again, so the `for blk in self.blocks` loops in
+    model forward fns work as is. Other attribute access on them is forwarded to the block.
+    """
+
+    def __init__(
+            self,
+            blocks: 'OrderedDict[str, nn.Module]',
+            block_weights: List[Dict[str, torch.Tensor]],
+            prefetch: bool = True,
+    ):
+        super().__init__(blocks)
+        assert len(block_weights) == len(blocks)
+        self.block_weights = block_weights
+        self.prefetch = prefetch
+        self._pending: Dict[int, Future] = {}
+
+    @classmethod
+    def from_module(cls, module: Union[nn.Sequential, nn.ModuleList], prefetch: bool = True) -> 'StreamingSequential':
+        """ Move the weights of each block of `module` out of the block and leave the block on meta. """
+        blocks = OrderedDict()
+        block_weights = []
+        for name, block in module.named_children():
+            # persistent state only, non-persistent buffers are re-created on materialization
+            block_weights.append({k: v.detach() for k, v in block.state_dict().items()})
+            blocks[name] = block.to_empty(device='meta')
+        return cls(blocks, block_weights, prefetch=prefetch)
+
+    def get_module(self, idx: int) -> nn.Module:
+        return super().__getitem__(idx)
+
+    def _wait_prefetch(self, idx: int) -> None:
+        future = self._pending.pop(idx, None)
+        if future is not None:
+            future.result()
+
+    def _start_prefetch(self, idx: int) -> None:
+        if self.prefetch and idx < len(self) and idx not in self._pending:
+            self._pending[idx] = _prefetch_executor().submit(_page_in, self.block_weights[idx])
+
+    def run_block(self, idx: int, x: torch.Tensor, *args, **kwargs) -> Any:
+        self._wait_prefetch(idx)
+        self._start_prefetch(idx + 1)
+
+        # no copy for (memory-mapped) CPU weights already matching the input device and dtype
+        device = x.device
+        dtype = x.dtype if x.is_floating_point() else None
+        weights = {
+            k: v.to(device=device, dtype=dtype if dtype is not None and v.is_floating_point() else v.dtype)
+            for k, v in self.block_weights[idx].items()
+        }
+        block = self.get_module(idx)
+        block.load_state_dict(weights, assign=True)
+        del weights
+        if not _materialize_meta_tensors(block, device=device):
+            raise RuntimeError(f'Unable to materialize all tensors of streamed block {idx}.')
+        try:
+            return block(x, *args, **kwargs)
+        finally:
+            block.to_empty(device='meta')
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        for blk in self:
+            x = blk(x)
+        return x
+
+    def __iter__(self) -> Iterator[_StreamedBlock]:
+        return iter([_StreamedBlock(self, i) for i in range(len(self))])
+
+    def __getitem__(self, idx: Union[int, slice]) -> Union[_StreamedBlock, 'StreamingSequential']:
+        if isinstance(idx, slice):
+            indices = range(len(self))[idx]
+            names = list(self._modules.keys())
+            return self.__class__(
+                OrderedDict((names[i], self.get_module(i)) for i in indices),
+                [self.block_weights[i] for i in indices],
+                prefetch=self.prefetch,
+            )
+        if idx < 0:
+            idx += len(self)
+        return _StreamedBlock(self, idx)
+
+    def _apply(self, fn, recurse=True):
+        # blocks stay on meta, weights are moved to the device / dtype of the input when materialized
+        return self
+
+    def state_dict(self, *args, destination=None, prefix='', keep_vars=False):
+        if destination is None:
+            destination = OrderedDict()
+        for name, weights in zip(self._modules.keys(), self.block_weights):
+            for k, v in weights.items():
+                destination[f'{prefix}{name}.{k}'] = v
+        return destination
+
+    def extra_repr(self) -> str:
+        return f'streaming=True, prefetch={self.prefetch}'
+
+
+def _resolve_block_attr(model: nn.Module) -> str:
+    for attr in ('blocks', 'stages', 'layers'):
+        module = getattr(model, attr, None)
+        if isinstance(module, (nn.Sequential, nn.ModuleList)):
+            return attr
+    raise RuntimeError(f'Unable to find a sequential block container to stream in {type(model).__name__}.')
+
+
+def stream_blocks(
+        model: nn.Module,
+        checkpoint_path: Optional[str] = None,
+        block_attr: Optional[str] = None,
+        prefetch: bool = True,
+) -> nn.Module:
+    """ Convert a model to layer-streaming inference.
+
+    Args:
+        model: Model to convert, in-place. Either with weights loaded (ideally memory-mapped, ie via
+            `create_model(..., meta_init=True)`), or on the meta device if `checkpoint_path` is set.
+        checkpoint_path: Optional checkpoint to memory-map and assign weights from.
+        block_attr: Attribute name of the block container, defaults to first of `blocks`, `stages`, `layers`.
+        prefetch: Read the next block's weights on a background thread.
+
+    Returns:
+        The model with its block container replaced by a StreamingSequential.
+    """
+    block_attr = block_attr or _resolve_block_attr(model)
+    if checkpoint_path:
+        state_dict = load_state_dict(checkpoint_path, mmap=True)
+        model.load_state_dict(state_dict, assign=True)
+        if not _materialize_meta_tensors(model):
+            raise RuntimeError(f'Unable to materialize all tensors of {type(model).__name__} from checkpoint.')
+
+    blocks = getattr(model, block_attr)
+    if isinstance(blocks, StreamingSequential):
+        return model
+    setattr(model, block_attr, StreamingSequential.from_module(blocks, prefetch=prefetch))
+    return model
@@ -60,6 +60,7 @@ from timm.layers import (
     resample_abs_pos_embed,
     resize_rel_pos_bias_table,
     ndgrid,
+    RelPosBiasCache,
 )
 
 from ._builder import build_model_with_cfg
@@ -174,6 +175,7 @@ class Attention(nn.Module):
             self.window_size = None
             self.relative_position_bias_table = None
             self.relative_position_index = None
+        self.bias_cache = RelPosBiasCache()
 
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(all_head_dim, dim, **dd)
@@ -182,12 +184,7 @@ class Attention(nn.Module):
         # TODO: skip init when on meta device when safe to do so
         self.reset_parameters()
 
-    def _get_rel_pos_bias(self) -> torch.Tensor:
-        """Get relative position bias for the attention window.
-
-        Returns:
-            Relative position bias tensor of shape (1, num_heads, window_area+1, window_area+1).
-        """
+    def _calc_rel_pos_bias(self) -> torch.Tensor:
         relative_position_bias = self.relative_position_bias_table[
             self.relative_position_index.view(-1)].view(
             self.window_size[0] * self.window_size[1] + 1,
@@ -195,6 +192,21 @@ class Attention(nn.Module):
         relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
         return relative_position_bias.unsqueeze(0)
 
+    @torch.jit.unused
+    def _cached_rel_pos_bias(self) -> torch.Tensor:
+        sources = (self.relative_position_bias_table, self.relative_position_index)
+        return self.bias_cache(self, self._calc_rel_pos_bias, sources, key=self.window_size)
+
+    def _get_rel_pos_bias(self) -> torch.Tensor:
+        """Get relative position bias for the attention window, cached in eval mode.
+
+        Returns:
+            Relative position bias tensor of shape (1, num_heads, window_area+1, window_area+1).
+        """
+        if torch.jit.is_scripting():
+            return self._calc_rel_pos_bias()
+        return self._cached_rel_pos_bias()
+
     def forward(self, x: torch.Tensor, shared_rel_pos_bias: Optional[torch.Tensor] = None) -> torch.Tensor:
         """Forward pass of attention module.
 
@@ -415,6 +427,7 @@ class RelativePositionBias(nn.Module):
             torch.empty((self.window_area + 1, self.window_area + 1), device=device, dtype=torch.long),
             persistent=False,
         )
+        self.bias_cache = RelPosBiasCache()
 
         # TODO: skip init when on meta device when safe to do so
         self.reset_parameters()
@@ -434,15 +447,25 @@ class RelativePositionBias(nn.Module):
         """Initialize non-persistent buffers."""
         self._init_buffers()
 
+    def _calc_bias(self) -> torch.Tensor:
+        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
+            self.window_area + 1, self.window_area + 1, -1)  # Wh*Ww,Wh*Ww,nH
+        return relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+
+    @torch.jit.unused
+    def _cached_bias(self) -> torch.Tensor:
+        sources = (self.relative_position_bias_table, self.relative_position_index)
+        return self.bias_cache(self, self._calc_bias, sources, key=self.window_size)
+
     def forward(self) -> torch.Tensor:
-        """Generate relative position bias.
+        """Generate relative position bias, cached in eval mode.
 
         Returns:
             Relative position bias tensor of shape (num_heads, window_area+1, window_area+1).
         """
-        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-            self.window_area + 1, self.window_area + 1, -1)  # Wh*Ww,Wh*Ww,nH
-        return relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+        if torch.jit.is_scripting():
+            return self._calc_bias()
+        return self._cached_bias()
 
 
 class Beit(nn.Module):
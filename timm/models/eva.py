@@ -86,6 +86,7 @@ from timm.layers import (
     trunc_normal_,
     resample_patch_embed,
     resample_abs_pos_embed,
+    PosEmbedCache,
     global_pool_nlc,
     to_2tuple,
     use_fused_attn,
@@ -93,6 +94,7 @@ from timm.layers import (
     resolve_self_attn_mask,
     AttentionRope,
     AttentionPoolLatent,
+    LocalAttnMixin,
 )
 from ._builder import build_model_with_cfg
 from ._features import feature_take_indices
@@ -102,7 +104,7 @@ from ._registry import generate_default_cfgs, register_model
 __all__ = ['Eva']
 
 
-class EvaAttention(nn.Module):
+class EvaAttention(nn.Module, LocalAttnMixin):
     """ EVA Attention with ROPE, no k-bias, and fused/unfused qkv options
     """
     fused_attn: torch.jit.Final[bool]
@@ -181,6 +183,8 @@ class EvaAttention(nn.Module):
         self.proj = nn.Linear(attn_dim, dim, **dd)
         self.proj_drop = nn.Dropout(proj_drop)
 
+        self._init_local_attn()
+
         # TODO: skip init when on meta device when safe to do so
         self.reset_parameters()
 
@@ -202,6 +206,7 @@ class EvaAttention(nn.Module):
             rope: Optional[torch.Tensor] = None,
             attn_mask: Optional[torch.Tensor] = None,
             is_causal: bool = False,
+            feat_size: Optional[Tuple[int, int]] = None,
     ):
         """Forward pass for the attention module.
 
@@ -210,6 +215,7 @@ class EvaAttention(nn.Module):
             rope: Rotary position embeddings tensor for position-aware attention
             attn_mask: Optional attention mask to apply during attention computation
             is_causal: If True, use causal (autoregressive) masking
+            feat_size: Patch grid (H, W) for local attention, overrides the grid set via set_local_attn()
 
         Returns:
             Tensor of shape (batch_size, sequence_length, embedding_dim)
@@ -242,7 +248,16 @@ class EvaAttention(nn.Module):
             q = torch.cat([q[:, :, :npt, :], apply_rot_embed_cat(q[:, :, npt:, :], rope, half=half)], dim=2).type_as(v)
             k = torch.cat([k[:, :, :npt, :], apply_rot_embed_cat(k[:, :, npt:, :], rope, half=half)], dim=2).type_as(v)
 
-        if self.fused_attn:
+        if self.local_window_size is not None:
+            assert attn_mask is None and not is_causal, 'attn_mask and is_causal not supported w/ local attention'
+            x = self._local_attn(
+                q, k, v,
+                num_prefix_tokens=self.num_prefix_tokens,
+                dropout_p=self.attn_drop.p if self.training else 0.,
+                fused=self.fused_attn,
+                feat_size=feat_size,
+            )
+        elif self.fused_attn:
             x = F.scaled_dot_product_attention(
                 q, k, v,
                 attn_mask=attn_mask,
@@ -395,12 +410,13 @@ class EvaBlock(nn.Module):
             rope: Optional[torch.Tensor] = None,
             attn_mask: Optional[torch.Tensor] = None,
             is_causal: bool = False,
+            feat_size: Optional[Tuple[int, int]] = None,
     ) -> torch.Tensor:
         if self.gamma_1 is None:
-            x = x + self.drop_path1(self.attn(self.norm1(x), rope=rope, attn_mask=attn_mask, is_causal=is_causal))
+            x = x + self.drop_path1(self.attn(self.norm1(x), rope=rope, attn_mask=attn_mask, is_causal=is_causal, feat_size=feat_size))
             x = x + self.drop_path2(self.mlp(self.norm2(x)))
         else:
-            x = x + self.drop_path1(self.gamma_1 * self.attn(self.norm1(x), rope=rope, attn_mask=attn_mask, is_causal=is_causal))
+            x = x + self.drop_path1(self.gamma_1 * self.attn(self.norm1(x), rope=rope, attn_mask=attn_mask, is_causal=is_causal, feat_size=feat_size))
             x = x + self.drop_path2(self.gamma_2 * self.mlp(self.norm2(x)))
         return x
 
@@ -517,8 +533,9 @@ class EvaBlockPostNorm(nn.Module):
             rope: Optional[torch.Tensor] = None,
             attn_mask: Optional[torch.Tensor] = None,
             is_causal: bool = False,
+            feat_size: Optional[Tuple[int, int]] = None,
     ) -> torch.Tensor:
-        x = x + self.drop_path1(self.norm1(self.attn(x, rope=rope, attn_mask=attn_mask, is_causal=is_causal)))
+        x = x + self.drop_path1(self.norm1(self.attn(x, rope=rope, attn_mask=attn_mask, is_causal=is_causal, feat_size=feat_size)))
         x = x + self.drop_path2(self.norm2(self.mlp(x)))
         return x
 
@@ -577,6 +594,10 @@ class Eva(nn.Module):
             dynamic_img_pad: bool = False,
             ref_feat_shape: Optional[Union[Tuple[int, int], int]] = None,
             head_init_scale: float = 0.001,
+            local_attn_window: Optional[Union[int, Tuple[int, int]]] = None,
+            local_attn_mode: str = 'window',
+            local_attn_blocks: Optional[Tuple[int, ...]] = None,
+            local_attn_global_prefix: bool = True,
             device=None,
             dtype=None,
     ):
@@ -626,6 +647,10 @@ class Eva(nn.Module):
             dynamic_img_pad: Apply dynamic padding for irregular image sizes
             ref_feat_shape: Reference feature shape for rotary position embedding scale
             head_init_scale: Initialization scale for classification head weights
+            local_attn_window: Use local attention w/ this window size (in patches) instead of global attention
+            local_attn_mode: Local attention mode, 'window' or 'neighborhood'
+            local_attn_blocks: Indices of blocks using local attention, all blocks if None
+            local_attn_global_prefix: Keep global attention to and from prefix (cls / reg) tokens
         """
         super().__init__()
         dd = {'device': device, 'dtype': dtype}
@@ -673,6 +698,8 @@ class Eva(nn.Module):
 
         num_pos_tokens = num_patches if no_embed_class else num_patches + self.num_prefix_tokens
         self.pos_embed = nn.Parameter(torch.empty(1, num_pos_tokens, embed_dim, **dd)) if use_abs_pos_emb else None
+        # pos embeds resampled to recently seen grid sizes w/ dynamic_img_size
+        self.pos_embed_cache = PosEmbedCache()
         self.pos_drop = nn.Dropout(p=pos_drop_rate)
         if patch_drop_rate > 0:
             self.patch_drop = PatchDropoutWithIndices(patch_drop_rate, num_prefix_tokens=self.num_prefix_tokens)
@@ -736,6 +763,15 @@ class Eva(nn.Module):
             dict(module=f'blocks.{i}', num_chs=embed_dim, reduction=r) for i in range(depth)]
 
         self.norm = norm_layer(embed_dim, **dd) if activate_post_norm else nn.Identity()
+        self.has_local_attn = False
+        if local_attn_window is not None:
+            assert not patch_drop_rate, 'patch dropout is not supported w/ local attention'
+            self.set_local_attn(
+                local_attn_window,
+                mode=local_attn_mode,
+                block_indices=local_attn_blocks,
+                global_prefix=local_attn_global_prefix,
+            )
 
         if global_pool == 'map':
             self.attn_pool = AttentionPoolLatent(
@@ -862,17 +898,76 @@ class Eva(nn.Module):
         if self.rope is not None:
             self.rope.update_feat_shape(self.patch_embed.grid_size)
 
+        if self.has_local_attn:
+            self._set_local_attn_feat_size(self.patch_embed.grid_size)
+
+    def set_local_attn(
+            self,
+            window_size: Optional[Union[int, Tuple[int, int]]],
+            mode: str = 'window',
+            block_indices: Optional[Tuple[int, ...]] = None,
+            global_prefix: bool = True,
+    ) -> None:
+        """Switch blocks between global and local (windowed / neighborhood) attention.
+
+        Weights are not modified, pretrained global attention weights are used as is.
+
+        Args:
+            window_size: Local attention window size (in patches), None to restore global attention.
+            mode: 'window' for non-overlapping windows, 'neighborhood' for a sliding window centered on each patch.
+            block_indices: Blocks to use local attention in (negative indices allowed), all blocks if None.
+            global_prefix: Keep global attention to and from prefix (cls / reg) tokens.
+        """
+        depth = len(self.blocks)
+        indices = set(range(depth)) if block_indices is None else {i % depth for i in block_indices}
+        for i, blk in enumerate(self.blocks):
+            use_local = window_size is not None and i in indices
+            blk.attn.set_local_attn(
+                window_size if use_local else None,
+                mode=mode,
+                feat_size=self.patch_embed.grid_size,
+                global_prefix=global_prefix,
+            )
+        self.has_local_attn = window_size is not None and len(indices) > 0
+
+    @torch.jit.unused
+    def _set_local_attn_feat_size(self, feat_size: Tuple[int, int]) -> None:
+        for blk in self.blocks:
+            if blk.attn.local_window_size is not None:
+                blk.attn.local_feat_size = tuple(feat_size)
+
+    def _local_attn_feat_size(self, x: torch.Tensor) -> Optional[Tuple[int, int]]:
+        """Patch grid of the current input for local attention, passed to blocks instead of set on modules."""
+        feat_size: Optional[Tuple[int, int]] = None
+        if self.dynamic_img_size and self.has_local_attn:
+            feat_size = (x.shape[1], x.shape[2])  # x is NHWC here
+        return feat_size
+
+    def _resample_pos_embed(self, H: int, W: int) -> torch.Tensor:
+        """Resample absolute position embedding to a (H, W) grid."""
+        return resample_abs_pos_embed(
+            self.pos_embed,
+            new_size=(H, W),
+            old_size=self.patch_embed.grid_size,
+            num_prefix_tokens=0 if self.no_embed_class else self.num_prefix_tokens,
+        )
+
+    @torch.jit.unused
+    def _cached_resample_pos_embed(self, H: int, W: int) -> torch.Tensor:
+        return self.pos_embed_cache(
+            lambda: self._resample_pos_embed(H, W),
+            (self.pos_embed,),
+            key=(H, W) + tuple(self.patch_embed.grid_size),
+        )
+
     def _pos_embed(self, x) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
         if self.dynamic_img_size:
             B, H, W, C = x.shape
             if self.pos_embed is not None:
-                prev_grid_size = self.patch_embed.grid_size
-                pos_embed = resample_abs_pos_embed(
-                    self.pos_embed,
-                    new_size=(H, W),
-                    old_size=prev_grid_size,
-                    num_prefix_tokens=0 if self.no_embed_class else self.num_prefix_tokens,
-                )
+                if torch.jit.is_scripting():
+                    pos_embed = self._resample_pos_embed(H, W)
+                else:
+                    pos_embed = self._cached_resample_pos_embed(H, W)
             else:
                 pos_embed = None
             x = x.view(B, -1, C)
@@ -949,6 +1044,7 @@ class Eva(nn.Module):
         # forward pass
         B, _, height, width = x.shape
         x = self.patch_embed(x)
+        feat_size = self._local_attn_feat_size(x)
         x, rot_pos_embed = self._pos_embed(x)
         x = self.norm_pre(x)
         if torch.jit.is_scripting() or not stop_early:  # can't slice blocks in torchscript
@@ -960,17 +1056,17 @@ class Eva(nn.Module):
         if getattr(self, 'rope_mixed', False) and rot_pos_embed is not None:
             for i, blk in enumerate(blocks):
                 if self.grad_checkpointing and not torch.jit.is_scripting():
-                    x = checkpoint(blk, x, rope=rot_pos_embed[i], attn_mask=attn_mask, is_causal=is_causal)
+                    x = checkpoint(blk, x, rope=rot_pos_embed[i], attn_mask=attn_mask, is_causal=is_causal, feat_size=feat_size)
                 else:
-                    x = blk(x, rope=rot_pos_embed[i], attn_mask=attn_mask, is_causal=is_causal)
+                    x = blk(x, rope=rot_pos_embed[i], attn_mask=attn_mask, is_causal=is_causal, feat_size=feat_size)
                 if i in take_indices:
                     intermediates.append(self.norm(x) if norm else x)
         else:
             for i, blk in enumerate(blocks):
                 if self.grad_checkpointing and not torch.jit.is_scripting():
-                    x = checkpoint(blk, x, rope=rot_pos_embed, attn_mask=attn_mask, is_causal=is_causal)
+                    x = checkpoint(blk, x, rope=rot_pos_embed, attn_mask=attn_mask, is_causal=is_causal, feat_size=feat_size)
                 else:
-                    x = blk(x, rope=rot_pos_embed, attn_mask=attn_mask, is_causal=is_causal)
+                    x = blk(x, rope=rot_pos_embed, attn_mask=attn_mask, is_causal=is_causal, feat_size=feat_size)
                 if i in take_indices:
                     intermediates.append(self.norm(x) if norm else x)
 
@@ -1037,6 +1133,7 @@ class Eva(nn.Module):
             Feature tensor.
         """
         x = self.patch_embed(x)
+        feat_size = self._local_attn_feat_size(x)
         x, rot_pos_embed = self._pos_embed(x)
         x = self.norm_pre(x)
 
@@ -1045,16 +1142,16 @@ class Eva(nn.Module):
             # pos embed has shape (depth, num_heads, H*W, dim) or (depth, batch_size, num_heads, H*W, dim)
             for i, blk in enumerate(self.blocks):
                 if self.grad_checkpointing and not torch.jit.is_scripting():
-                    x = checkpoint(blk, x, rope=rot_pos_embed[i], attn_mask=attn_mask, is_causal=is_causal)
+                    x = checkpoint(blk, x, rope=rot_pos_embed[i], attn_mask=attn_mask, is_causal=is_causal, feat_size=feat_size)
                 else:
-                    x = blk(x, rope=rot_pos_embed[i], attn_mask=attn_mask, is_causal=is_causal)
+                    x = blk(x, rope=rot_pos_embed[i], attn_mask=attn_mask, is_causal=is_causal, feat_size=feat_size)
         else:
             # Standard path for non-mixed mode
             for blk in self.blocks:
                 if self.grad_checkpointing and not torch.jit.is_scripting():
-                    x = checkpoint(blk, x, rope=rot_pos_embed, attn_mask=attn_mask, is_causal=is_causal)
+                    x = checkpoint(blk, x, rope=rot_pos_embed, attn_mask=attn_mask, is_causal=is_causal, feat_size=feat_size)
                 else:
-                    x = blk(x, rope=rot_pos_embed, attn_mask=attn_mask, is_causal=is_causal)
+                    x = blk(x, rope=rot_pos_embed, attn_mask=attn_mask, is_causal=is_causal, feat_size=feat_size)
 
         x = self.norm(x)
         return x
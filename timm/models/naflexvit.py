@@ -33,6 +33,7 @@ from timm.layers import (
     LayerNorm,
     PatchDropoutWithIndices,
     PatchEmbedInterpolator,
+    PosEmbedCache,
     _assert,
     to_2tuple,
     get_act_layer,
@@ -526,6 +527,9 @@ class NaFlexEmbeds(nn.Module):
             self.pos_embed = nn.Parameter(torch.empty(1, h, w, embed_dim, **dd))
             self.pos_embed_type = 'learned'
 
+        # learned pos embeds interpolated to recently seen grid sizes
+        self.pos_embed_cache = PosEmbedCache()
+
         # Dropout layer
         self.pos_drop = nn.Dropout(p=pos_drop_rate)
 
@@ -585,6 +589,44 @@ class NaFlexEmbeds(nn.Module):
         else:
             return img_size[0] // self.patch_size[0], img_size[1] // self.patch_size[1]
 
+    def _interp_learned_pos_embed(
+            self,
+            grid_size: List[int],
+            dtype: torch.dtype,
+    ) -> torch.Tensor:
+        """Return the learned 2D position embedding resized to grid_size as a (1, H*W, C) sequence."""
+        orig_h, orig_w = self.pos_embed.shape[1:3]
+        if grid_size[0] == orig_h and grid_size[1] == orig_w:
+            # No resize needed, just flatten
+            pos_embed_flat = self.pos_embed.reshape(1, orig_h * orig_w, -1)
+        else:
+            # Resize if needed - directly using F.interpolate
+            if self.pos_embed_ar_preserving:
+                L = max(grid_size)
+                _interp_size = L, L
+            else:
+                _interp_size = grid_size
+            pos_embed_flat = F.interpolate(
+                self.pos_embed.permute(0, 3, 1, 2).float(),  # B,C,H,W
+                size=_interp_size,
+                mode=self.pos_embed_interp_mode,
+                align_corners=False,
+                antialias=True,
+            )[:, :, :grid_size[0], :grid_size[1]].flatten(2).transpose(1, 2)
+        return pos_embed_flat.to(dtype=dtype)
+
+    def _get_learned_pos_embed_flat(
+            self,
+            grid_size: List[int],
+            dtype: torch.dtype,
+    ) -> torch.Tensor:
+        """Interpolated learned position embedding, cached per (grid size, dtype) when no grad is needed."""
+        return self.pos_embed_cache(
+            lambda: self._interp_learned_pos_embed(grid_size, dtype),
+            (self.pos_embed,),
+            key=tuple(grid_size) + (dtype,),
+        )
+
     @disable_compiler
     def _apply_learned_naflex_pos_embed(
             self,
@@ -602,28 +644,6 @@ class NaFlexEmbeds(nn.Module):
         """
         # Calculate grid sizes from patch coordinates
         naflex_grid_sizes = calculate_naflex_grid_sizes(patch_coord)
-        orig_h, orig_w = self.pos_embed.shape[1:3]
-        pos_embed_nchw = self.pos_embed.permute(0, 3, 1, 2).float()  # B,C,H,W
-
-        def _interp2d(size):
-            """
-            Return a flattened positional-embedding grid at an arbitrary spatial resolution.
-
-            Converts the learned 2-D table stored in NCHW format (pos_embed_nchw) into
-            a (1, H*W, C) sequence that matches the requested size.
-            """
-            if (size[0] == orig_h) and (size[1] == orig_w):
-                pos_embed_flat = self.pos_embed.reshape(1, orig_h * orig_w, -1)
-            else:
-                _interp_size = to_2tuple(max(size)) if self.pos_embed_ar_preserving else size
-                pos_embed_flat = F.interpolate(
-                    pos_embed_nchw,
-                    size=_interp_size,
-                    mode=self.pos_embed_interp_mode,
-                    align_corners=False,
-                    antialias=True,
-                )[:, :, :size[0], :size[1]].flatten(2).transpose(1, 2)
-            return pos_embed_flat.to(dtype=x.dtype)
 
         # Determine unique grid sizes to avoid duplicate interpolation
         size_to_indices: Dict[Tuple[int, int], List[int]] = {}
@@ -634,7 +654,7 @@ class NaFlexEmbeds(nn.Module):
         for k, batch_indices in size_to_indices.items():
             # h, w = k >> 16, k & 0xFFFF  # FIXME can get jit compat with this
             # Interpolate only once for this (h, w)
-            pos_embed_flat = _interp2d(k)
+            pos_embed_flat = self._get_learned_pos_embed_flat(k, x.dtype)
             seq_len = min(x.shape[1], pos_embed_flat.shape[1])
             x[:, :seq_len].index_add_(
                 0,
@@ -685,26 +705,7 @@ class NaFlexEmbeds(nn.Module):
             x: Input tensor to add position embeddings to [B, H*W, C]
             grid_size: Target grid size as [height, width]
         """
-        orig_h, orig_w = self.pos_embed.shape[1:3]
-        if grid_size[0] == orig_h and grid_size[1] == orig_w:
-            # No resize needed, just flatten
-            pos_embed_flat = self.pos_embed.reshape(1, orig_h * orig_w, -1)
-        else:
-            # Resize if needed - directly using F.interpolate
-            if self.pos_embed_ar_preserving:
-                L = max(grid_size)
-                _interp_size = L, L
-            else:
-                _interp_size = grid_size
-            pos_embed_flat = F.interpolate(
-                self.pos_embed.permute(0, 3, 1, 2).float(),  # B,C,H,W
-                size=_interp_size,
-                mode=self.pos_embed_interp_mode,
-                align_corners=False,
-                antialias=True,
-            )[:, :, :grid_size[0], :grid_size[1]].flatten(2).transpose(1, 2)
-        pos_embed_flat = pos_embed_flat.to(dtype=x.dtype)
-
+        pos_embed_flat = self._get_learned_pos_embed_flat(grid_size, x.dtype)
         x.add_(pos_embed_flat)
 
     @disable_compiler
@@ -24,7 +24,8 @@ import torch.nn as nn
 
 from timm.data import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 from timm.layers import PatchEmbed, Mlp, DropPath, calculate_drop_path_rates, ClassifierHead, to_2tuple, to_ntuple, trunc_normal_, \
-    use_fused_attn, resize_rel_pos_bias_table, resample_patch_embed, ndgrid
+    use_fused_attn, resize_rel_pos_bias_table, resample_patch_embed, ndgrid, RelPosBiasCache, PosEmbedCache, \
+    shifted_window_mask
 from ._builder import build_model_with_cfg
 from ._features import feature_take_indices
 from ._features_fx import register_notrace_function
@@ -158,6 +159,9 @@ class WindowAttention(nn.Module):
         self.proj = nn.Linear(attn_dim, dim, **dd)
         self.proj_drop = nn.Dropout(proj_drop)
         self.softmax = nn.Softmax(dim=-1)
+        self.bias_cache = RelPosBiasCache()
+        # (nW, nH, N, N) bias + shifted window mask per feature size, bounded by size as it grows w/ resolution
+        self.mask_bias_cache = RelPosBiasCache(max_size=8, max_bytes=64 * 2**20)
 
         # TODO: skip init when on meta device when safe to do so
         self.reset_parameters()
@@ -199,18 +203,63 @@ class WindowAttention(nn.Module):
                 persistent=False,
             )
 
-    def _get_rel_pos_bias(self) -> torch.Tensor:
+    def _calc_rel_pos_bias(self) -> torch.Tensor:
         relative_position_bias = self.relative_position_bias_table[
             self.relative_position_index.view(-1)].view(self.window_area, self.window_area, -1)  # Wh*Ww,Wh*Ww,nH
         relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
         return relative_position_bias.unsqueeze(0)
 
-    def forward(self, x: torch.Tensor, mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+    @torch.jit.unused
+    def _cached_rel_pos_bias(self) -> torch.Tensor:
+        sources = (self.relative_position_bias_table, self.relative_position_index)
+        return self.bias_cache(self, self._calc_rel_pos_bias, sources, key=self.window_size)
+
+    def _get_rel_pos_bias(self) -> torch.Tensor:
+        if torch.jit.is_scripting():
+            return self._calc_rel_pos_bias()
+        return self._cached_rel_pos_bias()
+
+    def _calc_masked_rel_pos_bias(self, mask: torch.Tensor) -> torch.Tensor:
+        # combine (1, nH, N, N) bias w/ (nW, N, N) window mask -> (nW, nH, N, N)
+        bias = self._get_rel_pos_bias()
+        mask = mask.unsqueeze(1)
+        if mask.dtype == torch.bool:
+            return bias.expand(mask.shape[0], -1, -1, -1).masked_fill(~mask, float('-inf'))
+        return bias + mask
+
+    @torch.jit.unused
+    def _cached_masked_rel_pos_bias(self, mask: torch.Tensor, mask_key: Tuple[int, int, int, int]) -> torch.Tensor:
+        sources = (self.relative_position_bias_table, self.relative_position_index)
+        return self.mask_bias_cache(
+            self,
+            lambda: self._calc_masked_rel_pos_bias(mask),
+            sources,
+            key=self.window_size + tuple(mask_key) + (mask.dtype,),
+        )
+
+    def _get_masked_rel_pos_bias(
+            self,
+            mask: torch.Tensor,
+            mask_key: Optional[Tuple[int, int, int, int]] = None,
+    ) -> torch.Tensor:
+        if torch.jit.is_scripting() or mask_key is None:
+            return self._calc_masked_rel_pos_bias(mask)
+        return self._cached_masked_rel_pos_bias(mask, mask_key)
+
+    def forward(
+            self,
+            x: torch.Tensor,
+            mask: Optional[torch.Tensor] = None,
+            mask_key: Optional[Tuple[int, int, int, int]] = None,
+    ) -> torch.Tensor:
         """Forward pass.
 
         Args:
             x: Input features with shape of (num_windows*B, N, C).
-            mask: (0/-inf) mask with shape of (num_windows, Wh*Ww, Wh*Ww) or None.
+            mask: Additive (0/-100) float or boolean (True = attend) mask with shape of
+                (num_windows, Wh*Ww, Wh*Ww) or None.
+            mask_key: (padded height, padded width, shift h, shift w) the mask was built for, the bias + mask
+                is cached per key (in eval mode) if set.
 
         Returns:
             Output features with shape of (num_windows*B, N, C).
@@ -219,25 +268,30 @@ class WindowAttention(nn.Module):
         qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
         q, k, v = qkv.unbind(0)
 
+        num_win = 1
+        if mask is None:
+            attn_bias = self._get_rel_pos_bias()  # 1, nH, N, N
+        else:
+            num_win = mask.shape[0]
+            attn_bias = self._get_masked_rel_pos_bias(mask, mask_key)  # nW, nH, N, N
+
         if self.fused_attn:
-            attn_mask = self._get_rel_pos_bias()
             if mask is not None:
-                num_win = mask.shape[0]
-                mask = mask.view(1, num_win, 1, N, N).expand(B_ // num_win, -1, self.num_heads, -1, -1)
-                attn_mask = attn_mask + mask.reshape(-1, self.num_heads, N, N)
+                attn_bias = attn_bias.unsqueeze(0).expand(B_ // num_win, -1, -1, -1, -1)
+                attn_bias = attn_bias.reshape(-1, self.num_heads, N, N)
             x = torch.nn.functional.scaled_dot_product_attention(
                 q, k, v,
-                attn_mask=attn_mask,
+                attn_mask=attn_bias,
                 dropout_p=self.attn_drop.p if self.training else 0.,
             )
         else:
             q = q * self.scale
             attn = q @ k.transpose(-2, -1)
-            attn = attn + self._get_rel_pos_bias()
             if mask is not None:
-                num_win = mask.shape[0]
-                attn = attn.view(-1, num_win, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)
+                attn = attn.view(-1, num_win, self.num_heads, N, N) + attn_bias.unsqueeze(0)
                 attn = attn.view(-1, self.num_heads, N, N)
+            else:
+                attn = attn + attn_bias
             attn = self.softmax(attn)
             attn = self.attn_drop(attn)
             x = attn @ v
@@ -268,6 +322,7 @@ class SwinTransformerBlock(nn.Module):
             shift_size: int = 0,
             always_partition: bool = False,
             dynamic_mask: bool = False,
+            bool_attn_mask: bool = False,
             mlp_ratio: float = 4.,
             qkv_bias: bool = True,
             proj_drop: float = 0.,
@@ -287,6 +342,8 @@ class SwinTransformerBlock(nn.Module):
             head_dim: Enforce the number of channels per head
             shift_size: Shift size for SW-MSA.
             always_partition: Always partition into full windows and shift
+            dynamic_mask: Create attention mask in forward based on current input size, cached per size.
+            bool_attn_mask: Use boolean shifted window masks (masked with -inf) instead of additive -100.
             mlp_ratio: Ratio of mlp hidden dim to embedding dim.
             qkv_bias: If True, add a learnable bias to query, key, value.
             proj_drop: Dropout rate.
@@ -302,9 +359,11 @@ class SwinTransformerBlock(nn.Module):
         self.target_shift_size = to_2tuple(shift_size)  # store for later resize
         self.always_partition = always_partition
         self.dynamic_mask = dynamic_mask
+        self.bool_attn_mask = bool_attn_mask
         self.window_size, self.shift_size = self._calc_window_shift(window_size, shift_size)
         self.window_area = self.window_size[0] * self.window_size[1]
         self.mlp_ratio = mlp_ratio
+        self.mask_cache = PosEmbedCache(max_size=8)  # dynamic_mask masks for recently seen feature sizes
 
         self.norm1 = norm_layer(dim, **dd)
         self.attn = WindowAttention(
@@ -361,32 +420,26 @@ class SwinTransformerBlock(nn.Module):
                 dtype = x.dtype
             else:
                 H, W = self.input_resolution
-                device = device
-                dtype = dtype
-            H = math.ceil(H / self.window_size[0]) * self.window_size[0]
-            W = math.ceil(W / self.window_size[1]) * self.window_size[1]
-            img_mask = torch.zeros((1, H, W, 1), dtype=dtype, device=device)  # 1 H W 1
-            cnt = 0
-            for h in (
-                    (0, -self.window_size[0]),
-                    (-self.window_size[0], -self.shift_size[0]),
-                    (-self.shift_size[0], None),
-            ):
-                for w in (
-                        (0, -self.window_size[1]),
-                        (-self.window_size[1], -self.shift_size[1]),
-                        (-self.shift_size[1], None),
-                ):
-                    img_mask[:, h[0]:h[1], w[0]:w[1], :] = cnt
-                    cnt += 1
-            mask_windows = window_partition(img_mask, self.window_size)  # nW, window_size, window_size, 1
-            mask_windows = mask_windows.view(-1, self.window_area)
-            attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-            attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
+            mask = shifted_window_mask((H, W), self.window_size, self.shift_size, device=device)  # nW, N, N
+            if self.bool_attn_mask:
+                return mask
+            attn_mask = torch.zeros(mask.shape, device=device, dtype=dtype).masked_fill_(~mask, -100.)
         else:
             attn_mask = None
         return attn_mask
 
+    @torch.jit.unused
+    def _cached_attn_mask(self, x: torch.Tensor) -> Optional[torch.Tensor]:
+        if not any(self.shift_size):
+            return None
+        key = (x.shape[1], x.shape[2], self.window_size, self.shift_size, x.device, x.dtype)
+        return self.mask_cache(lambda: self.get_attn_mask(x), (), key=key)
+
+    def _get_dynamic_attn_mask(self, x: torch.Tensor) -> Optional[torch.Tensor]:
+        if torch.jit.is_scripting():
+            return self.get_attn_mask(x)
+        return self._cached_attn_mask(x)
+
     def _calc_window_shift(
             self,
             target_window_size: Union[int, Tuple[int, int]],
@@ -456,10 +509,11 @@ class SwinTransformerBlock(nn.Module):
 
         # W-MSA/SW-MSA
         if getattr(self, 'dynamic_mask', False):
-            attn_mask = self.get_attn_mask(shifted_x)
+            attn_mask = self._get_dynamic_attn_mask(shifted_x)
         else:
             attn_mask = self.attn_mask
-        attn_windows = self.attn(x_windows, mask=attn_mask)  # nW*B, window_size*window_size, C
+        mask_key = (Hp, Wp, self.shift_size[0], self.shift_size[1])
+        attn_windows = self.attn(x_windows, mask=attn_mask, mask_key=mask_key)  # nW*B, window_size*window_size, C
 
         # merge windows
         attn_windows = attn_windows.view(-1, self.window_size[0], self.window_size[1], C)
@@ -560,6 +614,7 @@ class SwinTransformerStage(nn.Module):
             window_size: _int_or_tuple_2_t = 7,
             always_partition: bool = False,
             dynamic_mask: bool = False,
+            bool_attn_mask: bool = False,
             mlp_ratio: float = 4.,
             qkv_bias: bool = True,
             proj_drop: float = 0.,
@@ -579,6 +634,9 @@ class SwinTransformerStage(nn.Module):
             num_heads: Number of attention heads.
             head_dim: Channels per head (dim // num_heads if not set)
             window_size: Local window size.
+            always_partition: Always partition into full windows and shift
+            dynamic_mask: Create attention mask in forward based on current input size.
+            bool_attn_mask: Use boolean shifted window attention masks.
             mlp_ratio: Ratio of mlp hidden dim to embedding dim.
             qkv_bias: If True, add a learnable bias to query, key, value.
             proj_drop: Projection dropout rate.
@@ -619,6 +677,7 @@ class SwinTransformerStage(nn.Module):
                 shift_size=0 if (i % 2 == 0) else shift_size,
                 always_partition=always_partition,
                 dynamic_mask=dynamic_mask,
+                bool_attn_mask=bool_attn_mask,
                 mlp_ratio=mlp_ratio,
                 qkv_bias=qkv_bias,
                 proj_drop=proj_drop,
@@ -693,6 +752,7 @@ class SwinTransformer(nn.Module):
             window_size: _int_or_tuple_2_t = 7,
             always_partition: bool = False,
             strict_img_size: bool = True,
+            bool_attn_mask: bool = False,
             mlp_ratio: float = 4.,
             qkv_bias: bool = True,
             drop_rate: float = 0.,
@@ -717,6 +777,10 @@ class SwinTransformer(nn.Module):
             num_heads: Number of attention heads in different layers.
             head_dim: Dimension of self-attention heads.
             window_size: Window size.
+            always_partition: Always partition into full windows and shift.
+            strict_img_size: Input size must match img_size, otherwise masks are built (and cached) per input size.
+            bool_attn_mask: Use boolean shifted window attention masks, masked positions get -inf instead of the
+                additive -100, so outputs differ (slightly) from the numerics the pretrained weights were trained w/.
             mlp_ratio: Ratio of mlp hidden dim to embedding dim.
             qkv_bias: If True, add a learnable bias to query, key, value.
             drop_rate: Dropout rate.
@@ -782,6 +846,7 @@ class SwinTransformer(nn.Module):
                 window_size=window_size[i],
                 always_partition=always_partition,
                 dynamic_mask=not strict_img_size,
+                bool_attn_mask=bool_attn_mask,
                 mlp_ratio=mlp_ratio[i],
                 qkv_bias=qkv_bias,
                 proj_drop=proj_drop_rate,
@@ -22,7 +22,7 @@ import torch.nn.functional as F
 
 from timm.data import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 from timm.layers import PatchEmbed, Mlp, DropPath, calculate_drop_path_rates, to_2tuple, trunc_normal_, ClassifierHead,\
-    resample_patch_embed, ndgrid, get_act_layer, LayerType
+    resample_patch_embed, ndgrid, get_act_layer, LayerType, RelPosBiasCache, PosEmbedCache, shifted_window_mask
 from ._builder import build_model_with_cfg
 from ._features import feature_take_indices
 from ._features_fx import register_notrace_function
@@ -138,6 +138,7 @@ class WindowAttention(nn.Module):
         self.proj = nn.Linear(dim, dim, **dd)
         self.proj_drop = nn.Dropout(proj_drop)
         self.softmax = nn.Softmax(dim=-1)
+        self.bias_cache = RelPosBiasCache()
 
         # Register empty buffers with correct shapes
         win_h, win_w = self.window_size
@@ -236,12 +237,31 @@ class WindowAttention(nn.Module):
         """Initialize non-persistent buffers."""
         self._init_buffers()
 
+    def _calc_rel_pos_bias(self) -> torch.Tensor:
+        relative_position_bias_table = self.cpb_mlp(self.relative_coords_table).view(-1, self.num_heads)
+        relative_position_bias = relative_position_bias_table[self.relative_position_index.view(-1)].view(
+            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
+        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+        relative_position_bias = 16 * torch.sigmoid(relative_position_bias)
+        return relative_position_bias.unsqueeze(0)
+
+    @torch.jit.unused
+    def _cached_rel_pos_bias(self) -> torch.Tensor:
+        sources = tuple(self.cpb_mlp.parameters()) + (self.relative_coords_table, self.relative_position_index)
+        return self.bias_cache(self, self._calc_rel_pos_bias, sources, key=self.window_size)
+
+    def _get_rel_pos_bias(self) -> torch.Tensor:
+        if torch.jit.is_scripting():
+            return self._calc_rel_pos_bias()
+        return self._cached_rel_pos_bias()
+
     def forward(self, x: torch.Tensor, mask: Optional[torch.Tensor] = None) -> torch.Tensor:
         """Forward pass of window attention.
 
         Args:
             x: Input features with shape of (num_windows*B, N, C).
-            mask: Attention mask with shape of (num_windows, Wh*Ww, Wh*Ww) or None.
+            mask: Additive (0/-100) float or boolean (True = attend) mask with shape of
+                (num_windows, Wh*Ww, Wh*Ww) or None.
 
         Returns:
             Output features with shape of (num_windows*B, N, C).
@@ -265,16 +285,16 @@ class WindowAttention(nn.Module):
         logit_scale = torch.clamp(self.logit_scale, max=math.log(1. / 0.01)).exp()
         attn = attn * logit_scale
 
-        relative_position_bias_table = self.cpb_mlp(self.relative_coords_table).view(-1, self.num_heads)
-        relative_position_bias = relative_position_bias_table[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
-        relative_position_bias = 16 * torch.sigmoid(relative_position_bias)
-        attn = attn + relative_position_bias.unsqueeze(0)
+        attn = attn + self._get_rel_pos_bias()
 
         if mask is not None:
             num_win = mask.shape[0]
-            attn = attn.view(-1, num_win, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)
+            attn = attn.view(-1, num_win, self.num_heads, N, N)
+            mask = mask.unsqueeze(1).unsqueeze(0)
+            if mask.dtype == torch.bool:
+                attn = attn.masked_fill(~mask, float('-inf'))
+            else:
+                attn = attn + mask
             attn = attn.view(-1, self.num_heads, N, N)
             attn = self.softmax(attn)
         else:
@@ -304,6 +324,7 @@ class SwinTransformerV2Block(nn.Module):
             shift_size: _int_or_tuple_2_t = 0,
             always_partition: bool = False,
             dynamic_mask: bool = False,
+            bool_attn_mask: bool = False,
             mlp_ratio: float = 4.,
             qkv_bias: bool = True,
             proj_drop: float = 0.,
@@ -323,6 +344,8 @@ class SwinTransformerV2Block(nn.Module):
             window_size: Window size.
             shift_size: Shift size for SW-MSA.
             always_partition: Always partition into full windows and shift
+            dynamic_mask: Create attention mask in forward based on current input size, cached per size.
+            bool_attn_mask: Use boolean shifted window masks (masked with -inf) instead of additive -100.
             mlp_ratio: Ratio of mlp hidden dim to embedding dim.
             qkv_bias: If True, add a learnable bias to query, key, value.
             proj_drop: Dropout rate.
@@ -340,6 +363,8 @@ class SwinTransformerV2Block(nn.Module):
         self.target_shift_size = to_2tuple(shift_size)  # store for later resize
         self.always_partition = always_partition
         self.dynamic_mask = dynamic_mask
+        self.bool_attn_mask = bool_attn_mask
+        self.mask_cache = PosEmbedCache(max_size=8)  # dynamic_mask masks for recently seen feature sizes
         self.window_size, self.shift_size = self._calc_window_shift(window_size, shift_size)
         self.window_area = self.window_size[0] * self.window_size[1]
         self.mlp_ratio = mlp_ratio
@@ -391,30 +416,31 @@ class SwinTransformerV2Block(nn.Module):
         if any(self.shift_size):
             # calculate attention mask for SW-MSA
             if x is None:
-                img_mask = torch.zeros((1, *self.input_resolution, 1), device=device, dtype=dtype)  # 1 H W 1
+                feat_size = self.input_resolution
             else:
-                img_mask = torch.zeros((1, x.shape[1], x.shape[2], 1), device=x.device, dtype=x.dtype)  # 1 H W 1
-            cnt = 0
-            for h in (
-                    (0, -self.window_size[0]),
-                    (-self.window_size[0], -self.shift_size[0]),
-                    (-self.shift_size[0], None),
-            ):
-                for w in (
-                        (0, -self.window_size[1]),
-                        (-self.window_size[1], -self.shift_size[1]),
-                        (-self.shift_size[1], None),
-                ):
-                    img_mask[:, h[0]:h[1], w[0]:w[1], :] = cnt
-                    cnt += 1
-            mask_windows = window_partition(img_mask, self.window_size)  # nW, window_size, window_size, 1
-            mask_windows = mask_windows.view(-1, self.window_area)
-            attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-            attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
+                feat_size = (x.shape[1], x.shape[2])
+                device = x.device
+                dtype = x.dtype
+            mask = shifted_window_mask(feat_size, self.window_size, self.shift_size, device=device)
+            if self.bool_attn_mask:
+                return mask
+            attn_mask = torch.zeros(mask.shape, device=device, dtype=dtype).masked_fill_(~mask, -100.)
         else:
             attn_mask = None
         return attn_mask
 
+    @torch.jit.unused
+    def _cached_attn_mask(self, x: torch.Tensor) -> Optional[torch.Tensor]:
+        if not any(self.shift_size):
+            return None
+        key = (x.shape[1], x.shape[2], self.window_size, self.shift_size, x.device, x.dtype)
+        return self.mask_cache(lambda: self.get_attn_mask(x), (), key=key)
+
+    def _get_dynamic_attn_mask(self, x: torch.Tensor) -> Optional[torch.Tensor]:
+        if torch.jit.is_scripting():
+            return self.get_attn_mask(x)
+        return self._cached_attn_mask(x)
+
     def _calc_window_shift(
             self,
             target_window_size: _int_or_tuple_2_t,
@@ -505,7 +531,7 @@ class SwinTransformerV2Block(nn.Module):
 
         # W-MSA/SW-MSA
         if getattr(self, 'dynamic_mask', False):
-            attn_mask = self.get_attn_mask(shifted_x)
+            attn_mask = self._get_dynamic_attn_mask(shifted_x)
         else:
             attn_mask = self.attn_mask
         attn_windows = self.attn(x_windows, mask=attn_mask)  # nW*B, window_size*window_size, C
@@ -530,6 +556,11 @@ class SwinTransformerV2Block(nn.Module):
         x = x.reshape(B, H, W, C)
         return x
 
+    def init_non_persistent_buffers(self) -> None:
+        """Initialize non-persistent buffers."""
+        if self.attn_mask is not None:
+            self.attn_mask.copy_(self.get_attn_mask(device=self.attn_mask.device, dtype=self.attn_mask.dtype))
+
 
 class PatchMerging(nn.Module):
     """Patch Merging Layer.
@@ -589,6 +620,7 @@ class SwinTransformerV2Stage(nn.Module):
             window_size: _int_or_tuple_2_t,
             always_partition: bool = False,
             dynamic_mask: bool = False,
+            bool_attn_mask: bool = False,
             downsample: bool = False,
             mlp_ratio: float = 4.,
             qkv_bias: bool = True,
@@ -612,6 +644,7 @@ class SwinTransformerV2Stage(nn.Module):
             window_size: Local window size.
             always_partition: Always partition into full windows and shift
             dynamic_mask: Create attention mask in forward based on current input size
+            bool_attn_mask: Use boolean shifted window attention masks.
             downsample: Use downsample layer at start of the block.
             mlp_ratio: Ratio of mlp hidden dim to embedding dim.
             qkv_bias: If True, add a learnable bias to query, key, value.
@@ -651,6 +684,7 @@ class SwinTransformerV2Stage(nn.Module):
                 shift_size=0 if (i % 2 == 0) else shift_size,
                 always_partition=always_partition,
                 dynamic_mask=dynamic_mask,
+                bool_attn_mask=bool_attn_mask,
                 mlp_ratio=mlp_ratio,
                 qkv_bias=qkv_bias,
                 proj_drop=proj_drop,
@@ -739,6 +773,7 @@ class SwinTransformerV2(nn.Module):
             window_size: _int_or_tuple_2_t = 7,
             always_partition: bool = False,
             strict_img_size: bool = True,
+            bool_attn_mask: bool = False,
             mlp_ratio: float = 4.,
             qkv_bias: bool = True,
             drop_rate: float = 0.,
@@ -762,6 +797,8 @@ class SwinTransformerV2(nn.Module):
             depths: Depth of each Swin Transformer stage (layer).
             num_heads: Number of attention heads in different layers.
             window_size: Window size.
+            bool_attn_mask: Use boolean shifted window attention masks, masked positions get -inf instead of the
+                additive -100, so outputs differ (slightly) from the numerics the pretrained weights were trained w/.
             mlp_ratio: Ratio of mlp hidden dim to embedding dim.
             qkv_bias: If True, add a learnable bias to query, key, value.
             drop_rate: Head dropout rate.
@@ -819,6 +856,7 @@ class SwinTransformerV2(nn.Module):
                 window_size=window_size,
                 always_partition=always_partition,
                 dynamic_mask=not strict_img_size,
+                bool_attn_mask=bool_attn_mask,
                 mlp_ratio=mlp_ratio,
                 qkv_bias=qkv_bias,
                 proj_drop=proj_drop_rate,
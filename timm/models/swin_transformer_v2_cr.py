@@ -37,7 +37,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from timm.data import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
-from timm.layers import DropPath, calculate_drop_path_rates, Mlp, ClassifierHead, to_2tuple, _assert, ndgrid
+from timm.layers import DropPath, calculate_drop_path_rates, Mlp, ClassifierHead, to_2tuple, _assert, ndgrid, \
+    RelPosBiasCache, PosEmbedCache, shifted_window_mask
 from ._builder import build_model_with_cfg
 from ._features import feature_take_indices
 from ._features_fx import register_notrace_function
@@ -151,6 +152,7 @@ class WindowMultiHeadAttention(nn.Module):
             torch.empty(win_h * win_w * win_h * win_w, 2, **dd),
             persistent=False,
         )
+        self.bias_cache = RelPosBiasCache()
 
         # TODO: skip init when on meta device when safe to do so
         self.reset_parameters()
@@ -188,7 +190,7 @@ class WindowMultiHeadAttention(nn.Module):
             self.window_size = window_size
             self._make_pair_wise_relative_positions()
 
-    def _relative_positional_encodings(self) -> torch.Tensor:
+    def _calc_relative_positional_encodings(self) -> torch.Tensor:
         """Compute the relative positional encodings.
 
         Returns:
@@ -202,12 +204,23 @@ class WindowMultiHeadAttention(nn.Module):
         relative_position_bias = relative_position_bias.unsqueeze(0)
         return relative_position_bias
 
+    @torch.jit.unused
+    def _cached_relative_positional_encodings(self) -> torch.Tensor:
+        sources = tuple(self.meta_mlp.parameters()) + (self.relative_coordinates_log,)
+        return self.bias_cache(self, self._calc_relative_positional_encodings, sources, key=self.window_size)
+
+    def _relative_positional_encodings(self) -> torch.Tensor:
+        """Relative positional encodings, cached in eval mode."""
+        if torch.jit.is_scripting():
+            return self._calc_relative_positional_encodings()
+        return self._cached_relative_positional_encodings()
+
     def forward(self, x: torch.Tensor, mask: Optional[torch.Tensor] = None) -> torch.Tensor:
         """Forward pass of window multi-head self-attention.
 
         Args:
             x: Input tensor of shape (B * windows, N, C).
-            mask: Attention mask for the shift case.
+            mask: Attention mask for the shift case, additive (0/-100) float or boolean (True = attend).
 
         Returns:
             Output tensor of shape (B * windows, N, C).
@@ -227,7 +240,11 @@ class WindowMultiHeadAttention(nn.Module):
             # Apply mask if utilized
             num_win: int = mask.shape[0]
             attn = attn.view(Bw // num_win, num_win, self.num_heads, L, L)
-            attn = attn + mask.unsqueeze(1).unsqueeze(0)
+            mask = mask.unsqueeze(1).unsqueeze(0)
+            if mask.dtype == torch.bool:
+                attn = attn.masked_fill(~mask, float('-inf'))
+            else:
+                attn = attn + mask
             attn = attn.view(-1, self.num_heads, L, L)
         attn = attn.softmax(dim=-1)
         attn = self.attn_drop(attn)
@@ -251,6 +268,8 @@ class SwinTransformerV2CrBlock(nn.Module):
         feat_size (Tuple[int, int]): Input resolution
         window_size (Tuple[int, int]): Window size to be utilized
         shift_size (int): Shifting size to be used
+        dynamic_mask (bool): Create attention mask in forward based on current input size, cached per size
+        bool_attn_mask (bool): Use boolean shifted window masks (masked with -inf) instead of additive -100
         mlp_ratio (int): Ratio of the hidden dimension in the FFN to the input channels
         proj_drop (float): Dropout in input mapping
         drop_attn (float): Dropout rate of attention map
@@ -269,6 +288,7 @@ class SwinTransformerV2CrBlock(nn.Module):
             shift_size: Tuple[int, int] = (0, 0),
             always_partition: bool = False,
             dynamic_mask: bool = False,
+            bool_attn_mask: bool = False,
             mlp_ratio: float = 4.0,
             init_values: Optional[float] = 0,
             proj_drop: float = 0.0,
@@ -287,6 +307,8 @@ class SwinTransformerV2CrBlock(nn.Module):
         self.target_shift_size: Tuple[int, int] = to_2tuple(shift_size)
         self.always_partition = always_partition
         self.dynamic_mask = dynamic_mask
+        self.bool_attn_mask = bool_attn_mask
+        self.mask_cache = PosEmbedCache(max_size=8)  # dynamic_mask masks for recently seen feature sizes
         self.window_size, self.shift_size = self._calc_window_shift(window_size)
         self.window_area = self.window_size[0] * self.window_size[1]
         self.init_values: Optional[float] = init_values
@@ -369,30 +391,31 @@ class SwinTransformerV2CrBlock(nn.Module):
         if any(self.shift_size):
             # calculate attention mask for SW-MSA
             if x is None:
-                img_mask = torch.zeros((1, *self.feat_size, 1), device=device, dtype=dtype)  # 1 H W 1
+                feat_size = self.feat_size
             else:
-                img_mask = torch.zeros((1, x.shape[1], x.shape[2], 1), device=x.device, dtype=x.dtype)  # 1 H W 1
-            cnt = 0
-            for h in (
-                    (0, -self.window_size[0]),
-                    (-self.window_size[0], -self.shift_size[0]),
-                    (-self.shift_size[0], None),
-            ):
-                for w in (
-                        (0, -self.window_size[1]),
-                        (-self.window_size[1], -self.shift_size[1]),
-                        (-self.shift_size[1], None),
-                ):
-                    img_mask[:, h[0]:h[1], w[0]:w[1], :] = cnt
-                    cnt += 1
-            mask_windows = window_partition(img_mask, self.window_size)  # num_windows, window_size, window_size, 1
-            mask_windows = mask_windows.view(-1, self.window_area)
-            attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-            attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
+                feat_size = (x.shape[1], x.shape[2])
+                device = x.device
+                dtype = x.dtype
+            mask = shifted_window_mask(feat_size, self.window_size, self.shift_size, device=device)
+            if self.bool_attn_mask:
+                return mask
+            attn_mask = torch.zeros(mask.shape, device=device, dtype=dtype).masked_fill_(~mask, -100.)
         else:
             attn_mask = None
         return attn_mask
 
+    @torch.jit.unused
+    def _cached_attn_mask(self, x: torch.Tensor) -> Optional[torch.Tensor]:
+        if not any(self.shift_size):
+            return None
+        key = (x.shape[1], x.shape[2], self.window_size, self.shift_size, x.device, x.dtype)
+        return self.mask_cache(lambda: self.get_attn_mask(x), (), key=key)
+
+    def _get_dynamic_attn_mask(self, x: torch.Tensor) -> Optional[torch.Tensor]:
+        if torch.jit.is_scripting():
+            return self.get_attn_mask(x)
+        return self._cached_attn_mask(x)
+
     def set_input_size(self, feat_size: Tuple[int, int], window_size: Tuple[int, int]) -> None:
         """Method updates the image resolution to be processed and window size and so the pair-wise relative positions.
 
@@ -436,7 +459,7 @@ class SwinTransformerV2CrBlock(nn.Module):
 
         # W-MSA/SW-MSA
         if getattr(self, 'dynamic_mask', False):
-            attn_mask = self.get_attn_mask(x)
+            attn_mask = self._get_dynamic_attn_mask(x)
         else:
             attn_mask = self.attn_mask
         attn_windows = self.attn(x_windows, mask=attn_mask)  # num_windows * B, window_size * window_size, C
@@ -600,6 +623,7 @@ class SwinTransformerV2CrStage(nn.Module):
         feat_size (Tuple[int, int]): input feature map size (H, W)
         num_heads (int): Number of attention heads to be utilized
         window_size (int): Window size to be utilized
+        bool_attn_mask (bool): Use boolean shifted window attention masks
         mlp_ratio (int): Ratio of the hidden dimension in the FFN to the input channels
         proj_drop (float): Dropout in input mapping
         drop_attn (float): Dropout rate of attention map
@@ -620,6 +644,7 @@ class SwinTransformerV2CrStage(nn.Module):
             window_size: Tuple[int, int],
             always_partition: bool = False,
             dynamic_mask: bool = False,
+            bool_attn_mask: bool = False,
             mlp_ratio: float = 4.0,
             init_values: Optional[float] = 0.0,
             proj_drop: float = 0.0,
@@ -658,6 +683,7 @@ class SwinTransformerV2CrStage(nn.Module):
                 window_size=window_size,
                 always_partition=always_partition,
                 dynamic_mask=dynamic_mask,
+                bool_attn_mask=bool_attn_mask,
                 shift_size=tuple([0 if ((index % 2) == 0) else w // 2 for w in window_size]),
                 mlp_ratio=mlp_ratio,
                 init_values=init_values,
@@ -719,6 +745,8 @@ class SwinTransformerV2Cr(nn.Module):
         img_size: Input resolution.
         window_size: Window size. If None, grid_size // window_div
         window_ratio: Window size to patch grid ratio.
+        bool_attn_mask: Use boolean shifted window attention masks, masked positions get -inf instead of the
+            additive -100, so outputs differ (slightly) from the numerics the pretrained weights were trained w/.
         patch_size: Patch size.
         in_chans: Number of input channels.
         depths: Depth of the stage (number of layers).
@@ -744,6 +772,7 @@ class SwinTransformerV2Cr(nn.Module):
             window_ratio: int = 8,
             always_partition: bool = False,
             strict_img_size: bool = True,
+            bool_attn_mask: bool = False,
             in_chans: int = 3,
             num_classes: int = 1000,
             embed_dim: int = 96,
@@ -804,6 +833,7 @@ class SwinTransformerV2Cr(nn.Module):
                 window_size=self.window_size,
                 always_partition=always_partition,
                 dynamic_mask=not strict_img_size,
+                bool_attn_mask=bool_attn_mask,
                 mlp_ratio=mlp_ratio,
                 init_values=init_values,
                 proj_drop=proj_drop_rate,
@@ -63,6 +63,7 @@ from timm.layers import (
     lecun_normal_,
     resample_patch_embed,
     resample_abs_pos_embed,
+    PosEmbedCache,
     use_fused_attn,
     get_act_layer,
     get_norm_layer,
@@ -208,8 +209,10 @@ class Block(nn.Module):
             x: torch.Tensor,
             attn_mask: Optional[torch.Tensor] = None,
             is_causal: bool = False,
+            feat_size: Optional[Tuple[int, int]] = None,
     ) -> torch.Tensor:
-        x = x + self.drop_path1(self.ls1(self.attn(self.norm1(x), attn_mask=attn_mask, is_causal=is_causal)))
+        x = x + self.drop_path1(self.ls1(self.attn(
+            self.norm1(x), attn_mask=attn_mask, is_causal=is_causal, feat_size=feat_size)))
         x = x + self.drop_path2(self.ls2(self.mlp(self.norm2(x))))
         return x
 
@@ -283,8 +286,9 @@ class ResPostBlock(nn.Module):
             x: torch.Tensor,
             attn_mask: Optional[torch.Tensor] = None,
             is_causal: bool = False,
+            feat_size: Optional[Tuple[int, int]] = None,
     ) -> torch.Tensor:
-        x = x + self.drop_path1(self.norm1(self.attn(x, attn_mask=attn_mask, is_causal=is_causal)))
+        x = x + self.drop_path1(self.norm1(self.attn(x, attn_mask=attn_mask, is_causal=is_causal, feat_size=feat_size)))
         x = x + self.drop_path2(self.norm2(self.mlp(x)))
         return x
 
@@ -758,6 +762,10 @@ class VisionTransformer(nn.Module):
             block_fn: Type[nn.Module] = Block,
             mlp_layer: Type[nn.Module] = Mlp,
             attn_layer: LayerType = Attention,
+            local_attn_window: Optional[Union[int, Tuple[int, int]]] = None,
+            local_attn_mode: str = 'window',
+            local_attn_blocks: Optional[Tuple[int, ...]] = None,
+            local_attn_global_prefix: bool = True,
             device=None,
             dtype=None,
     ) -> None:
@@ -791,6 +799,10 @@ class VisionTransformer(nn.Module):
             norm_layer: Normalization layer.
             act_layer: MLP activation layer.
             block_fn: Transformer block layer.
+            local_attn_window: Use local attention w/ this window size (in patches) instead of global attention.
+            local_attn_mode: Local attention mode, 'window' or 'neighborhood'.
+            local_attn_blocks: Indices of blocks using local attention, all blocks if None.
+            local_attn_global_prefix: Keep global attention to and from prefix (cls / reg) tokens.
         """
         super().__init__()
         dd = {'device': device, 'dtype': dtype}
@@ -841,6 +853,8 @@ class VisionTransformer(nn.Module):
             self.pos_embed = None
         else:
             self.pos_embed = nn.Parameter(torch.empty(1, embed_len, embed_dim, **dd))
+        # pos embeds resampled to recently seen grid sizes w/ dynamic_img_size
+        self.pos_embed_cache = PosEmbedCache()
         self.pos_drop = nn.Dropout(p=pos_drop_rate)
         if patch_drop_rate > 0:
             self.patch_drop = PatchDropout(
@@ -877,6 +891,15 @@ class VisionTransformer(nn.Module):
         self.feature_info = [
             dict(module=f'blocks.{i}', num_chs=embed_dim, reduction=reduction) for i in range(depth)]
         self.norm = norm_layer(embed_dim, **dd) if final_norm and not use_fc_norm else nn.Identity()
+        self.has_local_attn = False
+        if local_attn_window is not None:
+            assert not patch_drop_rate, 'patch dropout is not supported w/ local attention'
+            self.set_local_attn(
+                local_attn_window,
+                mode=local_attn_mode,
+                block_indices=local_attn_blocks,
+                global_prefix=local_attn_global_prefix,
+            )
 
         # Classifier Head
         if global_pool == 'map':
@@ -1034,6 +1057,73 @@ class VisionTransformer(nn.Module):
                     num_prefix_tokens=num_prefix_tokens,
                     verbose=True,
                 ))
+        if self.has_local_attn:
+            self._set_local_attn_feat_size(self.patch_embed.grid_size)
+
+    def set_local_attn(
+            self,
+            window_size: Optional[Union[int, Tuple[int, int]]],
+            mode: str = 'window',
+            block_indices: Optional[Tuple[int, ...]] = None,
+            global_prefix: bool = True,
+    ) -> None:
+        """Switch blocks between global and local (windowed / neighborhood) attention.
+
+        Weights are not modified, pretrained global attention weights are used as is.
+
+        Args:
+            window_size: Local attention window size (in patches), None to restore global attention.
+            mode: 'window' for non-overlapping windows, 'neighborhood' for a sliding window centered on each patch.
+            block_indices: Blocks to use local attention in (negative indices allowed), all blocks if None.
+            global_prefix: Keep global attention to and from prefix (cls / reg) tokens.
+        """
+        depth = len(self.blocks)
+        indices = set(range(depth)) if block_indices is None else {i % depth for i in block_indices}
+        for i, blk in enumerate(self.blocks):
+            attn = getattr(blk, 'attn', None)
+            use_local = window_size is not None and i in indices
+            if not hasattr(attn, 'set_local_attn'):
+                assert not use_local, f'Attention in block {i} ({type(attn).__name__}) does not support local attention'
+                continue
+            attn.set_local_attn(
+                window_size if use_local else None,
+                mode=mode,
+                feat_size=self.patch_embed.grid_size,
+                num_prefix_tokens=self.num_prefix_tokens,
+                global_prefix=global_prefix,
+            )
+        self.has_local_attn = window_size is not None and len(indices) > 0
+
+    @torch.jit.unused
+    def _set_local_attn_feat_size(self, feat_size: Tuple[int, int]) -> None:
+        for blk in self.blocks:
+            attn = getattr(blk, 'attn', None)
+            if getattr(attn, 'local_window_size', None) is not None:
+                attn.local_feat_size = tuple(feat_size)
+
+    def _local_attn_feat_size(self, x: torch.Tensor) -> Optional[Tuple[int, int]]:
+        """Patch grid of the current input for local attention, passed to blocks instead of set on modules."""
+        feat_size: Optional[Tuple[int, int]] = None
+        if self.dynamic_img_size and self.has_local_attn:
+            feat_size = (x.shape[1], x.shape[2])  # x is NHWC here
+        return feat_size
+
+    def _resample_pos_embed(self, H: int, W: int) -> torch.Tensor:
+        """Resample position embedding to a (H, W) grid."""
+        return resample_abs_pos_embed(
+            self.pos_embed,
+            new_size=(H, W),
+            old_size=self.patch_embed.grid_size,
+            num_prefix_tokens=0 if self.no_embed_class else self.num_prefix_tokens,
+        )
+
+    @torch.jit.unused
+    def _cached_resample_pos_embed(self, H: int, W: int) -> torch.Tensor:
+        return self.pos_embed_cache(
+            lambda: self._resample_pos_embed(H, W),
+            (self.pos_embed,),
+            key=(H, W) + tuple(self.patch_embed.grid_size),
+        )
 
     def _pos_embed(self, x: torch.Tensor) -> torch.Tensor:
         """Apply positional embedding to input."""
@@ -1048,13 +1138,10 @@ class VisionTransformer(nn.Module):
 
         if self.dynamic_img_size:
             B, H, W, C = x.shape
-            prev_grid_size = self.patch_embed.grid_size
-            pos_embed = resample_abs_pos_embed(
-                self.pos_embed,
-                new_size=(H, W),
-                old_size=prev_grid_size,
-                num_prefix_tokens=0 if self.no_embed_class else self.num_prefix_tokens,
-            )
+            if torch.jit.is_scripting():
+                pos_embed = self._resample_pos_embed(H, W)
+            else:
+                pos_embed = self._cached_resample_pos_embed(H, W)
             x = x.view(B, -1, C)
         else:
             pos_embed = self.pos_embed
@@ -1112,6 +1199,7 @@ class VisionTransformer(nn.Module):
         # forward pass
         B, _, height, width = x.shape
         x = self.patch_embed(x)
+        feat_size = self._local_attn_feat_size(x)
         x = self._pos_embed(x)
         x = self.patch_drop(x)
         x = self.norm_pre(x)
@@ -1121,7 +1209,13 @@ class VisionTransformer(nn.Module):
         else:
             blocks = self.blocks[:max_index + 1]
         for i, blk in enumerate(blocks):
-            if attn_mask is not None or is_causal:
+            if feat_size is not None:
+                # local attention w/ dynamic grid, blocks support the feat_size kwarg
+                if self.grad_checkpointing and not torch.jit.is_scripting():
+                    x = checkpoint(blk, x, attn_mask=attn_mask, is_causal=is_causal, feat_size=feat_size)
+                else:
+                    x = blk(x, attn_mask=attn_mask, is_causal=is_causal, feat_size=feat_size)
+            elif attn_mask is not None or is_causal:
                 x = blk(x, attn_mask=attn_mask, is_causal=is_causal)
             elif self.grad_checkpointing and not torch.jit.is_scripting():
                 x = checkpoint(blk, x)
@@ -1236,11 +1330,19 @@ class VisionTransformer(nn.Module):
     ) -> torch.Tensor:
         """Forward pass through feature layers (embeddings, transformer blocks, post-transformer norm)."""
         x = self.patch_embed(x)
+        feat_size = self._local_attn_feat_size(x)
         x = self._pos_embed(x)
         x = self.patch_drop(x)
         x = self.norm_pre(x)
 
-        if attn_mask is not None or is_causal:
+        if feat_size is not None:
+            # local attention w/ dynamic grid, pass the input's grid to each block
+            for blk in self.blocks:
+                if self.grad_checkpointing and not torch.jit.is_scripting():
+                    x = checkpoint(blk, x, attn_mask=attn_mask, is_causal=is_causal, feat_size=feat_size)
+                else:
+                    x = blk(x, attn_mask=attn_mask, is_causal=is_causal, feat_size=feat_size)
+        elif attn_mask is not None or is_causal:
             # If mask/causal provided, we need to apply blocks one by one
             for blk in self.blocks:
                 x = blk(x, attn_mask=attn_mask, is_causal=is_causal)
@@ -2,11 +2,12 @@
 import argparse
 import logging
 import os
-from typing import Optional
+from typing import Callable, Optional
 
 import torch
 
 from timm.models import clean_state_dict
+from timm.utils.sharded_checkpoint import is_sharded_checkpoint, load_sharded_checkpoint
 
 
 _logger = logging.getLogger(__name__)
@@ -27,18 +28,32 @@ def resume_task_checkpoint(
         loss_scaler=None,
         log_info=True,
         weights_only=True,
+        load_rank_state_fn: Optional[Callable] = None,
 ) -> Optional[int]:
     """Resume a task-based training checkpoint.
 
     Supports task checkpoints with ``state_dict``/``task_state`` and legacy
-    training checkpoints that used a bare ``model`` key.
+    training checkpoints that used a bare ``model`` key. A sharded checkpoint
+    directory is restored collectively when distributed, each rank reads only
+    its own shards, and its per-rank state (if any) is passed to
+    ``load_rank_state_fn``.
     """
     resume_epoch = None
-    if not os.path.isfile(checkpoint_path):
+    if is_sharded_checkpoint(checkpoint_path):
+        exclude = ['state_dict_ema', 'task_state_ema']
+        if optimizer is None:
+            exclude.append('optimizer')
+        checkpoint, rank_state = load_sharded_checkpoint(
+            checkpoint_path, exclude=exclude, weights_only=weights_only)
+        if load_rank_state_fn is not None and rank_state is not None:
+            if log_info:
+                _logger.info('Restoring per-rank (RNG, sampler) state from checkpoint...')
+            load_rank_state_fn(rank_state)
+    elif not os.path.isfile(checkpoint_path):
         _logger.error("No checkpoint found at '{}'".format(checkpoint_path))
         raise FileNotFoundError()
-
-    checkpoint = _load_train_checkpoint(checkpoint_path, weights_only=weights_only)
+    else:
+        checkpoint = _load_train_checkpoint(checkpoint_path, weights_only=weights_only)
     if isinstance(checkpoint, dict):
         state_dict_key = ''
         task_state_key = ''
@@ -82,7 +97,10 @@ def resume_task_checkpoint(
 
 def load_task_ema_checkpoint(task, checkpoint_path, weights_only=True):
     """Load EMA weights and optional task state into a task EMA module."""
-    checkpoint = _load_train_checkpoint(checkpoint_path, weights_only=weights_only)
+    if is_sharded_checkpoint(checkpoint_path):
+        checkpoint, _ = load_sharded_checkpoint(checkpoint_path, exclude=['optimizer'], weights_only=weights_only)
+    else:
+        checkpoint = _load_train_checkpoint(checkpoint_path, weights_only=weights_only)
     state_dict_key = ''
     task_state_key = ''
     if isinstance(checkpoint, dict):
@@ -2,8 +2,11 @@ from .agc import adaptive_clip_grad
 from .attention_extract import AttentionExtract
 from .checkpoint_saver import CheckpointSaver
 from .clip_grad import dispatch_clip_grad
+from .compile import compile_regions
 from .cuda import ApexScaler, NativeScaler
-from .decay_batch import decay_batch_step, check_batch_size_retry
+from .decay_batch import decay_batch_step, check_batch_size_retry, estimate_batch_size, batch_size_arg
+from .export import ExportedModel, create_exported_model, export_model, load_exported
+from .flops import LayerStats, ModelStats, OpCounter, estimate_model_stats
 from .distributed import distribute_bn, reduce_tensor, init_distributed_device,\
     world_info_from_env, is_distributed_env, is_primary
 from .jit import set_jit_legacy, set_jit_fuser
@@ -12,5 +15,11 @@ from .metrics import AverageMeter, accuracy
 from .misc import natural_key, add_bool_arg, ParseKwargs
 from .model import unwrap_model, get_state_dict, freeze, unfreeze, reparameterize_model
 from .model_ema import ModelEma, ModelEmaV2, ModelEmaV3
-from .random import random_seed
+from .profile_capture import ProfilerCapture, create_profiler_capture
+from .profiler import ModelProfile, ModuleProfile, profile_model
+from .random import random_seed, get_rng_state, set_rng_state
+from .shape_buckets import ShapeBucketModel
+from .sharded_checkpoint import save_sharded_checkpoint, load_sharded_checkpoint, consolidate_sharded_checkpoint,\
+    is_sharded_checkpoint
 from .summary import update_summary, get_outdir
+from .telemetry import StepTelemetry
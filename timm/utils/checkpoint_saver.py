@@ -2,6 +2,15 @@
 
 Track top-n training checkpoints and maintain recovery checkpoints on specified intervals.
 
+With `async_save=True` the training state is snapshotted to (pinned) CPU buffers on the calling thread and
+serialized, fsynced and moved into place on a background thread, so training only blocks for the device to host
+copy (and on a previous save still in flight). The top-n list, best metric and recovery files are only updated
+once a save has been written successfully.
+
+With `sharded=True` the saver is created on every rank and each checkpoint is a directory written by all ranks
+in parallel (see `sharded_checkpoint`), the primary rank writes the manifest and does the file bookkeeping once
+all shards are in place.
+
 Hacked together by / Copyright 2020 Ross Wightman
 """
 
@@ -10,10 +19,14 @@ import logging
 import operator
 import os
 import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 
 from .model import unwrap_model, get_state_dict
+from .sharded_checkpoint import shard_state, write_shard, write_manifest, wait_for_shards
 
 
 _logger = logging.getLogger(__name__)
@@ -35,6 +48,13 @@ class CheckpointSaver:
             max_history=10,
             unwrap_fn=unwrap_model,
             task=None,
+            async_save=False,
+            sharded=False,
+            rank=0,
+            world_size=1,
+            rank_state_fn=None,
+            run_id=None,
+            reuse_buffers=False,
     ):
 
         # objects to save state_dicts of
@@ -58,14 +78,45 @@ class CheckpointSaver:
         self.recovery_dir = recovery_dir
         self.save_prefix = checkpoint_prefix
         self.recovery_prefix = recovery_prefix
-        self.extension = '.pth.tar'
+        self.extension = '' if sharded else '.pth.tar'
         self.decreasing = decreasing  # a lower metric is better if True
         self.cmp = operator.lt if decreasing else operator.gt  # True if lhs better than rhs
         self.max_history = max_history
         self.unwrap_fn = unwrap_fn
         assert self.max_history >= 1
 
+        # async save
+        self.async_save = async_save
+        self._executor = ThreadPoolExecutor(max_workers=1) if async_save else None
+        self._pending = None
+        self._buffers = {}
+        self.reuse_buffers = reuse_buffers  # keep the snapshot buffers between saves instead of freeing them
+        self.last_wait_time = 0.  # time (sec) the last save waited on the previous one in flight
+        self.total_wait_time = 0.
+
+        # sharded save, every rank writes its shard, the primary rank also does the file ops
+        self.sharded = sharded
+        self.rank = rank
+        self.world_size = world_size
+        self.rank_state_fn = rank_state_fn  # returns the per-rank state (ie RNG, sampler) stored in the shard
+        self.shard_timeout = 1800.
+        # save ids (run id + save count) must match on all ranks, a multi-rank saver needs the run id passed in
+        assert run_id is not None or not sharded or world_size == 1, 'run_id is required for a multi-rank saver.'
+        self.run_id = run_id if run_id is not None else uuid.uuid4().hex
+        self._save_count = 0
+
+    def _remove_path(self, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
     def _replace(self, src, dst):
+        if os.path.isdir(src):
+            if os.path.exists(dst):
+                self._remove_path(dst)
+            os.replace(src, dst)
+            return
         if self.can_hardlink:
             try:
                 if os.path.exists(dst):
@@ -75,6 +126,19 @@ class CheckpointSaver:
         os.replace(src, dst)
 
     def _duplicate(self, src, dst):
+        if os.path.isdir(src):
+            if os.path.exists(dst):
+                self._remove_path(dst)
+            if self.can_hardlink:
+                try:
+                    shutil.copytree(src, dst, copy_function=os.link)
+                    return
+                except (OSError, NotImplementedError) as e:
+                    self.can_hardlink = False
+                    if os.path.exists(dst):
+                        shutil.rmtree(dst)
+            shutil.copytree(src, dst)
+            return
         if self.can_hardlink:
             try:
                 if os.path.exists(dst):
@@ -86,7 +150,7 @@ class CheckpointSaver:
                 self.can_hardlink = False
         shutil.copy2(src, dst)
 
-    def _save(self, save_path, epoch, metric=None):
+    def _get_state(self, epoch, metric=None):
         save_state = {
             'epoch': epoch,
             'arch': type(self.model).__name__.lower(),
@@ -107,81 +171,239 @@ class CheckpointSaver:
                 save_state['state_dict_ema'] = get_state_dict(self.model_ema, self.unwrap_fn)
         if metric is not None:
             save_state['metric'] = metric
-        torch.save(save_state, save_path)
+        return save_state
 
-    def _cleanup_checkpoints(self, trim=0):
-        trim = min(len(self.checkpoint_files), trim)
-        delete_index = self.max_history - trim
-        if delete_index < 0 or len(self.checkpoint_files) <= delete_index:
+    def _snapshot(self, obj, key=(), memo=None):
+        # copy tensors into per-storage CPU buffers (pinned for device tensors), tensors sharing a storage
+        # (tied weights, views) are snapshotted once and remain views of one storage, as torch.save would see them
+        memo = {} if memo is None else memo
+        if isinstance(obj, torch.Tensor):
+            obj = obj.detach()
+            storage = obj.untyped_storage()
+            storage_key = (obj.device, storage.data_ptr())
+            buf = memo.get(storage_key, None)
+            if buf is None:
+                buf = self._buffers.get(key, None)
+                if buf is None or buf.numel() != storage.nbytes():
+                    pin = obj.device.type == 'cuda'
+                    buf = torch.empty(storage.nbytes(), dtype=torch.uint8, pin_memory=pin)
+                    self._buffers[key] = buf
+                src = torch.empty(0, dtype=torch.uint8, device=obj.device).set_(storage)
+                buf.copy_(src, non_blocking=buf.is_pinned())
+                memo[storage_key] = buf
+            out = torch.empty(0, dtype=obj.dtype)
+            return out.set_(buf.untyped_storage(), obj.storage_offset(), obj.shape, obj.stride())
+        if isinstance(obj, dict):
+            return obj.__class__((k, self._snapshot(v, key + (k,), memo)) for k, v in obj.items())
+        if isinstance(obj, (list, tuple)) and not hasattr(obj, '_fields'):
+            return obj.__class__(self._snapshot(v, key + (i,), memo) for i, v in enumerate(obj))
+        return obj
+
+    def _save(self, save_path, epoch, metric=None):
+        torch.save(self._get_state(epoch, metric), save_path)
+
+    def _write(self, save_state, save_path):
+        with open(save_path, 'wb') as f:
+            torch.save(save_state, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def wait(self):
+        """ Wait for an async save in flight to complete, re-raises its exception if it failed. """
+        if self._pending is None:
+            self.last_wait_time = 0.
+            return
+        t = time.perf_counter()
+        pending, self._pending = self._pending, None
+        pending.result()
+        self.last_wait_time = time.perf_counter() - t
+        self.total_wait_time += self.last_wait_time
+        if self.last_wait_time > 0.1:
+            _logger.info(f'Waited {self.last_wait_time:.2f}s for the previous checkpoint save to complete.')
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self._buffers.clear()
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _release_buffers(self):
+        # runs on the background thread once a snapshot is written, the buffers are a full host copy of the state
+        if not self.reuse_buffers:
+            self._buffers.clear()
+
+    def _submit_sharded_save(self, save_path, epoch, metric=None, then=None, commit=None):
+        self._save_count += 1
+        save_id = f'{self.run_id}-{self._save_count}'
+        common, tensors, index = shard_state(self._get_state(epoch, metric), self.rank, self.world_size)
+        rank_state = self.rank_state_fn() if self.rank_state_fn is not None else None
+        if self.async_save:
+            tensors = self._snapshot(tensors)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+
+        def _job():
+            write_shard(save_path, tensors, self.rank, self.world_size, rank_state, save_id=save_id)
+            if self.async_save:
+                self._release_buffers()
+            if self.rank == 0:
+                write_manifest(save_path, common, index, self.world_size, save_id=save_id)
+                # no collectives here (may run on a background thread), the other ranks' shards are awaited on
+                # disk, the save id check skips stale shards of an interrupted run in the same staging dir
+                if not wait_for_shards(save_path, self.world_size, save_id=save_id, timeout=self.shard_timeout):
+                    raise RuntimeError(f'Timed out waiting for all {self.world_size} shards of {save_path}.')
+                if then is not None:
+                    then()
+            if commit is not None:
+                commit()
+
+        if self.async_save:
+            self._pending = self._executor.submit(_job)
+        else:
+            _job()
+
+    def _submit_save(self, save_path, epoch, metric=None, then=None, commit=None):
+        """ Save the state to save_path, then run the file ops and commit the bookkeeping (in the background if async).
+
+        Neither runs if the write fails. Async callers wait for the previous save first, one save is in flight.
+        """
+        if self.sharded:
+            self._submit_sharded_save(save_path, epoch, metric, then=then, commit=commit)
+            return
+        if not self.async_save:
+            self._save(save_path, epoch, metric)
+            if then is not None:
+                then()
+            if commit is not None:
+                commit()
             return
-        to_delete = self.checkpoint_files[delete_index:]
+
+        save_state = self._snapshot(self._get_state(epoch, metric))
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()  # non-blocking device to host copies complete
+
+        def _job():
+            try:
+                self._write(save_state, save_path)
+            finally:
+                save_state.clear()
+                self._release_buffers()
+            if then is not None:
+                then()
+            if commit is not None:
+                commit()
+
+        self._pending = self._executor.submit(_job)
+
+    def _remove_checkpoints(self, to_delete):
         for d in to_delete:
             try:
                 _logger.debug("Cleaning checkpoint: {}".format(d))
-                os.remove(d[0])
+                self._remove_path(d[0])
             except Exception as e:
                 _logger.error("Exception '{}' while deleting checkpoint".format(e))
+
+    def _cleanup_checkpoints(self, trim=0):
+        trim = min(len(self.checkpoint_files), trim)
+        delete_index = self.max_history - trim
+        if delete_index < 0 or len(self.checkpoint_files) <= delete_index:
+            return
+        self._remove_checkpoints(self.checkpoint_files[delete_index:])
         self.checkpoint_files = self.checkpoint_files[:delete_index]
 
+    def _tmp_path(self, save_dir, name, *ids):
+        if self.sharded:
+            # unique per save, a rank may start writing the next save before the primary moved this one
+            name = '-'.join([name] + [str(i) for i in ids])
+        return os.path.join(save_dir, name + self.extension)
+
     def save_checkpoint(self, epoch, metric=None):
         assert epoch >= 0
-        tmp_save_path = os.path.join(self.checkpoint_dir, 'tmp' + self.extension)
+        if self.async_save:
+            self.wait()  # the previous save's bookkeeping is committed (or it raised) before this one is planned
+        tmp_save_path = self._tmp_path(self.checkpoint_dir, 'tmp', epoch)
         last_save_path = os.path.join(self.checkpoint_dir, 'last' + self.extension)
-        self._save(tmp_save_path, epoch, metric)
-        self._replace(tmp_save_path, last_save_path)
 
-        worst_file = self.checkpoint_files[-1] if self.checkpoint_files else None
+        # the new top-n list and best metric are planned now, committed once the save has been written
+        checkpoint_files = self.checkpoint_files
+        best_metric, best_epoch = self.best_metric, self.best_epoch
+        to_delete = []
+        to_duplicate = []
+        worst_file = checkpoint_files[-1] if checkpoint_files else None
         if (
-            len(self.checkpoint_files) < self.max_history
+            len(checkpoint_files) < self.max_history
             or metric is None
             or self.cmp(metric, worst_file[1])
         ):
-            if len(self.checkpoint_files) >= self.max_history:
-                self._cleanup_checkpoints(1)
+            if len(checkpoint_files) >= self.max_history:
+                to_delete = checkpoint_files[self.max_history - 1:]
+                checkpoint_files = checkpoint_files[:self.max_history - 1]
             filename = '-'.join([self.save_prefix, str(epoch)]) + self.extension
             save_path = os.path.join(self.checkpoint_dir, filename)
-            self._duplicate(last_save_path, save_path)
+            to_duplicate.append(save_path)
 
-            self.checkpoint_files.append((save_path, metric))
-            self.checkpoint_files = sorted(
-                self.checkpoint_files,
+            checkpoint_files = sorted(
+                checkpoint_files + [(save_path, metric)],
                 key=lambda x: x[1],
                 reverse=not self.decreasing  # sort in descending order if a lower metric is not better
             )
 
-            checkpoints_str = "Current checkpoints:\n"
-            for c in self.checkpoint_files:
-                checkpoints_str += ' {}\n'.format(c)
-            _logger.info(checkpoints_str)
-
-            if metric is not None and (self.best_metric is None or self.cmp(metric, self.best_metric)):
-                self.best_epoch = epoch
-                self.best_metric = metric
+            if metric is not None and (best_metric is None or self.cmp(metric, best_metric)):
+                best_epoch = epoch
+                best_metric = metric
                 best_save_path = os.path.join(self.checkpoint_dir, 'model_best' + self.extension)
-                self._duplicate(last_save_path, best_save_path)
+                to_duplicate.append(best_save_path)
+
+        def _finalize():
+            self._replace(tmp_save_path, last_save_path)
+            self._remove_checkpoints(to_delete)
+            for path in to_duplicate:
+                self._duplicate(last_save_path, path)
+
+        def _commit():
+            if checkpoint_files is not self.checkpoint_files and self.rank == 0:
+                checkpoints_str = "Current checkpoints:\n"
+                for c in checkpoint_files:
+                    checkpoints_str += ' {}\n'.format(c)
+                _logger.info(checkpoints_str)
+            self.checkpoint_files = checkpoint_files
+            self.best_metric, self.best_epoch = best_metric, best_epoch
 
-        return (None, None) if self.best_metric is None else (self.best_metric, self.best_epoch)
+        self._submit_save(tmp_save_path, epoch, metric, then=_finalize, commit=_commit)
+
+        return (None, None) if best_metric is None else (best_metric, best_epoch)
 
     def save_recovery(self, epoch, batch_idx=0):
         assert epoch >= 0
-        tmp_save_path = os.path.join(self.recovery_dir, 'recovery_tmp' + self.extension)
-        self._save(tmp_save_path, epoch)
-
+        if self.async_save:
+            self.wait()
+        tmp_save_path = self._tmp_path(self.recovery_dir, 'recovery_tmp', epoch, batch_idx)
         filename = '-'.join([self.recovery_prefix, str(epoch), str(batch_idx)]) + self.extension
         save_path = os.path.join(self.recovery_dir, filename)
-        self._replace(tmp_save_path, save_path)
+        prev_recovery_file = self.prev_recovery_file
 
-        if os.path.exists(self.prev_recovery_file):
-            try:
-                _logger.debug("Cleaning recovery: {}".format(self.prev_recovery_file))
-                os.remove(self.prev_recovery_file)
-            except Exception as e:
-                _logger.error("Exception '{}' while removing {}".format(e, self.prev_recovery_file))
-        self.prev_recovery_file = self.curr_recovery_file
-        self.curr_recovery_file = save_path
+        def _finalize():
+            self._replace(tmp_save_path, save_path)
+            if os.path.exists(prev_recovery_file):
+                try:
+                    _logger.debug("Cleaning recovery: {}".format(prev_recovery_file))
+                    self._remove_path(prev_recovery_file)
+                except Exception as e:
+                    _logger.error("Exception '{}' while removing {}".format(e, prev_recovery_file))
+
+        def _commit():
+            self.prev_recovery_file = self.curr_recovery_file
+            self.curr_recovery_file = save_path
+
+        self._submit_save(tmp_save_path, epoch, then=_finalize, commit=_commit)
 
     def find_recovery(self):
         recovery_path = os.path.join(self.recovery_dir, self.recovery_prefix)
+        if self.sharded:
+            recovery_path += '-'  # skip the 'recovery_tmp-*' staging dirs
         files = glob.glob(recovery_path + '*' + self.extension)
         files = sorted(files)
         return files[0] if len(files) else ''
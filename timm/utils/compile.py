@@ -0,0 +1,97 @@
+""" Regional (per-block) torch.compile
+
+Compile the repeated blocks of a model instead of the whole model. Structurally identical blocks share
+one compiled graph (params / buffers are graph inputs, not constants), so compile time is roughly that of
+a single block instead of the full depth, and a shape change only recompiles one block graph.
+"""
+import logging
+from typing import List, Optional, Sequence, Tuple
+
+import torch
+from torch import nn as nn
+
+_logger = logging.getLogger(__name__)
+
+_STEM_NAMES = ('stem', 'patch_embed', 'conv_stem')
+
+
+def _is_block(module: nn.Module) -> bool:
+    # a block has submodules, a container of repeated leaf layers (ie Linear, GELU, Linear) isn't a region
+    return next(module.children(), None) is not None
+
+
+def _find_regions(module: nn.Module, prefix: str = '') -> List[Tuple[str, nn.Module]]:
+    """ Find the children of the innermost containers with repeated (same class) blocks. """
+    regions = []
+    for name, child in module.named_children():
+        regions += _find_regions(child, f'{prefix}.{name}' if prefix else name)
+    if regions:
+        return regions
+    if isinstance(module, (nn.Sequential, nn.ModuleList)):
+        children = [(n, m) for n, m in module.named_children() if _is_block(m)]
+        block_types = [type(m) for _, m in children]
+        if len(set(block_types)) < len(block_types):
+            return [(f'{prefix}.{n}' if prefix else n, m) for n, m in children]
+    return []
+
+
+def compile_regions(
+        model: nn.Module,
+        backend: str = 'inductor',
+        mode: Optional[str] = None,
+        compile_stem: bool = False,
+        compile_head: bool = False,
+        regions: Optional[Sequence[str]] = None,
+        **compile_kwargs,
+) -> List[str]:
+    """ Compile the repeated blocks of a model in-place with torch.compile.
+
+    Blocks (ViT / Eva `blocks.N`, ConvNeXt `stages.N.blocks.M`, ResNet `layerN.M`, ...) are found as the
+    children of the innermost nn.Sequential / nn.ModuleList containers holding more than one block of the
+    same class. The model object, its state_dict keys and non-block code run unchanged (eager).
+
+    Args:
+        model: Model to compile in-place.
+        backend: torch.compile backend.
+        mode: torch.compile mode.
+        compile_stem: Also compile the stem / patch embedding module (first of `stem`, `patch_embed`,
+            `conv_stem`) if present.
+        compile_head: Also compile the model's `forward_head` (pooling, norm, classifier) if present.
+        regions: Explicit module names to compile instead of the auto detected blocks.
+        **compile_kwargs: Additional torch.compile args (ie `dynamic`, `options`).
+
+    Returns:
+        Names of the compiled modules (or methods).
+    """
+    assert hasattr(nn.Module, 'compile'), 'A version of torch w/ nn.Module.compile() is required.'
+    if regions is not None:
+        named = dict(model.named_modules())
+        found = [(n, named[n]) for n in regions]
+    else:
+        found = _find_regions(model)
+    if not found:
+        _logger.warning(f'No repeated blocks found in {type(model).__name__}, compiling the whole model.')
+        found = [('', model)]
+
+    compile_args = dict(backend=backend, mode=mode, **compile_kwargs)
+    compiled = []
+    for name, module in found:
+        module.compile(**compile_args)
+        compiled.append(name)
+
+    if compile_stem:
+        for name in _STEM_NAMES:
+            module = getattr(model, name, None)
+            if isinstance(module, nn.Module):
+                module.compile(**compile_args)
+                compiled.append(name)
+                break
+
+    if compile_head and hasattr(model, 'forward_head'):
+        model.forward_head = torch.compile(model.forward_head, **compile_args)
+        compiled.append('forward_head')
+
+    _logger.info(
+        f'Compiled {len(compiled)} regions of {type(model).__name__}, '
+        f'{len(set(type(m) for _, m in found))} distinct block classes.')
+    return compiled
@@ -26,9 +26,12 @@ class ApexScaler:
             parameters=None,
             create_graph=False,
             need_update=True,
+            post_backward_fn=None,
     ):
         with amp.scale_loss(loss, optimizer) as scaled_loss:
             scaled_loss.backward(create_graph=create_graph)
+        if post_backward_fn is not None:
+            post_backward_fn()
         if need_update:
             if clip_grad is not None:
                 dispatch_clip_grad(amp.master_params(optimizer), clip_grad, mode=clip_mode)
@@ -61,8 +64,12 @@ class NativeScaler:
             parameters=None,
             create_graph=False,
             need_update=True,
+            post_backward_fn=None,
     ):
         self._scaler.scale(loss).backward(create_graph=create_graph)
+        if post_backward_fn is not None:
+            # ie for timing the backward pass separately from the optimizer step
+            post_backward_fn()
         if need_update:
             if clip_grad is not None:
                 assert parameters is not None
@@ -1,8 +1,19 @@
-""" Batch size decay and retry helpers.
+""" Batch size decay, retry and estimation helpers.
 
 Copyright 2022 Ross Wightman
 """
+import ctypes
+import gc
+import logging
 import math
+from contextlib import suppress
+from functools import partial
+from typing import Callable, Optional, Sequence, Tuple
+
+import torch
+import torch.nn as nn
+
+_logger = logging.getLogger(__name__)
 
 
 def decay_batch_step(batch_size, num_intra_steps=2, no_odd=False):
@@ -29,6 +40,11 @@ def decay_batch_step(batch_size, num_intra_steps=2, no_odd=False):
     return batch_size
 
 
+def batch_size_arg(value):
+    """ argparse type for a batch size arg that also accepts 'auto' (estimate from memory use) """
+    return value if value == 'auto' else int(value)
+
+
 def check_batch_size_retry(error_str):
     """ check failure error string for conditions where batch decay retry should not be attempted
     """
@@ -41,3 +57,153 @@ def check_batch_size_retry(error_str):
         # 'Illegal memory access' errors in CUDA typically leave process in unusable state
         return False
     return True
+
+
+def _read_proc_kb(path, key):
+    with open(path) as f:
+        for line in f:
+            if line.startswith(key + ':'):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def _trim_host_memory():
+    gc.collect()
+    try:
+        # return freed heap pages to the OS so the RSS of the next trial starts from a clean baseline
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def _reset_host_peak():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')  # reset the peak RSS (VmHWM) to the current RSS
+        return True
+    except OSError:
+        return False
+
+
+def available_memory(device: torch.device) -> int:
+    """ Memory (in bytes) available for activations on device, on CPU the system MemAvailable. """
+    if device.type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(device)
+        # blocks cached by this process's allocator can be reused too
+        return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+    if device.type == 'cpu':
+        available = _read_proc_kb('/proc/meminfo', 'MemAvailable')
+        assert available is not None, 'Available host memory can only be determined on Linux.'
+        return available
+    raise ValueError(f'Memory budget cannot be determined for device type {device.type}, specify it.')
+
+
+def measure_peak_memory(fn: Callable, device: torch.device) -> int:
+    """ Peak memory (in bytes) allocated while running fn, above the memory in use when called.
+
+    Uses the CUDA caching allocator stats on GPU, the process peak RSS (Linux) on CPU.
+    """
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.empty_cache()
+        start = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        fn()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - start
+    assert device.type == 'cpu', f'Peak memory cannot be measured for device type {device.type}.'
+    _trim_host_memory()
+    assert _reset_host_peak(), 'Peak host memory can only be measured on Linux.'
+    start = _read_proc_kb('/proc/self/status', 'VmRSS')
+    fn()
+    return _read_proc_kb('/proc/self/status', 'VmHWM') - start
+
+
+def estimate_batch_size(
+        model: nn.Module,
+        input_size: Tuple[int, ...],
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+        training: bool = False,
+        amp_autocast: Callable = suppress,
+        channels_last: bool = False,
+        memory_budget: Optional[int] = None,
+        budget_fraction: float = 0.85,
+        reserved_bytes: int = 0,
+        trial_batch_sizes: Sequence[int] = (2, 8),
+        max_batch_size: int = 4096,
+        multiple_of: int = 8,
+) -> int:
+    """ Estimate the largest batch size that fits a memory budget.
+
+    Runs the model at two small trial batch sizes, measures the peak memory of each and fits a linear
+    `fixed + per_sample * batch_size` memory model, which is solved for the memory budget. Replaces
+    decaying the batch size on OOM, which is slow and doesn't work on CPU (where running out of memory
+    means swapping, not an exception).
+
+    Args:
+        model: Model to estimate for, already on device w/ the intended dtype, memory format and options such
+            as grad checkpointing applied. Estimate before compilation.
+        input_size: Input size of one sample (channels, height, width).
+        device: Device to estimate on (default: device of model parameters).
+        dtype: Input dtype (default: dtype of model parameters).
+        training: Estimate a train step (forward + backward) instead of inference.
+        amp_autocast: Autocast context used for the model forward.
+        channels_last: Use channels_last inputs.
+        memory_budget: Memory budget in bytes for the step, on top of the memory in use after a warmup step
+            (default: memory available on device after the warmup step).
+        budget_fraction: Fraction of the budget that may be used, margin for fragmentation / estimation error.
+        reserved_bytes: Memory that will be needed outside the measured step (ie optimizer state).
+        trial_batch_sizes: The two batch sizes trial runs are measured at.
+        max_batch_size: Upper limit of the returned batch size.
+        multiple_of: Round batch sizes larger than this down to a multiple of it.
+
+    Returns:
+        Estimated batch size, at least 1.
+    """
+    param = next(model.parameters())
+    device = torch.device(device) if device is not None else param.device
+    dtype = dtype or param.dtype
+    was_training = model.training
+    model.train(training)
+
+    def _step(batch_size):
+        x = torch.randn((batch_size,) + tuple(input_size), device=device, dtype=dtype)
+        if channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        if training:
+            with amp_autocast():
+                output = model(x)
+                if isinstance(output, (tuple, list)):
+                    output = output[0]
+                output.float().mean().backward()
+        else:
+            with torch.inference_mode(), amp_autocast():
+                model(x)
+
+    try:
+        b0, b1 = sorted(trial_batch_sizes)
+        _step(b0)  # warmup, lazy allocations (cudnn workspaces, grads, etc) are made before measuring
+        if memory_budget is None:
+            memory_budget = available_memory(device)
+        m0 = measure_peak_memory(partial(_step, b0), device)
+        m1 = measure_peak_memory(partial(_step, b1), device)
+    finally:
+        if training:
+            model.zero_grad(set_to_none=True)
+        model.train(was_training)
+
+    budget = memory_budget * budget_fraction - reserved_bytes
+    per_sample = (m1 - m0) / (b1 - b0)
+    if per_sample <= 0:
+        # measurement noise dominates, assume memory is all per sample
+        per_sample = max(m1, 1) / b1
+    fixed = max(m0 - per_sample * b0, 0)
+    batch_size = int((budget - fixed) // per_sample)
+    batch_size = max(1, min(batch_size, max_batch_size))
+    if multiple_of and batch_size > multiple_of:
+        batch_size -= batch_size % multiple_of
+    _logger.info(
+        f'Estimated batch size {batch_size} for a {budget / 2**30:.2f} GB budget '
+        f'({fixed / 2**20:.1f} MB fixed, {per_sample / 2**20:.2f} MB per sample).')
+    return batch_size
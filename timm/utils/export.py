@@ -0,0 +1,272 @@
+""" Ahead-of-time exported model artifacts
+
+Export a model with `torch.export` and either compile + package it with AOTInductor ('aoti', a shared
+library with weights, no Python model code needed to run it) or save the ExportedProgram ('export').
+Artifacts are kept in a content-addressed cache dir keyed on everything that changes the exported
+graph or weights (model name + pretrained tag, checkpoint, model kwargs, input shape, dtype, device,
+reparameterization, memory format, torch / timm versions), so repeat runs load the artifact directly
+instead of building the model, loading weights and re-compiling.
+"""
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+
+import torch
+from torch import nn as nn
+
+from timm.version import __version__
+from .model import reparameterize_model
+
+_logger = logging.getLogger(__name__)
+
+__all__ = ['ExportedModel', 'export_model', 'load_exported', 'create_exported_model', 'get_export_cache_dir']
+
+_EXPORT_FORMATS = ('aoti', 'export')
+_EXPORT_CACHE_ENV = 'TIMM_EXPORT_CACHE'
+_EXPORT_MAX_BATCH = 1024
+
+# pretrained_cfg keys kept with an artifact (for data config resolution and labels w/o the model)
+_CFG_KEYS = (
+    'architecture', 'tag', 'input_size', 'test_input_size', 'interpolation', 'mean', 'std', 'crop_pct',
+    'test_crop_pct', 'crop_mode', 'num_classes', 'label_names', 'label_descriptions',
+)
+
+
+def get_export_cache_dir(cache_dir: Optional[str] = None) -> str:
+    """ Export cache dir, `cache_dir` arg > `TIMM_EXPORT_CACHE` env > `<torch hub>/checkpoints/exported`. """
+    cache_dir = cache_dir or os.environ.get(_EXPORT_CACHE_ENV, None)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        return cache_dir
+    from timm.models._hub import get_cache_dir
+    return get_cache_dir('exported')
+
+
+class ExportedModel:
+    """ Callable wrapper of a loaded exported artifact with the model metadata kept alongside it.
+
+    Has the `pretrained_cfg` and `num_classes` attributes of the source model so it can be used in place of
+    the model for `resolve_data_config` and label mapping.
+    """
+
+    def __init__(self, runner: Callable, metadata: Dict[str, Any], path: str = ''):
+        self.runner = runner
+        self.metadata = metadata
+        self.path = path
+        self.pretrained_cfg = metadata.get('pretrained_cfg', {})
+        self.num_classes = metadata.get('num_classes', None)
+
+    def __call__(self, x: torch.Tensor) -> Any:
+        return self.runner(x)
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}({self.metadata.get("model_name", "")}, path={self.path})'
+
+
+def _dtype_str(dtype: torch.dtype) -> str:
+    return str(dtype).replace('torch.', '')
+
+
+def _pretrained_tag(model_name: str, pretrained: bool) -> str:
+    from timm.models import get_pretrained_cfg
+    from timm.models._registry import split_model_name_tag
+    if not pretrained:
+        return ''
+    _, tag = split_model_name_tag(model_name)
+    if tag:
+        return tag
+    cfg = get_pretrained_cfg(model_name)
+    return getattr(cfg, 'tag', '') if cfg is not None else ''
+
+
+def _export_key(spec: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(spec, sort_keys=True, default=repr).encode()).hexdigest()[:16]
+
+
+def export_model(
+        model: nn.Module,
+        package_path: str,
+        input_size: Tuple[int, int, int] = (3, 224, 224),
+        batch_size: int = 1,
+        dynamic_batch: bool = True,
+        max_batch_size: int = _EXPORT_MAX_BATCH,
+        dtype: Optional[torch.dtype] = None,
+        device: Union[str, torch.device] = 'cpu',
+        channels_last: bool = False,
+        export_format: str = 'aoti',
+) -> str:
+    """ Export (and for 'aoti', compile + package) a model to `package_path`.
+
+    Args:
+        model: Model to export, put in eval mode and moved to `device` / `dtype`.
+        package_path: Output artifact path (`.pt2`).
+        input_size: Input (C, H, W).
+        batch_size: Example batch size, the exported batch size if not `dynamic_batch`.
+        dynamic_batch: Export with a dynamic batch dim (1 .. max_batch_size).
+        max_batch_size: Max batch size for a dynamic batch dim.
+        dtype: Model and input dtype.
+        device: Device to export / compile for.
+        channels_last: Use channels_last memory format.
+        export_format: One of 'aoti' (AOTInductor package), 'export' (saved ExportedProgram).
+
+    Returns:
+        The artifact path.
+    """
+    assert export_format in _EXPORT_FORMATS, f'Unknown export format {export_format}'
+    device = torch.device(device)
+    model = model.eval().to(device=device, dtype=dtype)
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    model = model.to(memory_format=memory_format)
+    # batch size 1 examples are specialized by torch.export, use >= 2 for a dynamic batch dim
+    example_batch = max(2, batch_size) if dynamic_batch else batch_size
+    preprocess = getattr(model, 'input_preprocess', None)
+    if preprocess is not None:
+        # model w/ attached in-graph preprocessing takes uint8 images (`input_size` is the image size)
+        example = preprocess.example_input(example_batch, img_size=tuple(input_size[-2:]), device=device)
+    else:
+        example = torch.randn((example_batch,) + tuple(input_size), device=device, dtype=dtype)
+        example = example.contiguous(memory_format=memory_format)
+    dynamic_shapes = None
+    if dynamic_batch:
+        dynamic_shapes = ({0: torch.export.Dim('batch', min=1, max=max_batch_size)},)
+
+    with torch.no_grad():
+        program = torch.export.export(model, (example,), dynamic_shapes=dynamic_shapes)
+
+    os.makedirs(os.path.dirname(os.path.abspath(package_path)), exist_ok=True)
+    tmp_path = f'{package_path}.{os.getpid()}.tmp.pt2'
+    try:
+        if export_format == 'aoti':
+            torch._inductor.aoti_compile_and_package(program, package_path=tmp_path)
+        else:
+            torch.export.save(program, tmp_path)
+        os.replace(tmp_path, package_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return package_path
+
+
+def load_exported(
+        package_path: str,
+        export_format: str = 'aoti',
+        device: Union[str, torch.device] = 'cpu',
+) -> Callable:
+    """ Load an artifact created by `export_model`, returns a callable taking the input tensor. """
+    assert export_format in _EXPORT_FORMATS, f'Unknown export format {export_format}'
+    if export_format == 'aoti':
+        device = torch.device(device)
+        device_index = device.index if device.index is not None else -1
+        return torch._inductor.aoti_load_package(package_path, device_index=device_index)
+    return torch.export.load(package_path).module()
+
+
+def create_exported_model(
+        model_name: str,
+        pretrained: bool = False,
+        checkpoint_path: str = '',
+        input_size: Optional[Tuple[int, int, int]] = None,
+        batch_size: int = 1,
+        dynamic_batch: bool = True,
+        dtype: Optional[torch.dtype] = None,
+        device: Union[str, torch.device] = 'cpu',
+        reparam: bool = False,
+        channels_last: bool = False,
+        export_format: str = 'aoti',
+        cache_dir: Optional[str] = None,
+        rebuild: bool = False,
+        **kwargs,
+) -> ExportedModel:
+    """ Load an exported model artifact from the cache, creating (and exporting) the model on a miss.
+
+    Args:
+        model_name: Model name, optionally with pretrained tag.
+        pretrained: Load pretrained weights.
+        checkpoint_path: Checkpoint to load into the model.
+        input_size: Input (C, H, W), defaults to the model's pretrained_cfg input size.
+        batch_size: Example / static batch size.
+        dynamic_batch: Export with a dynamic batch dim.
+        dtype: Model and input dtype (default float32).
+        device: Device to run on.
+        reparam: Reparameterize (fuse) the model before export.
+        channels_last: Use channels_last memory format.
+        export_format: One of 'aoti', 'export'.
+        cache_dir: Artifact cache dir override.
+        rebuild: Re-export even if a cached artifact exists.
+        **kwargs: Additional model kwargs (ie num_classes).
+
+    Returns:
+        The loaded artifact.
+    """
+    from timm.data import resolve_data_config
+    from timm.models import create_model
+
+    dtype = dtype or torch.float32
+    device = torch.device(device)
+    checkpoint = ''
+    if checkpoint_path:
+        st = os.stat(checkpoint_path)
+        checkpoint = f'{os.path.abspath(checkpoint_path)}:{st.st_size}:{st.st_mtime_ns}'
+    spec = dict(
+        model_name=model_name,
+        pretrained=pretrained,
+        pretrained_tag=_pretrained_tag(model_name, pretrained),
+        checkpoint=checkpoint,
+        model_kwargs=kwargs,
+        input_size=list(input_size) if input_size else None,
+        batch_size=None if dynamic_batch else batch_size,  # example batch size doesn't change a dynamic export
+        dynamic_batch=dynamic_batch,
+        dtype=_dtype_str(dtype),
+        device=device.type,
+        reparam=reparam,
+        channels_last=channels_last,
+        export_format=export_format,
+        torch=torch.__version__,
+        timm=__version__,
+    )
+    key = _export_key(spec)
+    cache_dir = get_export_cache_dir(cache_dir)
+    name = model_name.replace('/', '_').replace(':', '_')
+    package_path = os.path.join(cache_dir, f'{name}-{key}.pt2')
+    metadata_path = os.path.join(cache_dir, f'{name}-{key}.json')
+
+    if rebuild or not (os.path.exists(package_path) and os.path.exists(metadata_path)):
+        _logger.info(f'Exporting {model_name} ({export_format}) to {package_path}')
+        model = create_model(model_name, pretrained=pretrained, checkpoint_path=checkpoint_path, **kwargs)
+        if reparam:
+            model = reparameterize_model(model)
+        pretrained_cfg = dict(getattr(model, 'pretrained_cfg', {}) or {})
+        input_size = tuple(input_size or resolve_data_config({}, model=model)['input_size'])
+        export_model(
+            model,
+            package_path,
+            input_size=input_size,
+            batch_size=batch_size,
+            dynamic_batch=dynamic_batch,
+            dtype=dtype,
+            device=device,
+            channels_last=channels_last,
+            export_format=export_format,
+        )
+        pretrained_cfg = {k: v for k, v in pretrained_cfg.items() if k in _CFG_KEYS}
+        pretrained_cfg['input_size'] = input_size
+        metadata = dict(
+            spec,
+            input_size=list(input_size),
+            num_classes=getattr(model, 'num_classes', None),
+            pretrained_cfg=pretrained_cfg,
+        )
+        tmp_path = f'{metadata_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(metadata, f, default=repr)
+        os.replace(tmp_path, metadata_path)
+        del model
+    else:
+        _logger.info(f'Loading exported {model_name} from {package_path}')
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+
+    runner = load_exported(package_path, export_format=export_format, device=device)
+    return ExportedModel(runner, metadata, path=package_path)
@@ -0,0 +1,187 @@
+""" Analytic FLOPs / params / activation size estimation
+
+Counts the FLOPs of every op dispatched in a forward pass with a `TorchDispatchMode` (op formulas from
+`torch.utils.flop_counter`). Run with a model built on the meta device (`create_model(name, device='meta')`),
+no weights are allocated or initialized and no compute is done, only shapes are propagated, so stats for
+any registered model at any input size take milliseconds.
+
+Example:
+    >>> stats = estimate_model_stats('convnext_tiny', input_size=(3, 288, 288))
+    >>> print(stats.macs / 1e9, stats.params / 1e6)
+"""
+import logging
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import torch
+import torch.nn as nn
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+from torch.utils.flop_counter import flop_registry
+
+_logger = logging.getLogger(__name__)
+
+__all__ = ['OpCounter', 'LayerStats', 'ModelStats', 'estimate_model_stats']
+
+
+class OpCounter(TorchDispatchMode):
+    """ Count the analytic FLOPs and output activations of the ops run in this mode.
+
+    Ops without a FLOP formula (elementwise, norms, reductions, data movement) count as 0 FLOPs, as in
+    `torch.utils.flop_counter.FlopCounterMode` and fvcore. Activations are the output elements of the ops
+    with a FLOP formula (convs, matmuls, attention), comparable to fvcore's activation count.
+
+    Args:
+        callback: Called with (op flops, op activation elements) of each counted op, ie for per-module
+            attribution by module hooks.
+    """
+
+    def __init__(self, callback: Optional[Callable[[int, int], None]] = None):
+        super().__init__()
+        self.callback = callback
+        self.flops = 0
+        self.acts = 0
+        self.flops_by_op: Dict[str, int] = {}
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        out = func(*args, **kwargs)
+        flop_fn = flop_registry.get(func._overloadpacket, None)
+        if flop_fn is not None:
+            flops = int(flop_fn(*args, **kwargs, out_val=out))
+            acts = sum(t.numel() for t in tree_flatten(out)[0] if isinstance(t, torch.Tensor))
+            op_name = func._overloadpacket.__name__
+            self.flops += flops
+            self.acts += acts
+            self.flops_by_op[op_name] = self.flops_by_op.get(op_name, 0) + flops
+            if self.callback is not None:
+                self.callback(flops, acts)
+        return out
+
+
+@dataclass
+class LayerStats:
+    """ Stats of one module. MACs of ops run directly in the module (not in its children). """
+    name: str
+    module_type: str = ''
+    output_shape: Tuple[int, ...] = ()
+    act_bytes: int = 0
+    macs: int = 0
+    params: int = 0
+
+
+@dataclass
+class ModelStats:
+    """ Model totals (for the whole batch) and optional per-layer stats. """
+    model: str
+    input_size: Tuple[int, ...]
+    batch_size: int = 1
+    params: int = 0
+    macs: int = 0
+    flops: int = 0
+    acts: int = 0
+    act_bytes: int = 0  # sum of leaf module output sizes
+    flops_by_op: Dict[str, int] = field(default_factory=dict)
+    layers: List[LayerStats] = field(default_factory=list)
+
+
+def _output_bytes(output) -> Tuple[Tuple[int, ...], int]:
+    tensors = [t for t in tree_flatten(output)[0] if isinstance(t, torch.Tensor)]
+    shape = tuple(tensors[0].shape) if tensors else ()
+    return shape, sum(t.numel() * t.element_size() for t in tensors)
+
+
+def estimate_model_stats(
+        model: Union[str, nn.Module],
+        input_size: Optional[Tuple[int, int, int]] = None,
+        batch_size: int = 1,
+        per_layer: bool = False,
+        dtype: Optional[torch.dtype] = None,
+        **kwargs,
+) -> ModelStats:
+    """ Estimate params, MACs, FLOPs and activation sizes of a model forward (inference) pass.
+
+    Args:
+        model: Model name (created on the meta device) or model instance (run on its own device, use a
+            model on the meta device to avoid allocation and compute).
+        input_size: Input (C, H, W), defaults to the model's pretrained_cfg input size.
+        batch_size: Batch size.
+        per_layer: Return per-module stats (leaf modules and modules running ops directly).
+        dtype: Model and input dtype, affects activation bytes only.
+        **kwargs: Model kwargs when `model` is a name.
+
+    Returns:
+        Model stats. MACs are FLOPs / 2 (for ops w/ multiply-accumulate formulas).
+    """
+    if isinstance(model, str):
+        from timm.models import create_model
+        model_name = model
+        model = create_model(model_name, device='meta', **kwargs)
+    else:
+        model_name = getattr(model, 'pretrained_cfg', {}).get('architecture', type(model).__name__)
+    model = model.eval()
+    if dtype is not None:
+        model = model.to(dtype=dtype)
+
+    if input_size is None:
+        from timm.data import resolve_data_config
+        input_size = resolve_data_config({}, model=model)['input_size']
+    param = next(model.parameters(), None)
+    device = param.device if param is not None else torch.device('meta')
+    dtype = dtype or (param.dtype if param is not None else torch.float32)
+    x = torch.empty((batch_size,) + tuple(input_size), device=device, dtype=dtype)
+
+    stats = ModelStats(
+        model=model_name,
+        input_size=tuple(input_size),
+        batch_size=batch_size,
+        params=sum(p.numel() for p in model.parameters()),
+    )
+
+    layers: Dict[str, LayerStats] = {}
+    active: List[str] = []
+    leaves = set()
+
+    def _count(flops: int, acts: int):
+        if active:
+            layers[active[-1]].macs += flops // 2
+
+    def _pre_hook(name, module, args):
+        active.append(name)
+
+    def _post_hook(name, module, args, output):
+        active.pop()
+        layer = layers[name]
+        layer.output_shape, act_bytes = _output_bytes(output)
+        layer.act_bytes += act_bytes
+
+    handles = []
+    for name, module in model.named_modules():
+        if not name:
+            continue
+        if next(module.children(), None) is None:
+            leaves.add(name)
+        layers[name] = LayerStats(
+            name=name,
+            module_type=type(module).__name__,
+            params=sum(p.numel() for p in module.parameters(recurse=False)),
+        )
+        handles.append(module.register_forward_pre_hook(lambda m, a, n=name: _pre_hook(n, m, a)))
+        handles.append(module.register_forward_hook(lambda m, a, o, n=name: _post_hook(n, m, a, o)))
+
+    counter = OpCounter(callback=_count)
+    try:
+        with torch.no_grad(), counter:
+            model(x)
+    finally:
+        for h in handles:
+            h.remove()
+
+    stats.flops = counter.flops
+    stats.macs = counter.flops // 2
+    stats.acts = counter.acts
+    stats.act_bytes = sum(layers[n].act_bytes for n in leaves)
+    stats.flops_by_op = counter.flops_by_op
+    if per_layer:
+        stats.layers = [l for n, l in layers.items() if n in leaves or l.macs]
+    return stats
@@ -1,3 +1,5 @@
+import inspect
+import os
 from typing import Optional, Tuple, List
 
 import torch
@@ -41,7 +43,11 @@ def onnx_export(
         training_mode = torch.onnx.TrainingMode.EVAL
         model.eval()
 
-    if example_input is None:
+    preprocess = getattr(model, 'input_preprocess', None)
+    if example_input is None and preprocess is not None:
+        # model w/ attached in-graph preprocessing takes uint8 images
+        example_input = preprocess.example_input(batch_size, img_size=tuple(input_size[-2:]) if input_size else None)
+    elif example_input is None:
         if not input_size:
             assert hasattr(model, 'default_cfg'), 'Cannot file model default config, input size must be provided'
             input_size = model.default_cfg.get('input_size')
@@ -62,8 +68,9 @@ def onnx_export(
 
     dynamic_axes = {'input0': {0: 'batch'}, 'output0': {0: 'batch'}}
     if dynamic_size:
-        dynamic_axes['input0'][2] = 'height'
-        dynamic_axes['input0'][3] = 'width'
+        h_dim, w_dim = (1, 2) if preprocess is not None and preprocess.input_fmt == 'NHWC' else (2, 3)
+        dynamic_axes['input0'][h_dim] = 'height'
+        dynamic_axes['input0'][w_dim] = 'width'
 
     if aten_fallback:
         export_type = torch.onnx.OperatorExportTypes.ONNX_ATEN_FALLBACK
@@ -79,6 +86,10 @@ def onnx_export(
         )
         export_output.save(output_file)
     else:
+        export_kwargs = {}
+        if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+            # newer PyTorch default to the dynamo exporter, the args below are for the TorchScript exporter
+            export_kwargs['dynamo'] = False
         torch.onnx.export(
             model,
             example_input,
@@ -91,7 +102,8 @@ def onnx_export(
             keep_initializers_as_inputs=keep_initializers,
             dynamic_axes=dynamic_axes,
             opset_version=opset,
-            operator_export_type=export_type
+            operator_export_type=export_type,
+            **export_kwargs,
         )
 
     if check:
@@ -102,3 +114,139 @@ def onnx_export(
             onnx_out = onnx_forward(output_file, example_input)
             np.testing.assert_almost_equal(original_out.numpy(), onnx_out, decimal=3)
 
+
+_ORT_OPT_LEVELS = {
+    'disable': 'ORT_DISABLE_ALL',
+    'basic': 'ORT_ENABLE_BASIC',
+    'extended': 'ORT_ENABLE_EXTENDED',
+    'all': 'ORT_ENABLE_ALL',
+}
+
+
+def onnx_quantize(onnx_file: str, output_file: str, per_channel: bool = False):
+    """ Dynamic (weight int8, activations quantized at runtime) onnxruntime quantization of an ONNX graph. """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    # pre-processing (shape inference + graph optimization) makes folded weights initializers again
+    preprocessed_file = os.path.splitext(output_file)[0] + '.pre.onnx'
+    try:
+        quant_pre_process(onnx_file, preprocessed_file)
+        quantize_dynamic(preprocessed_file, output_file, per_channel=per_channel, weight_type=QuantType.QInt8)
+    finally:
+        if os.path.exists(preprocessed_file):
+            os.remove(preprocessed_file)
+    return output_file
+
+
+class OnnxRuntimeModel:
+    """ onnxruntime inference session w/ a torch.Tensor in / out interface.
+
+    With `io_binding`, inputs are bound in place (no copy) and outputs are written into buffers
+    preallocated per input shape. Those buffers are reused by the next call with the same input shape,
+    set `reuse_outputs=False` if outputs are kept across calls.
+    """
+
+    def __init__(
+            self,
+            onnx_file: str,
+            intra_op_threads: int = 0,
+            inter_op_threads: int = 0,
+            opt_level: str = 'all',
+            io_binding: bool = True,
+            reuse_outputs: bool = True,
+            providers: Optional[List[str]] = None,
+            optimized_model_file: str = '',
+            profile: bool = False,
+    ):
+        import onnxruntime
+
+        assert opt_level in _ORT_OPT_LEVELS, f'Unknown graph optimization level {opt_level}'
+        sess_options = onnxruntime.SessionOptions()
+        sess_options.graph_optimization_level = getattr(onnxruntime.GraphOptimizationLevel, _ORT_OPT_LEVELS[opt_level])
+        sess_options.intra_op_num_threads = intra_op_threads
+        sess_options.inter_op_num_threads = inter_op_threads
+        if inter_op_threads > 1:
+            sess_options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+        if optimized_model_file:
+            sess_options.optimized_model_filepath = optimized_model_file
+        sess_options.enable_profiling = profile
+
+        self.session = onnxruntime.InferenceSession(
+            onnx_file, sess_options, providers=providers or ['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_names = [o.name for o in self.session.get_outputs()]
+        self.io_binding = io_binding
+        self.reuse_outputs = reuse_outputs
+        self._output_buffers = {}
+
+    def _run_bound(self, x: torch.Tensor) -> List[torch.Tensor]:
+        import numpy as np
+
+        binding = self.session.io_binding()
+        element_type = torch.empty((), dtype=x.dtype).numpy().dtype.type
+        binding.bind_input(self.input_name, 'cpu', 0, element_type, tuple(x.shape), x.data_ptr())
+        outputs = self._output_buffers.get(tuple(x.shape), None) if self.reuse_outputs else None
+        if outputs is None:
+            # output shapes are only known after a run, let onnxruntime allocate on first use of an input shape
+            for name in self.output_names:
+                binding.bind_output(name, 'cpu')
+            self.session.run_with_iobinding(binding)
+            outputs = [torch.from_numpy(np.asarray(o.numpy())) for o in binding.get_outputs()]
+            if self.reuse_outputs:
+                self._output_buffers[tuple(x.shape)] = outputs
+            return outputs
+        for name, out in zip(self.output_names, outputs):
+            out_type = torch.empty((), dtype=out.dtype).numpy().dtype.type
+            binding.bind_output(name, 'cpu', 0, out_type, tuple(out.shape), out.data_ptr())
+        self.session.run_with_iobinding(binding)
+        return outputs
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        x = x.detach().cpu().contiguous()
+        if self.io_binding:
+            outputs = self._run_bound(x)
+        else:
+            outputs = [torch.from_numpy(o) for o in self.session.run(self.output_names, {self.input_name: x.numpy()})]
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+    def eval(self):
+        return self
+
+    def end_profiling(self) -> str:
+        return self.session.end_profiling()
+
+
+def create_onnx_runtime_model(
+        model: Optional[torch.nn.Module] = None,
+        onnx_file: str = '',
+        input_size: Optional[Tuple[int, int, int]] = None,
+        quantize: bool = False,
+        opset: Optional[int] = None,
+        **session_kwargs,
+) -> OnnxRuntimeModel:
+    """ Create an onnxruntime session model, exporting `model` (w/ a dynamic batch dim) first if needed.
+
+    Args:
+        model: Model to export if `onnx_file` is empty or doesn't exist. Should be created w/ `exportable=True`.
+        onnx_file: ONNX graph to load, or the export destination (exported to a temp dir if empty).
+        input_size: Export input size, defaults to the model's pretrained_cfg.
+        quantize: Apply onnxruntime dynamic int8 quantization.
+        opset: Export opset.
+        **session_kwargs: OnnxRuntimeModel session args.
+    """
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if not onnx_file or not os.path.exists(onnx_file):
+            assert model is not None, 'A model is required to export when the ONNX file does not exist.'
+            onnx_file = onnx_file or os.path.join(tmp_dir, 'model.onnx')
+            input_size = tuple(input_size) if input_size else None
+            # batch size 2 so the batch dim isn't specialized
+            onnx_export(model.cpu().eval(), onnx_file, input_size=input_size, batch_size=2, opset=opset)
+        if quantize:
+            quantized_file = os.path.splitext(onnx_file)[0] + '.int8.onnx'
+            if not os.path.exists(quantized_file):
+                onnx_quantize(onnx_file, quantized_file)
+            onnx_file = quantized_file
+        return OnnxRuntimeModel(onnx_file, **session_kwargs)
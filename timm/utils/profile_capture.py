@@ -0,0 +1,272 @@
+""" torch.profiler capture windows for train / eval loops
+
+Profiles a configurable window of loop steps (wait / warmup / active / repeat schedule) with `torch.profiler`
+and exports, per captured window, a chrome trace, an op-level table and optionally the memory timeline,
+the peak memory of each model block (module rows as in `profile_model`) and a CUDA allocator snapshot
+(https://pytorch.org/memory_viz). Nothing is hooked or recorded until the capture is started.
+
+A capture can be stopped (ie around validation within a train loop) and started again, a restarted capture
+continues the step count and only captures the windows that remain of `repeat`. With `repeat=0` windows are
+captured for as long as the capture runs, it is never `done` and must be stopped explicitly.
+
+Example:
+    >>> capture = ProfilerCapture('./output', prefix='train', active=5, model=model)
+    >>> with capture:
+    >>>     for input, target in loader:
+    >>>         train_step(input, target)
+    >>>         capture.step()
+"""
+import bisect
+import json
+import logging
+import os
+from typing import Dict, Optional, Sequence, Union
+
+import torch
+import torch.nn as nn
+
+from .profiler import resolve_profile_rows
+
+_logger = logging.getLogger(__name__)
+
+_MODULE_LABEL = '## module: '
+
+
+def module_peak_memory(events, device_type: str = 'cpu') -> Dict[str, int]:
+    """ Peak memory (bytes) allocated within each labelled module range, from profiler memory events.
+
+    The live memory is reconstructed from the '[memory]' alloc / free events, the peak of a module is the
+    max live memory within its range(s) above the live memory at the start of the range.
+    """
+    mem_attr = 'cpu_memory_usage' if device_type == 'cpu' else 'device_memory_usage'
+    allocs = []
+    ranges = []
+    for e in events:
+        if e.name == '[memory]':
+            usage = getattr(e, mem_attr, None)
+            if usage is None:
+                usage = getattr(e, 'cuda_memory_usage', 0)  # older torch
+            if usage:
+                allocs.append((e.time_range.start, usage))
+        elif e.name.startswith(_MODULE_LABEL):
+            ranges.append((e.name[len(_MODULE_LABEL):], e.time_range.start, e.time_range.end))
+    if not allocs:
+        return {}
+
+    allocs.sort(key=lambda x: x[0])
+    times = [t for t, _ in allocs]
+    live = []
+    total = 0
+    for _, usage in allocs:
+        total += usage
+        live.append(total)
+
+    peaks = {}
+    for name, start, end in ranges:
+        i0 = bisect.bisect_left(times, start)
+        i1 = bisect.bisect_right(times, end)
+        base = live[i0 - 1] if i0 > 0 else 0
+        peak = max(live[i0:i1], default=base) - base
+        peaks[name] = max(peaks.get(name, 0), peak)
+    return peaks
+
+
+class ProfilerCapture:
+    """ Capture step windows of a loop w/ torch.profiler and export traces, op tables and memory stats.
+
+    Args:
+        output_dir: Directory the artifacts are written to.
+        prefix: Filename prefix of the artifacts (ie 'train', 'eval').
+        wait: Steps skipped at the start of each cycle.
+        warmup: Steps profiled but discarded at the start of each window.
+        active: Steps captured per window.
+        repeat: Number of windows captured, 0 to keep capturing (a window every wait + warmup + active steps)
+            until stopped.
+        skip_first: Steps skipped before the first cycle.
+        device: Device the loop runs on, device time / memory is profiled on CUDA.
+        profile_memory: Record allocations, export the memory timeline, per module peak memory and, on CUDA,
+            an allocator snapshot.
+        with_stack: Record python stacks (default: profile_memory, the memory timeline needs them).
+        model: Model to attribute memory to, per module rows at module_granularity.
+        module_granularity: Module rows (see `resolve_profile_rows`).
+        row_limit: Rows of the op table.
+    """
+
+    def __init__(
+            self,
+            output_dir: str,
+            prefix: str = 'train',
+            wait: int = 1,
+            warmup: int = 1,
+            active: int = 3,
+            repeat: int = 1,
+            skip_first: int = 0,
+            device: Union[str, torch.device] = 'cpu',
+            profile_memory: bool = False,
+            with_stack: Optional[bool] = None,
+            model: Optional[nn.Module] = None,
+            module_granularity: Union[str, int, Sequence[str]] = 'block',
+            row_limit: int = 40,
+    ):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.device = torch.device(device)
+        self.profile_memory = profile_memory
+        self.with_stack = profile_memory if with_stack is None else with_stack
+        self.repeat = repeat
+        self.row_limit = row_limit
+        self.model = model
+        self.module_granularity = module_granularity
+        self.num_captured = 0
+        self.num_steps = 0
+        self._schedule = dict(wait=wait, warmup=warmup, active=active, skip_first=skip_first)
+        self._step_base = 0
+        self._active = False
+        self._discard = False
+        self._hooks = []
+        self._label_stack = []
+        self.profiler = None
+        self._record_snapshot = profile_memory and self.device.type == 'cuda' and \
+            hasattr(torch.cuda.memory, '_record_memory_history')
+
+    @property
+    def done(self) -> bool:
+        """ All windows have been captured, never for `repeat=0` (capture until stopped). """
+        if self.repeat == 0:
+            return False
+        return self.num_captured >= self.repeat
+
+    def _create_profiler(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.device.type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        repeat = 0 if self.repeat == 0 else self.repeat - self.num_captured
+        schedule = dict(self._schedule)
+        if self.num_steps:
+            schedule['skip_first'] = 0  # already skipped by the first session
+        return torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(repeat=repeat, **schedule),
+            on_trace_ready=self._on_trace_ready,
+            record_shapes=True,
+            profile_memory=self.profile_memory,
+            with_stack=self.with_stack,
+        )
+
+    def _recording(self) -> bool:
+        return self.profiler is not None and self.profiler.current_action in (
+            torch.profiler.ProfilerAction.RECORD, torch.profiler.ProfilerAction.RECORD_AND_SAVE)
+
+    def _add_module_hooks(self):
+        if self.model is None or not self.profile_memory:
+            return
+
+        def _pre_hook(name, module, args):
+            if self._recording():
+                rf = torch.profiler.record_function(_MODULE_LABEL + name)
+                rf.__enter__()
+                self._label_stack.append(rf)
+
+        def _post_hook(name, module, args, output):
+            if self._label_stack:
+                self._label_stack.pop().__exit__(None, None, None)
+
+        modules = dict(self.model.named_modules())
+        for name in resolve_profile_rows(self.model, self.module_granularity):
+            self._hooks.append(modules[name].register_forward_pre_hook(
+                lambda m, a, n=name: _pre_hook(n, m, a)))
+            self._hooks.append(modules[name].register_forward_hook(
+                lambda m, a, o, n=name: _post_hook(n, m, a, o)))
+
+    def start(self):
+        """ Start (or restart) capturing, a no-op once done. """
+        if self._active or self.done:
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self._record_snapshot:
+            torch.cuda.memory._record_memory_history(max_entries=100000)
+        self._add_module_hooks()
+        self._step_base = self.num_steps
+        self.profiler = self._create_profiler()
+        self.profiler.start()
+        self._active = True
+
+    def stop(self):
+        """ Stop capturing, a window in progress is exported as is. """
+        if not self._active:
+            return
+        self._active = False
+        # stopping in warmup would emit an empty window, stopping in a window exports the partial window
+        self._discard = self.profiler.current_action == torch.profiler.ProfilerAction.WARMUP
+        self.profiler.stop()
+        self._discard = False
+        for h in self._hooks:
+            h.remove()
+        self._hooks = []
+        self._label_stack = []
+        if self._record_snapshot:
+            torch.cuda.memory._record_memory_history(enabled=None)
+
+    def step(self):
+        if not self._active:
+            return
+        self.num_steps += 1
+        self.profiler.step()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _path(self, kind: str, step: int, ext: str) -> str:
+        return os.path.join(self.output_dir, f'{self.prefix}-{kind}-step{step}.{ext}')
+
+    def _on_trace_ready(self, prof):
+        if self._discard:
+            return
+        step = self._step_base + prof.step_num
+        self.num_captured += 1
+        prof.export_chrome_trace(self._path('trace', step, 'json'))
+
+        sort_by = 'self_cuda_time_total' if self.device.type == 'cuda' else 'self_cpu_time_total'
+        tables = [prof.key_averages().table(sort_by=sort_by, row_limit=self.row_limit)]
+        if self.profile_memory:
+            mem_sort_by = 'self_cuda_memory_usage' if self.device.type == 'cuda' else 'self_cpu_memory_usage'
+            tables.append(prof.key_averages().table(sort_by=mem_sort_by, row_limit=self.row_limit))
+        with open(self._path('ops', step, 'txt'), 'w') as f:
+            f.write('\n\n'.join(tables))
+
+        if self.profile_memory:
+            if self.with_stack:
+                try:
+                    device_str = str(self.device) if self.device.type != 'cuda' or self.device.index is not None \
+                        else f'cuda:{torch.cuda.current_device()}'
+                    prof.export_memory_timeline(self._path('memory-timeline', step, 'json'), device=device_str)
+                except Exception as e:
+                    _logger.warning(f'Memory timeline export failed: {e}')
+
+            peaks = module_peak_memory(prof.events(), device_type=self.device.type)
+            if peaks:
+                with open(self._path('module-memory', step, 'json'), 'w') as f:
+                    json.dump(peaks, f, indent=4)
+                top = sorted(peaks.items(), key=lambda x: x[1], reverse=True)[:5]
+                _logger.info('Peak memory by module (MB): ' + ', '.join(f'{n}: {v / 2**20:.1f}' for n, v in top))
+
+            if self._record_snapshot:
+                torch.cuda.memory._dump_snapshot(self._path('memory-snapshot', step, 'pickle'))
+
+        _logger.info(f'Captured {self.prefix} profile of step {step} to {self.output_dir}.')
+
+
+def create_profiler_capture(
+        output_dir: str,
+        prefix: str = 'train',
+        schedule: Sequence[int] = (1, 1, 3, 1),
+        **kwargs,
+) -> ProfilerCapture:
+    """ ProfilerCapture from a (wait, warmup, active, repeat) schedule, as passed on the command line. """
+    wait, warmup, active, repeat = schedule
+    return ProfilerCapture(
+        output_dir, prefix=prefix, wait=wait, warmup=warmup, active=active, repeat=repeat, **kwargs)
@@ -0,0 +1,389 @@
+""" Per-module model profiler
+
+Forward / backward time, analytic FLOPs (`torch.utils.flop_counter`), activation memory and parameter
+size per module, with rows grouped at stage (`feature_info`), block, top-level, or fixed depth granularity.
+No external profiler dependencies. Results can be printed as a table or written as CSV / JSON and as a
+chrome trace (chrome://tracing, https://ui.perfetto.dev) of the forward / backward module spans.
+
+Example:
+    >>> profile = profile_model(timm.create_model('resnet50'), input_size=(3, 224, 224), batch_size=32)
+    >>> print(profile.table())
+    >>> profile.to_csv('resnet50_profile.csv')
+    >>> profile.to_chrome_trace('resnet50_trace.json')
+"""
+import csv
+import json
+import logging
+import time
+from contextlib import suppress
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import torch
+import torch.nn as nn
+
+from .compile import _find_regions
+from .flops import OpCounter
+
+_logger = logging.getLogger(__name__)
+
+__all__ = ['ModuleProfile', 'ModelProfile', 'profile_model', 'resolve_profile_rows']
+
+
+@dataclass
+class ModuleProfile:
+    """ Profile of one module (row). Times are per iteration (all calls of the module), in ms. """
+    name: str
+    module_type: str = ''
+    calls: int = 0
+    fwd_ms: float = 0.
+    bwd_ms: float = 0.
+    fwd_flops: int = 0
+    bwd_flops: int = 0
+    act_bytes: int = 0
+    param_bytes: int = 0
+    params: int = 0
+
+
+@dataclass
+class ModelProfile:
+    """ Per-module rows, a total row for the whole model, and the module spans of the last iteration. """
+    rows: List[ModuleProfile]
+    total: ModuleProfile
+    batch_size: int = 1
+    input_size: Tuple[int, ...] = ()
+    backward: bool = True
+    device: str = 'cpu'
+    peak_mem_bytes: Optional[int] = None
+    events: List[Dict[str, Any]] = field(default_factory=list)
+
+    def as_dicts(self, include_total: bool = True) -> List[Dict[str, Any]]:
+        rows = self.rows + [self.total] if include_total else self.rows
+        return [asdict(r) for r in rows]
+
+    def table(self, include_total: bool = True) -> str:
+        total_ms = (self.total.fwd_ms + self.total.bwd_ms) or 1.
+        name_width = max([len(r.name) for r in self.rows] + [len(self.total.name), 4])
+        header = (
+            f'{"name":<{name_width}}  {"type":<24} {"calls":>5} {"fwd ms":>9} {"bwd ms":>9} {"time %":>6} '
+            f'{"fwd GFLOP":>10} {"bwd GFLOP":>10} {"act MB":>9} {"param MB":>9}'
+        )
+        lines = [header, '-' * len(header)]
+        rows = self.rows + [self.total] if include_total else self.rows
+        for r in rows:
+            if r is self.total:
+                lines.append('-' * len(header))
+            lines.append(
+                f'{r.name:<{name_width}}  {r.module_type[:24]:<24} {r.calls:>5} {r.fwd_ms:>9.3f} {r.bwd_ms:>9.3f} '
+                f'{100 * (r.fwd_ms + r.bwd_ms) / total_ms:>6.1f} {r.fwd_flops / 1e9:>10.3f} '
+                f'{r.bwd_flops / 1e9:>10.3f} {r.act_bytes / 2**20:>9.2f} {r.param_bytes / 2**20:>9.2f}'
+            )
+        return '\n'.join(lines)
+
+    def to_csv(self, path: str) -> None:
+        rows = self.as_dicts()
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def to_json(self, path: str) -> None:
+        data = dict(
+            batch_size=self.batch_size,
+            input_size=list(self.input_size),
+            backward=self.backward,
+            device=self.device,
+            peak_mem_bytes=self.peak_mem_bytes,
+            rows=self.as_dicts(include_total=False),
+            total=asdict(self.total),
+        )
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2)
+
+    def to_chrome_trace(self, path: str) -> None:
+        trace_events = [
+            dict(name='thread_name', ph='M', pid=0, tid=tid, args=dict(name=name))
+            for tid, name in ((0, 'forward'), (1, 'backward'))
+        ]
+        trace_events += self.events
+        with open(path, 'w') as f:
+            json.dump(dict(traceEvents=trace_events, displayTimeUnit='ms'), f)
+
+
+def _parent_names(name: str) -> List[str]:
+    parts = name.split('.')
+    return ['.'.join(parts[:i]) for i in range(1, len(parts))]
+
+
+def resolve_profile_rows(model: nn.Module, granularity: Union[str, int, Sequence[str]] = 'block') -> List[str]:
+    """ Names of the modules profiled as rows.
+
+    Args:
+        model: Model to profile.
+        granularity: One of
+            'stage': `feature_info` modules (falls back to 'top' if the model has no feature_info),
+            'block': repeated blocks (as found for `compile_regions`),
+            'top': top-level children,
+            int: all modules at that depth (and shallower leaf modules),
+            a sequence of module names.
+        Top-level modules that aren't ancestors or descendants of a stage / block row are added as rows.
+
+    Returns:
+        Module names in registration order.
+    """
+    modules = dict(model.named_modules())
+    if isinstance(granularity, (list, tuple)):
+        names = set(granularity)
+    elif isinstance(granularity, int):
+        names = {
+            n for n, m in modules.items()
+            if n and (n.count('.') + 1 == granularity or (n.count('.') + 1 < granularity and not list(m.children())))
+        }
+    elif granularity == 'block':
+        names = {n for n, _ in _find_regions(model)}
+    elif granularity == 'stage':
+        feature_info = getattr(model, 'feature_info', None) or []
+        names = {f['module'] for f in feature_info if f.get('module', '') in modules}
+    else:
+        assert granularity == 'top', f'Unknown profile granularity {granularity}'
+        names = set()
+
+    if not isinstance(granularity, (list, tuple, int)):
+        covered = set(names)
+        for n in names:
+            covered.update(_parent_names(n))
+        for n, _ in model.named_children():
+            if n not in covered and not any(c.startswith(n + '.') for c in names):
+                names.add(n)
+    return [n for n in modules if n in names]
+
+
+def _tensors(x: Any) -> List[torch.Tensor]:
+    if isinstance(x, torch.Tensor):
+        return [x]
+    if isinstance(x, (list, tuple)):
+        return [t for v in x for t in _tensors(v)]
+    if isinstance(x, dict):
+        return [t for v in x.values() for t in _tensors(v)]
+    return []
+
+
+def profile_model(
+        model: nn.Module,
+        input_size: Tuple[int, int, int] = (3, 224, 224),
+        batch_size: int = 1,
+        granularity: Union[str, int, Sequence[str]] = 'block',
+        backward: bool = True,
+        num_iter: int = 10,
+        num_warmup: int = 2,
+        count_flops: bool = True,
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+        amp_autocast: Callable = suppress,
+        example_input: Optional[torch.Tensor] = None,
+) -> ModelProfile:
+    """ Profile a model per module.
+
+    Args:
+        model: Model to profile (in its current train / eval mode).
+        input_size: Input (C, H, W).
+        batch_size: Batch size.
+        granularity: Row granularity, see `resolve_profile_rows`.
+        backward: Profile backward (of output.sum()) as well as forward.
+        num_iter: Number of timed iterations (times are averaged).
+        num_warmup: Number of warmup iterations.
+        count_flops: Count analytic FLOPs (`torch.utils.flop_counter` formulas) in an extra iteration.
+        device: Input device, defaults to that of the model parameters.
+        dtype: Input dtype, defaults to that of the model parameters.
+        amp_autocast: Autocast context for the forward.
+        example_input: Input tensor to use instead of a random one of `input_size`.
+
+    Returns:
+        The model profile. `act_bytes` is the size of tensors saved for backward inside the module
+        (excluding params) if `backward`, otherwise the size of the module outputs.
+    """
+    param = next(model.parameters(), None)
+    if device is not None:
+        device = torch.device(device)
+    else:
+        device = param.device if param is not None else torch.device('cpu')
+    dtype = dtype or (param.dtype if param is not None else torch.float32)
+    if example_input is None:
+        example_input = torch.randn((batch_size,) + tuple(input_size), device=device, dtype=dtype)
+    sync = torch.cuda.synchronize if device.type == 'cuda' else (lambda: None)
+
+    modules = dict(model.named_modules())
+    row_names = resolve_profile_rows(model, granularity)
+    param_ptrs = {p.data_ptr() for p in model.parameters()}
+
+    def run_fwd():
+        with amp_autocast():
+            return model(example_input)
+
+    def run_bwd(output):
+        loss = sum(t.float().sum() for t in _tensors(output) if t.requires_grad)
+        if isinstance(loss, torch.Tensor):
+            loss.backward()
+        model.zero_grad(set_to_none=True)
+
+    # per iteration state, keys are (row name, call index)
+    state: Dict[str, Any] = {}
+
+    def _reset_state():
+        state.update(
+            calls={}, active=[], bwd_open=set(), fwd_start={}, fwd_end={}, bwd_start={}, bwd_end={},
+            act_bytes={}, act_seen={}, fwd_flops={}, bwd_flops={},
+        )
+
+    def _now():
+        sync()
+        return time.perf_counter()
+
+    def _add_act(name: str, t: torch.Tensor):
+        storage = t.untyped_storage()
+        key = storage.data_ptr()
+        seen = state['act_seen'].setdefault(name, set())
+        if key not in seen:
+            seen.add(key)
+            state['act_bytes'][name] = state['act_bytes'].get(name, 0) + storage.nbytes()
+
+    def _add_flops(flops: int, acts: int):
+        # forward ops count for the modules running forward, backward ops for those w/ backward in progress
+        if not state['active']:
+            counts, names = state['bwd_flops'], {n for n, _ in state['bwd_open']} | {''}
+        else:
+            counts, names = state['fwd_flops'], set(state['active']) | {''}
+        for name in names:
+            counts[name] = counts.get(name, 0) + flops
+
+    def _pre_hook(name, module, args):
+        idx = state['calls'].get(name, 0)
+        state['calls'][name] = idx + 1
+        key = (name, idx)
+        state['active'].append(name)
+        if backward and torch.is_grad_enabled():
+            def _end(grad, key=key):
+                state['bwd_end'][key] = max(state['bwd_end'].get(key, 0.), _now())
+                state['bwd_open'].discard(key)
+            for t in _tensors(args):
+                if t.requires_grad:
+                    t.register_hook(_end)
+        state['fwd_start'][key] = _now()
+
+    def _post_hook(name, module, args, output):
+        key = (name, state['calls'][name] - 1)
+        state['fwd_end'][key] = _now()
+        state['active'].pop()
+        # outputs that are inputs (Identity, no-op Dropout) have no backward of their own
+        input_ids = {id(t) for t in _tensors(args)}
+        outputs = [t for t in _tensors(output) if id(t) not in input_ids]
+        if backward and torch.is_grad_enabled():
+            grad_outputs = [t for t in outputs if t.requires_grad]
+            if grad_outputs:
+                def _start(grad, key=key):
+                    if key not in state['bwd_start']:
+                        state['bwd_start'][key] = _now()
+                        state['bwd_open'].add(key)
+                grad_outputs[0].register_hook(_start)
+        else:
+            for t in outputs:
+                _add_act(name, t)
+
+    def _pack_hook(t: torch.Tensor):
+        if t.data_ptr() not in param_ptrs:
+            for name in set(state['active']) | {''}:
+                _add_act(name, t)
+        return t
+
+    def _run(flops: bool = False):
+        _reset_state()
+        with torch.set_grad_enabled(backward), OpCounter(_add_flops) if flops else suppress():
+            if backward:
+                with torch.autograd.graph.saved_tensors_hooks(_pack_hook, lambda t: t):
+                    output = run_fwd()
+                run_bwd(output)
+            else:
+                run_fwd()
+        return _now()
+
+    handles = []
+    for name in row_names + ['']:
+        module = modules[name]
+        handles.append(module.register_forward_pre_hook(lambda m, a, n=name: _pre_hook(n, m, a)))
+        handles.append(module.register_forward_hook(lambda m, a, o, n=name: _post_hook(n, m, a, o)))
+
+    sums = {n: dict(fwd=0., bwd=0., act=0, calls=0) for n in row_names + ['']}
+    fwd_flops, bwd_flops = {}, {}
+    events = []
+    peak_mem_bytes = None
+    try:
+        if count_flops:
+            _run(flops=True)
+            fwd_flops, bwd_flops = state['fwd_flops'], state['bwd_flops']
+        for i in range(num_warmup + num_iter):
+            timed = i >= num_warmup
+            if timed and device.type == 'cuda':
+                torch.cuda.reset_peak_memory_stats(device)
+                mem_start = torch.cuda.memory_allocated(device)
+            bwd_done = _run()
+            if not timed:
+                continue
+            if device.type == 'cuda':
+                peak_mem_bytes = torch.cuda.max_memory_allocated(device) - mem_start
+
+            events = []
+            t0 = state['fwd_start'].get(('', 0), 0.)
+            for key, start in state['fwd_start'].items():
+                name = key[0]
+                end = state['fwd_end'][key]
+                sums[name]['fwd'] += end - start
+                events.append(dict(
+                    name=name or 'model', ph='X', pid=0, tid=0, ts=1e6 * (start - t0), dur=1e6 * (end - start),
+                    args=dict(call=key[1]),
+                ))
+                if key in state['bwd_start']:
+                    bwd_start = state['bwd_start'][key]
+                    bwd_end = state['bwd_end'].get(key, bwd_done)
+                    sums[name]['bwd'] += bwd_end - bwd_start
+                    events.append(dict(
+                        name=name or 'model', ph='X', pid=0, tid=1, ts=1e6 * (bwd_start - t0),
+                        dur=1e6 * (bwd_end - bwd_start), args=dict(call=key[1]),
+                    ))
+            for name in sums:
+                sums[name]['calls'] = state['calls'].get(name, 0)
+                sums[name]['act'] = state['act_bytes'].get(name, 0)
+    finally:
+        for h in handles:
+            h.remove()
+
+    def _row(name: str) -> ModuleProfile:
+        module = modules[name]
+        s = sums[name]
+        params = list(module.parameters())
+        return ModuleProfile(
+            name=name or 'total',
+            module_type=type(module).__name__,
+            calls=s['calls'],
+            fwd_ms=1000 * s['fwd'] / max(1, num_iter),
+            bwd_ms=1000 * s['bwd'] / max(1, num_iter),
+            fwd_flops=fwd_flops.get(name, 0),
+            bwd_flops=bwd_flops.get(name, 0),
+            act_bytes=s['act'],
+            param_bytes=sum(p.numel() * p.element_size() for p in params),
+            params=sum(p.numel() for p in params),
+        )
+
+    total = _row('')
+    if not backward:
+        # sum of row outputs (the model output alone isn't meaningful as the total)
+        total.act_bytes = sum(sums[n]['act'] for n in row_names)
+    return ModelProfile(
+        rows=[_row(n) for n in row_names],
+        total=total,
+        batch_size=example_input.shape[0],
+        input_size=tuple(example_input.shape[1:]),
+        backward=backward,
+        device=str(device),
+        peak_mem_bytes=peak_mem_bytes,
+        events=events,
+    )
@@ -7,3 +7,28 @@ def random_seed(seed=42, rank=0):
     torch.manual_seed(seed + rank)
     np.random.seed(seed + rank)
     random.seed(seed + rank)
+
+
+def get_rng_state():
+    """ RNG state of python, numpy, torch and (if available) CUDA.
+
+    Only python builtins and tensors are used so the state can be loaded w/ `torch.load(weights_only=True)`.
+    """
+    np_name, np_keys, np_pos, np_has_gauss, np_gauss = np.random.get_state()
+    state = {
+        'python': random.getstate(),
+        'numpy': (np_name, np_keys.tolist(), int(np_pos), int(np_has_gauss), float(np_gauss)),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        state['cuda'] = torch.cuda.get_rng_state()
+    return state
+
+
+def set_rng_state(state):
+    """ Restore an RNG state captured with `get_rng_state`. """
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state(state['cuda'])
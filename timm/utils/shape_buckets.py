@@ -0,0 +1,283 @@
+""" Shape-bucketed model dispatch
+
+Run a model on a fixed set of (batch, height, width) input shapes. Incoming batches are padded up to the
+nearest bucket and the outputs are sliced / cropped back, so `torch.compile` (dynamic=False), TorchScript
+traces, or cudagraph-style backends see a bounded set of static shapes instead of recompiling (or going
+dynamic) for every new batch size or resolution from a serving queue or a ragged final loader batch.
+"""
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import torch
+import torch.nn.functional as F
+from torch import nn as nn
+
+_logger = logging.getLogger(__name__)
+
+__all__ = ['ShapeBucketModel']
+
+_Bucket = Tuple[int, int, int]
+
+
+def _to_2tuple_sizes(img_sizes: Sequence[Union[int, Tuple[int, int]]]) -> List[Tuple[int, int]]:
+    sizes = [(s, s) if isinstance(s, int) else tuple(s) for s in img_sizes]
+    return sorted(set(sizes), key=lambda s: (s[0] * s[1], s))
+
+
+def _map_tensors(fn: Callable[[torch.Tensor], torch.Tensor], x: Any) -> Any:
+    if isinstance(x, torch.Tensor):
+        return fn(x)
+    if isinstance(x, (list, tuple)):
+        return type(x)(_map_tensors(fn, v) for v in x)
+    if isinstance(x, dict):
+        return type(x)((k, _map_tensors(fn, v)) for k, v in x.items())
+    return x
+
+
+def _cat_outputs(outputs: List[Any]) -> Any:
+    first = outputs[0]
+    if isinstance(first, torch.Tensor):
+        return torch.cat(outputs)
+    if isinstance(first, (list, tuple)):
+        return type(first)(_cat_outputs(list(v)) for v in zip(*outputs))
+    if isinstance(first, dict):
+        return type(first)((k, _cat_outputs([o[k] for o in outputs])) for k in first)
+    return first
+
+
+class ShapeBucketModel(nn.Module):
+    """ Dispatch inputs to a fixed set of static (batch, height, width) shape buckets.
+
+    * batch: padded (zeros) up to the smallest bucket batch size >= the input batch size and the padding
+      rows are sliced off all (nested) output tensors. Inputs larger than the largest batch bucket are
+      split into chunks.
+    * spatial (if `img_sizes` set): the input is zero padded (bottom / right) or resized to the smallest
+      bucket >= its height and width. For 'pad', 4D (spatial feature map) outputs are cropped back in
+      proportion. Note zero padding changes the result of a globally pooled classifier, use 'resize', or
+      models that take the padding into account, if that matters. Inputs larger than every bucket are
+      run on the unwrapped (eager) model.
+
+    Padding with zeros corresponds to the mean value for normalized inputs.
+
+    Modes:
+    * 'eager': run `model` as is (which may already be compiled, ie via `compile_regions`)
+    * 'compile': `torch.compile(model, dynamic=False)`, one static graph per bucket
+    * 'torchscript': `torch.jit.trace` one graph per bucket (and per input size if `img_sizes` isn't set)
+
+    Per-bucket statistics (calls, samples, padding samples, warmup and run time) are kept in `stats()`.
+    """
+
+    def __init__(
+            self,
+            model: nn.Module,
+            batch_sizes: Sequence[int] = (1, 8, 32),
+            img_sizes: Optional[Sequence[Union[int, Tuple[int, int]]]] = None,
+            mode: str = 'eager',
+            spatial_mode: str = 'pad',
+            output_fmt: str = 'NCHW',
+            synchronize: bool = False,
+            compile_kwargs: Optional[Dict[str, Any]] = None,
+    ):
+        """
+        Args:
+            model: Model to wrap.
+            batch_sizes: Batch size buckets.
+            img_sizes: Image size buckets (int or (H, W)), spatial size isn't bucketed if None.
+            mode: One of 'eager', 'compile', 'torchscript'.
+            spatial_mode: One of 'pad', 'resize'.
+            output_fmt: Layout of 4D outputs for spatial crop, 'NCHW' or 'NHWC'.
+            synchronize: Synchronize the device around each call for accurate per-bucket run times.
+            compile_kwargs: Additional torch.compile args (ie `backend`, `mode`) for mode 'compile'.
+        """
+        super().__init__()
+        assert mode in ('eager', 'compile', 'torchscript'), f'Unknown mode {mode}'
+        assert spatial_mode in ('pad', 'resize'), f'Unknown spatial_mode {spatial_mode}'
+        assert output_fmt in ('NCHW', 'NHWC'), f'Unknown output_fmt {output_fmt}'
+        assert len(batch_sizes) and min(batch_sizes) > 0
+        self.model = model
+        self.batch_sizes = sorted(set(batch_sizes))
+        self.img_sizes = _to_2tuple_sizes(img_sizes) if img_sizes else None
+        self.mode = mode
+        self.spatial_mode = spatial_mode
+        self.output_fmt = output_fmt
+        self.synchronize = synchronize
+
+        # plain dict, compiled / traced runners aren't registered as submodules (no extra state_dict keys)
+        self._runners: Dict[Union[_Bucket, str], Callable] = {}
+        if mode == 'compile':
+            num_buckets = len(self.batch_sizes) * (len(self.img_sizes) if self.img_sizes else 1)
+            import torch._dynamo.config as dynamo_config
+            limit_attr = 'recompile_limit' if hasattr(dynamo_config, 'recompile_limit') else 'cache_size_limit'
+            if getattr(dynamo_config, limit_attr) < num_buckets:
+                _logger.info(f'Increasing torch._dynamo.config.{limit_attr} to {num_buckets} for shape buckets.')
+                setattr(dynamo_config, limit_attr, num_buckets)
+            self._runners['compiled'] = torch.compile(model, dynamic=False, **(compile_kwargs or {}))
+
+        self._stats: Dict[Union[_Bucket, str], Dict[str, float]] = OrderedDict()
+
+    @property
+    def buckets(self) -> List[_Bucket]:
+        img_sizes = self.img_sizes or [(-1, -1)]
+        return [(b, h, w) for h, w in img_sizes for b in self.batch_sizes]
+
+    def find_bucket(self, batch_size: int, height: int, width: int) -> Optional[_Bucket]:
+        """ Smallest bucket fitting a (<= max bucket batch size) input, None if the spatial size doesn't fit. """
+        bucket_batch = next((b for b in self.batch_sizes if b >= batch_size), self.batch_sizes[-1])
+        if self.img_sizes is None:
+            return bucket_batch, -1, -1
+        for h, w in self.img_sizes:
+            if h >= height and w >= width:
+                return bucket_batch, h, w
+        return None
+
+    def _bucket_stats(self, key: Union[_Bucket, str]) -> Dict[str, float]:
+        if key not in self._stats:
+            self._stats[key] = dict(calls=0, samples=0, pad_samples=0, warmup_time=0., run_time=0.)
+        return self._stats[key]
+
+    def _sync(self, device: torch.device):
+        if self.synchronize and device.type != 'cpu' and hasattr(torch, 'accelerator'):
+            torch.accelerator.synchronize(device)
+
+    def _runner(self, bucket: _Bucket, x: torch.Tensor) -> Callable:
+        if self.mode == 'compile':
+            return self._runners['compiled']
+        if self.mode == 'torchscript':
+            # traces are specialized to the full input shape, w/o spatial buckets (H, W) varies within a bucket
+            key = tuple(x.shape)
+            traced = self._runners.get(key, None)
+            if traced is None:
+                # trace w/ a fresh (non-inference) example so this also works under torch.inference_mode
+                with torch.inference_mode(False), torch.no_grad():
+                    example = torch.zeros(x.shape, device=x.device, dtype=x.dtype)
+                    traced = torch.jit.trace(self.model, example, check_trace=False)
+                self._runners[key] = traced
+            return traced
+        return self.model
+
+    def _pad_input(self, x: torch.Tensor, bucket: _Bucket) -> torch.Tensor:
+        bucket_batch, bucket_h, bucket_w = bucket
+        if bucket_h > 0 and x.shape[-2:] != (bucket_h, bucket_w):
+            if self.spatial_mode == 'resize':
+                x = F.interpolate(x, size=(bucket_h, bucket_w), mode='bilinear', align_corners=False)
+            else:
+                x = F.pad(x, (0, bucket_w - x.shape[-1], 0, bucket_h - x.shape[-2]))
+        if x.shape[0] < bucket_batch:
+            x = torch.cat([x, x.new_zeros((bucket_batch - x.shape[0],) + x.shape[1:])])
+        return x
+
+    def _crop_output(self, out: Any, batch_size: int, height: int, width: int, bucket: _Bucket) -> Any:
+        _, bucket_h, bucket_w = bucket
+        crop_spatial = bucket_h > 0 and self.spatial_mode == 'pad' and (height, width) != (bucket_h, bucket_w)
+        h_dim, w_dim = (2, 3) if self.output_fmt == 'NCHW' else (1, 2)
+
+        def _crop(t: torch.Tensor) -> torch.Tensor:
+            t = t[:batch_size]
+            if crop_spatial and t.ndim == 4:
+                out_h = math.ceil(height * t.shape[h_dim] / bucket_h)
+                out_w = math.ceil(width * t.shape[w_dim] / bucket_w)
+                t = t.narrow(h_dim, 0, out_h).narrow(w_dim, 0, out_w)
+            return t
+
+        return _map_tensors(_crop, out)
+
+    def _run_bucket(self, x: torch.Tensor, bucket: _Bucket, warmup: bool = False) -> Any:
+        batch_size, height, width = x.shape[0], x.shape[-2], x.shape[-1]
+        x = self._pad_input(x, bucket)
+        runner = self._runner(bucket, x)
+        self._sync(x.device)
+        start = time.perf_counter()
+        out = runner(x)
+        self._sync(x.device)
+        elapsed = time.perf_counter() - start
+
+        stats = self._bucket_stats(bucket)
+        if warmup:
+            stats['warmup_time'] += elapsed
+        else:
+            stats['calls'] += 1
+            stats['samples'] += batch_size
+            stats['pad_samples'] += bucket[0] - batch_size
+            stats['run_time'] += elapsed
+        return self._crop_output(out, batch_size, height, width, bucket)
+
+    def forward(self, x: torch.Tensor) -> Any:
+        batch_size, height, width = x.shape[0], x.shape[-2], x.shape[-1]
+        bucket = self.find_bucket(batch_size, height, width)
+        if bucket is None:
+            # spatial size larger than all buckets, run the unwrapped model
+            stats = self._bucket_stats('miss')
+            start = time.perf_counter()
+            out = self.model(x)
+            stats['calls'] += 1
+            stats['samples'] += batch_size
+            stats['run_time'] += time.perf_counter() - start
+            return out
+
+        max_batch = self.batch_sizes[-1]
+        if batch_size <= max_batch:
+            return self._run_bucket(x, bucket)
+        outputs = [self._run_bucket(xs, self.find_bucket(xs.shape[0], height, width)) for xs in x.split(max_batch)]
+        return _cat_outputs(outputs)
+
+    @torch.no_grad()
+    def warmup(
+            self,
+            in_chans: int = 3,
+            img_size: Optional[Union[int, Tuple[int, int]]] = None,
+            device: Optional[torch.device] = None,
+            dtype: Optional[torch.dtype] = None,
+            memory_format: Optional[torch.memory_format] = None,
+    ) -> Dict[_Bucket, float]:
+        """ Run (and compile / trace) every bucket once ahead of time.
+
+        Args:
+            in_chans: Input channels.
+            img_size: Input size if spatial size isn't bucketed, defaults to the model's pretrained_cfg.
+            device: Input device, defaults to that of the model parameters.
+            dtype: Input dtype, defaults to that of the model parameters.
+            memory_format: Input memory format (ie torch.channels_last).
+
+        Returns:
+            Warmup (compile) time in seconds per bucket.
+        """
+        param = next(self.model.parameters(), None)
+        device = device or (param.device if param is not None else torch.device('cpu'))
+        dtype = dtype or (param.dtype if param is not None else torch.float32)
+        if self.img_sizes is None:
+            if img_size is None:
+                img_size = getattr(self.model, 'pretrained_cfg', {}).get('input_size', (3, 224, 224))[-2:]
+            img_size = (img_size, img_size) if isinstance(img_size, int) else tuple(img_size)
+
+        times = {}
+        for bucket in self.buckets:
+            h, w = bucket[1:] if bucket[1] > 0 else img_size
+            x = torch.zeros((bucket[0], in_chans, h, w), device=device, dtype=dtype)
+            if memory_format is not None:
+                x = x.contiguous(memory_format=memory_format)
+            self._run_bucket(x, bucket, warmup=True)
+            times[bucket] = self._stats[bucket]['warmup_time']
+            _logger.info(f'Warmed up bucket (batch={bucket[0]}, size={h}x{w}) in {times[bucket]:.3f}s.')
+        return times
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """ Per-bucket statistics (unbucketed fallback runs as bucket 'miss'). """
+        results = []
+        for key, s in self._stats.items():
+            if key == 'miss':
+                info = dict(bucket='miss', batch_size=None, img_size=None)
+            else:
+                img_size = None if key[1] < 0 else key[1:]
+                name = f'{key[0]}x{key[1]}x{key[2]}' if img_size else str(key[0])
+                info = dict(bucket=name, batch_size=key[0], img_size=img_size)
+            info.update(s)
+            info['pad_ratio'] = s['pad_samples'] / max(1, s['samples'] + s['pad_samples'])
+            info['avg_time'] = s['run_time'] / max(1, s['calls'])
+            results.append(info)
+        return results
+
+    def reset_stats(self):
+        self._stats.clear()
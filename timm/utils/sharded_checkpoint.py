@@ -0,0 +1,336 @@
+""" Sharded (per-rank) checkpoints
+
+A sharded checkpoint is a directory w/ a manifest, the non-tensor state and one file per rank:
+
+    manifest.json               world size, epoch, metric and the tensor index (key -> shard, shape, dtype)
+    common.pth                  the state w/ tensors replaced by references (epoch, args, optimizer param groups, ...)
+    shard-00000-of-00004.pth    the tensors owned by rank 0 and its per-rank state (RNG, sampler)
+    shard-00000-of-00004.done   the save id of the shard, written once the shard is complete
+    ...
+
+The tensors of the (DDP replicated) training state are assigned to ranks balanced by size, so each rank
+serializes ~1/N of the bytes and all ranks write in parallel. On restore each rank reads only its own shard(s)
+and receives the remaining tensors from their owners via broadcast, the file system serves each byte once
+instead of once per rank. Restoring w/ a different world size is supported, the per-rank state is only
+restored w/ the world size it was saved with. `consolidate_sharded_checkpoint` builds the standard single file
+checkpoint from the shards.
+
+Every save is tagged w/ a save id (the same on all ranks) stored in the manifest, the shards and their done
+markers. A checkpoint is only complete when the markers of all ranks hold the save id, so shards left in a
+(reused) directory by an earlier, interrupted run are never mixed into it.
+
+The sampler state restored is its epoch (and `state_dict()` if the sampler has one), the data loader position
+within an epoch is not restored. A resume from a mid-epoch (recovery) checkpoint restarts that epoch.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import torch
+from torch import distributed as dist
+
+_logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'manifest.json'
+COMMON_NAME = 'common.pth'
+_TENSOR_REF = '__sharded_tensor__'
+_FORMAT = 'timm-sharded'
+_ALIGN = 16  # byte alignment of tensors packed into a broadcast bucket
+
+
+def shard_filename(rank: int, world_size: int, ext: str = '.pth') -> str:
+    return f'shard-{rank:05d}-of-{world_size:05d}{ext}'
+
+
+def is_sharded_checkpoint(path: str) -> bool:
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, MANIFEST_NAME))
+
+
+def _split_tensors(obj, path, tensors):
+    # replace tensors w/ references keyed by their (json encoded) path in the state
+    if isinstance(obj, torch.Tensor):
+        key = json.dumps(path)
+        tensors[key] = obj
+        return {_TENSOR_REF: key}
+    if isinstance(obj, dict):
+        return obj.__class__((k, _split_tensors(v, path + [k], tensors)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)) and not hasattr(obj, '_fields'):
+        return obj.__class__(_split_tensors(v, path + [i], tensors) for i, v in enumerate(obj))
+    return obj
+
+
+def _fill_tensors(obj, tensors):
+    if isinstance(obj, dict):
+        if len(obj) == 1 and _TENSOR_REF in obj:
+            return tensors.get(obj[_TENSOR_REF], None)
+        return obj.__class__((k, _fill_tensors(v, tensors)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)) and not hasattr(obj, '_fields'):
+        return obj.__class__(_fill_tensors(v, tensors) for v in obj)
+    return obj
+
+
+def _assign_shards(nbytes: Dict[str, int], world_size: int) -> Dict[str, int]:
+    # largest first onto the least loaded rank, deterministic so every rank computes the same assignment
+    loads = [0] * world_size
+    owners = {}
+    for key in sorted(nbytes, key=lambda k: (-nbytes[k], k)):
+        rank = min(range(world_size), key=lambda r: (loads[r], r))
+        owners[key] = rank
+        loads[rank] += nbytes[key]
+    return owners
+
+
+def shard_state(
+        state: Dict[str, Any],
+        rank: int = 0,
+        world_size: int = 1,
+) -> Tuple[Dict[str, Any], Dict[str, torch.Tensor], Dict[str, Dict[str, Any]]]:
+    """ Split a checkpoint state into its non-tensor part, the tensors owned by rank and the tensor index.
+
+    The state must hold the same tensor keys, shapes and dtypes on every rank (ie replicated DDP state).
+
+    Returns:
+        (common state w/ tensor references, tensors owned by rank, index of all tensors)
+    """
+    tensors = {}
+    common = _split_tensors(state, [], tensors)
+    owners = _assign_shards({k: t.numel() * t.element_size() for k, t in tensors.items()}, world_size)
+    index = {
+        k: dict(shard=owners[k], shape=list(t.shape), dtype=str(t.dtype).split('.')[-1])
+        for k, t in tensors.items()
+    }
+    owned = {k: t for k, t in tensors.items() if owners[k] == rank}
+    return common, owned, index
+
+
+def _write(obj, path, fsync=True):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        if isinstance(obj, (bytes, str)):
+            f.write(obj.encode('utf-8') if isinstance(obj, str) else obj)
+        else:
+            torch.save(obj, f)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)  # a file w/ its final name is complete
+
+
+def write_shard(
+        checkpoint_dir: str,
+        tensors: Dict[str, torch.Tensor],
+        rank: int = 0,
+        world_size: int = 1,
+        rank_state: Optional[Dict[str, Any]] = None,
+        save_id: str = '',
+        fsync: bool = True,
+):
+    """ Write the tensors owned by rank and its per-rank state, then its done marker w/ the save id. """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    marker_path = os.path.join(checkpoint_dir, shard_filename(rank, world_size, '.done'))
+    if os.path.exists(marker_path):
+        os.remove(marker_path)  # stale marker of an earlier save into this dir
+    shard = {'tensors': tensors, 'rank_state': rank_state, 'save_id': save_id}
+    _write(shard, os.path.join(checkpoint_dir, shard_filename(rank, world_size)), fsync=fsync)
+    _write(save_id, marker_path, fsync=fsync)
+
+
+def write_manifest(
+        checkpoint_dir: str,
+        common: Dict[str, Any],
+        index: Dict[str, Dict[str, Any]],
+        world_size: int = 1,
+        save_id: str = '',
+        fsync: bool = True,
+):
+    """ Write the common state and the manifest (primary rank only). """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    _write(common, os.path.join(checkpoint_dir, COMMON_NAME), fsync=fsync)
+    manifest = dict(
+        format=_FORMAT,
+        version=1,
+        save_id=save_id,
+        world_size=world_size,
+        shards=[shard_filename(r, world_size) for r in range(world_size)],
+        epoch=common.get('epoch', None),
+        metric=common.get('metric', None),
+        tensors=index,
+    )
+    _write(json.dumps(manifest, indent=2), os.path.join(checkpoint_dir, MANIFEST_NAME), fsync=fsync)
+
+
+def _read_marker(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def wait_for_shards(
+        checkpoint_dir: str,
+        world_size: int,
+        save_id: str = '',
+        timeout: float = 1800.,
+        poll_interval: float = 0.1,
+) -> bool:
+    """ Wait until the shards of all ranks for save_id are written, returns False on timeout. """
+    paths = [os.path.join(checkpoint_dir, shard_filename(r, world_size, '.done')) for r in range(world_size)]
+    deadline = time.monotonic() + timeout
+    pending = list(paths)
+    while pending:
+        pending = [p for p in pending if _read_marker(p) != save_id]
+        if not pending:
+            break
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(poll_interval)
+    return True
+
+
+def save_sharded_checkpoint(
+        state: Dict[str, Any],
+        checkpoint_dir: str,
+        rank: int = 0,
+        world_size: int = 1,
+        rank_state: Optional[Dict[str, Any]] = None,
+        save_id: str = '',
+        fsync: bool = True,
+):
+    """ Save a (replicated) checkpoint state as a sharded checkpoint, called on every rank.
+
+    Args:
+        state: Checkpoint state, same tensor keys, shapes and dtypes on every rank.
+        checkpoint_dir: Output directory.
+        rank: Rank of the caller.
+        world_size: Number of ranks (shards).
+        rank_state: Per-rank state (ie RNG, sampler) stored in the shard of this rank.
+        save_id: Id of this save, the same on all ranks and unique per save into checkpoint_dir.
+        fsync: Sync the files to disk.
+    """
+    common, tensors, index = shard_state(state, rank, world_size)
+    write_shard(checkpoint_dir, tensors, rank, world_size, rank_state, save_id=save_id, fsync=fsync)
+    if rank == 0:
+        write_manifest(checkpoint_dir, common, index, world_size, save_id=save_id, fsync=fsync)
+
+
+def _load(path, weights_only=True):
+    if weights_only and hasattr(torch.serialization, 'safe_globals'):
+        with torch.serialization.safe_globals([argparse.Namespace]):
+            return torch.load(path, map_location='cpu', weights_only=True)
+    return torch.load(path, map_location='cpu', weights_only=weights_only)
+
+
+def _broadcast_tensors(
+        tensors: Dict[str, torch.Tensor],
+        index: Dict[str, Dict[str, Any]],
+        rank: int,
+        world_size: int,
+        device: torch.device,
+        bucket_bytes: int,
+):
+    # tensors are packed (as bytes) into buckets per source rank to keep the number of collectives low
+    buckets = []
+    for src in range(world_size):
+        bucket, size = [], 0
+        for key in sorted(index):
+            info = index[key]
+            if info['shard'] % world_size != src:
+                continue
+            dtype = getattr(torch, info['dtype'])
+            nbytes = torch.Size(info['shape']).numel() * torch.empty((), dtype=dtype).element_size()
+            if bucket and size + nbytes > bucket_bytes:
+                buckets.append((src, bucket, size))
+                bucket, size = [], 0
+            bucket.append((key, info['shape'], dtype, size, nbytes))
+            size += -(-nbytes // _ALIGN) * _ALIGN
+        if bucket:
+            buckets.append((src, bucket, size))
+
+    for src, bucket, size in buckets:
+        buf = torch.empty(size, dtype=torch.uint8, device=device)
+        if rank == src:
+            for key, _, _, offset, nbytes in bucket:
+                if nbytes:
+                    buf[offset:offset + nbytes].copy_(tensors[key].contiguous().view(-1).view(torch.uint8))
+        dist.broadcast(buf, src)
+        if rank != src:
+            buf = buf.cpu()
+            for key, shape, dtype, offset, nbytes in bucket:
+                tensors[key] = buf[offset:offset + nbytes].view(dtype).reshape(shape).clone()
+
+
+def load_sharded_checkpoint(
+        checkpoint_dir: str,
+        exclude: Sequence[str] = (),
+        device: Optional[torch.device] = None,
+        bucket_bytes: int = 64 * 2**20,
+        weights_only: bool = True,
+) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+    """ Load a sharded checkpoint into the standard (single file) checkpoint form.
+
+    When distributed is initialized this is a collective, each rank reads its own shard(s) (shard i is read by
+    rank i % world_size) and the other tensors are broadcast from their readers. Otherwise all shards are read.
+
+    Args:
+        checkpoint_dir: Sharded checkpoint directory.
+        exclude: Top-level state keys not to load (ie 'optimizer', 'state_dict_ema').
+        device: Device used for the broadcast (default: current CUDA device for NCCL, else CPU).
+        bucket_bytes: Broadcast bucket size.
+        weights_only: Load w/ torch.load(weights_only=True).
+
+    Returns:
+        (checkpoint state w/ CPU tensors, per-rank state of this rank or None)
+    """
+    with open(os.path.join(checkpoint_dir, MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+    assert manifest.get('format', None) == _FORMAT, f'{checkpoint_dir} is not a sharded checkpoint.'
+    saved_world_size = manifest['world_size']
+
+    distributed = dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+    rank, world_size = (dist.get_rank(), dist.get_world_size()) if distributed else (0, 1)
+    exclude = set(exclude)
+    index = {k: v for k, v in manifest['tensors'].items() if json.loads(k)[0] not in exclude}
+
+    common = _load(os.path.join(checkpoint_dir, COMMON_NAME), weights_only=weights_only)
+    common = {k: v for k, v in common.items() if k not in exclude}
+
+    tensors = {}
+    rank_state = None
+    needed = {info['shard'] for info in index.values()}
+    for shard_idx in range(saved_world_size):
+        if shard_idx % world_size != rank:
+            continue
+        if shard_idx not in needed and not (shard_idx == rank and saved_world_size == world_size):
+            continue
+        shard = _load(os.path.join(checkpoint_dir, manifest['shards'][shard_idx]), weights_only=weights_only)
+        assert shard.get('save_id', '') == manifest.get('save_id', ''), \
+            f'Shard {shard_idx} of {checkpoint_dir} is from a different save than the manifest.'
+        tensors.update({k: v for k, v in shard['tensors'].items() if k in index})
+        if shard_idx == rank and saved_world_size == world_size:
+            rank_state = shard['rank_state']
+        del shard
+
+    if distributed:
+        if device is None:
+            device = torch.device('cuda', torch.cuda.current_device()) \
+                if dist.get_backend() == 'nccl' else torch.device('cpu')
+        _broadcast_tensors(tensors, index, rank, world_size, device, bucket_bytes)
+
+    return _fill_tensors(common, tensors), rank_state
+
+
+def consolidate_sharded_checkpoint(
+        checkpoint_dir: str,
+        output_file: str = '',
+        exclude: Sequence[str] = (),
+        weights_only: bool = True,
+) -> Dict[str, Any]:
+    """ Assemble the standard single file checkpoint from a sharded checkpoint, optionally saving it. """
+    state, _ = load_sharded_checkpoint(checkpoint_dir, exclude=exclude, weights_only=weights_only)
+    if output_file:
+        torch.save(state, output_file)
+    return state
@@ -0,0 +1,118 @@
+""" Per-step phase timing telemetry
+
+Times the phases of a train step (data wait, host to device copy, forward, backward, optimizer, ...) without
+synchronizing the device every step. Device phases are bracketed with CUDA events, host phases (and all phases
+on CPU, where ops run synchronously) w/ host timestamps. The elapsed times are only resolved on `flush()`,
+which is intended to be called at the log interval where the host syncs anyway. The step `total` is the host
+wall time from `start()` to `end()`, so time not covered by a marked phase still counts.
+"""
+import json
+import time
+from collections import OrderedDict
+from typing import Dict
+
+import torch
+
+
+class StepTelemetry:
+    """ Low overhead per-step phase timer w/ a JSONL trace.
+
+    Usage per step:
+        telemetry.start()
+        ... telemetry.mark('data', host=True)
+        ... telemetry.mark('forward')
+        telemetry.end(epoch=epoch, step=step)
+    and `telemetry.flush()` every N steps to resolve the timings, append them to the trace and get the means.
+    """
+
+    def __init__(
+            self,
+            device: torch.device = torch.device('cuda'),
+            trace_file: str = '',
+            enabled: bool = True,
+    ):
+        self.enabled = enabled
+        self.use_events = enabled and device.type == 'cuda'
+        self.trace_file = trace_file
+        self._phases = []
+        self._pending = []
+        self._last_host = 0.
+        self._start_host = 0.
+        self._last_event = None
+
+    def _record_event(self):
+        event = torch.cuda.Event(enable_timing=True)
+        event.record()
+        return event
+
+    def start(self):
+        """ Start a step. """
+        if not self.enabled:
+            return
+        self._phases = []
+        self._last_host = time.perf_counter()
+        self._start_host = self._last_host
+        if self.use_events:
+            self._last_event = self._record_event()
+
+    def mark(self, phase: str, host: bool = False):
+        """ End phase (and start the next one).
+
+        Args:
+            phase: Name of the phase that just ended, a repeated name within a step is accumulated.
+            host: Time the phase on the host (ie data loader wait, checkpoint I/O) instead of the device.
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.use_events:
+            event = self._record_event()
+            if host:
+                self._phases.append((phase, now - self._last_host))
+            else:
+                self._phases.append((phase, (self._last_event, event)))
+            self._last_event = event
+        else:
+            self._phases.append((phase, now - self._last_host))
+        self._last_host = now
+
+    def end(self, **info):
+        """ End the step, info (ie epoch, step, batch size) is written to the trace along w/ the timings. """
+        if not self.enabled:
+            return
+        self._pending.append((self._phases, time.perf_counter() - self._start_host, info))
+        self._phases = []
+
+    def flush(self) -> Dict[str, float]:
+        """ Resolve the pending step timings, write them to the trace.
+
+        Returns:
+            Mean time (ms) per phase over the flushed steps.
+        """
+        if not self.enabled or not self._pending:
+            return OrderedDict()
+        if self.use_events and self._last_event is not None:
+            self._last_event.synchronize()
+
+        totals = OrderedDict()
+        lines = []
+        for phases, wall_time, info in self._pending:
+            step_times = OrderedDict()
+            for phase, t in phases:
+                if isinstance(t, tuple):
+                    ms = t[0].elapsed_time(t[1])
+                else:
+                    ms = 1000 * t
+                step_times[phase] = step_times.get(phase, 0.) + ms
+            step_times['total'] = 1000 * wall_time
+            for phase, ms in step_times.items():
+                totals[phase] = totals.get(phase, 0.) + ms
+            lines.append(json.dumps(dict(**info, **{f'{k}_ms': round(v, 4) for k, v in step_times.items()})))
+
+        if self.trace_file:
+            with open(self.trace_file, 'a') as f:
+                f.write('\n'.join(lines) + '\n')
+
+        num_steps = len(self._pending)
+        self._pending = []
+        return OrderedDict((k, v / num_steps) for k, v in totals.items())
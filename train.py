@@ -21,6 +21,7 @@ import json
 import logging
 import os
 import time
+import uuid
 from collections import OrderedDict
 from contextlib import suppress
 from datetime import datetime
@@ -160,6 +161,9 @@ group.add_argument('--head-init-bias', default=None, type=float,
                    help='Head initialization bias value')
 group.add_argument('--torchcompile-mode', type=str, default=None,
                     help="torch.compile mode (default: None).")
+group.add_argument('--torchcompile-regions', default=False, action='store_true',
+                   help="With --torchcompile, compile the repeated blocks (one graph per distinct block) "
+                        "instead of the whole model.")
 
 # scripting / codegen
 scripting_group = group.add_mutually_exclusive_group()
@@ -182,6 +186,18 @@ group.add_argument('--no-ddp-bb', action='store_true', default=False,
                    help='Force broadcast buffers for native DDP to off.')
 group.add_argument('--synchronize-step', action='store_true', default=False,
                    help='torch.cuda.synchronize() end of each step')
+group.add_argument('--step-telemetry', action='store_true', default=False,
+                   help='Time the phases of each train step (data, h2d copy, fwd, bwd, optimizer, ema, log, '
+                        'checkpoint, sched) w/o host syncs and write them to step_telemetry.jsonl in the output dir.')
+group.add_argument('--torch-profile', default='', type=str, choices=('', 'train', 'eval', 'both'),
+                   help='Capture train and / or eval step windows w/ torch.profiler, traces and op tables are '
+                        'written to the output dir.')
+group.add_argument('--torch-profile-schedule', type=int, nargs=4, default=(1, 1, 3, 1),
+                   metavar=('WAIT', 'WARMUP', 'ACTIVE', 'REPEAT'),
+                   help='torch.profiler step schedule (default: 1 1 3 1), REPEAT 0 captures train windows '
+                        'for the whole run.')
+group.add_argument('--torch-profile-memory', action='store_true', default=False,
+                   help='Also record memory timelines, peak memory by module and CUDA allocator snapshots.')
 group.add_argument("--local_rank", default=0, type=int)
 group.add_argument('--device-modules', default=None, type=str, nargs='+',
                     help="Python imports for device backend modules.")
@@ -374,6 +390,12 @@ group.add_argument('--recovery-interval', type=int, default=0, metavar='N',
                    help='how many batches to wait before writing recovery checkpoint')
 group.add_argument('--checkpoint-hist', type=int, default=10, metavar='N',
                    help='number of checkpoints to keep (default: 10)')
+group.add_argument('--checkpoint-async', action='store_true', default=False,
+                   help='Snapshot checkpoints to CPU memory and write them on a background thread.')
+group.add_argument('--checkpoint-sharded', action='store_true', default=False,
+                   help='Save checkpoints as directories w/ a shard per rank (written in parallel, incl. RNG and '
+                        'sampler epoch, a resume restarts the epoch). Use consolidate_checkpoint.py to get a single '
+                        'file checkpoint.')
 group.add_argument('-j', '--workers', type=int, default=4, metavar='N',
                    help='how many training processes to use (default: 4)')
 group.add_argument('--save-images', action='store_true', default=False,
@@ -475,6 +497,29 @@ def _parse_args():
     return args, args_text
 
 
+def _get_rank_state(loader):
+    state = {'rng': utils.get_rng_state()}
+    for name in ('sampler', 'batch_sampler'):
+        sampler = getattr(loader, name, None)
+        if hasattr(sampler, 'state_dict'):
+            state[name] = sampler.state_dict()
+        elif hasattr(sampler, 'epoch'):
+            state[name] = {'epoch': sampler.epoch}
+    return state
+
+
+def _load_rank_state(loader, state):
+    utils.set_rng_state(state['rng'])
+    for name in ('sampler', 'batch_sampler'):
+        sampler = getattr(loader, name, None)
+        if name not in state or sampler is None:
+            continue
+        if hasattr(sampler, 'load_state_dict'):
+            sampler.load_state_dict(state[name])
+        elif hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(state[name]['epoch'])
+
+
 def _set_loader_epoch(loader, epoch: int) -> None:
     if hasattr(loader.dataset, 'set_epoch'):
         loader.dataset.set_epoch(epoch)
@@ -991,6 +1036,7 @@ def main():
             optimizer=None if args.no_resume_opt else optimizer,
             loss_scaler=None if args.no_resume_opt else loss_scaler,
             log_info=utils.is_primary(args),
+            load_rank_state_fn=partial(_load_rank_state, loader_train),
         )
 
     # setup exponential moving average of model weights, SWA could be used here too
@@ -1012,10 +1058,20 @@ def main():
             _logger.info(
                 f"Compiling task components with backend={args.torchcompile}, mode={args.torchcompile_mode}"
             )
-        task.compile(backend=args.torchcompile, mode=args.torchcompile_mode)
+        if args.torchcompile_regions:
+            # in-place, the task modules and their state_dict keys are unchanged
+            utils.compile_regions(task.get_trainable_module(), backend=args.torchcompile, mode=args.torchcompile_mode)
+            if task.has_ema():
+                utils.compile_regions(
+                    task.get_trainable_module(ema=True),
+                    backend=args.torchcompile,
+                    mode=args.torchcompile_mode,
+                )
+        else:
+            task.compile(backend=args.torchcompile, mode=args.torchcompile_mode)
         model = task.get_trainable_module()
         eval_model = task.get_eval_model()
-        if task.has_ema():
+        if task.has_ema() and not args.torchcompile_regions:
             task.compile_ema(
                 backend=args.torchcompile,
                 mode=args.torchcompile_mode,
@@ -1035,6 +1091,28 @@ def main():
     best_epoch = None
     saver = None
     output_dir = None
+    saver_kwargs = dict(
+        model=model,
+        optimizer=optimizer,
+        args=args,
+        amp_scaler=loss_scaler,
+        decreasing=decreasing_metric,
+        max_history=args.checkpoint_hist,
+        task=task,
+        async_save=args.checkpoint_async,
+    )
+    if args.checkpoint_sharded:
+        saver_kwargs.update(
+            sharded=True,
+            rank=args.rank,
+            world_size=args.world_size,
+            rank_state_fn=partial(_get_rank_state, loader_train),
+        )
+        if args.distributed:
+            # the shards of a save are matched by the run id + save count, the same on all ranks
+            run_id = [uuid.uuid4().hex]
+            torch.distributed.broadcast_object_list(run_id, src=0)
+            saver_kwargs['run_id'] = run_id[0]
     if utils.is_primary(args):
         if args.experiment:
             exp_name = args.experiment
@@ -1045,17 +1123,7 @@ def main():
                 str(data_config['input_size'][-1])
             ])
         output_dir = utils.get_outdir(args.output if args.output else './output/train', exp_name)
-        saver = utils.CheckpointSaver(
-            model=model,
-            optimizer=optimizer,
-            args=args,
-            amp_scaler=loss_scaler,
-            checkpoint_dir=output_dir,
-            recovery_dir=output_dir,
-            decreasing=decreasing_metric,
-            max_history=args.checkpoint_hist,
-            task=task,
-        )
+        saver = utils.CheckpointSaver(checkpoint_dir=output_dir, recovery_dir=output_dir, **saver_kwargs)
         with open(os.path.join(output_dir, 'args.yaml'), 'w') as f:
             f.write(args_text)
 
@@ -1075,6 +1143,14 @@ def main():
                     "You've requested to log metrics to wandb but package not found. "
                     "Metrics not being logged to wandb, try `pip install wandb`")
 
+    if args.checkpoint_sharded and args.distributed:
+        # every rank writes its shard of each checkpoint into the primary's output dir
+        checkpoint_dir = [output_dir]
+        torch.distributed.broadcast_object_list(checkpoint_dir, src=0)
+        if saver is None:
+            saver = utils.CheckpointSaver(
+                checkpoint_dir=checkpoint_dir[0], recovery_dir=checkpoint_dir[0], **saver_kwargs)
+
     # setup learning rate schedule and starting epoch
     updates_per_epoch = (len(loader_train) + args.grad_accum_steps - 1) // args.grad_accum_steps
     lr_scheduler, num_epochs = create_scheduler_v2(
@@ -1103,10 +1179,23 @@ def main():
             f'Scheduled epochs: {num_epochs} {sched_explain}. '
             f'LR stepped per {"epoch" if lr_scheduler.t_in_epochs else "update"}.')
 
+    telemetry = None
+    if args.step_telemetry and output_dir is not None:
+        telemetry = utils.StepTelemetry(device, trace_file=os.path.join(output_dir, 'step_telemetry.jsonl'))
+
+    profile_kwargs = dict(device=device, profile_memory=args.torch_profile_memory)
+    train_profiler = None
+    if args.torch_profile in ('train', 'both') and output_dir is not None:
+        train_profiler = utils.create_profiler_capture(
+            output_dir, 'train', args.torch_profile_schedule, model=utils.unwrap_model(model), **profile_kwargs)
+    eval_profile_pending = args.torch_profile in ('eval', 'both') and output_dir is not None
+
     results = []
     try:
         for epoch in range(start_epoch, num_epochs):
             _set_loader_epoch(loader_train, epoch)
+            if train_profiler is not None:
+                train_profiler.start()  # (re)started each epoch until all windows are captured
 
             train_metrics = train_one_epoch(
                 epoch,
@@ -1119,6 +1208,8 @@ def main():
                 lr_scheduler=lr_scheduler,
                 saver=saver,
                 output_dir=output_dir,
+                telemetry=telemetry,
+                profiler=train_profiler,
                 amp_autocast=amp_autocast,
                 loss_scaler=loss_scaler,
                 model_dtype=model_dtype,
@@ -1129,6 +1220,12 @@ def main():
                 batch_size_reference=batch_size_reference,
             )
 
+            if train_profiler is not None:
+                # stopped around eval / checkpointing so those ops don't end up in a train window
+                train_profiler.stop()
+                if train_profiler.done:
+                    train_profiler = None
+
             if args.distributed and args.dist_bn in ('broadcast', 'reduce'):
                 if utils.is_primary(args):
                     _logger.info("Distributing BatchNorm running means and vars")
@@ -1147,15 +1244,25 @@ def main():
                 continue
 
             if loader_eval is not None:
-                eval_metrics = validate(
-                    eval_model,
-                    loader_eval,
-                    validate_loss_fn,
-                    args,
-                    device=device,
-                    amp_autocast=amp_autocast,
-                    model_dtype=model_dtype,
-                )
+                eval_profiler = None
+                if eval_profile_pending:
+                    # profile the first eval, the train capture (if any) is stopped outside of train_one_epoch
+                    eval_profiler = utils.create_profiler_capture(
+                        output_dir, 'eval', args.torch_profile_schedule, model=utils.unwrap_model(eval_model),
+                        **profile_kwargs)
+                    eval_profile_pending = False
+
+                with eval_profiler or suppress():
+                    eval_metrics = validate(
+                        eval_model,
+                        loader_eval,
+                        validate_loss_fn,
+                        args,
+                        device=device,
+                        amp_autocast=amp_autocast,
+                        model_dtype=model_dtype,
+                        profiler=eval_profiler,
+                    )
 
                 ema_model = task.get_trainable_module(ema=True)
                 if ema_model is not None and not args.model_ema_force_cpu:
@@ -1211,10 +1318,16 @@ def main():
     except KeyboardInterrupt:
         pass
 
+    if train_profiler is not None:
+        train_profiler.stop()
+
+    if saver is not None:
+        saver.close()  # wait for an async save in flight
+
     if args.distributed:
         torch.distributed.destroy_process_group()
 
-    if best_metric is not None:
+    if best_metric is not None and utils.is_primary(args):
         # log best metric as tracked by checkpoint saver
         _logger.info('*** Best metric: {0} (epoch {1})'.format(best_metric, best_epoch))
 
@@ -1239,6 +1352,8 @@ def train_one_epoch(
         lr_scheduler=None,
         saver=None,
         output_dir=None,
+        telemetry=None,
+        profiler=None,
         amp_autocast=suppress,
         loss_scaler=None,
         model_dtype=None,
@@ -1259,6 +1374,11 @@ def train_one_epoch(
     update_time_m = utils.AverageMeter()
     data_time_m = utils.AverageMeter()
     losses_m = utils.AverageMeter()
+    # loss is accumulated on device and only synced at the log interval
+    loss_sum = torch.zeros((), device=device)
+    loss_count = 0
+    if telemetry is None:
+        telemetry = utils.StepTelemetry(device, enabled=False)
 
     trainable_module = task.get_trainable_module()
     trainable_module.train()
@@ -1273,7 +1393,9 @@ def train_one_epoch(
     data_start_time = update_start_time = time.time()
     optimizer.zero_grad()
     update_sample_count = 0
+    telemetry.start()
     for batch_idx, (input, target) in enumerate(loader):
+        telemetry.mark('data', host=True)
         last_batch = batch_idx == last_batch_idx
         need_update = last_batch or (batch_idx + 1) % accum_steps == 0
         update_idx = batch_idx // accum_steps
@@ -1286,6 +1408,7 @@ def train_one_epoch(
                 input, target = mixup_fn(input, target)
         if args.channels_last:
             input = input.contiguous(memory_format=torch.channels_last)
+        telemetry.mark('h2d')
 
         # multiply by accum steps to get equivalent for full update
         data_time_m.update(accum_steps * (time.time() - data_start_time))
@@ -1298,6 +1421,7 @@ def train_one_epoch(
 
             if accum_steps > 1:
                 _loss /= accum_steps
+            telemetry.mark('forward')
             return _loss, result
 
         def _backward(_loss):
@@ -1313,9 +1437,11 @@ def train_one_epoch(
                     parameters=clip_parameters,
                     create_graph=second_order,
                     need_update=need_update,
+                    post_backward_fn=partial(telemetry.mark, 'backward') if telemetry.enabled else None,
                 )
             else:
                 _loss.backward(create_graph=second_order)
+                telemetry.mark('backward')
                 if need_update:
                     if args.clip_grad is not None:
                         utils.dispatch_clip_grad(
@@ -1324,6 +1450,7 @@ def train_one_epoch(
                             mode=args.clip_mode,
                         )
                     optimizer.step()
+            telemetry.mark('optimizer')
 
         if naflex_mode:
             assert isinstance(input, dict)
@@ -1381,16 +1508,22 @@ def train_one_epoch(
                 loss, result = _forward()
                 _backward(loss)
 
-        losses_m.update(loss.item() * accum_steps, batch_size)
+        loss_sum += loss.detach() * (accum_steps * batch_size)
+        loss_count += batch_size
         update_sample_count += global_batch_size
 
         if not need_update:
+            telemetry.end(epoch=epoch, step=update_idx, batch_idx=batch_idx, batch_size=batch_size)
+            if profiler is not None:
+                profiler.step()
             data_start_time = time.time()
+            telemetry.start()
             continue
 
         num_updates += 1
         optimizer.zero_grad()
         task.update_ema(step=num_updates)
+        telemetry.mark('ema')
 
         if args.synchronize_step:
             if device.type == 'cuda':
@@ -1406,7 +1539,10 @@ def train_one_epoch(
             lrl = [param_group['lr'] for param_group in optimizer.param_groups]
             lr = sum(lrl) / len(lrl)
 
-            loss_avg, loss_now = losses_m.avg, losses_m.val
+            losses_m.update(loss_sum.item() / loss_count, loss_count)
+            loss_sum.zero_()
+            loss_count = 0
+            loss_avg, loss_now = losses_m.avg, loss.item() * accum_steps
             if args.distributed:
                 # synchronize current step and avg loss, each process keeps its own running avg
                 loss_avg = utils.reduce_tensor(loss.new([loss_avg]), args.world_size).item()
@@ -1430,21 +1566,40 @@ def train_one_epoch(
                         padding=0,
                         normalize=True
                     )
+        telemetry.mark('log', host=True)  # incl. the loss sync at the log interval
 
+        step_info = dict(epoch=epoch, step=update_idx, batch_idx=batch_idx, batch_size=batch_size)
         if saver is not None and args.recovery_interval and (
                 (update_idx + 1) % args.recovery_interval == 0):
             saver.save_recovery(epoch, batch_idx=update_idx)
+            telemetry.mark('checkpoint', host=True)
+            # time blocked on a previous (async) save in flight, included in the checkpoint phase
+            step_info['checkpoint_wait_ms'] = round(1000 * saver.last_wait_time, 4)
 
         if lr_scheduler is not None:
+            # loss metric is only updated at the log interval to avoid syncing every step
             lr_scheduler.step_update(num_updates=num_updates, metric=losses_m.avg)
+        telemetry.mark('sched', host=True)
+
+        telemetry.end(**step_info)
+        if profiler is not None:
+            profiler.step()
+        if update_idx % args.log_interval == 0 or last_batch:
+            phase_ms = telemetry.flush()
+            if phase_ms and utils.is_primary(args):
+                _logger.info('Step phases (ms): ' + ', '.join(f'{k}: {v:.2f}' for k, v in phase_ms.items()))
 
         update_sample_count = 0
         data_start_time = time.time()
+        telemetry.start()
         # end for
 
     if hasattr(optimizer, 'sync_lookahead'):
         optimizer.sync_lookahead()
 
+    if loss_count:
+        losses_m.update(loss_sum.item() / loss_count, loss_count)
+    telemetry.flush()
     loss_avg = losses_m.avg
     if args.distributed:
         # synchronize avg loss, each process keeps its own running avg
@@ -1461,7 +1616,8 @@ def validate(
         device=torch.device('cuda'),
         amp_autocast=suppress,
         model_dtype=None,
-        log_suffix=''
+        log_suffix='',
+        profiler=None,
 ):
     batch_time_m = utils.AverageMeter()
     losses_m = utils.AverageMeter()
@@ -1512,6 +1668,9 @@ def validate(
             top1_m.update(acc1.item(), batch_size)
             top5_m.update(acc5.item(), batch_size)
 
+            if profiler is not None:
+                profiler.step()
+
             batch_time_m.update(time.time() - end)
             end = time.time()
             if utils.is_primary(args) and (last_batch or batch_idx % args.log_interval == 0):
@@ -25,9 +25,11 @@ import torch.nn.parallel
 from timm import utils
 from timm.data import create_dataset, create_loader, resolve_data_config, RealLabelsImagenet
 from timm.layers import apply_test_time_pool, set_fast_norm
-from timm.models import create_model, load_checkpoint, is_model, list_models
+from timm.models import create_model, load_checkpoint, is_model, list_models, safe_model_name
 from timm.utils import accuracy, AverageMeter, natural_key, setup_default_logging, set_jit_fuser, \
-    decay_batch_step, check_batch_size_retry, ParseKwargs, reparameterize_model
+    decay_batch_step, check_batch_size_retry, estimate_batch_size, batch_size_arg, ParseKwargs, reparameterize_model, \
+    compile_regions
+from timm.utils.onnx import create_onnx_runtime_model
 
 
 try:
@@ -77,8 +79,10 @@ parser.add_argument('--pretrained', dest='pretrained', action='store_true',
                     help='use pre-trained model')
 parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
                     help='number of data loading workers (default: 4)')
-parser.add_argument('-b', '--batch-size', default=256, type=int,
-                    metavar='N', help='mini-batch size (default: 256)')
+parser.add_argument('-b', '--batch-size', default=256, type=batch_size_arg,
+                    metavar='N', help="mini-batch size, 'auto' to estimate from memory use (default: 256)")
+parser.add_argument('--memory-budget', default=None, type=float, metavar='GB',
+                    help='Memory budget for --batch-size auto (default: memory available on device)')
 parser.add_argument('--img-size', default=None, type=int,
                     metavar='N', help='Input image dimension, uses model default if empty')
 parser.add_argument('--in-chans', type=int, default=None, metavar='N',
@@ -138,6 +142,22 @@ parser.add_argument('--reparam', default=False, action='store_true',
 parser.add_argument('--model-kwargs', nargs='*', default={}, action=ParseKwargs)
 parser.add_argument('--torchcompile-mode', type=str, default=None,
                     help="torch.compile mode (default: None).")
+parser.add_argument('--torchcompile-regions', default=False, action='store_true',
+                    help="With --torchcompile, compile the repeated blocks (one graph per distinct block) "
+                         "instead of the whole model.")
+
+parser.add_argument('--backend', default='torch', type=str, choices=('torch', 'onnxruntime'),
+                    help='Execution backend (default: torch). onnxruntime runs on CPU.')
+parser.add_argument('--onnx-file', default='', type=str, metavar='PATH',
+                    help='ONNX graph for --backend onnxruntime, exported from the model if empty or missing.')
+parser.add_argument('--ort-intra-threads', default=0, type=int, metavar='N',
+                    help='onnxruntime intra-op threads (default: 0, onnxruntime default)')
+parser.add_argument('--ort-inter-threads', default=0, type=int, metavar='N',
+                    help='onnxruntime inter-op threads (default: 0, onnxruntime default)')
+parser.add_argument('--ort-opt-level', default='all', type=str, choices=('disable', 'basic', 'extended', 'all'),
+                    help='onnxruntime graph optimization level (default: all)')
+parser.add_argument('--ort-quantize', default=False, action='store_true',
+                    help='Apply onnxruntime dynamic int8 quantization.')
 
 scripting_group = parser.add_mutually_exclusive_group()
 scripting_group.add_argument('--torchscript', default=False, action='store_true',
@@ -159,6 +179,15 @@ parser.add_argument('--retry', default=False, action='store_true',
                     help='Enable batch size decay & retry for single model validation')
 parser.add_argument('--seed', type=int, default=42, metavar='S',
                     help='random seed (default: 42)')
+parser.add_argument('--torch-profile', action='store_true', default=False,
+                    help='Capture a window of validation steps w/ torch.profiler.')
+parser.add_argument('--torch-profile-schedule', type=int, nargs=4, default=(1, 1, 3, 1),
+                    metavar=('WAIT', 'WARMUP', 'ACTIVE', 'REPEAT'),
+                    help='torch.profiler step schedule (default: 1 1 3 1)')
+parser.add_argument('--torch-profile-memory', action='store_true', default=False,
+                    help='Also record memory timelines, peak memory by module and CUDA allocator snapshots.')
+parser.add_argument('--torch-profile-dir', default='./output/profile', type=str, metavar='PATH',
+                    help='Output dir of the torch.profiler traces and tables (default: ./output/profile)')
 
 parser.add_argument('--metrics-avg', type=str, default=None,
                     choices=['micro', 'macro', 'weighted'],
@@ -226,6 +255,7 @@ def validate(args):
         in_chans=in_chans,
         global_pool=args.gp,
         scriptable=args.torchscript,
+        exportable=args.backend == 'onnxruntime',
         **args.model_kwargs,
     )
     if args.num_classes is None:
@@ -255,12 +285,39 @@ def validate(args):
     if args.channels_last:
         model = model.to(memory_format=torch.channels_last)
 
-    if args.torchscript:
+    if args.batch_size == 'auto':
+        # estimate on the eager model, before compilation / export
+        assert not args.naflex_loader, '--batch-size auto is not supported with the NaFlex loader.'
+        args.batch_size = estimate_batch_size(
+            model,
+            data_config['input_size'],
+            dtype=model_dtype or torch.float32,
+            amp_autocast=amp_autocast,
+            channels_last=args.channels_last,
+            memory_budget=args.memory_budget * 2**30 if args.memory_budget else None,
+        ) * args.num_gpu
+
+    if args.backend == 'onnxruntime':
+        assert device.type == 'cpu' and model_dtype in (None, torch.float32) and not args.amp, \
+            'The onnxruntime backend runs in float32 on CPU.'
+        model = create_onnx_runtime_model(
+            model,
+            onnx_file=args.onnx_file,
+            input_size=data_config['input_size'],
+            quantize=args.ort_quantize,
+            intra_op_threads=args.ort_intra_threads,
+            inter_op_threads=args.ort_inter_threads,
+            opt_level=args.ort_opt_level,
+        )
+    elif args.torchscript:
         model = torch.jit.script(model)
     elif args.torchcompile:
         assert has_compile, 'A version of torch w/ torch.compile() is required for --compile, possibly a nightly.'
         torch._dynamo.reset()
-        model = torch.compile(model, backend=args.torchcompile, mode=args.torchcompile_mode)
+        if args.torchcompile_regions:
+            compile_regions(model, backend=args.torchcompile, mode=args.torchcompile_mode)
+        else:
+            model = torch.compile(model, backend=args.torchcompile, mode=args.torchcompile_mode)
     elif args.aot_autograd:
         assert has_functorch, "functorch is needed for --aot-autograd"
         model = memory_efficient_fusion(model)
@@ -353,8 +410,19 @@ def validate(args):
         all_preds = []
         all_targets = []
 
+    profiler = None
+    if args.torch_profile:
+        profiler = utils.create_profiler_capture(
+            os.path.join(args.torch_profile_dir, safe_model_name(args.model)),
+            'eval',
+            args.torch_profile_schedule,
+            device=device,
+            profile_memory=args.torch_profile_memory,
+            model=utils.unwrap_model(model) if isinstance(model, nn.Module) else None,
+        )
+
     model.eval()
-    with torch.inference_mode():
+    with torch.inference_mode(), profiler or suppress():
         # warmup, reduce variability of first batch time, especially for comparing torchscript vs non
         if not args.naflex_loader:
             input = torch.randn((args.batch_size,) + tuple(data_config['input_size'])).to(device=device, dtype=model_dtype)
@@ -394,6 +462,9 @@ def validate(args):
                 all_preds.append(predictions.cpu())
                 all_targets.append(target.cpu())
 
+            if profiler is not None:
+                profiler.step()
+
             # measure elapsed time
             batch_time.update(time.time() - end)
             end = time.time()
@@ -464,7 +535,8 @@ def _try_run(args, initial_batch_size):
     results = OrderedDict()
     error_str = 'Unknown'
     while batch_size:
-        args.batch_size = batch_size * args.num_gpu  # multiply by num-gpu for DataParallel case
+        # multiply by num-gpu for DataParallel case, 'auto' is resolved (per-gpu estimate * num-gpu) in validate
+        args.batch_size = batch_size if batch_size == 'auto' else batch_size * args.num_gpu
         try:
             if 'cuda' in args.device and torch.cuda.is_available():
                 torch.cuda.empty_cache()
@@ -475,8 +547,10 @@ def _try_run(args, initial_batch_size):
         except RuntimeError as e:
             error_str = str(e)
             _logger.error(f'"{error_str}" while running validation.')
-            if not check_batch_size_retry(error_str):
+            if not check_batch_size_retry(error_str) or args.batch_size == 'auto':
                 break
+        if batch_size == 'auto':
+            batch_size = args.batch_size // args.num_gpu  # estimated batch size
         batch_size = decay_batch_step(batch_size)
         _logger.warning(f'Reducing batch size to {batch_size} for retry.')
     results['model'] = args.model